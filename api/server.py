@@ -1,12 +1,36 @@
 import os
+import base64
+import bisect
+import hashlib
+import gzip
 import json
+import re
+import time
+import fcntl
+import functools
+import tempfile
+import random
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 import requests
-from flask import Flask, request, jsonify
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from flask import Flask, Response, request, jsonify
 import firebase_admin
 from firebase_admin import credentials, firestore, auth
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
 from flask_cors import CORS
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 # Load environment variables
 load_dotenv()
 
@@ -28,36 +52,293 @@ AIRALO_BASE_URL = os.getenv('AIRALO_BASE_URL', 'https://partners-api.airalo.com'
 AIRALO_CLIENT_SECRET = os.getenv('AIRALO_CLIENT_SECRET')
 AIRALO_CLIENT_ID = os.getenv('AIRALO_CLIENT_ID')
 
+# ============================================================================
+# Upstream HTTP Client
+# One pooled keep-alive Session per upstream host, with connect/read timeouts
+# configured per upstream. Failed connects are retried; reads never are, so a
+# POST that reached the upstream is not replayed.
+# ============================================================================
+
+UPSTREAM_POOL_SIZE = int(os.getenv('UPSTREAM_POOL_SIZE', 10))
+UPSTREAM_TIMEOUTS = {
+    'airalo': (float(os.getenv('AIRALO_CONNECT_TIMEOUT', 5)), float(os.getenv('AIRALO_READ_TIMEOUT', 30))),
+}
+
+_upstream_sessions = {}
+_upstream_sessions_lock = threading.Lock()
+
+def get_upstream_session(url):
+    """Shared keep-alive Session for the host of url"""
+    host = urlsplit(url).netloc
+    session = _upstream_sessions.get(host)
+    if session is None:
+        with _upstream_sessions_lock:
+            session = _upstream_sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=UPSTREAM_POOL_SIZE,
+                                      max_retries=Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.2))
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _upstream_sessions[host] = session
+    return session
+
+def upstream_request(upstream, method, url, **kwargs):
+    """Send a request through the pooled session, with the upstream's (connect, read) timeouts.
+    
+    An Airalo request rejected with 401 is retried once with a fresh token, in
+    case Airalo revoked or rotated the cached one (a 401 was not processed, so
+    this is safe for POSTs too).
+    """
+    kwargs.setdefault('timeout', UPSTREAM_TIMEOUTS[upstream])
+    response = get_upstream_session(url).request(method, url, **kwargs)
+    headers = kwargs.get('headers') or {}
+    if upstream == 'airalo' and response.status_code == 401 and 'Authorization' in headers:
+        rejected_token = headers['Authorization'].split(' ', 1)[-1]
+        token = get_airalo_token()
+        if token == rejected_token:
+            token = get_airalo_token(force_refresh=True)
+        if token and token != rejected_token:
+            print(f"🔑 Airalo rejected the cached token, retrying with a fresh one")
+            kwargs['headers'] = {**headers, 'Authorization': f'Bearer {token}'}
+            response = get_upstream_session(url).request(method, url, **kwargs)
+    return response
+
+# Airalo token cache - the file store is shared by all gunicorn workers
+AIRALO_TOKEN_CACHE_FILE = os.getenv('AIRALO_TOKEN_CACHE_FILE', '/tmp/airalo_token.json')
+AIRALO_TOKEN_REFRESH_MARGIN = int(os.getenv('AIRALO_TOKEN_REFRESH_MARGIN', 300))  # Refresh 5 minutes before expiry
+AIRALO_TOKEN_DEFAULT_TTL = 3600  # Used when Airalo does not return expires_in
+
+_airalo_token_cache = {}
+_airalo_token_lock = threading.Lock()
+_airalo_token_state_lock = threading.Lock()
+_airalo_token_refresh_pending = False
+
+# ============================================================================
+# API Key Identity Cache
+# Process-local index of apiCredentials.apiKey -> business identity, kept
+# current by a Firestore snapshot listener on business_users
+# ============================================================================
+
+API_KEY_CACHE_TTL = int(os.getenv('API_KEY_CACHE_TTL', 10))  # Seconds, used while the listener is down
+API_KEY_LISTENER_LOAD_GRACE = int(os.getenv('API_KEY_LISTENER_LOAD_GRACE', 300))  # Seconds the initial snapshot may take before the listener is restarted
+API_KEY_FALLBACK_CACHE_MAX = 10000
+
+_api_key_index = {}
+_api_key_by_uid = {}
+_api_key_index_lock = threading.Lock()  # Guards the index and the fallback cache
+_api_key_index_ready = False
+_api_key_listener = None
+_api_key_listener_lock = threading.RLock()  # One thread (re)starts the listener at a time
+_api_key_listener_generation = 0  # Snapshots from a replaced listener are ignored
+_api_key_listener_started_at = 0
+_api_key_fallback_cache = {}
+
+def _business_identity(uid, user_data):
+    """Build the cached identity for a business_users document"""
+    api_credentials = user_data.get('apiCredentials') or {}
+    return {
+        'uid': uid,
+        'email': user_data.get('email'),
+        'mode': api_credentials.get('mode', 'sandbox'),
+        'kycStatus': user_data.get('kycStatus', 'pending'),
+        'emailVerified': user_data.get('emailVerified', False),
+        'balance': user_data.get('balance', 0),
+        'balanceShards': user_data.get('balanceShards', 0),
+    }
+
+def _on_business_users_snapshot(col_snapshot, changes, read_time, generation=None):
+    """Apply business_users changes to the API key index"""
+    global _api_key_index_ready
+    with _api_key_index_lock:
+        if generation != _api_key_listener_generation:
+            return  # Late delivery from a listener that has been replaced
+        for change in changes:
+            doc = change.document
+            old_key = _api_key_by_uid.pop(doc.id, None)
+            if old_key:
+                _api_key_index.pop(old_key, None)
+            
+            if change.type.name == 'REMOVED':
+                continue
+            
+            user_data = doc.to_dict() or {}
+            api_key = (user_data.get('apiCredentials') or {}).get('apiKey')
+            if api_key:
+                _api_key_index[api_key] = _business_identity(doc.id, user_data)
+                _api_key_by_uid[doc.id] = api_key
+        
+        _api_key_fallback_cache.clear()
+        if not _api_key_index_ready:
+            print(f"✅ API key index loaded: {len(_api_key_index)} keys")
+        _api_key_index_ready = True
+
+def start_api_key_listener():
+    """(Re)start the business_users snapshot listener that feeds the API key index"""
+    global _api_key_listener, _api_key_listener_started_at, _api_key_index_ready, _api_key_listener_generation
+    with _api_key_listener_lock:
+        _api_key_listener_started_at = time.time()
+        
+        if _api_key_listener is not None:
+            try:
+                _api_key_listener.unsubscribe()
+            except Exception as e:
+                print(f"⚠️ Could not stop API key listener: {e}")
+        
+        # The initial snapshot re-delivers every document, so start from an empty index
+        with _api_key_index_lock:
+            _api_key_listener_generation += 1
+            generation = _api_key_listener_generation
+            _api_key_index_ready = False
+            _api_key_index.clear()
+            _api_key_by_uid.clear()
+        
+        try:
+            _api_key_listener = db.collection('business_users').on_snapshot(
+                functools.partial(_on_business_users_snapshot, generation=generation))
+            print(f"👂 API key listener started on business_users")
+        except Exception as e:
+            _api_key_listener = None
+            print(f"⚠️ Could not start API key listener, using TTL cache: {e}")
+
+def _api_key_listener_stale(now):
+    """True when the listener should be restarted: it failed or stopped, or its initial snapshot is overdue"""
+    since_start = now - _api_key_listener_started_at
+    if _api_key_listener is None or not getattr(_api_key_listener, 'is_active', True):
+        return since_start > API_KEY_CACHE_TTL
+    return not _api_key_index_ready and since_start > API_KEY_LISTENER_LOAD_GRACE
+
+def _restart_stale_api_key_listener():
+    """Retry the listener from one request thread; the others carry on with the TTL cache"""
+    if not _api_key_listener_lock.acquire(blocking=False):
+        return
+    try:
+        if _api_key_listener_stale(time.time()):
+            start_api_key_listener()
+    finally:
+        _api_key_listener_lock.release()
+
+def _api_key_listener_healthy():
+    """True when the listener is running and has delivered its initial snapshot"""
+    if _api_key_listener is None or not _api_key_index_ready:
+        return False
+    return getattr(_api_key_listener, 'is_active', True)
+
+def lookup_api_key_identity(api_key):
+    """Resolve an API key to its business identity (dictionary lookup while the listener is healthy)"""
+    if _api_key_listener_healthy():
+        return _api_key_index.get(api_key)
+    
+    # Listener is down or still loading - restart it if it failed (or is stuck loading)
+    # and use a short TTL cache meanwhile
+    now = time.time()
+    if _api_key_listener_stale(now):
+        _restart_stale_api_key_listener()
+    
+    with _api_key_index_lock:
+        cached = _api_key_fallback_cache.get(api_key)
+    if cached and cached[1] > now:
+        return cached[0]
+    
+    users_ref = db.collection('business_users')
+    query = users_ref.where('apiCredentials.apiKey', '==', api_key).limit(1)
+    docs = list(query.stream())
+    identity = _business_identity(docs[0].id, docs[0].to_dict()) if docs else None
+    
+    with _api_key_index_lock:
+        if len(_api_key_fallback_cache) >= API_KEY_FALLBACK_CACHE_MAX:
+            _api_key_fallback_cache.clear()
+        _api_key_fallback_cache[api_key] = (identity, now + API_KEY_CACHE_TTL)
+    return identity
+
 def authenticate_api_key(api_key):
-    """Authenticate API key against Firestore business_users collection"""
+    """Authenticate API key against the cached business_users index"""
     try:
-        users_ref = db.collection('business_users')
-        query = users_ref.where('apiCredentials.apiKey', '==', api_key).limit(1)
-        docs = list(query.stream())
+        identity = lookup_api_key_identity(api_key)
         
-        if not docs:
+        if not identity:
             return None
-            
-        user_data = docs[0].to_dict()
         
         # Check if email is verified
-        if not user_data.get('emailVerified', False):
+        if not identity.get('emailVerified', False):
             return None
             
         return {
-            'uid': docs[0].id,
-            'email': user_data.get('email'),
-            'mode': user_data.get('apiCredentials', {}).get('mode', 'sandbox'),
-            'balance': user_data.get('balance', 0)
+            'uid': identity['uid'],
+            'email': identity.get('email'),
+            'mode': identity.get('mode', 'sandbox'),
+            'kycStatus': identity.get('kycStatus', 'pending'),
+            'balance': identity.get('balance', 0),
+            'balanceShards': identity.get('balanceShards', 0)
         }
     except Exception as e:
         print(f"Authentication error: {e}")
         return None
 
+# ============================================================================
+# Firebase ID Token Cache
+# Verified claims are kept in a bounded LRU keyed by the token's SHA-256
+# digest until the token's own "exp"
+# ============================================================================
+
+FIREBASE_TOKEN_CACHE_SIZE = int(os.getenv('FIREBASE_TOKEN_CACHE_SIZE', 10000))
+FIREBASE_ID_TOKEN_CERT_URL = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
+
+_firebase_token_cache = OrderedDict()
+_firebase_token_cache_lock = threading.Lock()
+_firebase_token_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def verify_firebase_id_token(id_token):
+    """Verify a Firebase ID token, reusing cached claims while the token is unexpired"""
+    digest = hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+    now = time.time()
+    
+    with _firebase_token_cache_lock:
+        cached = _firebase_token_cache.get(digest)
+        if cached is not None:
+            if cached['exp'] > now:
+                _firebase_token_cache.move_to_end(digest)
+                _firebase_token_cache_stats['hits'] += 1
+                return cached['claims']
+            del _firebase_token_cache[digest]
+        _firebase_token_cache_stats['misses'] += 1
+    
+    decoded_token = auth.verify_id_token(id_token)
+    
+    with _firebase_token_cache_lock:
+        _firebase_token_cache[digest] = {'claims': decoded_token, 'exp': decoded_token.get('exp', 0)}
+        _firebase_token_cache.move_to_end(digest)
+        while len(_firebase_token_cache) > FIREBASE_TOKEN_CACHE_SIZE:
+            _firebase_token_cache.popitem(last=False)
+            _firebase_token_cache_stats['evictions'] += 1
+    
+    return decoded_token
+
+def get_firebase_token_cache_stats():
+    """Hit/miss counters for the ID token cache"""
+    with _firebase_token_cache_lock:
+        lookups = _firebase_token_cache_stats['hits'] + _firebase_token_cache_stats['misses']
+        return {
+            **_firebase_token_cache_stats,
+            'size': len(_firebase_token_cache),
+            'hit_rate': round(_firebase_token_cache_stats['hits'] / lookups, 4) if lookups else 0,
+        }
+
+def warm_firebase_public_keys():
+    """Prefetch the securetoken certificates into firebase_admin's cache-control session"""
+    try:
+        client = auth._get_client(firebase_admin.get_app())
+        client._token_verifier.request(url=FIREBASE_ID_TOKEN_CERT_URL)
+        print(f"🔑 Firebase public keys prefetched")
+    except Exception as e:
+        print(f"⚠️ Could not prefetch Firebase public keys: {e}")
+
+threading.Thread(target=warm_firebase_public_keys, daemon=True).start()
+
 def authenticate_firebase_token(id_token):
     """Authenticate Firebase ID token for regular users"""
     try:
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = verify_firebase_id_token(id_token)
         uid = decoded_token['uid']
         email = decoded_token.get('email')
         
@@ -70,39 +351,260 @@ def authenticate_firebase_token(id_token):
         print(f"Firebase token authentication error: {e}")
         return None
 
-def get_airalo_token():
-    """Get Airalo API token"""
+def _load_airalo_token_store():
+    """Read the token shared by all workers from the cache file"""
     try:
-        response = requests.post(f"{AIRALO_BASE_URL}/v2/token", json={
-            'client_id': AIRALO_CLIENT_ID,
-            'client_secret': AIRALO_CLIENT_SECRET
-        })
-        response.raise_for_status()
-        data = response.json()
-        # v2 API returns {"data": {"access_token": "..."}}
-        return data.get('data', {}).get('access_token')
+        with open(AIRALO_TOKEN_CACHE_FILE, 'r') as f:
+            entry = json.load(f)
+        if entry.get('access_token') and entry.get('expires_at'):
+            return entry
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _save_airalo_token_store(entry):
+    """Atomically write the token to the cache file so other workers can reuse it"""
+    try:
+        cache_dir = os.path.dirname(AIRALO_TOKEN_CACHE_FILE) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.airalo_token_')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, AIRALO_TOKEN_CACHE_FILE)
+    except OSError as e:
+        print(f"⚠️ Could not persist Airalo token cache: {e}")
+
+def _fetch_airalo_token():
+    """Request a new access token from Airalo /v2/token"""
+    response = upstream_request('airalo', 'POST', f"{AIRALO_BASE_URL}/v2/token", json={
+        'client_id': AIRALO_CLIENT_ID,
+        'client_secret': AIRALO_CLIENT_SECRET
+    })
+    response.raise_for_status()
+    data = response.json()
+    # v2 API returns {"data": {"access_token": "...", "expires_in": <seconds>}}
+    token_data = data.get('data', {})
+    access_token = token_data.get('access_token')
+    if not access_token:
+        raise ValueError('No access_token in Airalo token response')
+    expires_in = int(token_data.get('expires_in') or AIRALO_TOKEN_DEFAULT_TTL)
+    return {'access_token': access_token, 'expires_at': time.time() + expires_in}
+
+def _refresh_airalo_token(stale_token=None):
+    """Refresh the Airalo token (single-flight within the process and across workers)"""
+    global _airalo_token_cache
+    with _airalo_token_lock:
+        with open(f"{AIRALO_TOKEN_CACHE_FILE}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Another thread or worker may have refreshed while we were waiting
+                entry = _load_airalo_token_store()
+                if (entry and entry['access_token'] != stale_token and
+                        entry['expires_at'] - time.time() > AIRALO_TOKEN_REFRESH_MARGIN):
+                    _airalo_token_cache = entry
+                    return entry['access_token']
+                
+                entry = _fetch_airalo_token()
+                _save_airalo_token_store(entry)
+                _airalo_token_cache = entry
+                print(f"🔑 Airalo token refreshed (valid for {int(entry['expires_at'] - time.time())}s)")
+                return entry['access_token']
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _schedule_airalo_token_refresh(stale_token):
+    """Refresh the token in the background while callers keep using the current one"""
+    global _airalo_token_refresh_pending
+    with _airalo_token_state_lock:
+        if _airalo_token_refresh_pending:
+            return
+        _airalo_token_refresh_pending = True
+    
+    def run():
+        global _airalo_token_refresh_pending
+        try:
+            _refresh_airalo_token(stale_token)
+        except Exception as e:
+            print(f"⚠️ Background Airalo token refresh failed: {e}")
+        finally:
+            with _airalo_token_state_lock:
+                _airalo_token_refresh_pending = False
+    
+    threading.Thread(target=run, daemon=True).start()
+
+def get_airalo_token(force_refresh=False):
+    """Get Airalo API token (cached until shortly before expiry)"""
+    global _airalo_token_cache
+    try:
+        now = time.time()
+        entry = _airalo_token_cache
+        if not entry.get('access_token') or entry.get('expires_at', 0) <= now:
+            entry = _load_airalo_token_store() or {}
+            if entry:
+                _airalo_token_cache = entry
+        
+        token = entry.get('access_token')
+        expires_at = entry.get('expires_at', 0)
+        
+        if force_refresh or not token or expires_at <= now:
+            return _refresh_airalo_token(stale_token=token)
+        
+        if expires_at - now <= AIRALO_TOKEN_REFRESH_MARGIN:
+            _schedule_airalo_token_refresh(token)
+        
+        return token
     except Exception as e:
         print(f"Airalo token error: {e}")
         return None
 
+# ============================================================================
+# Materialized Balances
+# business_balances/{uid} stores the ledger total up to checkpointAt. Reads add
+# only the billing_transactions / api_usage entries created after it.
+# Needs composite indexes on (userId, createdAt) for both ledger collections.
+# Entries whose createdAt is missing or not a Timestamp never match the delta
+# query: a rebuild folds them into the checkpoint, and rebuild-balances
+# --verify lists them, since ones written after the checkpoint are missed.
+# ============================================================================
+
+BALANCE_CHECKPOINT_LAG = int(os.getenv('BALANCE_CHECKPOINT_LAG', 60))  # Seconds; newer entries stay in the delta
+BALANCE_CHECKPOINT_INTERVAL = int(os.getenv('BALANCE_CHECKPOINT_INTERVAL', 3600))  # Max checkpoint age in seconds
+BALANCE_CHECKPOINT_MAX_DELTA = int(os.getenv('BALANCE_CHECKPOINT_MAX_DELTA', 100))  # Max entries read past the checkpoint
+
+def _ledger_entries(user_uid, since=None, transaction=None):
+    """Yield (amount, createdAt, path) for a user's ledger, credits positive and debits negative.
+    
+    createdAt is None unless it is a Timestamp (billing_transactions are written
+    outside this service and may lack one or store it as a string).
+    """
+    for collection_name, sign in (('billing_transactions', 1), ('api_usage', -1)):
+        query = db.collection(collection_name).where('userId', '==', user_uid)
+        if since is not None:
+            query = query.where('createdAt', '>', since)
+        for doc in query.stream(transaction=transaction):
+            entry = doc.to_dict()
+            created_at = entry.get('createdAt')
+            if not isinstance(created_at, datetime):
+                created_at = None
+            yield sign * float(entry.get('amount', 0) or 0), created_at, doc.reference.path
+
+def _checkpoint_cutoff():
+    """Entries newer than this may still be in flight and are never folded into a checkpoint"""
+    return datetime.now(timezone.utc) - timedelta(seconds=BALANCE_CHECKPOINT_LAG)
+
+def rebuild_user_balance(user_uid):
+    """Recompute a user's balance from the full ledger and store a fresh checkpoint"""
+    cutoff = _checkpoint_cutoff()
+    checkpoint_balance = 0
+    pending = 0
+    entry_count = 0
+    untimestamped = 0
+    
+    for amount, created_at, _ in _ledger_entries(user_uid):
+        entry_count += 1
+        if created_at is not None and created_at > cutoff:
+            pending += amount
+        else:
+            checkpoint_balance += amount
+            untimestamped += created_at is None
+    if untimestamped:
+        print(f"⚠️ {untimestamped} ledger entries for {user_uid} have no Timestamp createdAt; folded into the checkpoint")
+    
+    db.collection('business_balances').document(user_uid).set({
+        'balance': checkpoint_balance,
+        'checkpointAt': cutoff,
+        'entryCount': entry_count,
+        'updatedAt': firestore.SERVER_TIMESTAMP
+    })
+    
+    return {
+        'uid': user_uid,
+        'balance': checkpoint_balance + pending,
+        'checkpoint_balance': checkpoint_balance,
+        'entries': entry_count,
+        'untimestamped': untimestamped
+    }
+
 def get_user_balance(user_uid):
-    """Get current balance for a business user"""
+    """Get current balance for a business user (checkpoint + entries since it)"""
     try:
-        # Get billing transactions (credits)
-        billing_transactions = db.collection('billing_transactions').where('userId', '==', user_uid).stream()
-        credits = sum(t.to_dict().get('amount', 0) for t in billing_transactions)
-        
-        # Get api_usage (debits) - only from global collection
-        api_usage = db.collection('api_usage').where('userId', '==', user_uid).stream()
-        debits = sum(u.to_dict().get('amount', 0) for u in api_usage)
+        balance_ref = db.collection('business_balances').document(user_uid)
+        snapshot = balance_ref.get()
+        
+        if not snapshot.exists:
+            result = rebuild_user_balance(user_uid)
+            print(f"💰 Balance rebuilt for {user_uid}: Entries={result['entries']}, Balance={result['balance']}")
+            return result['balance']
+        
+        state = snapshot.to_dict()
+        checkpoint_at = state.get('checkpointAt')
+        checkpoint_balance = float(state.get('balance', 0) or 0)
+        
+        cutoff = _checkpoint_cutoff()
+        delta = 0
+        foldable = 0
+        foldable_count = 0
+        delta_count = 0
+        for amount, created_at, _ in _ledger_entries(user_uid, since=checkpoint_at):
+            delta += amount
+            delta_count += 1
+            if created_at is not None and created_at <= cutoff:
+                foldable += amount
+                foldable_count += 1
+        
+        balance = checkpoint_balance + delta
+        print(f"💰 Balance calculation for {user_uid}: Checkpoint={checkpoint_balance}, Delta={delta} ({delta_count} entries), Balance={balance}")
+        
+        # Advance the checkpoint once the delta grows or the checkpoint gets old
+        checkpoint_age = (cutoff - checkpoint_at).total_seconds() if checkpoint_at else BALANCE_CHECKPOINT_INTERVAL
+        if foldable_count and (delta_count >= BALANCE_CHECKPOINT_MAX_DELTA or checkpoint_age >= BALANCE_CHECKPOINT_INTERVAL):
+            try:
+                balance_ref.update({
+                    'balance': checkpoint_balance + foldable,
+                    'checkpointAt': cutoff,
+                    'entryCount': firestore.Increment(foldable_count),
+                    'updatedAt': firestore.SERVER_TIMESTAMP
+                }, option=db.write_option(last_update_time=snapshot.update_time))
+            except Exception as checkpoint_error:
+                # Another request advanced the checkpoint first
+                print(f"⚠️ Balance checkpoint not advanced for {user_uid}: {checkpoint_error}")
         
-        balance = credits - debits
-        print(f"💰 Balance calculation for {user_uid}: Credits={credits}, Debits={debits}, Balance={balance}")
         return balance
+    except Exception as e:
+        print(f"❌ Error calculating balance from checkpoint, summing the full ledger: {e}")
+    
+    try:
+        return sum(amount for amount, _, _ in _ledger_entries(user_uid))
     except Exception as e:
         print(f"❌ Error calculating balance: {e}")
         return 0
 
+@firestore.transactional
+def _read_balance_state(transaction, user_uid):
+    """The balance checkpoint and the full ledger, read at one point in time"""
+    snapshot = db.collection('business_balances').document(user_uid).get(transaction=transaction)
+    return snapshot, list(_ledger_entries(user_uid, transaction=transaction))
+
+def verify_user_balance(user_uid, fix=False):
+    """Compare the materialized balance with a full ledger scan (read-only unless fix=True)"""
+    # One read-only transaction, so both figures see the same writes and no checkpoint moves
+    snapshot, entries = _read_balance_state(db.transaction(read_only=True), user_uid)
+    ledger = sum(amount for amount, _, _ in entries)
+    untimestamped = [path for _, created_at, path in entries if created_at is None]
+    
+    materialized = None
+    if snapshot.exists:
+        state = snapshot.to_dict()
+        checkpoint_at = state.get('checkpointAt')
+        materialized = float(state.get('balance', 0) or 0) + sum(
+            amount for amount, created_at, _ in entries
+            if checkpoint_at is None or (created_at is not None and created_at > checkpoint_at))
+    matches = materialized is not None and abs(materialized - ledger) < 0.005
+    if not matches and fix:
+        rebuild_user_balance(user_uid)
+    return {'uid': user_uid, 'materialized': materialized, 'ledger': ledger, 'matches': matches,
+            'untimestamped': untimestamped}
+
 def check_minimum_balance(user_uid, minimum=4.0):
     """Check if user has at least minimum balance (default $4)"""
     try:
@@ -123,40 +625,282 @@ def check_minimum_balance(user_uid, minimum=4.0):
             'error': str(e)
         }
 
-def deduct_balance(user_uid, amount):
+# ============================================================================
+# Balance Deduction
+# Every deduction runs in one Firestore transaction together with its
+# transactions/ entry. Hot accounts can spread their balance over
+# balance_shards/{n} (business_users.balanceShards = N); the parent balance
+# field then acts as the top-up bucket that rebalancing drains into the shards.
+# ============================================================================
+
+BALANCE_SHARD_ATTEMPTS = 2  # Random shards tried before pooling all of them
+
+def _balance_transaction_record(amount, balance_before, balance_after, shard=None):
+    """Entry for business_users/{uid}/transactions"""
+    record = {
+        'type': 'esim_purchase',
+        'amount': amount,
+        'balance_before': balance_before,
+        'balance_after': balance_after,
+        'timestamp': firestore.SERVER_TIMESTAMP
+    }
+    if shard is not None:
+        record['shard'] = shard
+    return record
+
+@firestore.transactional
+def _deduct_from_document(transaction, user_ref, balance_ref, amount, shard=None):
+    """Deduct from a single balance document (the user document or one shard)"""
+    snapshot = balance_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return False
+    
+    current_balance = snapshot.to_dict().get('balance', 0)
+    if current_balance < amount:
+        return False
+    
+    new_balance = round(current_balance - amount, 2)
+    transaction.update(balance_ref, {'balance': new_balance})
+    transaction.set(user_ref.collection('transactions').document(),
+                    _balance_transaction_record(amount, current_balance, new_balance, shard))
+    return True
+
+@firestore.transactional
+def _rebalance_and_deduct(transaction, user_ref, shard_count, amount):
+    """Pool the top-up bucket and every shard, deduct, and spread the rest evenly"""
+    user_snapshot = user_ref.get(transaction=transaction)
+    if not user_snapshot.exists:
+        return False
+    
+    shard_refs = [user_ref.collection('balance_shards').document(str(i)) for i in range(shard_count)]
+    shard_balances = {snapshot.id: (snapshot.to_dict() or {}).get('balance', 0)
+                      for snapshot in transaction.get_all(shard_refs) if snapshot.exists}
+    
+    total = user_snapshot.to_dict().get('balance', 0) + sum(shard_balances.values())
+    if total < amount:
+        return False
+    
+    remaining_cents = int(round((total - amount) * 100))
+    per_shard_cents, extra_cents = divmod(remaining_cents, shard_count)
+    for i, shard_ref in enumerate(shard_refs):
+        transaction.set(shard_ref, {'balance': (per_shard_cents + (1 if i < extra_cents else 0)) / 100})
+    
+    transaction.update(user_ref, {'balance': 0})
+    transaction.set(user_ref.collection('transactions').document(),
+                    _balance_transaction_record(amount, round(total, 2), remaining_cents / 100, 'all'))
+    return True
+
+def get_business_balance(user_uid, shard_count=0):
+    """Current business_users balance, including balance shards when enabled"""
+    user_ref = db.collection('business_users').document(user_uid)
+    refs = [user_ref] + [user_ref.collection('balance_shards').document(str(i)) for i in range(shard_count or 0)]
+    return round(sum((snapshot.to_dict() or {}).get('balance', 0)
+                     for snapshot in db.get_all(refs) if snapshot.exists), 2)
+
+def deduct_balance(user_uid, amount, shard_count=0):
     """Deduct balance from user account"""
     try:
         user_ref = db.collection('business_users').document(user_uid)
-        user_doc = user_ref.get()
         
-        if not user_doc.exists:
-            return False
-            
-        current_balance = user_doc.to_dict().get('balance', 0)
-        if current_balance < amount:
-            return False
-            
-        new_balance = current_balance - amount
-        user_ref.update({'balance': new_balance})
-        
-        # Record transaction
-        transaction_data = {
-            'type': 'esim_purchase',
-            'amount': amount,
-            'balance_before': current_balance,
-            'balance_after': new_balance,
-            'timestamp': firestore.SERVER_TIMESTAMP
-        }
-        db.collection('business_users').document(user_uid).collection('transactions').add(transaction_data)
+        if not shard_count:
+            return _deduct_from_document(db.transaction(), user_ref, user_ref, amount)
         
-        return True
+        # Sharded account: a single random shard only contends with orders that picked the same shard
+        for _ in range(BALANCE_SHARD_ATTEMPTS):
+            shard = random.randrange(shard_count)
+            shard_ref = user_ref.collection('balance_shards').document(str(shard))
+            if _deduct_from_document(db.transaction(), user_ref, shard_ref, amount, shard):
+                return True
+        
+        return _rebalance_and_deduct(db.transaction(), user_ref, shard_count, amount)
     except Exception as e:
         print(f"Balance deduction error: {e}")
         return False
 
+# ============================================================================
+# Idempotency Keys
+# /api/user/order and /api/esim/create
+# accept an Idempotency-Key header. The first request with a key runs and its
+# response is stored in idempotency_keys/{id} (scoped to the caller and path,
+# with a fingerprint of the request). Repeats get the stored response without
+# reaching Airalo; a duplicate arriving while the first is still running waits
+# for it. Reusing a key for a different request is a 422. A request that
+# fails before its side effect (an Airalo order, a balance deduction) releases
+# its key so a retry runs again; one that fails after it is stored as failed
+# and replayed, so a retry can't order or charge twice.
+# ============================================================================
+
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', 24 * 3600))  # Seconds a stored response is replayed
+IDEMPOTENCY_LOCK_TTL = 120  # Seconds before a key whose request died mid-flight can be taken over
+IDEMPOTENCY_WAIT_TIMEOUT = 60  # Seconds a duplicate waits for the first request before a 409
+IDEMPOTENCY_POLL_INTERVAL = 0.25  # Seconds between checks on a key held by another process
+# Responses for requests that never ran (and 5xx before the side effect) are not stored, so a retry runs again
+IDEMPOTENCY_UNSTORED_STATUSES = {401, 403, 409, 429}
+IDEMPOTENCY_INCOMPLETE_ERROR = 'The request failed after its side effect was committed; do not retry it, contact support'
+IDEMPOTENCY_REPLAYED_HEADERS = ('Location', 'Preference-Applied')
+
+_idempotency_inflight = {}  # key doc id -> Event set when this process finishes the request
+_idempotency_inflight_lock = threading.Lock()
+_idempotency_request = threading.local()  # side_effect flag for the request this thread is serving
+
+def idempotency_scope():
+    """Uid of the caller (API key owner or Firebase user); 'anonymous' when it can't be resolved"""
+    api_key = request.headers.get('X-API-Key', '')
+    auth_header = request.headers.get('Authorization', '')
+    bearer = auth_header[7:] if auth_header.startswith('Bearer ') else ''
+    for credential in (api_key, bearer):
+        if credential:
+            owner = authenticate_api_key(credential)
+            if owner:
+                return owner['uid']
+    if bearer:
+        user = authenticate_firebase_token(bearer)
+        if user:
+            return user['uid']
+    return 'anonymous'
+
+def request_fingerprint():
+    """Hash of the method, path, query and (canonicalized JSON) body"""
+    body = request.get_data() or b''
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True, separators=(',', ':')).encode('utf-8')
+    except ValueError:
+        pass
+    return hashlib.sha256(f"{request.method} {request.full_path}\n".encode('utf-8') + body).hexdigest()
+
+@firestore.transactional
+def _acquire_idempotency_key(transaction, key_ref, fingerprint):
+    """('acquired' | 'replay' | 'wait' | 'mismatch', stored key data)"""
+    snapshot = key_ref.get(transaction=transaction)
+    data = snapshot.to_dict() if snapshot.exists else None
+    now = datetime.now(timezone.utc)
+    if data and data.get('expiresAt') and data['expiresAt'] > now:
+        if data.get('fingerprint') != fingerprint:
+            return 'mismatch', data
+        if data.get('state') in ('completed', 'failed'):
+            return 'replay', data
+        if data.get('lockedUntil', 0) > time.time():
+            return 'wait', data
+    transaction.set(key_ref, {
+        'state': 'in_progress',
+        'fingerprint': fingerprint,
+        'path': request.path,
+        'lockedUntil': time.time() + IDEMPOTENCY_LOCK_TTL,
+        'createdAt': firestore.SERVER_TIMESTAMP,
+        'expiresAt': now + timedelta(seconds=IDEMPOTENCY_KEY_TTL)  # Firestore TTL policy field
+    })
+    return 'acquired', None
+
+def idempotent_side_effect_committed():
+    """Call once a request's side effect has happened; later failures are then replayed, not retried"""
+    _idempotency_request.side_effect = True
+
+def _store_idempotent_response(key_ref, response, side_effect=False):
+    """Keep a finished request's response for replay, or release the key if it shouldn't be replayed"""
+    try:
+        if (response.status_code in IDEMPOTENCY_UNSTORED_STATUSES or response.is_streamed
+                or (response.status_code >= 500 and not side_effect)):
+            key_ref.delete()
+            return
+        key_ref.update({
+            'state': 'failed' if response.status_code >= 500 else 'completed',
+            'lockedUntil': 0,
+            'completedAt': firestore.SERVER_TIMESTAMP,
+            'response': {
+                'status': response.status_code,
+                'body': response.get_data(as_text=True),
+                'mimetype': response.mimetype,
+                'headers': {name: response.headers[name] for name in IDEMPOTENCY_REPLAYED_HEADERS if name in response.headers}
+            }
+        })
+    except Exception as e:
+        print(f"⚠️ Could not store idempotent response for {key_ref.id}: {e}")
+
+def _replay_idempotent_response(data):
+    stored = data.get('response') or {}
+    response = Response(stored.get('body', ''), status=stored.get('status', 200),
+                        mimetype=stored.get('mimetype', 'application/json'), headers=stored.get('headers') or {})
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def _wait_for_idempotency_key(doc_id, deadline):
+    """Block until the request holding a key finishes here, or for one poll interval if it runs elsewhere"""
+    with _idempotency_inflight_lock:
+        event = _idempotency_inflight.get(doc_id)
+    if event is not None:
+        event.wait(max(0, deadline - time.time()))
+    else:
+        time.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+def idempotent(handler):
+    """Route decorator: honour the Idempotency-Key header"""
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return handler(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({'success': False, 'error': 'Idempotency-Key must be at most 255 characters'}), 400
+        
+        doc_id = hashlib.sha256(f"{idempotency_scope()}\n{request.path}\n{key}".encode('utf-8')).hexdigest()
+        key_ref = db.collection('idempotency_keys').document(doc_id)
+        fingerprint = request_fingerprint()
+        deadline = time.time() + IDEMPOTENCY_WAIT_TIMEOUT
+        while True:
+            outcome, data = _acquire_idempotency_key(db.transaction(), key_ref, fingerprint)
+            if outcome == 'acquired':
+                break
+            if outcome == 'replay':
+                print(f"🔁 Replaying response for Idempotency-Key on {request.path}")
+                return _replay_idempotent_response(data)
+            if outcome == 'mismatch':
+                return jsonify({
+                    'success': False,
+                    'error': 'Idempotency-Key was already used for a different request'
+                }), 422
+            if time.time() >= deadline:
+                response = jsonify({
+                    'success': False,
+                    'error': 'A request with this Idempotency-Key is still in progress'
+                })
+                response.status_code = 409
+                response.headers['Retry-After'] = '1'
+                return response
+            _wait_for_idempotency_key(doc_id, deadline)
+        
+        event = threading.Event()
+        with _idempotency_inflight_lock:
+            _idempotency_inflight[doc_id] = event
+        _idempotency_request.side_effect = False
+        response = None
+        try:
+            response = app.make_response(handler(*args, **kwargs))
+            return response
+        finally:
+            side_effect = _idempotency_request.side_effect
+            if response is None and side_effect:
+                # The handler raised after its side effect; keep a failure to replay
+                response = app.make_response((jsonify({'success': False, 'error': IDEMPOTENCY_INCOMPLETE_ERROR}), 500))
+            if response is not None:
+                _store_idempotent_response(key_ref, response, side_effect)
+            else:
+                try:
+                    key_ref.delete()
+                except Exception as e:
+                    print(f"⚠️ Could not release Idempotency-Key {doc_id}: {e}")
+            with _idempotency_inflight_lock:
+                _idempotency_inflight.pop(doc_id, None)
+            event.set()
+    return wrapper
+
 @app.route('/health', methods=['GET'])
 def health():
-    return jsonify({'status': 'ok', 'message': 'Server is running'})
+    return jsonify({
+        'status': 'ok',
+        'message': 'Server is running',
+        'token_cache': get_firebase_token_cache_stats(),
+        'api_usage_buffer': get_usage_buffer_stats()
+    })
 
 @app.route('/api/user/balance', methods=['GET'])
 def get_user_balance_endpoint():
@@ -205,6 +949,7 @@ def get_user_balance_endpoint():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/esim/create', methods=['POST'])
+@idempotent
 def create_esim():
     """Create a new eSIM"""
     auth_header = request.headers.get('Authorization', '')
@@ -244,14 +989,15 @@ def create_esim():
         
         # Get package price first
         headers = {'Authorization': f'Bearer {token}'}
-        package_response = requests.get(f"{AIRALO_BASE_URL}/packages/{package_id}", headers=headers)
+        package_response = upstream_request('airalo', 'GET', f"{AIRALO_BASE_URL}/packages/{package_id}", headers=headers)
         package_response.raise_for_status()
         package_data = package_response.json()
         package_price = package_data.get('price', 0)
         
         # Check and deduct balance
-        if not deduct_balance(user['uid'], package_price):
+        if not deduct_balance(user['uid'], package_price, user.get('balanceShards', 0)):
             return jsonify({'success': False, 'error': 'Insufficient balance'}), 400
+        idempotent_side_effect_committed()
         
         # Create eSIM with Airalo
         esim_data = {
@@ -259,7 +1005,7 @@ def create_esim():
             'customer_email': user['email']
         }
         
-        esim_response = requests.post(f"{AIRALO_BASE_URL}/esims", 
+        esim_response = upstream_request('airalo', 'POST', f"{AIRALO_BASE_URL}/esims", 
                                    json=esim_data, headers=headers)
         esim_response.raise_for_status()
         
@@ -319,7 +1065,7 @@ def get_esim_details():
             return jsonify({'success': False, 'error': 'Failed to authenticate with Airalo'}), 500
         
         headers = {'Authorization': f'Bearer {token}'}
-        response = requests.get(f"{AIRALO_BASE_URL}/esims/{esim_id}", headers=headers)
+        response = upstream_request('airalo', 'GET', f"{AIRALO_BASE_URL}/esims/{esim_id}", headers=headers)
         response.raise_for_status()
         
         esim_data = response.json()
@@ -366,7 +1112,7 @@ def get_esim_usage():
             return jsonify({'success': False, 'error': 'Failed to authenticate with Airalo'}), 500
         
         headers = {'Authorization': f'Bearer {token}'}
-        response = requests.get(f"{AIRALO_BASE_URL}/esims/{esim_id}/usage", headers=headers)
+        response = upstream_request('airalo', 'GET', f"{AIRALO_BASE_URL}/esims/{esim_id}/usage", headers=headers)
         response.raise_for_status()
         
         usage_data = response.json()
@@ -377,234 +1123,1024 @@ def get_esim_usage():
         return jsonify({'success': False, 'error': 'Failed to fetch eSIM usage'}), 500
 
 # ============================================================================
-# Regular User Endpoints (for esim-main frontend)
-# These endpoints authenticate via Firebase ID token and use server's Airalo credentials
+# ICCID Index
+# iccid_index/{iccid} maps an eSIM to the order that created it, so ICCID
+# lookups are a single document get instead of a scan over every order.
 # ============================================================================
 
-@app.route('/api/user/order', methods=['POST'])
-def create_user_order():
-    """Create REAL eSIM order (production only - makes real Airalo API call)"""
+def order_iccids(order_data):
+    """Every ICCID an order document carries (top level, esimData and the sims lists)"""
+    iccids = [order_data.get('iccid'), (order_data.get('esimData') or {}).get('iccid')]
+    for container in (order_data.get('airaloOrderData'), order_data.get('orderData'), order_data):
+        sims = container.get('sims') if isinstance(container, dict) else None
+        if isinstance(sims, list):
+            iccids.extend(sim.get('iccid') for sim in sims if isinstance(sim, dict))
+    return list(dict.fromkeys(str(iccid).strip() for iccid in iccids if iccid))
+
+def order_country_codes(order_data):
+    """Country codes of an order, from its own fields and the Airalo order data"""
+    codes = (
+        order_data.get('countryCode') or
+        order_data.get('country_code') or
+        order_data.get('countryCodes') or
+        order_data.get('country_codes') or
+        []
+    )
+    if isinstance(codes, str):
+        codes = [codes]
+    elif not isinstance(codes, list):
+        codes = []
+    codes = list(codes)
+    
+    airalo_data = order_data.get('airaloOrderData') or {}
+    package = airalo_data.get('package')
+    package_code = (package.get('country_code') or package.get('countryCode')) if isinstance(package, dict) else None
+    for code in (airalo_data.get('country_code'), package_code):
+        if code and code not in codes:
+            codes.append(code)
+    return codes
+
+def order_operator(order_data):
+    package = (order_data.get('airaloOrderData') or {}).get('package')
+    if isinstance(package, dict):
+        return package.get('operator') or package.get('operator_title')
+    return None
+
+def iccid_index_entry(order_ref, order_data):
+    """iccid_index document for an order (without the iccid itself)"""
+    return {
+        'orderId': order_ref.id,
+        'orderPath': order_ref.path,
+        # users/{uid}/esims documents don't repeat the uid
+        'userId': order_data.get('userId') or (order_ref.parent.parent.id if order_ref.parent.parent else None),
+        'email': order_data.get('userEmail') or order_data.get('customerEmail'),
+        'countryCodes': order_country_codes(order_data),
+        'operator': order_operator(order_data),
+        'airaloOrderId': order_data.get('airaloOrderId') or (order_data.get('airaloOrderData') or {}).get('id'),
+        'indexedAt': firestore.SERVER_TIMESTAMP,
+    }
+
+def index_order_iccids(order_ref, order_data, batch=None):
+    """Write iccid_index entries for an order (into batch when given); returns the ICCIDs indexed"""
+    iccids = order_iccids(order_data)
+    if not iccids:
+        return iccids
+    
+    entry = iccid_index_entry(order_ref, order_data)
+    writer = batch if batch is not None else db.batch()
+    for iccid in iccids:
+        writer.set(db.collection('iccid_index').document(iccid), {**entry, 'iccid': iccid})
+    if batch is None:
+        writer.commit()
+    return iccids
+
+def commit_order_side_effects(order_ref, order_data, api_usage_data):
+    """Write an order, its ICCID index entries and its api_usage document in one batch"""
+    usage_ref = db.collection('api_usage').document()
+    usage_writes = [(usage_ref, api_usage_data)]
+    batch = db.batch()
+    batch.set(order_ref, order_data, merge=True)  # merge: async orders complete their intent document
+    index_order_iccids(order_ref, order_data, batch=batch)
+    if not API_USAGE_WRITE_BEHIND:
+        batch.set(usage_ref, api_usage_data)
     try:
-        # Get request data first to extract email
-        data = request.get_json()
-        to_email = data.get('to_email') if data else None
-        
-        # Authenticate via API key (required for API access)
-        # Priority: X-API-Key header first, then Authorization Bearer header
-        api_key = request.headers.get('X-API-Key', '')
-        auth_header = request.headers.get('Authorization', '')
-        
-        # If no API key in X-API-Key header, check Authorization Bearer header
-        if not api_key and auth_header.startswith('Bearer '):
-            potential_key = auth_header[7:]
-            # Try to authenticate as API key first
-            test_owner = authenticate_api_key(potential_key)
-            if test_owner:
-                api_key = potential_key
-            else:
-                # Not an API key, might be Firebase token (will handle later)
-                pass
-        
-        if not api_key:
-            return jsonify({'success': False, 'error': 'API key is required'}), 401
-        
-        # Authenticate API key (business owner)
-        business_owner = authenticate_api_key(api_key)
-        if not business_owner:
-            return jsonify({'success': False, 'error': 'Invalid or unverified API key'}), 401
-        
-        print(f"🔑 API Key owner identified: {business_owner['email']} ({business_owner['uid']})")
-        
-        # Try to authenticate user via Firebase token (optional)
-        # Only if Authorization header contains a Firebase token (not the API key we already used)
-        user = None
-        if auth_header.startswith('Bearer '):
-            id_token = auth_header[7:]
-            # Only try Firebase auth if it's not the API key we already used
-            if id_token != api_key:
-                user = authenticate_firebase_token(id_token)
-        
-        # If no Firebase user, create user object from email
-        if not user:
-            if not to_email:
-                return jsonify({'success': False, 'error': 'to_email is required when Firebase token is not provided'}), 400
-            # Create a user object from email
-            user = {
-                'uid': f'email_{to_email.replace("@", "_").replace(".", "_")}',
-                'email': to_email,
-                'type': 'email_user'
-            }
-            print(f"📧 Using email-based user: {user['email']} ({user['uid']})")
-        
-        # Check KYC status
-        user_ref = db.collection('business_users').document(business_owner['uid'])
-        user_doc = user_ref.get()
-        if not user_doc.exists:
-            return jsonify({'success': False, 'error': 'Business user not found'}), 404
-        
-        user_data = user_doc.to_dict()
-        kyc_status = user_data.get('kycStatus', 'pending')
-        
-        if kyc_status != 'approved':
-            return jsonify({
-                'success': False, 
-                'error': 'KYC verification required',
-                'kycStatus': kyc_status,
-                'message': 'Please complete KYC verification to use the production API'
-            }), 403
-        
-        print(f"✅ KYC verified for {business_owner['email']}")
-        
-        # Check balance
-        current_balance = business_owner.get('balance', 0)
-        if current_balance <= 0:
-            return jsonify({
-                'success': False,
-                'error': 'Insufficient balance',
-                'balance': current_balance,
-                'message': 'Please add funds to your account to create orders'
-            }), 402
-        
-        print(f"✅ Balance check passed: ${current_balance}")
-        
-        # Get request data (already retrieved above)
-        package_id = data.get('package_id')
-        quantity = data.get('quantity', '1')
-        to_email = data.get('to_email', user.get('email') if user else None)
-        description = data.get('description', f"eSIM order for {to_email}")
-        
-        if not to_email:
-            return jsonify({'success': False, 'error': 'to_email is required'}), 400
-        
-        if not package_id:
-            return jsonify({'success': False, 'error': 'package_id is required'}), 400
-        
-        print(f"")
-        print(f"{'='*80}")
-        print(f"💳 PRODUCTION - Creating REAL Airalo order")
-        print(f"{'='*80}")
-        print(f"  User: {user['email']} ({user['uid']})")
-        print(f"  Package: {package_id}")
-        print(f"  Quantity: {quantity}")
-        print(f"{'='*80}")
-        print(f"")
-        
-        # Get Airalo token using server's credentials
-        token = get_airalo_token()
-        if not token:
-            return jsonify({'success': False, 'error': 'Failed to authenticate with Airalo'}), 500
-        
-        # Prepare form data for Airalo API
-        form_data = {
-            'quantity': quantity,
-            'package_id': package_id,
-            'type': 'sim',
-            'description': description,
-            'to_email': to_email,
-            'sharing_option[]': ['link']
-        }
-        
-        print(f"📦 Sending order to Airalo API")
-        
-        # Create order with Airalo
-        headers = {
-            'Authorization': f'Bearer {token}',
-            'Accept': 'application/json'
-        }
-        
-        response = requests.post(
-            f"{AIRALO_BASE_URL}/v2/orders",
-            headers=headers,
-            data=form_data
-        )
-        
-        if not response.ok:
-            error_text = response.text
-            print(f"❌ Airalo order error: {error_text}")
-            return jsonify({
-                'success': False,
-                'error': f'Failed to create order: {response.status_code}'
-            }), 500
-        
-        order_result = response.json()
-        airalo_order_id = order_result.get('data', {}).get('id')
-        airalo_price = order_result.get('data', {}).get('price', 0)
-        
-        print(f"✅ REAL order created successfully: {airalo_order_id}")
-        
-        # Save order to Firestore
-        order_data = {
-            'userId': user['uid'],
-            'userEmail': user['email'],
-            'airaloOrderId': airalo_order_id,
-            'packageId': package_id,
-            'quantity': quantity,
-            'status': 'pending',
-            'orderData': order_result.get('data', {}),
-            'createdAt': firestore.SERVER_TIMESTAMP,
-            'mode': 'production',
-            'isTestMode': False
-        }
-        
-        order_ref = db.collection('orders').add(order_data)
-        order_id = order_ref[1].id
-        
-        # LOG TO api_usage FOR BUSINESS DASHBOARD
-        api_usage_data = {
-            'customerId': user['uid'],  # The customer who purchased
-            'customerEmail': user['email'],
-            'userId': business_owner['uid'],  # Business owner (for filtering orders in dashboard)
-            'userEmail': business_owner['email'],  # Business owner email
-            'businessOwnerId': business_owner['uid'],  # The business owner who should get paid
-            'businessOwnerEmail': business_owner['email'],
-            'endpoint': '/api/user/order',
-            'method': 'POST',
-            'mode': 'production',
-            'packageId': package_id,
-            'packageName': package_id,
-            'orderId': order_id,
-            'airaloOrderId': airalo_order_id,
-            'amount': airalo_price,
-            'status': 'pending',
-            'isTestOrder': False,
-            'testModeLabel': None,
-            'createdAt': firestore.SERVER_TIMESTAMP,
-            'metadata': {
-                'quantity': quantity,
-                'iccid': order_result.get('data', {}).get('sims', [{}])[0].get('iccid') if order_result.get('data', {}).get('sims') else None,
-                'hasBusinessOwner': True
-            }
-        }
-        
-        # Add to api_usage collection for business dashboard (GLOBAL COLLECTION ONLY)
-        db.collection('api_usage').add(api_usage_data)
-        print(f"✅ Logged to global api_usage collection (PRODUCTION)")
-        print(f"   Customer: {user['email']} ({user['uid']})")
-        print(f"   Business Owner: {business_owner['email'] if business_owner else 'NOT SET'} ({business_owner['uid'] if business_owner else 'N/A'})")
-        
-        return jsonify({
-            'success': True,
-            'orderId': order_id,
-            'airaloOrderId': airalo_order_id,
-            'orderData': order_result.get('data', {}),
-            'isTestMode': False
-        })
-        
+        batch.commit()
     except Exception as e:
-        print(f"❌ Error creating user order: {e}")
-        return jsonify({'success': False, 'error': str(e)}), 500
+        _record_order_alone(order_ref, order_data, usage_writes, e)
+        return usage_ref
+    
+    if API_USAGE_WRITE_BEHIND:
+        buffer_usage_writes(usage_writes)
+    return usage_ref
 
-@app.route('/api/user/qr-code', methods=['POST'])
-def get_user_qr_code():
-    """Get QR code for regular user's order"""
+def _record_order_alone(order_ref, order_data, usage_writes, batch_error):
+    """Fallback when an order's batch fails: the order on its own, then its index and api_usage"""
+    # Airalo has already charged for the order, so it is recorded even if its index can't be
+    print(f"⚠️ Order batch for {order_ref.id} failed ({batch_error}), writing the order alone")
+    order_ref.set(order_data, merge=True)
     try:
-        # Authenticate user via Firebase ID token
-        auth_header = request.headers.get('Authorization', '')
-        if not auth_header.startswith('Bearer '):
-            return jsonify({'success': False, 'error': 'Missing or invalid authorization header'}), 401
-        
-        id_token = auth_header[7:]
-        user = authenticate_firebase_token(id_token)
+        index_order_iccids(order_ref, order_data)
+    except Exception as e:
+        print(f"⚠️ ICCID index not written for order {order_ref.id}: {e}")
+    try:
+        write_usage_now(usage_writes)
+    except Exception as e:
+        print(f"⚠️ api_usage for order {order_ref.id} not written ({e}), buffering it for retry")
+        buffer_usage_writes(usage_writes)
+
+# ============================================================================
+# api_usage Write-Behind Buffer
+# With API_USAGE_WRITE_BEHIND=true, api_usage documents are appended to a
+# local SQLite file (WAL mode, one INSERT per order) instead of joining the
+# order's batch, and a background thread flushes them to Firestore in batches
+# of up to 500, at most API_USAGE_FLUSH_INTERVAL after they arrive. This takes
+# a document per order off the request path, at a price: the order and its
+# usage are no longer written atomically, and usage only reaches Firestore
+# (and billing) once flushed. Off by default: orders and usage share a batch.
+# createdAt is still stamped by the server when the row is flushed, so the
+# balance checkpoint lag holds; bufferedAt records when the order was placed.
+# Rows are deleted only once their batch commits, so events buffered before a
+# crash or restart are flushed by the next process. Rows are flushed with
+# create(): a row flushed twice fails with AlreadyExists and is dropped rather
+# than re-stamping createdAt. A batch Firestore rejects is halved until the
+# rejected rows are found; those move to the usage_dead_letters table.
+# Flushers claim rows before writing them, so several workers can share the
+# file; a claim left behind by a dead worker expires after API_USAGE_CLAIM_TTL.
+# ============================================================================
+
+API_USAGE_WRITE_BEHIND = os.getenv('API_USAGE_WRITE_BEHIND', 'false').lower() == 'true'
+API_USAGE_BUFFER_FILE = os.getenv('API_USAGE_BUFFER_FILE', '/tmp/api_usage_buffer.sqlite3')
+API_USAGE_FLUSH_INTERVAL = float(os.getenv('API_USAGE_FLUSH_INTERVAL', 1.0))  # Max seconds before a buffered event is flushed
+API_USAGE_BATCH_SIZE = 500  # Firestore batch limit
+API_USAGE_CLAIM_TTL = 60  # Seconds before rows claimed by a flusher that died are flushed again
+API_USAGE_ROW_ERRORS = (google_exceptions.BadRequest, ValueError, TypeError)  # Errors caused by the rows, not by Firestore being unavailable
+
+_usage_buffer_local = threading.local()  # Per-thread SQLite connection
+_usage_buffer_wakeup = threading.Event()  # Set when a full batch is waiting
+_usage_buffer_flusher = None
+_usage_buffer_lock = threading.Lock()
+_usage_buffer_stats = {
+    'buffered': 0,
+    'buffer_seconds': 0.0,
+    'inline_fallbacks': 0,
+    'flushed': 0,
+    'flush_batches': 0,
+    'flush_errors': 0,
+    'dead_lettered': 0,
+    'last_flush_ms': None,
+    'max_flush_ms': 0.0,
+    'last_flush_lag_seconds': None,  # Age of the oldest event in the last batch when it committed
+    'unflushed_since_wakeup': 0
+}
+
+def _usage_buffer_connection():
+    """This thread's connection to the buffer file (reopened after a fork)"""
+    conn = getattr(_usage_buffer_local, 'conn', None)
+    if conn is None or _usage_buffer_local.pid != os.getpid():
+        conn = sqlite3.connect(API_USAGE_BUFFER_FILE, timeout=10)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')  # Survives a process crash without an fsync per event
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS usage_events ('
+                         'seq INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT NOT NULL, data TEXT NOT NULL, '
+                         'buffered_at REAL NOT NULL, claimed_by TEXT, claimed_at REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS usage_dead_letters ('
+                         'seq INTEGER PRIMARY KEY, path TEXT NOT NULL, data TEXT NOT NULL, '
+                         'buffered_at REAL NOT NULL, error TEXT, failed_at REAL NOT NULL)')
+        _usage_buffer_local.conn = conn
+        _usage_buffer_local.pid = os.getpid()
+    return conn
+
+def _encode_usage_value(value):
+    """JSON-safe copy of a document (SERVER_TIMESTAMP is kept as a marker for the flush)"""
+    if value is firestore.SERVER_TIMESTAMP:
+        return {'__server_timestamp__': True}
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, dict):
+        return {key: _encode_usage_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode_usage_value(item) for item in value]
+    return value
+
+def _decode_usage_value(obj):
+    if len(obj) == 1 and '__server_timestamp__' in obj:
+        return firestore.SERVER_TIMESTAMP
+    if len(obj) == 1 and '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    return obj
+
+def write_usage_now(writes):
+    """Write (document ref, data) pairs in one batch"""
+    batch = db.batch()
+    for ref, data in writes:
+        batch.set(ref, data)
+    batch.commit()
+
+def buffer_usage_writes(writes):
+    """Append (document ref, data) pairs to the buffer, writing them inline if the buffer is unavailable"""
+    started = time.perf_counter()
+    buffered_at = datetime.now(timezone.utc)
+    rows = [(ref.path, json.dumps(_encode_usage_value({**data, 'bufferedAt': buffered_at}), default=str),
+             buffered_at.timestamp())
+            for ref, data in writes]
+    try:
+        conn = _usage_buffer_connection()
+        with conn:
+            conn.executemany('INSERT INTO usage_events (path, data, buffered_at) VALUES (?, ?, ?)', rows)
+    except sqlite3.Error as e:
+        print(f"⚠️ api_usage buffer unavailable, writing {len(writes)} document(s) inline: {e}")
+        _usage_buffer_stats['inline_fallbacks'] += 1
+        write_usage_now(writes)
+        return
+    
+    _usage_buffer_stats['buffered'] += len(rows)
+    _usage_buffer_stats['buffer_seconds'] += time.perf_counter() - started
+    _usage_buffer_stats['unflushed_since_wakeup'] += len(rows)
+    if _usage_buffer_stats['unflushed_since_wakeup'] >= API_USAGE_BATCH_SIZE:
+        _usage_buffer_wakeup.set()
+    if _usage_buffer_flusher is None or not _usage_buffer_flusher.is_alive():
+        start_usage_buffer_flusher()
+
+def _create_usage_documents(rows):
+    """Create buffered rows' documents in one batch, halving it around rows Firestore rejects.
+    
+    Returns (rows written, [(row, error)] rejected); errors that are not about
+    the rows themselves (Firestore unavailable, timeouts) are raised.
+    """
+    try:
+        batch = db.batch()
+        for seq, path, data, buffered_at in rows:
+            batch.create(db.document(path), json.loads(data, object_hook=_decode_usage_value))
+        batch.commit()
+        return rows, []
+    except google_exceptions.Conflict:
+        if len(rows) == 1:
+            return rows, []  # Created by an earlier flush that died before deleting the row
+    except API_USAGE_ROW_ERRORS as e:
+        if len(rows) == 1:
+            return [], [(rows[0], e)]
+    
+    middle = len(rows) // 2
+    written, rejected = _create_usage_documents(rows[:middle])
+    more_written, more_rejected = _create_usage_documents(rows[middle:])
+    return written + more_written, rejected + more_rejected
+
+def flush_usage_buffer():
+    """Flush up to API_USAGE_BATCH_SIZE buffered events; returns how many rows were taken off the buffer"""
+    conn = _usage_buffer_connection()
+    claim = f'{os.getpid()}:{threading.get_ident()}:{time.time()}'
+    now = time.time()
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('UPDATE usage_events SET claimed_by = ?, claimed_at = ? WHERE seq IN ('
+                     'SELECT seq FROM usage_events WHERE claimed_by IS NULL OR claimed_at < ? ORDER BY seq LIMIT ?)',
+                     (claim, now, now - API_USAGE_CLAIM_TTL, API_USAGE_BATCH_SIZE))
+        rows = conn.execute('SELECT seq, path, data, buffered_at FROM usage_events WHERE claimed_by = ? ORDER BY seq',
+                            (claim,)).fetchall()
+    if not rows:
+        return 0
+    
+    started = time.time()
+    try:
+        written, rejected = _create_usage_documents(rows)
+    except Exception as e:
+        print(f"⚠️ Could not flush {len(rows)} buffered api_usage writes: {e}")
+        _usage_buffer_stats['flush_errors'] += 1
+        with conn:
+            conn.execute('UPDATE usage_events SET claimed_by = NULL, claimed_at = NULL WHERE claimed_by = ?', (claim,))
+        return 0
+    
+    finished = time.time()
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO usage_dead_letters (seq, path, data, buffered_at, error, failed_at) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         [(*row, str(error), finished) for row, error in rejected])
+        conn.execute('DELETE FROM usage_events WHERE claimed_by = ?', (claim,))
+    for (seq, path, _, _), error in rejected:
+        print(f"☠️ Firestore rejected buffered api_usage write {path}, moved to usage_dead_letters: {error}")
+    
+    flush_ms = round((finished - started) * 1000, 1)
+    _usage_buffer_stats['flushed'] += len(written)
+    _usage_buffer_stats['dead_lettered'] += len(rejected)
+    _usage_buffer_stats['flush_batches'] += 1
+    _usage_buffer_stats['last_flush_ms'] = flush_ms
+    _usage_buffer_stats['max_flush_ms'] = max(_usage_buffer_stats['max_flush_ms'], flush_ms)
+    _usage_buffer_stats['last_flush_lag_seconds'] = round(finished - min(row[3] for row in rows), 3)
+    return len(rows)
+
+def _flush_usage_buffer_forever():
+    while True:
+        _usage_buffer_wakeup.wait(API_USAGE_FLUSH_INTERVAL)
+        _usage_buffer_wakeup.clear()
+        _usage_buffer_stats['unflushed_since_wakeup'] = 0
+        try:
+            while flush_usage_buffer() == API_USAGE_BATCH_SIZE:
+                pass
+        except sqlite3.Error as e:
+            print(f"⚠️ api_usage buffer flush failed: {e}")
+
+def start_usage_buffer_flusher():
+    """Start the flusher (which also replays events left by a previous process)"""
+    global _usage_buffer_flusher
+    if not API_USAGE_WRITE_BEHIND and not os.path.exists(API_USAGE_BUFFER_FILE):
+        return
+    with _usage_buffer_lock:
+        if _usage_buffer_flusher is not None and _usage_buffer_flusher.is_alive():
+            return
+        try:
+            pending = _usage_buffer_connection().execute('SELECT COUNT(*) FROM usage_events').fetchone()[0]
+            if pending:
+                print(f"♻️ Replaying {pending} buffered api_usage writes from {API_USAGE_BUFFER_FILE}")
+        except sqlite3.Error as e:
+            print(f"⚠️ Could not open api_usage buffer {API_USAGE_BUFFER_FILE}: {e}")
+            return
+        _usage_buffer_flusher = threading.Thread(target=_flush_usage_buffer_forever, daemon=True)
+        _usage_buffer_flusher.start()
+
+def get_usage_buffer_stats():
+    """Buffer and dead-letter depth (shared by all workers) and this process's buffering and flush metrics"""
+    stats = {key: value for key, value in _usage_buffer_stats.items()
+             if key not in ('buffer_seconds', 'unflushed_since_wakeup')}
+    stats['enabled'] = API_USAGE_WRITE_BEHIND
+    stats['avg_buffer_us'] = (round(_usage_buffer_stats['buffer_seconds'] * 1e6 / _usage_buffer_stats['buffered'], 1)
+                              if _usage_buffer_stats['buffered'] else None)
+    try:
+        conn = _usage_buffer_connection()
+        depth, oldest = conn.execute('SELECT COUNT(*), MIN(buffered_at) FROM usage_events').fetchone()
+        stats['depth'] = depth
+        stats['oldest_age_seconds'] = round(time.time() - oldest, 3) if oldest else 0
+        stats['dead_letter_depth'] = conn.execute('SELECT COUNT(*) FROM usage_dead_letters').fetchone()[0]
+    except sqlite3.Error as e:
+        stats['error'] = str(e)
+    return stats
+
+# ============================================================================
+# Async Orders
+# With `Prefer: respond-async` (or ?async=1) /api/user/order validates the
+# request, stores it as an order intent and answers 202. A worker pool places
+# the Airalo order and completes the same orders/{id} document, so slow
+# upstream responses hold pool threads instead of gunicorn workers. Clients
+# poll /api/orders/<id>/status, paced by its Retry-After header. An intent
+# whose worker died mid-order is moved to 'unknown' after
+# ORDER_PROCESSING_LEASE rather than placed again, since Airalo may already
+# have accepted it.
+# ============================================================================
+
+ORDER_WORKER_CONCURRENCY = int(os.getenv('ORDER_WORKER_CONCURRENCY', 8))
+ORDER_INTENT_RECOVERY_INTERVAL = 60  # Seconds between scans for intents left queued
+ORDER_INTENT_RECOVERY_AFTER = int(os.getenv('ORDER_INTENT_RECOVERY_AFTER', 300))  # Seconds queued before another process takes over
+ORDER_PROCESSING_LEASE = int(os.getenv('ORDER_PROCESSING_LEASE', 900))  # Seconds processing before an intent is given up as 'unknown'
+ORDER_STATUS_RETRY_AFTER = 2  # Seconds clients should wait between status polls
+ORDER_PENDING_STATES = ('queued', 'processing')
+ORDER_UNSETTLED_STATES = ('failed', 'unknown')  # Terminal states other than completed
+
+_order_pool = ThreadPoolExecutor(max_workers=ORDER_WORKER_CONCURRENCY, thread_name_prefix='order')
+_order_intent_recovery = None
+
+def wants_async_order():
+    prefer = request.headers.get('Prefer', '')
+    return 'respond-async' in prefer or request.args.get('async', '').lower() in ('1', 'true', 'yes')
+
+def submit_order_intent(order_request):
+    """Persist an order intent, queue it and answer 202 Accepted"""
+    order_ref = db.collection('orders').document()
+    order_ref.set({
+        'userId': order_request['user']['uid'],
+        'userEmail': order_request['user']['email'],
+        'businessOwnerId': order_request['business_owner']['uid'],
+        'packageId': order_request['package_id'],
+        'quantity': order_request['quantity'],
+        'status': 'queued',
+        'intent': order_request,
+        'asyncOrder': True,
+        'queuedAt': firestore.SERVER_TIMESTAMP,
+        'createdAt': firestore.SERVER_TIMESTAMP,
+        'mode': 'production',
+        'isTestMode': False
+    })
+    _order_pool.submit(run_order_intent, order_ref.id)
+    print(f"📥 Order intent {order_ref.id} queued for {order_request['user']['email']} ({order_request['package_id']})")
+    
+    status_url = f"/api/orders/{order_ref.id}/status"
+    response = jsonify({
+        'success': True,
+        'orderId': order_ref.id,
+        'status': 'queued',
+        'statusUrl': status_url,
+        'isTestMode': False
+    })
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    response.headers['Retry-After'] = str(ORDER_STATUS_RETRY_AFTER)
+    response.headers['Preference-Applied'] = 'respond-async'
+    return response
+
+@firestore.transactional
+def _claim_order_intent(transaction, order_ref):
+    """Move a queued intent to processing; returns its request, or None if it isn't queued"""
+    snapshot = order_ref.get(transaction=transaction)
+    data = snapshot.to_dict() if snapshot.exists else None
+    if not data or data.get('status') != 'queued':
+        return None
+    transaction.update(order_ref, {'status': 'processing', 'processingAt': firestore.SERVER_TIMESTAMP})
+    return data.get('intent')
+
+@firestore.transactional
+def _expire_order_intent(transaction, order_ref, cutoff):
+    """Move an intent stuck in processing since before cutoff to 'unknown'; True if it did"""
+    snapshot = order_ref.get(transaction=transaction)
+    data = snapshot.to_dict() if snapshot.exists else None
+    if not data or data.get('status') != 'processing':
+        return False
+    processing_at = data.get('processingAt')
+    if not processing_at or processing_at >= cutoff:
+        return False
+    transaction.update(order_ref, {
+        'status': 'unknown',
+        'error': 'The order worker stopped while placing this order; it may or may not have been placed',
+        'expiredAt': firestore.SERVER_TIMESTAMP
+    })
+    return True
+
+def run_order_intent(order_id):
+    """Pool task: place a queued order unless another worker already claimed it"""
+    order_ref = db.collection('orders').document(order_id)
+    try:
+        order_request = _claim_order_intent(db.transaction(), order_ref)
+    except Exception as e:
+        print(f"⚠️ Could not claim order intent {order_id}: {e}")
+        return
+    if order_request is None:
+        return
+    
+    try:
+        payload, status_code = place_user_order(order_request, order_ref)
+    except Exception as e:
+        print(f"❌ Error placing queued order {order_id}: {e}")
+        payload = {'success': False, 'error': str(e)}
+    if not payload.get('success'):
+        update = {'error': payload.get('error'), 'failedAt': firestore.SERVER_TIMESTAMP}
+        # Once Airalo accepted the order it stands, even if recording it failed afterwards
+        if payload.get('airaloOrderId'):
+            update.update({'status': 'unknown', 'airaloOrderId': payload['airaloOrderId']})
+        elif not (order_ref.get().to_dict() or {}).get('airaloOrderId'):
+            update['status'] = 'failed'
+        order_ref.set(update, merge=True)
+
+def _recover_order_intents_forever():
+    """Requeue intents whose process went away before placing them; give up on ones it died placing"""
+    while True:
+        time.sleep(ORDER_INTENT_RECOVERY_INTERVAL)
+        try:
+            cutoff = datetime.now(timezone.utc) - timedelta(seconds=ORDER_INTENT_RECOVERY_AFTER)
+            for doc in db.collection('orders').where('status', '==', 'queued').limit(100).stream():
+                queued_at = (doc.to_dict() or {}).get('queuedAt')
+                if queued_at and queued_at < cutoff:
+                    print(f"♻️ Recovering order intent {doc.id}")
+                    _order_pool.submit(run_order_intent, doc.id)
+            
+            # Never resubmitted: Airalo may have accepted the order before the worker died
+            lease_cutoff = datetime.now(timezone.utc) - timedelta(seconds=ORDER_PROCESSING_LEASE)
+            for doc in db.collection('orders').where('status', '==', 'processing').limit(100).stream():
+                processing_at = (doc.to_dict() or {}).get('processingAt')
+                if processing_at and processing_at < lease_cutoff:
+                    if _expire_order_intent(db.transaction(), doc.reference, lease_cutoff):
+                        print(f"⚠️ Order intent {doc.id} stuck in processing, marked unknown")
+        except Exception as e:
+            print(f"⚠️ Order intent recovery failed: {e}")
+
+def start_order_intent_recovery():
+    global _order_intent_recovery
+    if _order_intent_recovery is not None:
+        return
+    _order_intent_recovery = threading.Thread(target=_recover_order_intents_forever, daemon=True)
+    _order_intent_recovery.start()
+
+def order_requester_ids():
+    """Uids this request authenticates as (API key owner and/or Firebase user)"""
+    ids = set()
+    api_key = request.headers.get('X-API-Key', '')
+    auth_header = request.headers.get('Authorization', '')
+    bearer = auth_header[7:] if auth_header.startswith('Bearer ') else ''
+    if api_key:
+        owner = authenticate_api_key(api_key)
+        if owner:
+            ids.add(owner['uid'])
+    if bearer:
+        owner = authenticate_api_key(bearer)
+        if owner:
+            ids.add(owner['uid'])
+        else:
+            user = authenticate_firebase_token(bearer)
+            if user:
+                ids.add(user['uid'])
+    return ids
+
+def order_status_payload(order_id, order_data):
+    """Status response for an order (async or not)"""
+    status = order_data.get('status', 'pending')
+    payload = {
+        'success': True,
+        'orderId': order_id,
+        'status': status if status in ORDER_PENDING_STATES or status in ORDER_UNSETTLED_STATES else 'completed',
+        'orderStatus': status,
+        'isTestMode': order_data.get('isTestMode', False)
+    }
+    if order_data.get('airaloOrderId'):
+        payload['airaloOrderId'] = order_data['airaloOrderId']
+        payload['orderData'] = order_data.get('orderData', {})
+    if status in ORDER_UNSETTLED_STATES:
+        payload['error'] = order_data.get('error')
+    return payload
+
+def _load_requested_order(order_id):
+    """(order data, None) for an order the caller may see, else (None, error response)"""
+    requester_ids = order_requester_ids()
+    if not requester_ids:
+        return None, (jsonify({'success': False, 'error': 'Unauthorized'}), 401)
+    snapshot = db.collection('orders').document(order_id).get()
+    order_data = snapshot.to_dict() if snapshot.exists else None
+    if not order_data or not requester_ids & {order_data.get('userId'), order_data.get('businessOwnerId')}:
+        return None, (jsonify({'success': False, 'error': 'Order not found'}), 404)
+    return order_data, None
+
+@app.route('/api/orders/<order_id>/status', methods=['GET'])
+def get_order_status(order_id):
+    """Status of an order; async orders report queued/processing until placed"""
+    try:
+        order_data, error = _load_requested_order(order_id)
+        if error:
+            return error
+        payload = order_status_payload(order_id, order_data)
+        response = jsonify(payload)
+        if payload['status'] in ORDER_PENDING_STATES:
+            response.headers['Retry-After'] = str(ORDER_STATUS_RETRY_AFTER)
+        return response
+    except Exception as e:
+        print(f"❌ Error fetching order status: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# ============================================================================
+# Regular User Endpoints (for esim-main frontend)
+# These endpoints authenticate via Firebase ID token and use server's Airalo credentials
+# ============================================================================
+
+def submit_airalo_order(order_request, token):
+    """POST an order to Airalo /v2/orders; returns (Airalo order data, None) or (None, error message)"""
+    # Prepare form data for Airalo API
+    form_data = {
+        'quantity': order_request['quantity'],
+        'package_id': order_request['package_id'],
+        'type': 'sim',
+        'description': order_request['description'],
+        'to_email': order_request['to_email'],
+        'sharing_option[]': ['link']
+    }
+    
+    print(f"📦 Sending order to Airalo API")
+    
+    # Create order with Airalo
+    headers = {
+        'Authorization': f'Bearer {token}',
+        'Accept': 'application/json'
+    }
+    
+    response = upstream_request('airalo', 'POST',
+        f"{AIRALO_BASE_URL}/v2/orders",
+        headers=headers,
+        data=form_data
+    )
+    
+    if not response.ok:
+        error_text = response.text
+        print(f"❌ Airalo order error: {error_text}")
+        return None, f'Failed to create order: {response.status_code}'
+    
+    return response.json().get('data', {}), None
+
+def user_order_documents(order_request, airalo_order, order_id):
+    """orders and api_usage documents for an order Airalo accepted"""
+    user = order_request['user']
+    business_owner = order_request['business_owner']
+    package_id = order_request['package_id']
+    quantity = order_request['quantity']
+    airalo_order_id = airalo_order.get('id')
+    
+    order_data = {
+        'userId': user['uid'],
+        'userEmail': user['email'],
+        'airaloOrderId': airalo_order_id,
+        'packageId': package_id,
+        'quantity': quantity,
+        'status': 'pending',
+        'orderData': airalo_order,
+        'createdAt': firestore.SERVER_TIMESTAMP,
+        'mode': 'production',
+        'isTestMode': False
+    }
+    
+    # LOG TO api_usage FOR BUSINESS DASHBOARD
+    api_usage_data = {
+        'customerId': user['uid'],  # The customer who purchased
+        'customerEmail': user['email'],
+        'userId': business_owner['uid'],  # Business owner (for filtering orders in dashboard)
+        'userEmail': business_owner['email'],  # Business owner email
+        'businessOwnerId': business_owner['uid'],  # The business owner who should get paid
+        'businessOwnerEmail': business_owner['email'],
+        'endpoint': order_request.get('endpoint', '/api/user/order'),
+        'method': 'POST',
+        'mode': 'production',
+        'packageId': package_id,
+        'packageName': package_id,
+        'orderId': order_id,
+        'airaloOrderId': airalo_order_id,
+        'amount': airalo_order.get('price', 0),
+        'status': 'pending',
+        'isTestOrder': False,
+        'testModeLabel': None,
+        'createdAt': firestore.SERVER_TIMESTAMP,
+        'metadata': {
+            'quantity': quantity,
+            'iccid': airalo_order.get('sims', [{}])[0].get('iccid') if airalo_order.get('sims') else None,
+            'hasBusinessOwner': True
+        }
+    }
+    return order_data, api_usage_data
+
+def place_user_order(order_request, order_ref=None):
+    """Place a validated /api/user/order request with Airalo and record it; returns (payload, status code)"""
+    user = order_request['user']
+    business_owner = order_request['business_owner']
+    
+    print(f"")
+    print(f"{'='*80}")
+    print(f"💳 PRODUCTION - Creating REAL Airalo order")
+    print(f"{'='*80}")
+    print(f"  User: {user['email']} ({user['uid']})")
+    print(f"  Package: {order_request['package_id']}")
+    print(f"  Quantity: {order_request['quantity']}")
+    print(f"{'='*80}")
+    print(f"")
+    
+    # Get Airalo token using server's credentials
+    token = get_airalo_token()
+    if not token:
+        return {'success': False, 'error': 'Failed to authenticate with Airalo'}, 500
+    
+    airalo_order, error = submit_airalo_order(order_request, token)
+    if error:
+        return {'success': False, 'error': error}, 500
+    idempotent_side_effect_committed()
+    
+    print(f"✅ REAL order created successfully: {airalo_order.get('id')}")
+    
+    # Save the order, its ICCID index and api_usage (GLOBAL COLLECTION ONLY) in one batch
+    if order_ref is None:
+        order_ref = db.collection('orders').document()
+    order_id = order_ref.id
+    order_data, api_usage_data = user_order_documents(order_request, airalo_order, order_id)
+    try:
+        commit_order_side_effects(order_ref, order_data, api_usage_data)
+    except Exception as e:
+        print(f"❌ Order {airalo_order.get('id')} placed with Airalo but not recorded: {e}")
+        return {
+            'success': False,
+            'error': f'Order placed with Airalo but could not be recorded: {e}',
+            'airaloOrderId': airalo_order.get('id'),
+            'recorded': False
+        }, 500
+    print(f"✅ Logged to global api_usage collection (PRODUCTION)")
+    print(f"   Customer: {user['email']} ({user['uid']})")
+    print(f"   Business Owner: {business_owner['email'] if business_owner else 'NOT SET'} ({business_owner['uid'] if business_owner else 'N/A'})")
+    
+    return {
+        'success': True,
+        'orderId': order_id,
+        'airaloOrderId': airalo_order.get('id'),
+        'orderData': airalo_order,
+        'isTestMode': False
+    }, 200
+
+def authenticate_order_caller():
+    """(business owner, Firebase user or None, None), or (None, None, error response) for order endpoints"""
+    # Authenticate via API key (required for API access)
+    # Priority: X-API-Key header first, then Authorization Bearer header
+    api_key = request.headers.get('X-API-Key', '')
+    auth_header = request.headers.get('Authorization', '')
+    
+    # If no API key in X-API-Key header, check Authorization Bearer header
+    business_owner = None
+    if not api_key and auth_header.startswith('Bearer '):
+        potential_key = auth_header[7:]
+        # Try to authenticate as API key first
+        business_owner = authenticate_api_key(potential_key)
+        if business_owner:
+            api_key = potential_key
+        else:
+            # Not an API key, might be Firebase token (will handle later)
+            pass
+    
+    if not api_key:
+        return None, None, (jsonify({'success': False, 'error': 'API key is required'}), 401)
+    
+    # Authenticate API key (business owner)
+    if not business_owner:
+        business_owner = authenticate_api_key(api_key)
+    if not business_owner:
+        return None, None, (jsonify({'success': False, 'error': 'Invalid or unverified API key'}), 401)
+    
+    print(f"🔑 API Key owner identified: {business_owner['email']} ({business_owner['uid']})")
+    
+    # Try to authenticate user via Firebase token (optional)
+    # Only if Authorization header contains a Firebase token (not the API key we already used)
+    user = None
+    if auth_header.startswith('Bearer '):
+        id_token = auth_header[7:]
+        # Only try Firebase auth if it's not the API key we already used
+        if id_token != api_key:
+            user = authenticate_firebase_token(id_token)
+    return business_owner, user, None
+
+def email_order_user(to_email):
+    """User object for orders placed for an email address rather than a Firebase user"""
+    return {
+        'uid': f'email_{to_email.replace("@", "_").replace(".", "_")}',
+        'email': to_email,
+        'type': 'email_user'
+    }
+
+def check_order_eligibility(business_owner):
+    """Error response when the business owner may not order (KYC or balance), else None"""
+    # Check KYC status (from the cached business identity)
+    kyc_status = business_owner.get('kycStatus', 'pending')
+    
+    if kyc_status != 'approved':
+        return jsonify({
+            'success': False, 
+            'error': 'KYC verification required',
+            'kycStatus': kyc_status,
+            'message': 'Please complete KYC verification to use the production API'
+        }), 403
+    
+    print(f"✅ KYC verified for {business_owner['email']}")
+    
+    # Check balance (sharded accounts keep most of it in balance_shards)
+    current_balance = business_owner.get('balance', 0)
+    if business_owner.get('balanceShards'):
+        current_balance = get_business_balance(business_owner['uid'], business_owner['balanceShards'])
+    if current_balance <= 0:
+        return jsonify({
+            'success': False,
+            'error': 'Insufficient balance',
+            'balance': current_balance,
+            'message': 'Please add funds to your account to create orders'
+        }), 402
+    
+    print(f"✅ Balance check passed: ${current_balance}")
+    return None
+
+@app.route('/api/user/order', methods=['POST'])
+@idempotent
+def create_user_order():
+    """Create REAL eSIM order (production only - makes real Airalo API call)"""
+    try:
+        # Get request data first to extract email
+        data = request.get_json()
+        to_email = data.get('to_email') if data else None
+        
+        business_owner, user, error = authenticate_order_caller()
+        if error:
+            return error
+        
+        # If no Firebase user, create user object from email
+        if not user:
+            if not to_email:
+                return jsonify({'success': False, 'error': 'to_email is required when Firebase token is not provided'}), 400
+            user = email_order_user(to_email)
+            print(f"📧 Using email-based user: {user['email']} ({user['uid']})")
+        
+        error = check_order_eligibility(business_owner)
+        if error:
+            return error
+        
+        # Get request data (already retrieved above)
+        package_id = data.get('package_id')
+        quantity = data.get('quantity', '1')
+        to_email = data.get('to_email', user.get('email') if user else None)
+        description = data.get('description', f"eSIM order for {to_email}")
+        
+        if not to_email:
+            return jsonify({'success': False, 'error': 'to_email is required'}), 400
+        
+        if not package_id:
+            return jsonify({'success': False, 'error': 'package_id is required'}), 400
+        
+        order_request = {
+            'user': {'uid': user['uid'], 'email': user['email']},
+            'business_owner': {'uid': business_owner['uid'], 'email': business_owner['email']},
+            'package_id': package_id,
+            'quantity': quantity,
+            'to_email': to_email,
+            'description': description,
+        }
+        if wants_async_order():
+            return submit_order_intent(order_request)
+        
+        payload, status_code = place_user_order(order_request)
+        return jsonify(payload), status_code
+        
+    except Exception as e:
+        print(f"❌ Error creating user order: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# Batch orders authenticate and check KYC/balance once for up to
+# ORDER_BATCH_MAX_LINES lines. Airalo orders run ORDER_BATCH_CONCURRENCY at a
+# time; the orders, iccid_index and api_usage documents of the lines Airalo
+# accepted are committed together, a whole line per batch. The batch is priced
+# and checked against a fresh balance read before any line is placed.
+ORDER_BATCH_MAX_LINES = int(os.getenv('ORDER_BATCH_MAX_LINES', 50))
+ORDER_BATCH_CONCURRENCY = int(os.getenv('ORDER_BATCH_CONCURRENCY', 5))
+ORDER_BATCH_COMMIT_ATTEMPTS = 2
+
+def _submit_batch_line(order_request, token):
+    """Pool task for one batch line: (Airalo order data, None) or (None, error message)"""
+    try:
+        return submit_airalo_order(order_request, token)
+    except Exception as e:
+        print(f"❌ Airalo order error: {e}")
+        return None, str(e)
+
+def record_batch_orders(order_requests, placed, results):
+    """Write the documents of placed batch lines in grouped commits, filling in their results"""
+    groups = []
+    group, group_writes = [], 0
+    for index, airalo_order in placed.items():
+        order_ref = db.collection('orders').document()
+        order_data, api_usage_data = user_order_documents(order_requests[index], airalo_order, order_ref.id)
+        writes = 1 + len(order_iccids(order_data)) + (0 if API_USAGE_WRITE_BEHIND else 1)
+        if group and group_writes + writes > BULK_WRITE_BATCH_SIZE:
+            groups.append(group)
+            group, group_writes = [], 0
+        group.append((index, order_ref, order_data, api_usage_data))
+        group_writes += writes
+        results[index] = {
+            'index': index,
+            'success': True,
+            'orderId': order_ref.id,
+            'airaloOrderId': airalo_order.get('id'),
+            'orderData': airalo_order
+        }
+    if group:
+        groups.append(group)
+    
+    for group in groups:
+        error = None
+        usage_writes = [(db.collection('api_usage').document(), api_usage_data) for *_, api_usage_data in group]
+        for attempt in range(ORDER_BATCH_COMMIT_ATTEMPTS):
+            batch = db.batch()
+            for index, order_ref, order_data, _ in group:
+                batch.set(order_ref, order_data)
+                index_order_iccids(order_ref, order_data, batch=batch)
+            if not API_USAGE_WRITE_BEHIND:
+                for usage_ref, api_usage_data in usage_writes:
+                    batch.set(usage_ref, api_usage_data)
+            try:
+                batch.commit()
+                error = None
+                break
+            except Exception as e:
+                error = e
+                print(f"⚠️ Batch order commit failed (attempt {attempt + 1}): {e}")
+        if error is None:
+            if API_USAGE_WRITE_BEHIND:
+                buffer_usage_writes(usage_writes)
+            continue
+        
+        # Record the group's lines one at a time, so one bad line can't leave the others unrecorded
+        for (index, order_ref, order_data, _), usage_write in zip(group, usage_writes):
+            try:
+                _record_order_alone(order_ref, order_data, [usage_write], error)
+            except Exception as line_error:
+                results[index]['success'] = False
+                results[index]['recorded'] = False
+                results[index]['error'] = f'Order placed with Airalo but could not be recorded: {line_error}'
+    recorded = sum(1 for index in placed if results[index].get('recorded', True))
+    print(f"✅ Recorded {recorded}/{len(placed)} batch orders in {len(groups)} commit(s)")
+
+def check_batch_balance(business_owner, order_requests, results):
+    """Price every line up front (dropping unknown packages); error response if a fresh balance can't cover them, else None"""
+    package_refs = [db.collection('dataplans').document(package_id)
+                    for package_id in {order_request['package_id'] for order_request in order_requests.values()}]
+    prices = {}
+    for snapshot in db.get_all(package_refs):
+        if snapshot.exists:
+            plan = snapshot.to_dict() or {}
+            # original_price is what Airalo charges (and what api_usage records)
+            prices[snapshot.id] = float(plan.get('original_price') or plan.get('price') or 0)
+    
+    total = 0.0
+    for index, order_request in list(order_requests.items()):
+        price = prices.get(order_request['package_id'])
+        if price is None:
+            results[index] = {'index': index, 'success': False, 'error': 'Unknown package_id'}
+            del order_requests[index]
+            continue
+        total += price * int(order_request['quantity'])
+    
+    balance = get_business_balance(business_owner['uid'], business_owner.get('balanceShards', 0))
+    if total > balance:
+        return jsonify({
+            'success': False,
+            'error': 'Insufficient balance',
+            'balance': balance,
+            'required': round(total, 2),
+            'message': 'The balance does not cover every order in this batch'
+        }), 402
+    return None
+
+@app.route('/api/user/orders:batch', methods=['POST'])
+@idempotent
+def create_user_orders_batch():
+    """Create several REAL eSIM orders in one request; lines succeed or fail individually"""
+    try:
+        data = request.get_json() or {}
+        lines = data.get('orders')
+        if not isinstance(lines, list) or not lines:
+            return jsonify({'success': False, 'error': 'orders must be a non-empty list'}), 400
+        if len(lines) > ORDER_BATCH_MAX_LINES:
+            return jsonify({'success': False, 'error': f'At most {ORDER_BATCH_MAX_LINES} orders per batch'}), 400
+        
+        business_owner, user, error = authenticate_order_caller()
+        if error:
+            return error
+        error = check_order_eligibility(business_owner)
+        if error:
+            return error
+        
+        results = [None] * len(lines)
+        order_requests = {}
+        for index, line in enumerate(lines):
+            if not isinstance(line, dict) or not line.get('package_id'):
+                results[index] = {'index': index, 'success': False, 'error': 'package_id is required'}
+                continue
+            if not str(line.get('quantity', '1')).isdigit() or int(line.get('quantity', '1')) < 1:
+                results[index] = {'index': index, 'success': False, 'error': 'quantity must be a positive integer'}
+                continue
+            to_email = line.get('to_email') or (user['email'] if user else None)
+            if not to_email:
+                results[index] = {'index': index, 'success': False,
+                                  'error': 'to_email is required when Firebase token is not provided'}
+                continue
+            line_user = user or email_order_user(to_email)
+            order_requests[index] = {
+                'user': {'uid': line_user['uid'], 'email': line_user['email']},
+                'business_owner': {'uid': business_owner['uid'], 'email': business_owner['email']},
+                'package_id': line['package_id'],
+                'quantity': line.get('quantity', '1'),
+                'to_email': to_email,
+                'description': line.get('description', f"eSIM order for {to_email}"),
+                'endpoint': '/api/user/orders:batch',
+            }
+        
+        # One balance check for the whole batch, before any line reaches Airalo
+        if order_requests:
+            error = check_batch_balance(business_owner, order_requests, results)
+            if error:
+                return error
+        
+        print(f"💳 PRODUCTION - Creating {len(order_requests)} REAL Airalo orders for {business_owner['email']} (batch)")
+        
+        if order_requests:
+            # Get Airalo token using server's credentials
+            token = get_airalo_token()
+            if not token:
+                return jsonify({'success': False, 'error': 'Failed to authenticate with Airalo'}), 500
+            
+            workers = min(ORDER_BATCH_CONCURRENCY, len(order_requests))
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='order-batch') as pool:
+                futures = {index: pool.submit(_submit_batch_line, order_request, token)
+                           for index, order_request in order_requests.items()}
+            
+            placed = {}
+            for index, future in futures.items():
+                airalo_order, error = future.result()
+                if error:
+                    results[index] = {'index': index, 'success': False, 'error': error}
+                else:
+                    placed[index] = airalo_order
+            if placed:
+                idempotent_side_effect_committed()
+                record_batch_orders(order_requests, placed, results)
+        
+        placed_count = sum(1 for result in results if result['success'])
+        unrecorded_count = sum(1 for result in results if result.get('recorded') is False)
+        failed_count = len(lines) - placed_count - unrecorded_count
+        print(f"✅ Batch complete: {placed_count} placed, {unrecorded_count} unrecorded, {failed_count} failed")
+        return jsonify({
+            'success': placed_count == len(lines),
+            'placed': placed_count,
+            'unrecorded': unrecorded_count,
+            'failed': failed_count,
+            'results': results,
+            'isTestMode': False
+        })
+        
+    except Exception as e:
+        print(f"❌ Error creating batch orders: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/user/qr-code', methods=['POST'])
+def get_user_qr_code():
+    """Get QR code for regular user's order"""
+    try:
+        # Authenticate user via Firebase ID token
+        auth_header = request.headers.get('Authorization', '')
+        if not auth_header.startswith('Bearer '):
+            return jsonify({'success': False, 'error': 'Missing or invalid authorization header'}), 401
+        
+        id_token = auth_header[7:]
+        user = authenticate_firebase_token(id_token)
         
         if not user:
             return jsonify({'success': False, 'error': 'Unauthorized'}), 401
@@ -733,7 +2269,7 @@ def get_user_qr_code():
         
         # Get order details from Airalo
         print(f"📱 Fetching order details from Airalo")
-        order_response = requests.get(
+        order_response = upstream_request('airalo', 'GET',
             f"{AIRALO_BASE_URL}/v2/orders/{airalo_order_id}",
             headers=headers
         )
@@ -766,7 +2302,7 @@ def get_user_qr_code():
         print(f"📱 Fetching SIM details for ICCID: {sim_iccid}")
         
         # Get SIM details
-        sim_response = requests.get(
+        sim_response = upstream_request('airalo', 'GET',
             f"{AIRALO_BASE_URL}/v2/sims/{sim_iccid}",
             headers=headers
         )
@@ -809,6 +2345,11 @@ def get_user_qr_code():
         
         order_ref.update(qr_data)
         
+        try:
+            index_order_iccids(order_ref, {**order_data, **qr_data})
+        except Exception as index_error:
+            print(f"⚠️ Could not index ICCID {sim_iccid}: {index_error}")
+        
         print(f"✅ QR code retrieved and saved successfully")
         
         return jsonify({
@@ -898,7 +2439,7 @@ def get_user_sim_details():
         }
         
         # Get SIM details from Airalo
-        response = requests.get(
+        response = upstream_request('airalo', 'GET',
             f"{AIRALO_BASE_URL}/v2/sims/{iccid}",
             headers=headers
         )
@@ -996,7 +2537,7 @@ def get_user_sim_usage():
         }
         
         # Get usage data from Airalo
-        response = requests.get(
+        response = upstream_request('airalo', 'GET',
             f"{AIRALO_BASE_URL}/v2/sims/{iccid}/usage",
             headers=headers
         )
@@ -1012,263 +2553,1411 @@ def get_user_sim_usage():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 # ============================================================================
-# PUBLIC Endpoints (no authentication required)
-# These endpoints are for the public-facing frontend
+# Public Catalog Snapshot
+# dataplans, topups and countries are held in memory as ready-to-serve dicts
+# with inverted indexes, kept current by Firestore snapshot listeners
 # ============================================================================
 
-@app.route('/api/public/countries', methods=['GET'])
-def get_public_countries():
-    """Get available countries - PUBLIC endpoint (no auth required)"""
-    try:
-        print(f"🌍 PUBLIC: Fetching countries from Firebase")
-        
-        countries_ref = db.collection('countries')
-        countries_docs = countries_ref.stream()
-        
-        countries = []
-        for doc in countries_docs:
-            country_data = doc.to_dict()
-            
-            # Format country data for API response
-            country = {
-                'id': doc.id,
-                'name': country_data.get('name'),
-                'code': country_data.get('code'),
-                'flag': country_data.get('flag'),
-                'flagEmoji': country_data.get('flagEmoji'),
-                'region': country_data.get('region'),
-                'continent': country_data.get('continent')
-            }
-            countries.append(country)
-        
-        print(f"✅ Found {len(countries)} countries")
-        
-        return jsonify({
-            'success': True,
-            'data': {
-                'countries': countries,
-                'count': len(countries)
-            }
-        })
-        
-    except Exception as e:
-        print(f"❌ Error fetching countries: {e}")
-        return jsonify({'success': False, 'error': f'Failed to fetch countries: {str(e)}'}), 500
+_VALIDITY_NAME_RE = re.compile(r'(\d+)\s*Days?')
+_VALIDITY_SLUG_RE = re.compile(r'(\d+)days?')
 
-@app.route('/api/public/plans', methods=['GET'])
-def get_public_plans():
-    """Get all plans - PUBLIC endpoint (no auth required)"""
-    try:
-        print(f"📦 PUBLIC: Fetching plans from Firebase")
-        
-        plans_ref = db.collection('dataplans')
-        
-        # Get optional filters from query params
-        country_code = request.args.get('country')
-        plan_type_filter = request.args.get('type')  # global, regional, other
-        limit = request.args.get('limit', type=int)
-        
-        # Add default limit to prevent memory issues
-        if not limit:
-            limit = 1000  # Default limit to prevent memory overload
-        
-        # Apply filters if provided
-        if country_code:
-            plans_ref = plans_ref.where('country_codes', 'array_contains', country_code)
-        
-        # Apply limit to Firestore query to reduce memory usage
-        plans_ref = plans_ref.limit(limit + 100)  # Add buffer for filtering
-        
-        # Fetch plans
-        plans_docs = plans_ref.stream()
-        
-        plans = []
-        for doc in plans_docs:
-            plan_data = doc.to_dict()
-            
-            # Only include enabled plans
-            if plan_data.get('enabled', True) == False:
-                continue
-            
-            # Extract validity from plan name/slug if not available in validity field
-            validity = plan_data.get('validity')
-            if not validity:
-                # Try to extract from name like "1 GB - 7 Days" or slug like "plan-7days-1gb"
-                name = plan_data.get('name', '')
-                slug = plan_data.get('slug', '')
-                
-                # Look for patterns like "7 Days", "30 Days", etc. in name
-                import re
-                name_match = re.search(r'(\d+)\s*Days?', name)
-                if name_match:
-                    validity = int(name_match.group(1))
-                else:
-                    # Look for patterns like "7days", "30days" in slug
-                    slug_match = re.search(r'(\d+)days?', slug)
-                    if slug_match:
-                        validity = int(slug_match.group(1))
-            
-            # Format plan data for API response
-            # Get data capacity from 'data' field or 'capacity' field
-            data_value = plan_data.get('data') or plan_data.get('capacity')
-            
-            # Categorize the plan (global, regional, or other)
-            category = categorize_plan(plan_data)
-            
-            plan = {
-                'id': doc.id,
-                'slug': plan_data.get('slug'),
-                'name': plan_data.get('name'),
-                'title': plan_data.get('title', plan_data.get('name')),
-                'price': float(plan_data.get('price', 0)),
-                'data': data_value,  # Original field
-                'capacity': data_value,  # Alias for mobile app compatibility
-                'validity': validity,
-                'validity_unit': plan_data.get('validity_unit', 'days'),
-                'period': validity,  # Alias for mobile app compatibility (validity days)
-                'countries': plan_data.get('country_codes', []),
-                'country_codes': plan_data.get('country_codes', []),
-                'country_ids': plan_data.get('country_ids', []),
-                'operator': plan_data.get('operator', {}).get('title') if isinstance(plan_data.get('operator'), dict) else plan_data.get('operator'),
-                'type': category,  # Use categorized type (global, regional, other) for frontend filtering
-                'planType': plan_data.get('type', 'data'),  # MongoDB field - use original type (data, voice, sms, unlimited)
-                'is_unlimited': plan_data.get('is_unlimited', False),
-                'day': plan_data.get('day'),
-                'amount': plan_data.get('amount'),
-                'enabled': plan_data.get('enabled', True)
+CATALOG_COLLECTIONS = {'plans': 'dataplans', 'topups': 'topups', 'countries': 'countries'}
+
+_catalog_lock = threading.Lock()
+_catalog = {
+    kind: {
+        'entries': {},  # doc id -> formatted response dict
+        'by_country': {},  # country code -> set of doc ids
+        'by_category': {},  # global / regional / other -> set of doc ids
+        'by_plan_type': {},  # planType -> set of doc ids
+        'order': None,  # sorted doc ids, rebuilt lazily after changes
+        'version': 0,
+        'ready': False,
+        'live': False,  # True once the listener has delivered the whole collection
+    }
+    for kind in CATALOG_COLLECTIONS
+}
+_catalog_listeners = {}
+
+def _parse_validity(plan_data):
+    """Validity in days, falling back to the plan name/slug ("7 Days", "plan-7days-1gb")"""
+    validity = plan_data.get('validity')
+    if not validity:
+        name_match = _VALIDITY_NAME_RE.search(plan_data.get('name', '') or '')
+        if name_match:
+            validity = int(name_match.group(1))
+        else:
+            slug_match = _VALIDITY_SLUG_RE.search(plan_data.get('slug', '') or '')
+            if slug_match:
+                validity = int(slug_match.group(1))
+    return validity
+
+# Display fields derived from a plan's stored fields. Syncs store them on every
+# document, so formatting a plan for the public endpoints parses nothing;
+# documents synced before this (or under older derivation rules) are derived
+# on the fly until the next sync rewrites them.
+CATALOG_DERIVED_VERSION = 1
+CATALOG_DERIVED_FIELDS = ('category', 'validity_days', 'operator_title', 'capacity_value')
+
+def derive_catalog_fields(plan_data):
+    """Derived display fields for a dataplans/topups document"""
+    operator = plan_data.get('operator')
+    return {
+        'category': categorize_plan(plan_data),
+        'validity_days': _parse_validity(plan_data),
+        'operator_title': operator.get('title') if isinstance(operator, dict) else operator,
+        'capacity_value': plan_data.get('data') or plan_data.get('capacity'),
+        'derived_version': CATALOG_DERIVED_VERSION,
+    }
+
+def catalog_derived_fields(plan_data):
+    """The stored derived fields when they are current, otherwise freshly derived ones"""
+    if plan_data.get('derived_version') == CATALOG_DERIVED_VERSION:
+        return plan_data
+    return derive_catalog_fields(plan_data)
+
+def _format_public_plan(doc_id, plan_data):
+    """Format a dataplans document for /api/public/plans"""
+    derived = catalog_derived_fields(plan_data)
+    data_value = derived.get('capacity_value')
+    validity = derived.get('validity_days')
+    
+    return {
+        'id': doc_id,
+        'slug': plan_data.get('slug'),
+        'name': plan_data.get('name'),
+        'title': plan_data.get('title', plan_data.get('name')),
+        'price': float(plan_data.get('price', 0)),
+        'data': data_value,  # Original field
+        'capacity': data_value,  # Alias for mobile app compatibility
+        'validity': validity,
+        'validity_unit': plan_data.get('validity_unit', 'days'),
+        'period': validity,  # Alias for mobile app compatibility (validity days)
+        'countries': plan_data.get('country_codes', []),
+        'country_codes': plan_data.get('country_codes', []),
+        'country_ids': plan_data.get('country_ids', []),
+        'operator': derived.get('operator_title'),
+        'type': derived.get('category'),  # Categorized type (global, regional, other) for frontend filtering
+        'planType': plan_data.get('type', 'data'),  # MongoDB field - use original type (data, voice, sms, unlimited)
+        'is_unlimited': plan_data.get('is_unlimited', False),
+        'day': plan_data.get('day'),
+        'amount': plan_data.get('amount'),
+        'enabled': plan_data.get('enabled', True)
+    }
+
+def _format_public_topup(doc_id, plan_data):
+    """Format a topups document for /api/public/topups"""
+    derived = catalog_derived_fields(plan_data)
+    data_value = derived.get('capacity_value')
+    validity = derived.get('validity_days')
+    category = derived.get('category')
+    
+    return {
+        'id': doc_id,
+        'slug': plan_data.get('slug'),
+        'name': plan_data.get('name'),
+        'title': plan_data.get('title', plan_data.get('name')),
+        'price': float(plan_data.get('price', 0)),
+        'data': data_value,  # Original field
+        'capacity': data_value,  # Alias for mobile app compatibility
+        'validity': validity,
+        'validity_unit': plan_data.get('validity_unit', 'days'),
+        'period': validity,  # Alias for mobile app compatibility (validity days)
+        'countries': plan_data.get('country_codes', []),
+        'country_codes': plan_data.get('country_codes', []),
+        'country_ids': plan_data.get('country_ids', []),
+        'operator': derived.get('operator_title'),
+        'type': category,  # Categorized type (global, regional, other) for frontend filtering
+        'planType': 'topup',  # MongoDB field - always 'topup' for topup plans
+        'category': category,  # MongoDB field - for categorization (global, regional, other)
+        'is_unlimited': plan_data.get('is_unlimited', False),
+        'is_topup_package': plan_data.get('is_topup_package', True),
+        'day': plan_data.get('day'),
+        'amount': plan_data.get('amount'),
+        'enabled': plan_data.get('enabled', True)
+    }
+
+def _format_public_country(doc_id, country_data):
+    """Format a countries document for /api/public/countries"""
+    return {
+        'id': doc_id,
+        'name': country_data.get('name'),
+        'code': country_data.get('code'),
+        'flag': country_data.get('flag'),
+        'flagEmoji': country_data.get('flagEmoji'),
+        'region': country_data.get('region'),
+        'continent': country_data.get('continent')
+    }
+
+def _format_catalog_entry(kind, doc_id, data):
+    """Formatted entry for the catalog, or None when the document is not publicly listed"""
+    if kind == 'countries':
+        return _format_public_country(doc_id, data)
+    
+    # Only include enabled plans
+    if data.get('enabled', True) == False:
+        return None
+    
+    if kind == 'topups':
+        # Only include actual topup packages
+        if not data.get('is_topup_package', False):
+            return None
+        return _format_public_topup(doc_id, data)
+    
+    return _format_public_plan(doc_id, data)
+
+def _catalog_unindex(section, doc_id):
+    """Remove a document from a catalog section and its indexes (lock held)"""
+    entry = section['entries'].pop(doc_id, None)
+    if not entry:
+        return
+    for code in entry.get('country_codes') or []:
+        ids = section['by_country'].get(code)
+        if ids is not None:
+            ids.discard(doc_id)
+    section['by_category'].get(entry.get('type'), set()).discard(doc_id)
+    section['by_plan_type'].get(entry.get('planType'), set()).discard(doc_id)
+
+def _catalog_index(section, doc_id, entry):
+    """Add a formatted document to a catalog section and its indexes (lock held)"""
+    section['entries'][doc_id] = entry
+    for code in entry.get('country_codes') or []:
+        section['by_country'].setdefault(code, set()).add(doc_id)
+    if 'type' in entry:
+        section['by_category'].setdefault(entry['type'], set()).add(doc_id)
+    if 'planType' in entry:
+        section['by_plan_type'].setdefault(entry['planType'], set()).add(doc_id)
+
+def _apply_catalog_documents(kind, documents, reset=False):
+    """Apply (doc id, data or None) pairs to a catalog section.
+    
+    With reset, documents is the whole collection and entries missing from it
+    are dropped. The version only moves when an entry actually changed, so a
+    listener catching up with a section restored from disk doesn't invalidate
+    cached responses. Changes are written through to the disk snapshot.
+    """
+    formatted = {}
+    for doc_id, data in documents:
+        try:
+            formatted[doc_id] = _format_catalog_entry(kind, doc_id, data) if data is not None else None
+        except Exception as e:
+            print(f"⚠️ Could not index {CATALOG_COLLECTIONS[kind]}/{doc_id}: {e}")
+    
+    with _catalog_lock:
+        section = _catalog[kind]
+        if reset:
+            for doc_id in section['entries'].keys() - formatted.keys():
+                formatted[doc_id] = None
+        changes = [(doc_id, entry) for doc_id, entry in formatted.items() if section['entries'].get(doc_id) != entry]
+        for doc_id, entry in changes:
+            _catalog_unindex(section, doc_id)
+            if entry is not None:
+                _catalog_index(section, doc_id, entry)
+        if changes:
+            section['order'] = None
+            section['version'] += 1
+        section['ready'] = True
+    
+    if changes or reset:
+        save_catalog_snapshot(kind, changes)
+    return changes
+
+def _on_catalog_snapshot(kind):
+    """Snapshot listener callback for one catalog collection"""
+    def callback(col_snapshot, changes, read_time):
+        documents = [
+            (change.document.id, None if change.type.name == 'REMOVED' else (change.document.to_dict() or {}))
+            for change in changes
+        ]
+        section = _catalog[kind]
+        if section['live']:
+            _apply_catalog_documents(kind, stage_catalog_documents(kind, documents))
+            release_staged_catalog_documents(kind)
+            return
+        # The first callback carries the whole collection; reconcile anything
+        # restored from disk against it
+        changes = _apply_catalog_documents(kind, documents, reset=True)
+        section['live'] = True
+        print(f"✅ Catalog {kind} loaded: {len(section['entries'])} entries ({len(changes)} changed since snapshot)")
+    return callback
+
+def start_catalog_listeners():
+    """Start snapshot listeners that keep the public catalog in memory"""
+    start_catalog_versions_listener()
+    for kind, collection_name in CATALOG_COLLECTIONS.items():
+        try:
+            _catalog_listeners[kind] = db.collection(collection_name).on_snapshot(_on_catalog_snapshot(kind))
+            print(f"👂 Catalog listener started on {collection_name}")
+        except Exception as e:
+            print(f"⚠️ Could not start catalog listener on {collection_name}: {e}")
+
+def reload_catalog(kind):
+    """Reload a catalog section from Firestore (used when its listener is not running)"""
+    docs = db.collection(CATALOG_COLLECTIONS[kind]).stream()
+    _apply_catalog_documents(kind, ((doc.id, doc.to_dict() or {}) for doc in docs), reset=True)
+
+def refresh_catalog_after_sync(kind):
+    """Make a finished sync visible even if the listener for this section is down"""
+    listener = _catalog_listeners.get(kind)
+    if listener is not None and getattr(listener, 'is_active', True):
+        return
+    try:
+        reload_catalog(kind)
+    except Exception as e:
+        print(f"⚠️ Could not reload catalog {kind}: {e}")
+
+def catalog_ready(kind):
+    return _catalog[kind]['ready']
+
+def query_catalog(kind, country=None, category=None, plan_type=None, limit=None, after=None):
+    """Answer a filtered catalog query from memory, in document id order"""
+    with _catalog_lock:
+        section = _catalog[kind]
+        filters = []
+        if country:
+            filters.append(section['by_country'].get(country, set()))
+        if category:
+            filters.append(section['by_category'].get(category, set()))
+        if plan_type:
+            filters.append(section['by_plan_type'].get(plan_type, set()))
+        
+        if filters:
+            filters.sort(key=len)
+            ids = sorted(filters[0].intersection(*filters[1:]))
+        else:
+            if section['order'] is None:
+                section['order'] = sorted(section['entries'])
+            ids = section['order']
+        
+        if after is not None:
+            ids = ids[bisect.bisect_right(ids, after):]
+        if limit:
+            ids = ids[:limit]
+        return [section['entries'][doc_id] for doc_id in ids]
+
+# Pagination and field projection for the public plan listings.
+# Cursors are opaque (base64 of the last document id); pages are in id order.
+PUBLIC_PAGE_SIZE_DEFAULT = 100
+PUBLIC_PAGE_SIZE_MAX = 500
+
+_CATEGORY_SOURCE_FIELDS = ['category', 'derived_version', 'type', 'region', 'region_slug', 'name', 'title', 'slug',
+                           'country_codes', 'is_global', 'is_regional']
+
+# Stored fields each public field is derived from (used for Firestore select())
+PUBLIC_FIELD_SOURCES = {
+    'id': [],
+    'slug': ['slug'],
+    'name': ['name'],
+    'title': ['title', 'name'],
+    'price': ['price'],
+    'data': ['capacity_value', 'derived_version', 'data', 'capacity'],
+    'capacity': ['capacity_value', 'derived_version', 'data', 'capacity'],
+    'validity': ['validity_days', 'derived_version', 'validity', 'name', 'slug'],
+    'validity_unit': ['validity_unit'],
+    'period': ['validity_days', 'derived_version', 'validity', 'name', 'slug'],
+    'countries': ['country_codes'],
+    'country_codes': ['country_codes'],
+    'country_ids': ['country_ids'],
+    'operator': ['operator_title', 'derived_version', 'operator'],
+    'type': _CATEGORY_SOURCE_FIELDS,
+    'category': _CATEGORY_SOURCE_FIELDS,
+    'planType': ['type'],
+    'is_unlimited': ['is_unlimited'],
+    'is_topup_package': ['is_topup_package'],
+    'day': ['day'],
+    'amount': ['amount'],
+    'enabled': ['enabled'],
+}
+
+def encode_catalog_cursor(doc_id):
+    return base64.urlsafe_b64encode(doc_id.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_catalog_cursor(cursor):
+    """Document id a cursor points after; raises ValueError for malformed cursors"""
+    try:
+        return base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+def parse_listing_params():
+    """(after, page_size, fields) from the query string; page_size is None for unpaginated requests"""
+    cursor = request.args.get('cursor')
+    page_size = request.args.get('page_size', type=int)
+    after = decode_catalog_cursor(cursor) if cursor else None
+    if cursor is not None or page_size is not None:
+        page_size = min(max(page_size or PUBLIC_PAGE_SIZE_DEFAULT, 1), PUBLIC_PAGE_SIZE_MAX)
+    
+    fields = None
+    if request.args.get('fields'):
+        requested = {field.strip() for field in request.args['fields'].split(',')}
+        fields = tuple(sorted((requested & PUBLIC_FIELD_SOURCES.keys()) | {'id'}))
+    return after, page_size, fields
+
+def project_catalog_entries(entries, fields):
+    if not fields:
+        return entries
+    return [{field: entry[field] for field in fields if field in entry} for entry in entries]
+
+def catalog_source_fields(kind, fields, category_filter=None, plan_type_filter=None):
+    """Stored fields a Firestore read needs for a projection, or None for whole documents"""
+    if not fields:
+        return None
+    source = {'enabled'}
+    if kind == 'topups':
+        source.add('is_topup_package')
+    if category_filter:
+        source.update(_CATEGORY_SOURCE_FIELDS)
+    if plan_type_filter:
+        source.add('type')
+    for field in fields:
+        source.update(PUBLIC_FIELD_SOURCES[field])
+    return sorted(source)
+
+def query_catalog_page(kind, country=None, category=None, plan_type=None, after=None, page_size=PUBLIC_PAGE_SIZE_DEFAULT):
+    """One page of a catalog query; returns (entries, id to continue after or None)"""
+    entries = query_catalog(kind, country=country, category=category, plan_type=plan_type,
+                            after=after, limit=page_size + 1)
+    if len(entries) > page_size:
+        entries = entries[:page_size]
+        return entries, entries[-1]['id']
+    return entries, None
+
+# ============================================================================
+# Catalog Disk Snapshot
+# The formatted catalog is mirrored to a local SQLite file so a restarted
+# worker serves /api/public/* from disk in milliseconds instead of waiting for
+# its listeners to read every collection. Listener changes are written through
+# per document; the first full listener snapshot reconciles whatever was
+# restored.
+# ============================================================================
+
+CATALOG_SNAPSHOT_FILE = os.getenv('CATALOG_SNAPSHOT_FILE', '/tmp/catalog_snapshot.sqlite3')
+CATALOG_SNAPSHOT_MAX_AGE = int(os.getenv('CATALOG_SNAPSHOT_MAX_AGE', 7 * 24 * 3600))  # Seconds
+# Bump when the formatted entry shape changes so older snapshots are discarded
+CATALOG_SNAPSHOT_FORMAT = f'1.{CATALOG_DERIVED_VERSION}'
+
+def _open_catalog_snapshot():
+    """Connection to the snapshot file, created (or cleared when its format is outdated) as needed"""
+    conn = sqlite3.connect(CATALOG_SNAPSHOT_FILE, timeout=10)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    with conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS catalog_entries ('
+                     'kind TEXT NOT NULL, doc_id TEXT NOT NULL, entry TEXT NOT NULL, '
+                     'PRIMARY KEY (kind, doc_id)) WITHOUT ROWID')
+        conn.execute('CREATE TABLE IF NOT EXISTS catalog_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        row = conn.execute("SELECT value FROM catalog_meta WHERE key = 'format'").fetchone()
+        if row is None or row[0] != CATALOG_SNAPSHOT_FORMAT:
+            conn.execute('DELETE FROM catalog_entries')
+            conn.execute('DELETE FROM catalog_meta')
+            conn.execute("INSERT INTO catalog_meta (key, value) VALUES ('format', ?)", (CATALOG_SNAPSHOT_FORMAT,))
+    return conn
+
+def save_catalog_snapshot(kind, changes):
+    """Write (doc id, entry or None) changes for a catalog section to disk"""
+    try:
+        conn = _open_catalog_snapshot()
+        try:
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO catalog_entries (kind, doc_id, entry) VALUES (?, ?, ?)',
+                    [(kind, doc_id, json.dumps(entry, default=str)) for doc_id, entry in changes if entry is not None])
+                conn.executemany(
+                    'DELETE FROM catalog_entries WHERE kind = ? AND doc_id = ?',
+                    [(kind, doc_id) for doc_id, entry in changes if entry is None])
+                conn.execute('INSERT OR REPLACE INTO catalog_meta (key, value) VALUES (?, ?)',
+                             (f'saved_at:{kind}', str(time.time())))
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"⚠️ Could not update catalog snapshot for {kind}: {e}")
+
+def save_catalog_snapshot_meta(values):
+    """Record small values (published catalog versions) alongside the snapshot"""
+    try:
+        conn = _open_catalog_snapshot()
+        try:
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO catalog_meta (key, value) VALUES (?, ?)',
+                                 [(key, json.dumps(value)) for key, value in values.items()])
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"⚠️ Could not update catalog snapshot metadata: {e}")
+
+def load_catalog_snapshot():
+    """Restore catalog sections (and published versions) saved by a previous run"""
+    started = time.time()
+    try:
+        if not os.path.exists(CATALOG_SNAPSHOT_FILE):
+            return
+        conn = _open_catalog_snapshot()
+        try:
+            meta = dict(conn.execute('SELECT key, value FROM catalog_meta'))
+            restored = {}
+            for kind in CATALOG_COLLECTIONS:
+                saved_at = float(meta.get(f'saved_at:{kind}', 0))
+                if time.time() - saved_at > CATALOG_SNAPSHOT_MAX_AGE:
+                    continue
+                rows = conn.execute('SELECT doc_id, entry FROM catalog_entries WHERE kind = ?', (kind,))
+                restored[kind] = ([(doc_id, json.loads(entry)) for doc_id, entry in rows], saved_at)
+        finally:
+            conn.close()
+    except (sqlite3.Error, ValueError) as e:
+        print(f"⚠️ Could not load catalog snapshot: {e}")
+        return
+    
+    for kind, (entries, saved_at) in restored.items():
+        with _catalog_lock:
+            section = _catalog[kind]
+            if section['ready']:
+                continue  # A listener got there first
+            for doc_id, entry in entries:
+                _catalog_index(section, doc_id, entry)
+            section['order'] = None
+            section['version'] += 1
+            section['ready'] = True
+        print(f"💾 Catalog {kind} restored from snapshot: {len(entries)} entries, "
+              f"{round(time.time() - saved_at)}s old")
+    
+    for kind in CATALOG_COLLECTIONS:
+        version = meta.get(f'published_version:{kind}')
+        if version is not None and kind not in _published_catalog_versions:
+            _published_catalog_versions[kind] = (json.loads(version), time.time())
+    print(f"💾 Catalog snapshot loaded in {round((time.time() - started) * 1000)}ms")
+
+# ============================================================================
+# Catalog Response Cache
+# Public catalog responses are serialized once per catalog version and filter
+# combination; gzip/brotli variants are encoded once on first use. ETags are
+# content hashes, so every worker hands out the same tag for the same body.
+# ============================================================================
+
+CATALOG_RESPONSE_CACHE_SIZE = int(os.getenv('CATALOG_RESPONSE_CACHE_SIZE', 256))
+CATALOG_CACHE_MAX_AGE = int(os.getenv('CATALOG_CACHE_MAX_AGE', 60))  # Seconds clients may reuse a response
+
+_catalog_response_cache = OrderedDict()
+_catalog_response_cache_lock = threading.Lock()
+
+def catalog_version(kind):
+    return _catalog[kind]['version']
+
+def get_catalog_response_entry(key, version, build_payload):
+    """Serialized payload for a filter combination, rebuilt when the catalog version changes"""
+    with _catalog_response_cache_lock:
+        entry = _catalog_response_cache.get(key)
+        if entry is not None and entry['version'] == version:
+            _catalog_response_cache.move_to_end(key)
+            return entry
+    
+    body = app.json.dumps(build_payload()).encode('utf-8')
+    entry = {
+        'version': version,
+        'digest': hashlib.sha256(body).hexdigest()[:32],
+        'encodings': {'identity': body},
+    }
+    
+    with _catalog_response_cache_lock:
+        _catalog_response_cache[key] = entry
+        _catalog_response_cache.move_to_end(key)
+        while len(_catalog_response_cache) > CATALOG_RESPONSE_CACHE_SIZE:
+            _catalog_response_cache.popitem(last=False)
+    return entry
+
+def _negotiate_catalog_encoding():
+    """Pick br, gzip or identity from Accept-Encoding"""
+    if brotli is not None and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return 'identity'
+
+def _encoded_catalog_body(entry, encoding):
+    """Compressed variant of a cached payload (encoded once, then reused)"""
+    body = entry['encodings'].get(encoding)
+    if body is None:
+        identity = entry['encodings']['identity']
+        if encoding == 'br':
+            body = brotli.compress(identity, quality=5)
+        else:
+            body = gzip.compress(identity, compresslevel=6, mtime=0)
+        entry['encodings'][encoding] = body
+    return body
+
+def catalog_response(entry):
+    """Serve a cached payload, answering 304 when the client already has it"""
+    encoding = _negotiate_catalog_encoding()
+    etag = entry['digest'] if encoding == 'identity' else f"{entry['digest']}-{encoding}"
+    known_tags = [entry['digest']] + [f"{entry['digest']}-{variant}" for variant in ('gzip', 'br')]
+    
+    if request.if_none_match and any(request.if_none_match.contains(tag) for tag in known_tags):
+        response = Response(status=304)
+    else:
+        response = Response(_encoded_catalog_body(entry, encoding), mimetype='application/json')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = f'public, max-age={CATALOG_CACHE_MAX_AGE}'
+    return response
+
+# ============================================================================
+# Catalog Change Feed
+# Sync jobs stamp every plan whose content changed with a catalogVersion and
+# then publish that version in catalog_versions/{kind}. Clients remember the
+# version they last saw and ask only for what changed since.
+# ============================================================================
+
+CATALOG_VOLATILE_FIELDS = {'updated_at', 'synced_at', 'updated_by', 'contentHash', 'catalogVersion'}
+CATALOG_CHANGES_MAX = int(os.getenv('CATALOG_CHANGES_MAX', 2000))  # Larger deltas ask the client to refetch
+CATALOG_VERSION_CACHE_TTL = 5  # Seconds
+
+_published_catalog_versions = {}
+
+def catalog_content_hash(data):
+    """Stable hash of a catalog document, ignoring sync bookkeeping fields"""
+    content = {key: value for key, value in data.items() if key not in CATALOG_VOLATILE_FIELDS}
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+@firestore.transactional
+def _allocate_catalog_version(transaction, version_ref):
+    snapshot = version_ref.get(transaction=transaction)
+    data = snapshot.to_dict() if snapshot.exists else {}
+    version = max(data.get('nextVersion', 0), data.get('version', 0)) + 1
+    transaction.set(version_ref, {'nextVersion': version}, merge=True)
+    return version
+
+@firestore.transactional
+def _publish_catalog_version(transaction, version_ref, version):
+    snapshot = version_ref.get(transaction=transaction)
+    data = snapshot.to_dict() if snapshot.exists else {}
+    if version > data.get('version', 0):
+        transaction.set(version_ref, {'version': version, 'publishedAt': firestore.SERVER_TIMESTAMP}, merge=True)
+
+def stamp_catalog_change(kind, doc_data, existing, sync_state):
+    """Stamp doc_data with a new catalogVersion when it changes the stored document; returns True if it did"""
+    existing = existing or {}
+    # Hash the document as it will look after a merge write, so partial writers agree with full ones
+    content_hash = catalog_content_hash({**existing, **doc_data})
+    if content_hash == existing.get('contentHash'):
+        return False
+    
+    # Allocate the version lazily so syncs without changes don't bump it
+    if sync_state.get('version') is None:
+        version_ref = db.collection('catalog_versions').document(kind)
+        sync_state['version'] = _allocate_catalog_version(db.transaction(), version_ref)
+    
+    doc_data['contentHash'] = content_hash
+    doc_data['catalogVersion'] = sync_state['version']
+    sync_state['changed'] = sync_state.get('changed', 0) + 1
+    return True
+
+def publish_catalog_version(kind, sync_state):
+    """Make a sync's changes visible to the feed (call after all its writes committed)"""
+    if sync_state.get('version') is None:
+        return
+    version_ref = db.collection('catalog_versions').document(kind)
+    _publish_catalog_version(db.transaction(), version_ref, sync_state['version'])
+    _published_catalog_versions.pop(kind, None)
+    print(f"📰 Published {kind} catalog version {sync_state['version']} ({sync_state.get('changed', 0)} changed)")
+
+def get_published_catalog_version(kind):
+    """Latest published catalog version (kept current by the versions listener, else briefly cached)"""
+    cached = _published_catalog_versions.get(kind)
+    if cached and (catalog_versions_listener_active() or time.time() - cached[1] < CATALOG_VERSION_CACHE_TTL):
+        return cached[0]
+    
+    snapshot = db.collection('catalog_versions').document(kind).get()
+    version = (snapshot.to_dict() or {}).get('version', 0) if snapshot.exists else 0
+    if not cached or cached[0] != version:
+        save_catalog_snapshot_meta({f'published_version:{kind}': version})
+    _published_catalog_versions[kind] = (version, time.time())
+    return version
+
+def build_catalog_changes(kind, since, version):
+    """Entries changed and ids removed in (since, version]"""
+    if since > version:
+        # Client holds a version this catalog never published
+        return {'version': version, 'since': since, 'reset': True, 'changed': [], 'removed': [], 'count': 0}
+    
+    changed = []
+    removed = []
+    if since < version:
+        query = (db.collection(CATALOG_COLLECTIONS[kind])
+                 .where('catalogVersion', '>', since)
+                 .where('catalogVersion', '<=', version)
+                 .limit(CATALOG_CHANGES_MAX + 1))
+        for doc in query.stream():
+            entry = _format_catalog_entry(kind, doc.id, doc.to_dict())
+            if entry is None:
+                removed.append(doc.id)
+            else:
+                changed.append(entry)
+    
+    if len(changed) + len(removed) > CATALOG_CHANGES_MAX:
+        return {'version': version, 'since': since, 'reset': True, 'changed': [], 'removed': [], 'count': 0}
+    
+    changed.sort(key=lambda entry: entry['id'])
+    removed.sort()
+    return {
+        'version': version,
+        'since': since,
+        'reset': False,
+        'changed': changed,
+        'removed': removed,
+        'count': len(changed) + len(removed),
+    }
+
+def catalog_changes_response(kind):
+    """Shared handler for the /changes endpoints"""
+    since = request.args.get('since', type=int)
+    if since is None or since < 0:
+        return jsonify({'success': False, 'error': 'since must be a non-negative catalog version'}), 400
+    
+    version = get_published_catalog_version(kind)
+    entry = get_catalog_response_entry(('changes', kind, since), version, lambda: {
+        'success': True,
+        'data': build_catalog_changes(kind, since, version),
+    })
+    return catalog_response(entry)
+
+# ============================================================================
+# Catalog Invalidation
+# Syncs (here or in the sdk service) publish catalog_versions/{kind} once all
+# of their writes have committed. A listener on that collection keeps the
+# published versions current without polling. Plan changes stamped with a
+# version that isn't published yet are held back and applied together when it
+# is, so the public catalog moves from one published state to the next in a
+# single swap instead of showing a sync half-applied.
+# ============================================================================
+
+CATALOG_STAGING_MAX_AGE = int(os.getenv('CATALOG_STAGING_MAX_AGE', 1800))  # Seconds held changes of an unpublished sync wait
+
+_catalog_staging_lock = threading.Lock()
+_catalog_staging = {kind: {} for kind in CATALOG_COLLECTIONS}  # doc id -> (catalogVersion, data, held since)
+_catalog_versions_listener = {'watch': None, 'live': False}
+
+def stage_catalog_documents(kind, documents):
+    """Listener changes that can be applied now; the rest wait for their catalogVersion to be published"""
+    if kind == 'countries' or not _catalog_versions_listener['live']:
+        return documents
+    ready = []
+    with _catalog_staging_lock:
+        published = _published_catalog_versions.get(kind, (0, 0))[0]
+        staged = _catalog_staging[kind]
+        for doc_id, data in documents:
+            version = (data or {}).get('catalogVersion') or 0
+            if data is not None and version > published:
+                staged[doc_id] = (version, data, time.time())
+            else:
+                staged.pop(doc_id, None)  # Superseded by a change that isn't waiting
+                ready.append((doc_id, data))
+    return ready
+
+def release_staged_catalog_documents(kind):
+    """Apply held changes whose version is published, or that an abandoned sync left waiting too long"""
+    now = time.time()
+    with _catalog_staging_lock:
+        published = _published_catalog_versions.get(kind, (0, 0))[0]
+        staged = _catalog_staging[kind]
+        doc_ids = [
+            doc_id for doc_id, (version, data, held_since) in staged.items()
+            if version <= published or now - held_since > CATALOG_STAGING_MAX_AGE
+        ]
+        documents = [(doc_id, staged.pop(doc_id)[1]) for doc_id in doc_ids]
+    if documents:
+        _apply_catalog_documents(kind, documents)
+        print(f"🔄 Catalog {kind}: swapped in {len(documents)} changes (published version {published})")
+
+def _on_catalog_versions_snapshot(col_snapshot, changes, read_time):
+    """Versions listener callback: record newly published versions and release their changes"""
+    for change in changes:
+        kind = change.document.id
+        if kind not in CATALOG_COLLECTIONS or change.type.name == 'REMOVED':
+            continue
+        version = (change.document.to_dict() or {}).get('version', 0)
+        with _catalog_staging_lock:
+            previous = _published_catalog_versions.get(kind, (None, 0))[0]
+            _published_catalog_versions[kind] = (version, time.time())
+        if version != previous:
+            save_catalog_snapshot_meta({f'published_version:{kind}': version})
+            print(f"📰 Catalog {kind} version {version} published")
+        release_staged_catalog_documents(kind)
+    _catalog_versions_listener['live'] = True
+
+def start_catalog_versions_listener():
+    try:
+        _catalog_versions_listener['watch'] = db.collection('catalog_versions').on_snapshot(_on_catalog_versions_snapshot)
+        print("👂 Catalog listener started on catalog_versions")
+    except Exception as e:
+        print(f"⚠️ Could not start catalog versions listener: {e}")
+
+def catalog_versions_listener_active():
+    watch = _catalog_versions_listener['watch']
+    return _catalog_versions_listener['live'] and watch is not None and getattr(watch, 'is_active', True)
+
+# ============================================================================
+# PUBLIC Endpoints (no authentication required)
+# These endpoints are for the public-facing frontend
+# ============================================================================
+
+@app.route('/api/public/countries', methods=['GET'])
+def get_public_countries():
+    """Get available countries - PUBLIC endpoint (no auth required)"""
+    try:
+        def build_payload(countries):
+            print(f"✅ Found {len(countries)} countries")
+            return {
+                'success': True,
+                'data': {
+                    'countries': countries,
+                    'count': len(countries)
+                }
             }
-            plans.append(plan)
-            
-            # Apply limit if specified
-            if limit and len(plans) >= limit:
-                break
         
-        print(f"✅ Found {len(plans)} plans")
+        if catalog_ready('countries'):
+            entry = get_catalog_response_entry(('countries',), catalog_version('countries'),
+                                               lambda: build_payload(query_catalog('countries')))
+            return catalog_response(entry)
         
-        return jsonify({
-            'success': True,
-            'data': {
-                'plans': plans,
-                'count': len(plans)
+        print(f"🌍 PUBLIC: Catalog not loaded yet, fetching countries from Firebase")
+        countries = [_format_public_country(doc.id, doc.to_dict()) for doc in db.collection('countries').stream()]
+        return jsonify(build_payload(countries))
+        
+    except Exception as e:
+        print(f"❌ Error fetching countries: {e}")
+        return jsonify({'success': False, 'error': f'Failed to fetch countries: {str(e)}'}), 500
+
+def _fetch_public_plans_from_firestore(kind, country_code, category_filter, plan_type_filter, limit,
+                                       after=None, page_size=None, fields=None):
+    """Firestore fallback for the public plan endpoints while the catalog is loading.
+    
+    Returns (plans, id to continue after or None). Paginated requests read at
+    most page_size documents, so a filtered page may come back short.
+    """
+    plans_ref = db.collection(CATALOG_COLLECTIONS[kind])
+    
+    # Apply filters if provided
+    if country_code:
+        plans_ref = plans_ref.where('country_codes', 'array_contains', country_code)
+    
+    # Only read the fields the projection needs
+    source_fields = catalog_source_fields(kind, fields, category_filter, plan_type_filter)
+    if source_fields:
+        plans_ref = plans_ref.select(source_fields)
+    
+    if page_size:
+        plans_ref = plans_ref.order_by('__name__')
+        if after is not None:
+            plans_ref = plans_ref.start_after({'__name__': after})
+        plans_ref = plans_ref.limit(page_size)
+    else:
+        # Apply limit to Firestore query to reduce memory usage
+        plans_ref = plans_ref.limit(limit + 100)  # Add buffer for filtering
+    
+    plans = []
+    scanned = 0
+    last_id = None
+    for doc in plans_ref.stream():
+        scanned += 1
+        last_id = doc.id
+        plan = _format_catalog_entry(kind, doc.id, doc.to_dict())
+        if plan is None:
+            continue
+        if category_filter and plan['type'] != category_filter:
+            continue
+        if plan_type_filter and plan['planType'] != plan_type_filter:
+            continue
+        plans.append(plan)
+        
+        # Apply limit if specified
+        if not page_size and limit and len(plans) >= limit:
+            break
+    
+    next_after = last_id if page_size and scanned == page_size else None
+    return plans, next_after
+
+@app.route('/api/public/plans', methods=['GET'])
+def get_public_plans():
+    """Get all plans - PUBLIC endpoint (no auth required)"""
+    try:
+        # Get optional filters from query params
+        country_code = request.args.get('country')
+        category_filter = request.args.get('type')  # global, regional, other
+        plan_type_filter = request.args.get('planType')  # data, voice, sms, unlimited
+        limit = request.args.get('limit', type=int)
+        
+        # Add default limit to prevent memory issues
+        if not limit:
+            limit = 1000  # Default limit to prevent memory overload
+        
+        try:
+            after, page_size, fields = parse_listing_params()
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
+        # Read once: the payload embeds it, so it is part of the cached entry's version too
+        published_version = get_published_catalog_version('plans')
+        
+        def build_payload(plans, next_after=None):
+            print(f"✅ Found {len(plans)} plans")
+            data = {
+                'plans': project_catalog_entries(plans, fields),
+                'count': len(plans),
+                'version': published_version
             }
-        })
+            if page_size:
+                data['next_cursor'] = encode_catalog_cursor(next_after) if next_after else None
+            return {'success': True, 'data': data}
+        
+        if catalog_ready('plans'):
+            def build_from_catalog():
+                if page_size:
+                    return build_payload(*query_catalog_page('plans', country=country_code, category=category_filter,
+                                                             plan_type=plan_type_filter, after=after, page_size=page_size))
+                return build_payload(query_catalog('plans', country=country_code, category=category_filter,
+                                                   plan_type=plan_type_filter, limit=limit))
+            
+            key = ('plans', country_code, category_filter, plan_type_filter, limit, after, page_size, fields)
+            entry = get_catalog_response_entry(key, (catalog_version('plans'), published_version),
+                                               build_from_catalog)
+            return catalog_response(entry)
+        
+        print(f"📦 PUBLIC: Catalog not loaded yet, fetching plans from Firebase")
+        plans, next_after = _fetch_public_plans_from_firestore('plans', country_code, category_filter, plan_type_filter,
+                                                               limit, after=after, page_size=page_size, fields=fields)
+        return jsonify(build_payload(plans, next_after))
         
     except Exception as e:
         print(f"❌ Error fetching plans: {e}")
         return jsonify({'success': False, 'error': f'Failed to fetch plans: {str(e)}'}), 500
 
+@app.route('/api/public/plans/changes', methods=['GET'])
+def get_public_plan_changes():
+    """Plans added, updated or disabled since a catalog version - PUBLIC endpoint (no auth required)"""
+    try:
+        return catalog_changes_response('plans')
+    except Exception as e:
+        print(f"❌ Error fetching plan changes: {e}")
+        return jsonify({'success': False, 'error': f'Failed to fetch plan changes: {str(e)}'}), 500
+
 @app.route('/api/public/topups', methods=['GET'])
 def get_public_topups():
     """Get all topup plans - PUBLIC endpoint (no auth required)"""
     try:
-        print(f"📦 PUBLIC: Fetching topup plans from Firebase")
-        
-        topups_ref = db.collection('topups')
-        
         # Get optional filters from query params
         country_code = request.args.get('country')
+        category_filter = request.args.get('type')  # global, regional, other
         limit = request.args.get('limit', type=int)
         
         # Add default limit to prevent memory issues
         if not limit:
             limit = 1000  # Default limit to prevent memory overload
         
-        # Apply filters if provided
-        if country_code:
-            topups_ref = topups_ref.where('country_codes', 'array_contains', country_code)
-        
-        # Apply limit to Firestore query to reduce memory usage
-        topups_ref = topups_ref.limit(limit + 100)  # Add buffer for filtering
-        
-        # Fetch topup plans
-        topups_docs = topups_ref.stream()
-        
-        topups = []
-        for doc in topups_docs:
-            plan_data = doc.to_dict()
-            
-            # Only include enabled topup plans
-            if plan_data.get('enabled', True) == False:
-                continue
-            
-            # Only include actual topup packages
-            if not plan_data.get('is_topup_package', False):
-                continue
-            
-            # Extract validity from plan name/slug if not available in validity field
-            validity = plan_data.get('validity')
-            if not validity:
-                # Try to extract from name like "1 GB - 7 Days" or slug like "plan-7days-1gb"
-                name = plan_data.get('name', '')
-                slug = plan_data.get('slug', '')
-                
-                # Look for patterns like "7 Days", "30 Days", etc. in name
-                import re
-                name_match = re.search(r'(\d+)\s*Days?', name)
-                if name_match:
-                    validity = int(name_match.group(1))
-                else:
-                    # Look for patterns like "7days", "30days" in slug
-                    slug_match = re.search(r'(\d+)days?', slug)
-                    if slug_match:
-                        validity = int(slug_match.group(1))
-            
-            # Format topup plan data for API response
-            # Get data capacity from 'data' field or 'capacity' field
-            data_value = plan_data.get('data') or plan_data.get('capacity')
-            
-            # Categorize the topup plan (global, regional, or other)
-            category = categorize_plan(plan_data)
-            
-            topup = {
-                'id': doc.id,
-                'slug': plan_data.get('slug'),
-                'name': plan_data.get('name'),
-                'title': plan_data.get('title', plan_data.get('name')),
-                'price': float(plan_data.get('price', 0)),
-                'data': data_value,  # Original field
-                'capacity': data_value,  # Alias for mobile app compatibility
-                'validity': validity,
-                'validity_unit': plan_data.get('validity_unit', 'days'),
-                'period': validity,  # Alias for mobile app compatibility (validity days)
-                'countries': plan_data.get('country_codes', []),
-                'country_codes': plan_data.get('country_codes', []),
-                'country_ids': plan_data.get('country_ids', []),
-                'operator': plan_data.get('operator', {}).get('title') if isinstance(plan_data.get('operator'), dict) else plan_data.get('operator'),
-                'type': category,  # Use categorized type (global, regional, other) for frontend filtering
-                'planType': 'topup',  # MongoDB field - always 'topup' for topup plans
-                'category': category,  # MongoDB field - for categorization (global, regional, other)
-                'is_unlimited': plan_data.get('is_unlimited', False),
-                'is_topup_package': plan_data.get('is_topup_package', True),
-                'day': plan_data.get('day'),
-                'amount': plan_data.get('amount'),
-                'enabled': plan_data.get('enabled', True)
+        try:
+            after, page_size, fields = parse_listing_params()
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
+        # Read once: the payload embeds it, so it is part of the cached entry's version too
+        published_version = get_published_catalog_version('topups')
+        
+        def build_payload(topups, next_after=None):
+            print(f"✅ Found {len(topups)} topup plans")
+            data = {
+                'plans': project_catalog_entries(topups, fields),
+                'count': len(topups),
+                'version': published_version
             }
-            topups.append(topup)
+            if page_size:
+                data['next_cursor'] = encode_catalog_cursor(next_after) if next_after else None
+            return {'success': True, 'data': data}
+        
+        if catalog_ready('topups'):
+            def build_from_catalog():
+                if page_size:
+                    return build_payload(*query_catalog_page('topups', country=country_code, category=category_filter,
+                                                             after=after, page_size=page_size))
+                return build_payload(query_catalog('topups', country=country_code, category=category_filter, limit=limit))
             
-            # Apply limit if specified
-            if limit and len(topups) >= limit:
-                break
+            key = ('topups', country_code, category_filter, limit, after, page_size, fields)
+            entry = get_catalog_response_entry(key, (catalog_version('topups'), published_version),
+                                               build_from_catalog)
+            return catalog_response(entry)
         
-        print(f"✅ Found {len(topups)} topup plans")
-        
-        return jsonify({
-            'success': True,
-            'data': {
-                'plans': topups,
-                'count': len(topups)
-            }
-        })
+        print(f"📦 PUBLIC: Catalog not loaded yet, fetching topup plans from Firebase")
+        topups, next_after = _fetch_public_plans_from_firestore('topups', country_code, category_filter, None,
+                                                                limit, after=after, page_size=page_size, fields=fields)
+        return jsonify(build_payload(topups, next_after))
         
     except Exception as e:
         print(f"❌ Error fetching topup plans: {e}")
         return jsonify({'success': False, 'error': f'Failed to fetch topup plans: {str(e)}'}), 500
 
+@app.route('/api/public/topups/changes', methods=['GET'])
+def get_public_topup_changes():
+    """Topup plans added, updated or disabled since a catalog version - PUBLIC endpoint (no auth required)"""
+    try:
+        return catalog_changes_response('topups')
+    except Exception as e:
+        print(f"❌ Error fetching topup plan changes: {e}")
+        return jsonify({'success': False, 'error': f'Failed to fetch topup plan changes: {str(e)}'}), 500
+
+# ============================================================================
+# Bulk Firestore Writer
+# Catalog syncs queue their writes here instead of committing one 500-op
+# batch at a time: full batches are committed from a small thread pool with
+# several in flight, contention/quota errors slow every batch of the writer
+# down (and speed back up on success), and a batch that keeps failing is
+# retried write by write so one bad document doesn't drop the other 499.
+# ============================================================================
+
+BULK_WRITE_BATCH_SIZE = 500  # Firestore batch limit
+BULK_WRITE_CONCURRENCY = int(os.getenv('BULK_WRITE_CONCURRENCY', 4))
+BULK_WRITE_MAX_ATTEMPTS = 4
+BULK_WRITE_MAX_DELAY = 5.0
+
+# Errors that mean "slow down and try again" rather than "this write is bad"
+BULK_WRITE_RETRYABLE_ERRORS = (
+    google_exceptions.Aborted,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+)
+
+def start_bulk_writer(label):
+    """New writer state; queue writes with bulk_write() and finish with close_bulk_writer()"""
+    return {
+        'label': label,
+        'ops': [],
+        'executor': ThreadPoolExecutor(max_workers=BULK_WRITE_CONCURRENCY, thread_name_prefix=f'bulk-{label}'),
+        'in_flight': [],
+        'lock': threading.Lock(),
+        'delay': 0.0,
+        'next_seq': 0,
+        'committed_seq': -1,
+        'done_seqs': set(),
+        'checkpoints': [],
+        'metrics': {
+            'batches': 0,
+            'writes': 0,
+            'failed_writes': 0,
+            'retries': 0,
+            'throttled': 0,
+            'commit_seconds': 0.0,
+            'max_batch_seconds': 0.0,
+        },
+        'failed_ids': [],
+        'first_failed_seq': None,  # Checkpoints at or past this batch never fire
+        'started': time.time(),
+    }
+
+def _apply_bulk_op(target, op):
+    kind, ref, data, merge = op
+    if kind == 'set':
+        target.set(ref, data, merge=merge)
+    elif kind == 'update':
+        target.update(ref, data)
+    else:
+        target.delete(ref)
+
+def _bulk_backoff(writer, error):
+    """Widen the writer-wide delay after contention; returns how long this caller should wait"""
+    with writer['lock']:
+        writer['delay'] = min(max(writer['delay'] * 2, 0.1), BULK_WRITE_MAX_DELAY)
+        writer['metrics']['throttled'] += 1
+        delay = writer['delay']
+    print(f"⏳ Bulk writer {writer['label']} backing off {delay:.2f}s: {error}")
+    return delay * (0.5 + random.random())
+
+def _commit_bulk_ops(writer, ops):
+    """Commit ops as one batch, retrying contention errors with backoff; raises after the last attempt"""
+    for attempt in range(BULK_WRITE_MAX_ATTEMPTS):
+        if writer['delay']:
+            time.sleep(writer['delay'])
+        batch = db.batch()
+        for op in ops:
+            _apply_bulk_op(batch, op)
+        try:
+            batch.commit()
+            with writer['lock']:
+                writer['delay'] = writer['delay'] / 2 if writer['delay'] > 0.05 else 0.0
+            return attempt
+        except BULK_WRITE_RETRYABLE_ERRORS as e:
+            if attempt == BULK_WRITE_MAX_ATTEMPTS - 1:
+                raise
+            with writer['lock']:
+                writer['metrics']['retries'] += 1
+            time.sleep(_bulk_backoff(writer, e))
+
+def _run_bulk_batch(writer, seq, ops):
+    started = time.time()
+    failed = []
+    try:
+        _commit_bulk_ops(writer, ops)
+    except Exception as batch_error:
+        # Fall back to one write per commit so only the writes that really fail are lost
+        print(f"⚠️ Bulk writer {writer['label']} batch {seq} failed ({batch_error}), retrying {len(ops)} writes individually")
+        for op in ops:
+            try:
+                _commit_bulk_ops(writer, [op])
+            except Exception as write_error:
+                print(f"❌ Bulk write {op[0]} {op[1].id} failed: {write_error}")
+                failed.append(op[1].id)
+    elapsed = time.time() - started
+    
+    ready = []
+    with writer['lock']:
+        metrics = writer['metrics']
+        metrics['batches'] += 1
+        metrics['writes'] += len(ops) - len(failed)
+        metrics['failed_writes'] += len(failed)
+        metrics['commit_seconds'] += elapsed
+        metrics['max_batch_seconds'] = max(metrics['max_batch_seconds'], elapsed)
+        writer['failed_ids'].extend(failed)
+        if failed and (writer['first_failed_seq'] is None or seq < writer['first_failed_seq']):
+            writer['first_failed_seq'] = seq
+        
+        # Checkpoints fire only once every batch queued before them has committed, and
+        # never past a batch that lost writes, so a resumed job retries those writes
+        writer['done_seqs'].add(seq)
+        while writer['committed_seq'] + 1 in writer['done_seqs']:
+            writer['committed_seq'] += 1
+            writer['done_seqs'].discard(writer['committed_seq'])
+        while writer['checkpoints'] and writer['checkpoints'][0][0] <= writer['committed_seq']:
+            checkpoint_seq, callback = writer['checkpoints'].pop(0)
+            if writer['first_failed_seq'] is None or checkpoint_seq < writer['first_failed_seq']:
+                ready.append(callback)
+    
+    for callback in ready:
+        try:
+            callback()
+        except Exception as e:
+            print(f"⚠️ Bulk writer {writer['label']} checkpoint failed: {e}")
+
+def _submit_bulk_batch(writer):
+    ops, writer['ops'] = writer['ops'], []
+    # Bound the batches in flight so a fast producer doesn't buffer the whole catalog
+    writer['in_flight'] = [future for future in writer['in_flight'] if not future.done()]
+    while len(writer['in_flight']) >= BULK_WRITE_CONCURRENCY * 2:
+        writer['in_flight'].pop(0).result()
+    seq = writer['next_seq']
+    writer['next_seq'] += 1
+    writer['in_flight'].append(writer['executor'].submit(_run_bulk_batch, writer, seq, ops))
+
+def bulk_write(writer, kind, ref, data=None, merge=False):
+    """Queue a 'set', 'update' or 'delete'; returns True when this write filled a batch and sent it"""
+    writer['ops'].append((kind, ref, data, merge))
+    if len(writer['ops']) >= BULK_WRITE_BATCH_SIZE:
+        _submit_bulk_batch(writer)
+        return True
+    return False
+
+def bulk_writer_checkpoint(writer, callback):
+    """Run callback once every write queued so far has been committed (never after a lost write)"""
+    if writer['ops']:
+        _submit_bulk_batch(writer)
+    with writer['lock']:
+        if writer['first_failed_seq'] is not None:
+            ready = False
+        elif writer['next_seq'] - 1 <= writer['committed_seq']:
+            ready = True
+        else:
+            writer['checkpoints'].append((writer['next_seq'] - 1, callback))
+            ready = False
+    if ready:
+        callback()
+
+def close_bulk_writer(writer):
+    """Send the last partial batch, wait for everything in flight and return the writer's metrics"""
+    if writer['ops']:
+        _submit_bulk_batch(writer)
+    writer['executor'].shutdown(wait=True)
+    metrics = dict(writer['metrics'])
+    metrics['elapsed_seconds'] = round(time.time() - writer['started'], 3)
+    metrics['commit_seconds'] = round(metrics['commit_seconds'], 3)
+    metrics['max_batch_seconds'] = round(metrics['max_batch_seconds'], 3)
+    metrics['avg_batch_seconds'] = round(metrics['commit_seconds'] / metrics['batches'], 3) if metrics['batches'] else 0.0
+    metrics['failed_ids'] = writer['failed_ids'][:50]
+    print(f"📝 Bulk writer {writer['label']}: {metrics['writes']} writes in {metrics['batches']} batches, "
+          f"{metrics['failed_writes']} failed, {metrics['retries']} retries, {metrics['elapsed_seconds']}s")
+    return metrics
+
+# ============================================================================
+# Background Sync Jobs
+# Syncs run as jobs in a background thread: the request gets a job id back at
+# once and progress/checkpoints live in sync_jobs/{id}. A leased lock in
+# sync_locks/packages (shared by every worker and service that syncs
+# packages) keeps two syncs from running at once; a watchdog resumes jobs
+# whose worker stopped heartbeating.
+# ============================================================================
+
+SYNC_JOB_LEASE_SECONDS = int(os.getenv('SYNC_JOB_LEASE_SECONDS', 120))
+SYNC_JOB_HEARTBEAT_SECONDS = 30
+SYNC_LOCK_NAME = 'packages'
+SYNC_WORKER_ID = f"{os.uname().nodename}:{os.getpid()}"
+
+SYNC_JOB_RUNNERS = {}  # job type -> function(job) returning (result, http status)
+
+_sync_job_watchdog = None
+
+@firestore.transactional
+def _acquire_sync_lock(transaction, lock_ref, job_id):
+    """Take or extend the sync lock for job_id; returns the job id holding it afterwards"""
+    snapshot = lock_ref.get(transaction=transaction)
+    now = datetime.now(timezone.utc)
+    if snapshot.exists:
+        lock = snapshot.to_dict()
+        if lock.get('jobId') != job_id and lock.get('expiresAt') and lock['expiresAt'] > now:
+            return lock.get('jobId')
+    transaction.set(lock_ref, {
+        'jobId': job_id,
+        'worker': SYNC_WORKER_ID,
+        'expiresAt': now + timedelta(seconds=SYNC_JOB_LEASE_SECONDS),
+    })
+    return job_id
+
+@firestore.transactional
+def _release_sync_lock(transaction, lock_ref, job_id):
+    snapshot = lock_ref.get(transaction=transaction)
+    if snapshot.exists and snapshot.to_dict().get('jobId') == job_id:
+        transaction.delete(lock_ref)
+
+def acquire_sync_lock(job_id):
+    lock_ref = db.collection('sync_locks').document(SYNC_LOCK_NAME)
+    return _acquire_sync_lock(db.transaction(), lock_ref, job_id)
+
+def release_sync_lock(job_id):
+    lock_ref = db.collection('sync_locks').document(SYNC_LOCK_NAME)
+    _release_sync_lock(db.transaction(), lock_ref, job_id)
+
+def _sync_job_heartbeat(job, stop_event):
+    """Keep the lock lease and job heartbeat fresh while the job runs"""
+    while not stop_event.wait(SYNC_JOB_HEARTBEAT_SECONDS):
+        try:
+            if acquire_sync_lock(job['id']) != job['id']:
+                job['lock_lost'] = True
+                return
+            job['ref'].update({'heartbeatAt': datetime.now(timezone.utc)})
+        except Exception as e:
+            print(f"⚠️ Sync job {job['id']} heartbeat failed: {e}")
+
+def ensure_sync_lock_held(job):
+    """Stop a job whose lock lease was taken over (e.g. after a long stall)"""
+    if job is not None and job.get('lock_lost'):
+        raise RuntimeError('Sync lock was taken over by another worker')
+
+def record_sync_progress(job, checkpoint, packages_seen):
+    """Store progress and a checkpoint after a committed batch (no-op outside jobs)"""
+    if job is None:
+        return
+    job['progress']['batches_committed'] += 1
+    job['progress']['packages_seen'] = packages_seen
+    if not job.get('checkpoint_held'):
+        job['checkpoint'] = checkpoint
+    job['ref'].update({
+        'progress': job['progress'],
+        'checkpoint': job['checkpoint'],
+        'heartbeatAt': datetime.now(timezone.utc),
+    })
+
+def record_sync_error(job):
+    if job is not None:
+        job['progress']['errors'] += 1
+
+def _load_sync_job(snapshot):
+    data = snapshot.to_dict() or {}
+    return {
+        'id': snapshot.id,
+        'ref': snapshot.reference,
+        'type': data.get('type'),
+        'requestedBy': data.get('requestedBy', 'unknown'),
+        'checkpoint': data.get('checkpoint') or {},
+        'progress': {'packages_seen': 0, 'batches_committed': 0, 'errors': 0, **(data.get('progress') or {})},
+    }
+
+def run_sync_job(job):
+    """Run a job that already holds the sync lock; returns (result, http status)"""
+    stop_event = threading.Event()
+    threading.Thread(target=_sync_job_heartbeat, args=(job, stop_event), daemon=True).start()
+    job['ref'].update({
+        'status': 'running',
+        'worker': SYNC_WORKER_ID,
+        'startedAt': datetime.now(timezone.utc),
+        'heartbeatAt': datetime.now(timezone.utc),
+    })
+    
+    try:
+        outcome = SYNC_JOB_RUNNERS[job['type']](job)
+        result, status = outcome if isinstance(outcome, tuple) else (outcome, 200)
+        job['ref'].update({
+            'status': 'completed' if status < 400 else 'failed',
+            'result': result,
+            'progress': job['progress'],
+            'finishedAt': datetime.now(timezone.utc),
+        })
+        return result, status
+    except Exception as e:
+        print(f"❌ Sync job {job['id']} failed: {e}")
+        import traceback
+        traceback.print_exc()
+        job['ref'].update({
+            'status': 'failed',
+            'error': str(e),
+            'progress': job['progress'],
+            'finishedAt': datetime.now(timezone.utc),
+        })
+        return {'success': False, 'error': str(e)}, 500
+    finally:
+        stop_event.set()
+        try:
+            release_sync_lock(job['id'])
+        except Exception as e:
+            print(f"⚠️ Could not release sync lock for job {job['id']}: {e}")
+
+def submit_sync_job_request(job_type):
+    """Shared handler for the sync endpoints: authenticate, then queue (or with ?wait=true run) a job"""
+    api_key = request.headers.get('X-API-Key')
+    auth_header = request.headers.get('Authorization', '')
+    
+    user = None
+    if api_key:
+        user = authenticate_api_key(api_key)
+    elif auth_header.startswith('Bearer '):
+        user = authenticate_firebase_token(auth_header[7:])
+    
+    if not user:
+        return jsonify({'success': False, 'error': 'Unauthorized - API key or Firebase token required'}), 401
+    
+    job_ref = db.collection('sync_jobs').document()
+    holder = acquire_sync_lock(job_ref.id)
+    if holder != job_ref.id:
+        return jsonify({
+            'success': False,
+            'error': 'A package sync is already running',
+            'jobId': holder,
+            'statusUrl': f'/api/sync-jobs/{holder}',
+        }), 409
+    
+    job_ref.set({
+        'type': job_type,
+        'status': 'queued',
+        'requestedBy': user.get('email', 'unknown'),
+        'createdAt': datetime.now(timezone.utc),
+        'progress': {'packages_seen': 0, 'batches_committed': 0, 'errors': 0},
+        'checkpoint': {},
+    })
+    job = _load_sync_job(job_ref.get())
+    print(f"🗂️ Sync job {job['id']} ({job_type}) submitted by {job['requestedBy']}")
+    
+    if request.args.get('wait', '').lower() == 'true':
+        result, status = run_sync_job(job)
+        return jsonify({**result, 'jobId': job['id']}), status
+    
+    threading.Thread(target=run_sync_job, args=(job,), daemon=True).start()
+    return jsonify({
+        'success': True,
+        'jobId': job['id'],
+        'status': 'queued',
+        'statusUrl': f"/api/sync-jobs/{job['id']}",
+    }), 202
+
+def resume_stale_sync_jobs():
+    """Resume queued/running jobs whose worker stopped heartbeating"""
+    stale_before = datetime.now(timezone.utc) - timedelta(seconds=SYNC_JOB_LEASE_SECONDS)
+    for snapshot in db.collection('sync_jobs').where('status', 'in', ['queued', 'running']).stream():
+        data = snapshot.to_dict() or {}
+        if data.get('type') not in SYNC_JOB_RUNNERS:
+            continue
+        heartbeat = data.get('heartbeatAt') or data.get('createdAt')
+        if heartbeat and heartbeat > stale_before:
+            continue
+        if acquire_sync_lock(snapshot.id) != snapshot.id:
+            continue
+        print(f"♻️ Resuming sync job {snapshot.id} from checkpoint {data.get('checkpoint')}")
+        snapshot.reference.update({'resumedAt': datetime.now(timezone.utc), 'resumeCount': firestore.Increment(1)})
+        threading.Thread(target=run_sync_job, args=(_load_sync_job(snapshot),), daemon=True).start()
+
+def _watch_sync_jobs():
+    while True:
+        try:
+            resume_stale_sync_jobs()
+        except Exception as e:
+            print(f"⚠️ Sync job watchdog failed: {e}")
+        time.sleep(SYNC_JOB_LEASE_SECONDS)
+
+def start_sync_job_watchdog():
+    global _sync_job_watchdog
+    if _sync_job_watchdog is None:
+        _sync_job_watchdog = threading.Thread(target=_watch_sync_jobs, daemon=True)
+        _sync_job_watchdog.start()
+
+@app.route('/api/sync-jobs/<job_id>', methods=['GET'])
+def get_sync_job(job_id):
+    """Status, progress and result of a background sync job"""
+    try:
+        api_key = request.headers.get('X-API-Key')
+        auth_header = request.headers.get('Authorization', '')
+        
+        user = None
+        if api_key:
+            user = authenticate_api_key(api_key)
+        elif auth_header.startswith('Bearer '):
+            user = authenticate_firebase_token(auth_header[7:])
+        
+        if not user:
+            return jsonify({'success': False, 'error': 'Unauthorized - API key or Firebase token required'}), 401
+        
+        snapshot = db.collection('sync_jobs').document(job_id).get()
+        if not snapshot.exists:
+            return jsonify({'success': False, 'error': 'Sync job not found'}), 404
+        
+        job = {key: value.isoformat() if isinstance(value, datetime) else value
+               for key, value in snapshot.to_dict().items()}
+        return jsonify({'success': True, 'jobId': job_id, **job})
+        
+    except Exception as e:
+        print(f"❌ Error fetching sync job {job_id}: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 # ============================================================================
 # Package Sync Endpoints (Copy from Firebase)
 # These endpoints copy packages from Firebase Firestore collections
 # ============================================================================
 
+REGIONAL_IDENTIFIERS = frozenset([
+    'asia', 'europe', 'africa', 'americas', 'middle-east', 'middle east',
+    'oceania', 'caribbean', 'latin-america', 'latin america',
+    'north-america', 'south-america', 'central-america',
+    'eastern-europe', 'western-europe', 'scandinavia',
+    'asean', 'gcc', 'european-union', 'eu', 'mena',
+    'middle-east-and-north-africa', 'middle-east-north-africa',
+    'euconnect', 'euroconnect'  # Add specific regional operators
+])
+
+def _identifier_pattern(identifiers):
+    """Regex matching any identifier as a substring, as one prefix trie so each position is tried once"""
+    # An identifier that contains another can never be the only one found
+    identifiers = [word for word in identifiers
+                   if not any(other != word and other in word for other in identifiers)]
+    trie = {}
+    for word in identifiers:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+    
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        return branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+    return re.compile(build(trie))
+
+_REGIONAL_IDENTIFIER_RE = _identifier_pattern(REGIONAL_IDENTIFIERS)
+
 def categorize_plan(plan_data):
     """Categorize a plan as global, regional, or other based on its properties"""
     plan_type = (plan_data.get('type') or '').lower()
@@ -1277,6 +3966,38 @@ def categorize_plan(plan_data):
     plan_slug = (plan_data.get('slug') or '').lower()
     country_codes = plan_data.get('country_codes', []) or []
     
+    # Check if it's a global package
+    if (plan_data.get('is_global') == True or
+            plan_type == 'global' or
+            plan_region == 'global' or
+            plan_slug == 'global' or
+            plan_name == 'global' or
+            plan_slug.startswith('discover') or
+            plan_name.startswith('discover')):
+        return 'global'
+    
+    # Check if it's a regional package; cheap field checks first, then one scan of slug and name
+    if (plan_data.get('is_regional') == True or
+            plan_type == 'regional' or
+            plan_region in REGIONAL_IDENTIFIERS or
+            # Plans with no country codes or N/A are likely regional
+            (not country_codes or country_codes == ['N/A'] or country_codes == [None]) or
+            # Plans with multiple countries (2+) are likely regional
+            (isinstance(country_codes, list) and len(country_codes) >= 2) or
+            # Regional identifiers (including regional operators) anywhere in slug/name
+            _REGIONAL_IDENTIFIER_RE.search(f"{plan_slug}\n{plan_name}")):
+        return 'regional'
+    
+    return 'other'
+
+def _categorize_plan_reference(plan_data):
+    """The original substring-scan categorizer, kept as the reference for benchmark-categorizer"""
+    plan_type = (plan_data.get('type') or '').lower()
+    plan_region = (plan_data.get('region') or plan_data.get('region_slug') or '').lower()
+    plan_name = (plan_data.get('name') or plan_data.get('title') or '').lower()
+    plan_slug = (plan_data.get('slug') or '').lower()
+    country_codes = plan_data.get('country_codes', []) or []
+    
     # Check if it's a global package
     is_global = (
         plan_data.get('is_global') == True or
@@ -1322,23 +4043,37 @@ def categorize_plan(plan_data):
     else:
         return 'other'
 
-def _sync_packages_from_firebase():
+def _sync_packages_from_firebase(job=None):
     """Internal function to copy packages from Firebase dataplans collection"""
     print(f"🔄 Copying packages from Firebase dataplans collection")
     
-    # Read all packages from dataplans collection
-    plans_ref = db.collection('dataplans')
+    # Resume after the last committed batch when an interrupted job is picked up again
+    checkpoint = (job or {}).get('checkpoint') or {}
+    resume_after = checkpoint.get('last_id') if checkpoint.get('stage') == 'plans' else None
+    
+    # Read all packages from dataplans collection, in id order so a checkpoint can resume it
+    plans_ref = db.collection('dataplans').order_by('__name__')
+    if resume_after:
+        print(f"♻️ Resuming after {resume_after}")
+        plans_ref = plans_ref.start_after({'__name__': resume_after})
     plans_docs = plans_ref.stream()
     
     synced_count = 0
     global_count = 0
     regional_count = 0
     other_count = 0
-    batch = db.batch()
-    batch_count = 0
-    MAX_BATCH_SIZE = 500
+    written_count = 0
+    skipped_count = 0
+    sync_state = {}
+    writer = start_bulk_writer('plans')
+    
+    seen_count = 0
+    last_id = resume_after
     
     for doc in plans_docs:
+        seen_count += 1
+        last_id = doc.id
+        ensure_sync_lock_held(job)
         try:
             plan_data = doc.to_dict()
             plan_id = doc.id
@@ -1351,8 +4086,10 @@ def _sync_packages_from_firebase():
             if plan_data.get('is_topup_package', False):
                 continue
             
-            # Categorize the plan
-            category = categorize_plan(plan_data)
+            # Categorize the plan, storing it with the other derived display fields
+            # so the public endpoints don't recompute them
+            plan_data.update(derive_catalog_fields(plan_data))
+            category = plan_data['category']
             
             if category == 'global':
                 global_count += 1
@@ -1361,34 +4098,46 @@ def _sync_packages_from_firebase():
             else:
                 other_count += 1
             
-            # Copy package to dataplans collection (update existing or create new)
-            plan_ref = db.collection('dataplans').document(plan_id)
-            batch.set(plan_ref, plan_data, merge=True)
-            batch_count += 1
+            # Only documents whose content hash changed since the last sync are rewritten
+            if stamp_catalog_change('plans', plan_data, plan_data, sync_state):
+                plan_ref = db.collection('dataplans').document(plan_id)
+                if bulk_write(writer, 'set', plan_ref, plan_data, merge=True):
+                    bulk_writer_checkpoint(writer, functools.partial(
+                        record_sync_progress, job, {'stage': 'plans', 'last_id': plan_id}, seen_count))
+                written_count += 1
+            else:
+                skipped_count += 1
             synced_count += 1
             
-            if batch_count >= MAX_BATCH_SIZE:
-                batch.commit()
-                batch = db.batch()
-                batch_count = 0
-                
         except Exception as e:
             print(f"⚠️ Error processing package {doc.id}: {e}")
+            record_sync_error(job)
             continue
     
-    # Commit remaining batch
-    if batch_count > 0:
-        batch.commit()
+    # Wait for the remaining batches
+    write_metrics = close_bulk_writer(writer)
+    if write_metrics['batches'] and not write_metrics['failed_writes']:
+        record_sync_progress(job, {'stage': 'plans', 'last_id': last_id}, seen_count)
     
     print(f"✅ Successfully copied {synced_count} packages from Firebase")
+    print(f"   - Written: {written_count}, unchanged: {skipped_count}")
     print(f"   - Global: {global_count}")
     print(f"   - Regional: {regional_count}")
     print(f"   - Other: {other_count}")
     
+    publish_catalog_version('plans', sync_state)
+    refresh_catalog_after_sync('plans')
+    
     return {
         'success': True,
         'message': f'Successfully copied {synced_count} packages from Firebase',
         'total_synced': synced_count,
+        'resumed_after': resume_after,
+        'written_count': written_count,
+        'write_metrics': write_metrics,
+        'skipped_count': skipped_count,
+        'changed_count': sync_state.get('changed', 0),
+        'catalog_version': sync_state.get('version'),
         'global_count': global_count,
         'regional_count': regional_count,
         'other_count': other_count,
@@ -1396,24 +4145,10 @@ def _sync_packages_from_firebase():
 
 @app.route('/api/sync-packages', methods=['POST'])
 def sync_packages():
-    """Copy packages from Firebase dataplans collection (sync from Firestore)"""
+    """Copy packages from Firebase dataplans collection (sync from Firestore) as a background job"""
     try:
-        # Authenticate user via Firebase ID token or API key
-        auth_header = request.headers.get('Authorization', '')
-        api_key = request.headers.get('X-API-Key', '')
-        
-        user = None
-        if api_key:
-            user = authenticate_api_key(api_key)
-        elif auth_header.startswith('Bearer '):
-            id_token = auth_header[7:]
-            user = authenticate_firebase_token(id_token)
-        
-        if not user:
-            return jsonify({'success': False, 'error': 'Unauthorized - API key or Firebase token required'}), 401
-        
-        result = _sync_packages_from_firebase()
-        return jsonify(result)
+        # Runs as a background job; poll /api/sync-jobs/<jobId> (or pass ?wait=true)
+        return submit_sync_job_request('packages')
         
     except Exception as e:
         print(f"❌ Error copying packages: {e}")
@@ -1421,12 +4156,19 @@ def sync_packages():
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
 
-def _sync_topup_packages_from_firebase():
+def _sync_topup_packages_from_firebase(job=None):
     """Internal function to copy topup packages from Firebase topups collection"""
     print(f"🔄 Copying topup packages from Firebase topups collection")
     
-    # Read all topup packages from topups collection
-    topups_ref = db.collection('topups')
+    # Resume after the last committed batch when an interrupted job is picked up again
+    checkpoint = (job or {}).get('checkpoint') or {}
+    resume_after = checkpoint.get('last_id') if checkpoint.get('stage') == 'topups' else None
+    
+    # Read all topup packages from topups collection, in id order so a checkpoint can resume it
+    topups_ref = db.collection('topups').order_by('__name__')
+    if resume_after:
+        print(f"♻️ Resuming after {resume_after}")
+        topups_ref = topups_ref.start_after({'__name__': resume_after})
     topups_docs = topups_ref.stream()
     
     synced_count = 0
@@ -1434,11 +4176,18 @@ def _sync_topup_packages_from_firebase():
     global_count = 0
     regional_count = 0
     other_count = 0
-    batch = db.batch()
-    batch_count = 0
-    MAX_BATCH_SIZE = 500
+    written_count = 0
+    skipped_count = 0
+    sync_state = {}
+    writer = start_bulk_writer('topups')
+    
+    seen_count = 0
+    last_id = resume_after
     
     for doc in topups_docs:
+        seen_count += 1
+        last_id = doc.id
+        ensure_sync_lock_held(job)
         try:
             plan_data = doc.to_dict()
             plan_id = doc.id
@@ -1453,8 +4202,10 @@ def _sync_topup_packages_from_firebase():
             
             topup_count += 1
             
-            # Categorize the plan
-            category = categorize_plan(plan_data)
+            # Categorize the plan, storing it with the other derived display fields
+            # so the public endpoints don't recompute them
+            plan_data.update(derive_catalog_fields(plan_data))
+            category = plan_data['category']
             
             if category == 'global':
                 global_count += 1
@@ -1463,35 +4214,47 @@ def _sync_topup_packages_from_firebase():
             else:
                 other_count += 1
             
-            # Copy topup package to topups collection (update existing or create new)
-            plan_ref = db.collection('topups').document(plan_id)
-            batch.set(plan_ref, plan_data, merge=True)
-            batch_count += 1
+            # Only documents whose content hash changed since the last sync are rewritten
+            if stamp_catalog_change('topups', plan_data, plan_data, sync_state):
+                plan_ref = db.collection('topups').document(plan_id)
+                if bulk_write(writer, 'set', plan_ref, plan_data, merge=True):
+                    bulk_writer_checkpoint(writer, functools.partial(
+                        record_sync_progress, job, {'stage': 'topups', 'last_id': plan_id}, seen_count))
+                written_count += 1
+            else:
+                skipped_count += 1
             synced_count += 1
             
-            if batch_count >= MAX_BATCH_SIZE:
-                batch.commit()
-                batch = db.batch()
-                batch_count = 0
-                
         except Exception as e:
             print(f"⚠️ Error processing topup package {doc.id}: {e}")
+            record_sync_error(job)
             continue
     
-    # Commit remaining batch
-    if batch_count > 0:
-        batch.commit()
+    # Wait for the remaining batches
+    write_metrics = close_bulk_writer(writer)
+    if write_metrics['batches'] and not write_metrics['failed_writes']:
+        record_sync_progress(job, {'stage': 'topups', 'last_id': last_id}, seen_count)
     
     print(f"✅ Successfully copied {synced_count} topup packages from Firebase")
+    print(f"   - Written: {written_count}, unchanged: {skipped_count}")
     print(f"   - Total topup packages: {topup_count}")
     print(f"   - Global: {global_count}")
     print(f"   - Regional: {regional_count}")
     print(f"   - Other: {other_count}")
     
+    publish_catalog_version('topups', sync_state)
+    refresh_catalog_after_sync('topups')
+    
     return {
         'success': True,
         'message': f'Successfully copied {synced_count} topup packages from Firebase',
         'total_synced': synced_count,
+        'resumed_after': resume_after,
+        'written_count': written_count,
+        'write_metrics': write_metrics,
+        'skipped_count': skipped_count,
+        'changed_count': sync_state.get('changed', 0),
+        'catalog_version': sync_state.get('version'),
         'topup_count': topup_count,
         'global_count': global_count,
         'regional_count': regional_count,
@@ -1500,24 +4263,10 @@ def _sync_topup_packages_from_firebase():
 
 @app.route('/api/sync-topup-packages', methods=['POST'])
 def sync_topup_packages():
-    """Copy topup packages from Firebase topups collection (sync from Firestore)"""
+    """Copy topup packages from Firebase topups collection (sync from Firestore) as a background job"""
     try:
-        # Authenticate user via Firebase ID token or API key
-        auth_header = request.headers.get('Authorization', '')
-        api_key = request.headers.get('X-API-Key', '')
-        
-        user = None
-        if api_key:
-            user = authenticate_api_key(api_key)
-        elif auth_header.startswith('Bearer '):
-            id_token = auth_header[7:]
-            user = authenticate_firebase_token(id_token)
-        
-        if not user:
-            return jsonify({'success': False, 'error': 'Unauthorized - API key or Firebase token required'}), 401
-        
-        result = _sync_topup_packages_from_firebase()
-        return jsonify(result)
+        # Runs as a background job; poll /api/sync-jobs/<jobId> (or pass ?wait=true)
+        return submit_sync_job_request('topups')
         
     except Exception as e:
         print(f"❌ Error copying topup packages: {e}")
@@ -1525,71 +4274,75 @@ def sync_topup_packages():
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
 
+def _sync_all_packages(job=None):
+    """Copy both regular and topup packages; the plans stage is checkpointed so a resumed job skips it"""
+    print(f"🔄 Copying all packages from Firebase (regular + topup)")
+    
+    # Copy regular packages (skipped when resuming a job that already finished them)
+    regular_result = {'success': False, 'error': 'Not executed'}
+    try:
+        if job and job['checkpoint'].get('stage') == 'topups':
+            regular_result = job['checkpoint'].get('regular_result') or {'success': True, 'resumed': True}
+        else:
+            regular_result = _sync_packages_from_firebase(job)
+            if job and (regular_result.get('write_metrics') or {}).get('failed_writes'):
+                # Keep the last clean plans checkpoint so a resumed job retries the lost writes
+                job['checkpoint_held'] = True
+            elif job:
+                job['checkpoint'] = {'stage': 'topups', 'regular_result': regular_result}
+                job['ref'].update({'checkpoint': job['checkpoint']})
+    except Exception as e:
+        regular_result = {'success': False, 'error': str(e)}
+        print(f"❌ Error copying regular packages: {e}")
+    
+    # Copy topup packages
+    topup_result = {'success': False, 'error': 'Not executed'}
+    try:
+        topup_result = _sync_topup_packages_from_firebase(job)
+    except Exception as e:
+        topup_result = {'success': False, 'error': str(e)}
+        print(f"❌ Error copying topup packages: {e}")
+    
+    # Combine results
+    combined_result = {
+        'success': regular_result.get('success', False) and topup_result.get('success', False),
+        'regular': {
+            'success': regular_result.get('success', False),
+            'total_synced': regular_result.get('total_synced', 0),
+            'written_count': regular_result.get('written_count', 0),
+            'skipped_count': regular_result.get('skipped_count', 0),
+            'global_count': regular_result.get('global_count', 0),
+            'regional_count': regular_result.get('regional_count', 0),
+            'other_count': regular_result.get('other_count', 0),
+            'error': regular_result.get('error')
+        },
+        'topup': {
+            'success': topup_result.get('success', False),
+            'total_synced': topup_result.get('total_synced', 0),
+            'written_count': topup_result.get('written_count', 0),
+            'skipped_count': topup_result.get('skipped_count', 0),
+            'topup_count': topup_result.get('topup_count', 0),
+            'global_count': topup_result.get('global_count', 0),
+            'regional_count': topup_result.get('regional_count', 0),
+            'other_count': topup_result.get('other_count', 0),
+            'error': topup_result.get('error')
+        },
+        'total_synced': regular_result.get('total_synced', 0) + topup_result.get('total_synced', 0)
+    }
+    
+    print(f"✅ Copy all completed:")
+    print(f"   Regular: {combined_result['regular']['total_synced']} packages")
+    print(f"   Topup: {combined_result['topup']['total_synced']} packages")
+    print(f"   Total: {combined_result['total_synced']} packages")
+    
+    return combined_result
+
 @app.route('/api/sync-all-packages', methods=['POST'])
 def sync_all_packages():
-    """Copy both regular and topup packages from Firebase (convenience endpoint)"""
+    """Copy both regular and topup packages from Firebase (convenience endpoint) as a background job"""
     try:
-        # Authenticate user
-        auth_header = request.headers.get('Authorization', '')
-        api_key = request.headers.get('X-API-Key', '')
-        
-        user = None
-        if api_key:
-            user = authenticate_api_key(api_key)
-        elif auth_header.startswith('Bearer '):
-            id_token = auth_header[7:]
-            user = authenticate_firebase_token(id_token)
-        
-        if not user:
-            return jsonify({'success': False, 'error': 'Unauthorized - API key or Firebase token required'}), 401
-        
-        print(f"🔄 Copying all packages from Firebase (regular + topup)")
-        
-        # Copy regular packages
-        regular_result = {'success': False, 'error': 'Not executed'}
-        try:
-            regular_result = _sync_packages_from_firebase()
-        except Exception as e:
-            regular_result = {'success': False, 'error': str(e)}
-            print(f"❌ Error copying regular packages: {e}")
-        
-        # Copy topup packages
-        topup_result = {'success': False, 'error': 'Not executed'}
-        try:
-            topup_result = _sync_topup_packages_from_firebase()
-        except Exception as e:
-            topup_result = {'success': False, 'error': str(e)}
-            print(f"❌ Error copying topup packages: {e}")
-        
-        # Combine results
-        combined_result = {
-            'success': regular_result.get('success', False) and topup_result.get('success', False),
-            'regular': {
-                'success': regular_result.get('success', False),
-                'total_synced': regular_result.get('total_synced', 0),
-                'global_count': regular_result.get('global_count', 0),
-                'regional_count': regular_result.get('regional_count', 0),
-                'other_count': regular_result.get('other_count', 0),
-                'error': regular_result.get('error')
-            },
-            'topup': {
-                'success': topup_result.get('success', False),
-                'total_synced': topup_result.get('total_synced', 0),
-                'topup_count': topup_result.get('topup_count', 0),
-                'global_count': topup_result.get('global_count', 0),
-                'regional_count': topup_result.get('regional_count', 0),
-                'other_count': topup_result.get('other_count', 0),
-                'error': topup_result.get('error')
-            },
-            'total_synced': regular_result.get('total_synced', 0) + topup_result.get('total_synced', 0)
-        }
-        
-        print(f"✅ Copy all completed:")
-        print(f"   Regular: {combined_result['regular']['total_synced']} packages")
-        print(f"   Topup: {combined_result['topup']['total_synced']} packages")
-        print(f"   Total: {combined_result['total_synced']} packages")
-        
-        return jsonify(combined_result)
+        # Runs as a background job; poll /api/sync-jobs/<jobId> (or pass ?wait=true)
+        return submit_sync_job_request('all')
         
     except Exception as e:
         print(f"❌ Error copying all packages: {e}")
@@ -1597,7 +4350,126 @@ def sync_all_packages():
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
 
+SYNC_JOB_RUNNERS.update({
+    'packages': _sync_packages_from_firebase,
+    'topups': _sync_topup_packages_from_firebase,
+    'all': _sync_all_packages,
+})
+def rebuild_balances_command(args):
+    """CLI: python server.py rebuild-balances [--verify] [uid ...]"""
+    verify_only = '--verify' in args
+    uids = [arg for arg in args if not arg.startswith('--')]
+    if not uids:
+        uids = [doc.id for doc in db.collection('business_users').select(['email']).stream()]
+    
+    mismatches = 0
+    for uid in uids:
+        if verify_only:
+            result = verify_user_balance(uid)
+            status = '✅' if result['matches'] else '❌'
+            if not result['matches']:
+                mismatches += 1
+            materialized = 'no checkpoint' if result['materialized'] is None else f"{result['materialized']:.2f}"
+            print(f"{status} {uid}: materialized={materialized} ledger={result['ledger']:.2f}")
+            for path in result['untimestamped']:
+                print(f"   ⚠️ {path}: createdAt missing or not a Timestamp (not seen past the checkpoint)")
+        else:
+            result = rebuild_user_balance(uid)
+            print(f"🔄 {uid}: balance={result['balance']:.2f} ({result['entries']} entries)")
+    
+    print(f"Done: {len(uids)} balances {'verified' if verify_only else 'rebuilt'}, {mismatches} mismatches")
+    return 1 if mismatches else 0
+
+def backfill_iccid_index_command(args):
+    """CLI: python server.py backfill-iccid-index
+
+    Indexes every ICCID found in users/*/esims and orders. Orders are written
+    last so their entries win when both carry the same ICCID.
+    """
+    sources = [('users/*/esims', db.collection_group('esims').stream()), ('orders', db.collection('orders').stream())]
+    batch = db.batch()
+    batch_count = 0
+    MAX_BATCH_SIZE = 500
+    
+    for label, documents in sources:
+        scanned = 0
+        indexed = 0
+        for doc in documents:
+            scanned += 1
+            order_data = doc.to_dict() or {}
+            if batch_count + len(order_iccids(order_data)) > MAX_BATCH_SIZE:
+                batch.commit()
+                batch = db.batch()
+                batch_count = 0
+            
+            iccids = index_order_iccids(doc.reference, order_data, batch=batch)
+            indexed += len(iccids)
+            batch_count += len(iccids)
+        print(f"🔄 {label}: scanned {scanned} documents, indexed {indexed} ICCIDs")
+    
+    if batch_count > 0:
+        batch.commit()
+    print(f"Done: iccid_index backfilled")
+    return 0
+
+def benchmark_categorizer_command(args):
+    """CLI: python server.py benchmark-categorizer [rounds]
+
+    Times categorize_plan against the original substring-scan implementation
+    on the stored dataplans and topups, and checks they agree on every plan.
+    """
+    import timeit
+    rounds = int(args[0]) if args else 20
+    plans = [doc.to_dict() or {}
+             for collection_name in ('dataplans', 'topups')
+             for doc in db.collection(collection_name).select(_CATEGORY_SOURCE_FIELDS).stream()]
+    if not plans:
+        print("⚠️ No plans to benchmark")
+        return 1
+    
+    mismatches = [plan.get('slug') for plan in plans if categorize_plan(plan) != _categorize_plan_reference(plan)]
+    timings = {}
+    for label, categorize in (('reference', _categorize_plan_reference), ('categorize_plan', categorize_plan)):
+        best = min(timeit.repeat(lambda: [categorize(plan) for plan in plans], number=1, repeat=rounds))
+        timings[label] = best / len(plans) * 1e6
+        print(f"⏱️ {label}: {timings[label]:.2f} µs/plan")
+    print(f"🚀 {timings['reference'] / timings['categorize_plan']:.1f}x faster over {len(plans)} plans (best of {rounds})")
+    
+    if mismatches:
+        print(f"❌ {len(mismatches)} plans categorized differently, e.g. {mismatches[:10]}")
+        return 1
+    print("✅ Both implementations agree on every plan")
+    return 0
+
+def start_background_services():
+    """Start the listeners and background threads the server runs on.
+    
+    Only the server starts them (gunicorn workers on import, `python server.py`
+    before app.run): the CLI commands above share this module, and a one-shot
+    process must not take sync_locks or resume a sync job it will kill on exit.
+    """
+    start_api_key_listener()
+    start_sync_job_watchdog()
+    start_order_intent_recovery()
+    start_usage_buffer_flusher()
+    # The disk snapshot serves requests until the catalog listeners have caught up
+    load_catalog_snapshot()
+    start_catalog_listeners()
+
+if __name__ != '__main__':
+    start_background_services()  # Imported by gunicorn (server:app)
+
 if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'rebuild-balances':
+        sys.exit(rebuild_balances_command(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'backfill-iccid-index':
+        sys.exit(backfill_iccid_index_command(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark-categorizer':
+        sys.exit(benchmark_categorizer_command(sys.argv[2:]))
+    
+    start_background_services()
+    
     port = int(os.getenv('PORT', 5000))
     host = os.getenv('HOST', '0.0.0.0')
     debug = os.getenv('DEBUG', 'True').lower() == 'true'
@@ -1,6 +1,10 @@
 import os
 import json
+import threading
 import requests
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, request, jsonify
 from dotenv import load_dotenv
 from flask_cors import CORS
@@ -23,6 +27,43 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 IMAGE_MODEL = os.getenv('IMAGE_MODEL', 'dall-e-3')  # For OpenAI: dall-e-2, dall-e-3
 CHAT_MODEL = os.getenv('CHAT_MODEL', 'gpt-4o-mini')  # For OpenAI: gpt-4o-mini, gpt-4o, etc.
 
+# ============================================================================
+# Upstream HTTP Client
+# One pooled keep-alive Session per upstream host, with connect/read timeouts
+# configured per upstream. Failed connects are retried; reads never are, so a
+# POST that reached the upstream is not replayed.
+# ============================================================================
+
+UPSTREAM_POOL_SIZE = int(os.getenv('UPSTREAM_POOL_SIZE', 10))
+UPSTREAM_TIMEOUTS = {
+    'openai_images': (float(os.getenv('OPENAI_CONNECT_TIMEOUT', 5)), float(os.getenv('OPENAI_IMAGE_READ_TIMEOUT', 120))),  # Image generation can take time
+    'openai_chat': (float(os.getenv('OPENAI_CONNECT_TIMEOUT', 5)), float(os.getenv('OPENAI_CHAT_READ_TIMEOUT', 60))),
+}
+
+_upstream_sessions = {}
+_upstream_sessions_lock = threading.Lock()
+
+def get_upstream_session(url):
+    """Shared keep-alive Session for the host of url"""
+    host = urlsplit(url).netloc
+    session = _upstream_sessions.get(host)
+    if session is None:
+        with _upstream_sessions_lock:
+            session = _upstream_sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=UPSTREAM_POOL_SIZE,
+                                      max_retries=Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.2))
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _upstream_sessions[host] = session
+    return session
+
+def upstream_request(upstream, method, url, **kwargs):
+    """Send a request through the pooled session, with the upstream's (connect, read) timeouts"""
+    kwargs.setdefault('timeout', UPSTREAM_TIMEOUTS[upstream])
+    return get_upstream_session(url).request(method, url, **kwargs)
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
@@ -73,11 +114,10 @@ def generate_image():
         api_url = 'https://api.openai.com/v1/images/generations'
         
         # Call the API
-        response = requests.post(
+        response = upstream_request('openai_images', 'POST',
             api_url,
             headers=headers,
-            json=payload,
-            timeout=120  # Image generation can take time
+            json=payload
         )
         
         if not response.ok:
@@ -154,11 +194,10 @@ def chat_completion():
         api_url = 'https://api.openai.com/v1/chat/completions'
         
         # Call the API
-        response = requests.post(
+        response = upstream_request('openai_chat', 'POST',
             api_url,
             headers=headers,
-            json=payload,
-            timeout=60  # Chat completion timeout
+            json=payload
         )
         
         if not response.ok:
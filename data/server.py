@@ -3,13 +3,22 @@ Standalone Flask server for data usage/balance checks only
 Simple, no circular imports, just works
 """
 import os
+import hashlib
 import json
+import time
+import fcntl
+import tempfile
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from firebase_admin import credentials, firestore, auth
 import firebase_admin
 from dotenv import load_dotenv
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from airalo import Airalo
 
 load_dotenv()
@@ -33,6 +42,68 @@ AIRALO_CLIENT_ID = os.getenv('AIRALO_CLIENT_ID')
 AIRALO_CLIENT_SECRET = os.getenv('AIRALO_CLIENT_SECRET')
 AIRALO_BASE_URL = os.getenv('AIRALO_BASE_URL', 'https://partners-api.airalo.com')
 
+# ============================================================================
+# Upstream HTTP Client
+# One pooled keep-alive Session per upstream host, with connect/read timeouts
+# configured per upstream. Failed connects are retried; reads never are, so a
+# POST that reached the upstream is not replayed.
+# ============================================================================
+
+UPSTREAM_POOL_SIZE = int(os.getenv('UPSTREAM_POOL_SIZE', 10))
+UPSTREAM_TIMEOUTS = {
+    'airalo': (float(os.getenv('AIRALO_CONNECT_TIMEOUT', 5)), float(os.getenv('AIRALO_READ_TIMEOUT', 30))),
+}
+
+_upstream_sessions = {}
+_upstream_sessions_lock = threading.Lock()
+
+def get_upstream_session(url):
+    """Shared keep-alive Session for the host of url"""
+    host = urlsplit(url).netloc
+    session = _upstream_sessions.get(host)
+    if session is None:
+        with _upstream_sessions_lock:
+            session = _upstream_sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=UPSTREAM_POOL_SIZE,
+                                      max_retries=Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.2))
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _upstream_sessions[host] = session
+    return session
+
+def upstream_request(upstream, method, url, **kwargs):
+    """Send a request through the pooled session, with the upstream's (connect, read) timeouts.
+    
+    An Airalo request rejected with 401 is retried once with a fresh token, in
+    case Airalo revoked or rotated the cached one (a 401 was not processed, so
+    this is safe for POSTs too).
+    """
+    kwargs.setdefault('timeout', UPSTREAM_TIMEOUTS[upstream])
+    response = get_upstream_session(url).request(method, url, **kwargs)
+    headers = kwargs.get('headers') or {}
+    if upstream == 'airalo' and response.status_code == 401 and 'Authorization' in headers:
+        rejected_token = headers['Authorization'].split(' ', 1)[-1]
+        token = get_airalo_token()
+        if token == rejected_token:
+            token = get_airalo_token(force_refresh=True)
+        if token and token != rejected_token:
+            print(f"🔑 Airalo rejected the cached token, retrying with a fresh one")
+            kwargs['headers'] = {**headers, 'Authorization': f'Bearer {token}'}
+            response = get_upstream_session(url).request(method, url, **kwargs)
+    return response
+
+# Airalo token cache - the file store is shared by all worker processes
+AIRALO_TOKEN_CACHE_FILE = os.getenv('AIRALO_TOKEN_CACHE_FILE', '/tmp/airalo_token.json')
+AIRALO_TOKEN_REFRESH_MARGIN = int(os.getenv('AIRALO_TOKEN_REFRESH_MARGIN', 300))  # Refresh 5 minutes before expiry
+AIRALO_TOKEN_DEFAULT_TTL = 3600  # Used when Airalo does not return expires_in
+
+_airalo_token_cache = {}
+_airalo_token_lock = threading.Lock()
+_airalo_token_state_lock = threading.Lock()
+_airalo_token_refresh_pending = False
+
 alo = None
 if AIRALO_CLIENT_ID and AIRALO_CLIENT_SECRET:
     try:
@@ -45,10 +116,70 @@ if AIRALO_CLIENT_ID and AIRALO_CLIENT_SECRET:
         print(f"⚠️ Airalo SDK initialization failed: {e}")
         alo = None
 
+# ============================================================================
+# Firebase ID Token Cache
+# Verified claims are kept in a bounded LRU keyed by the token's SHA-256
+# digest until the token's own "exp"
+# ============================================================================
+
+FIREBASE_TOKEN_CACHE_SIZE = int(os.getenv('FIREBASE_TOKEN_CACHE_SIZE', 10000))
+FIREBASE_ID_TOKEN_CERT_URL = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
+
+_firebase_token_cache = OrderedDict()
+_firebase_token_cache_lock = threading.Lock()
+_firebase_token_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def verify_firebase_id_token(id_token):
+    """Verify a Firebase ID token, reusing cached claims while the token is unexpired"""
+    digest = hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+    now = time.time()
+    
+    with _firebase_token_cache_lock:
+        cached = _firebase_token_cache.get(digest)
+        if cached is not None:
+            if cached['exp'] > now:
+                _firebase_token_cache.move_to_end(digest)
+                _firebase_token_cache_stats['hits'] += 1
+                return cached['claims']
+            del _firebase_token_cache[digest]
+        _firebase_token_cache_stats['misses'] += 1
+    
+    decoded_token = auth.verify_id_token(id_token)
+    
+    with _firebase_token_cache_lock:
+        _firebase_token_cache[digest] = {'claims': decoded_token, 'exp': decoded_token.get('exp', 0)}
+        _firebase_token_cache.move_to_end(digest)
+        while len(_firebase_token_cache) > FIREBASE_TOKEN_CACHE_SIZE:
+            _firebase_token_cache.popitem(last=False)
+            _firebase_token_cache_stats['evictions'] += 1
+    
+    return decoded_token
+
+def get_firebase_token_cache_stats():
+    """Hit/miss counters for the ID token cache"""
+    with _firebase_token_cache_lock:
+        lookups = _firebase_token_cache_stats['hits'] + _firebase_token_cache_stats['misses']
+        return {
+            **_firebase_token_cache_stats,
+            'size': len(_firebase_token_cache),
+            'hit_rate': round(_firebase_token_cache_stats['hits'] / lookups, 4) if lookups else 0,
+        }
+
+def warm_firebase_public_keys():
+    """Prefetch the securetoken certificates into firebase_admin's cache-control session"""
+    try:
+        client = auth._get_client(firebase_admin.get_app())
+        client._token_verifier.request(url=FIREBASE_ID_TOKEN_CERT_URL)
+        print(f"🔑 Firebase public keys prefetched")
+    except Exception as e:
+        print(f"⚠️ Could not prefetch Firebase public keys: {e}")
+
+threading.Thread(target=warm_firebase_public_keys, daemon=True).start()
+
 def authenticate_firebase_token(id_token):
     """Authenticate Firebase ID token"""
     try:
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = verify_firebase_id_token(id_token)
         return {
             'uid': decoded_token['uid'],
             'email': decoded_token.get('email'),
@@ -58,12 +189,187 @@ def authenticate_firebase_token(id_token):
         print(f"Firebase token authentication error: {e}")
         return None
 
+def _load_airalo_token_store():
+    """Read the token shared by all workers from the cache file"""
+    try:
+        with open(AIRALO_TOKEN_CACHE_FILE, 'r') as f:
+            entry = json.load(f)
+        if entry.get('access_token') and entry.get('expires_at'):
+            return entry
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _save_airalo_token_store(entry):
+    """Atomically write the token to the cache file so other workers can reuse it"""
+    try:
+        cache_dir = os.path.dirname(AIRALO_TOKEN_CACHE_FILE) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.airalo_token_')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, AIRALO_TOKEN_CACHE_FILE)
+    except OSError as e:
+        print(f"⚠️ Could not persist Airalo token cache: {e}")
+
+def _fetch_airalo_token():
+    """Request a new access token from Airalo /v2/token"""
+    response = upstream_request('airalo', 'POST',
+        f'{AIRALO_BASE_URL}/v2/token',
+        json={
+            'client_id': AIRALO_CLIENT_ID,
+            'client_secret': AIRALO_CLIENT_SECRET,
+            'grant_type': 'client_credentials'
+        }
+    )
+    response.raise_for_status()
+    data = response.json()
+    # v2 API returns {"data": {"access_token": "...", "expires_in": <seconds>}}
+    token_data = data.get('data', {})
+    access_token = token_data.get('access_token')
+    if not access_token:
+        raise ValueError('No access_token in Airalo token response')
+    expires_in = int(token_data.get('expires_in') or AIRALO_TOKEN_DEFAULT_TTL)
+    return {'access_token': access_token, 'expires_at': time.time() + expires_in}
+
+def _refresh_airalo_token(stale_token=None):
+    """Refresh the Airalo token (single-flight within the process and across workers)"""
+    global _airalo_token_cache
+    with _airalo_token_lock:
+        with open(f"{AIRALO_TOKEN_CACHE_FILE}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Another thread or worker may have refreshed while we were waiting
+                entry = _load_airalo_token_store()
+                if (entry and entry['access_token'] != stale_token and
+                        entry['expires_at'] - time.time() > AIRALO_TOKEN_REFRESH_MARGIN):
+                    _airalo_token_cache = entry
+                    return entry['access_token']
+                
+                entry = _fetch_airalo_token()
+                _save_airalo_token_store(entry)
+                _airalo_token_cache = entry
+                print(f"🔑 Airalo token refreshed (valid for {int(entry['expires_at'] - time.time())}s)")
+                return entry['access_token']
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _schedule_airalo_token_refresh(stale_token):
+    """Refresh the token in the background while callers keep using the current one"""
+    global _airalo_token_refresh_pending
+    with _airalo_token_state_lock:
+        if _airalo_token_refresh_pending:
+            return
+        _airalo_token_refresh_pending = True
+    
+    def run():
+        global _airalo_token_refresh_pending
+        try:
+            _refresh_airalo_token(stale_token)
+        except Exception as e:
+            print(f"⚠️ Background Airalo token refresh failed: {e}")
+        finally:
+            with _airalo_token_state_lock:
+                _airalo_token_refresh_pending = False
+    
+    threading.Thread(target=run, daemon=True).start()
+
+def get_airalo_token(force_refresh=False):
+    """Get Airalo API token (cached until shortly before expiry)"""
+    global _airalo_token_cache
+    try:
+        now = time.time()
+        entry = _airalo_token_cache
+        if not entry.get('access_token') or entry.get('expires_at', 0) <= now:
+            entry = _load_airalo_token_store() or {}
+            if entry:
+                _airalo_token_cache = entry
+        
+        token = entry.get('access_token')
+        expires_at = entry.get('expires_at', 0)
+        
+        if force_refresh or not token or expires_at <= now:
+            return _refresh_airalo_token(stale_token=token)
+        
+        if expires_at - now <= AIRALO_TOKEN_REFRESH_MARGIN:
+            _schedule_airalo_token_refresh(token)
+        
+        return token
+    except Exception as e:
+        print(f"Airalo token error: {e}")
+        return None
+
+# ============================================================================
+# ICCID Index
+# iccid_index/{iccid} maps an eSIM to the order that created it, so ICCID
+# lookups are a single document get instead of a scan over every order.
+# Entries are written by the order services (api, sdk, sandbox).
+# ============================================================================
+
+def order_country_codes(order_data):
+    """Country codes of an order, from its own fields and the Airalo order data"""
+    codes = (
+        order_data.get('countryCode') or
+        order_data.get('country_code') or
+        order_data.get('countryCodes') or
+        order_data.get('country_codes') or
+        []
+    )
+    if isinstance(codes, str):
+        codes = [codes]
+    elif not isinstance(codes, list):
+        codes = []
+    codes = list(codes)
+    
+    airalo_data = order_data.get('airaloOrderData') or {}
+    package = airalo_data.get('package')
+    package_code = (package.get('country_code') or package.get('countryCode')) if isinstance(package, dict) else None
+    for code in (airalo_data.get('country_code'), package_code):
+        if code and code not in codes:
+            codes.append(code)
+    return codes
+
+def order_operator(order_data):
+    package = (order_data.get('airaloOrderData') or {}).get('package')
+    if isinstance(package, dict):
+        return package.get('operator') or package.get('operator_title')
+    return None
+
+def iccid_index_entry(order_ref, order_data):
+    """iccid_index document for an order (without the iccid itself)"""
+    return {
+        'orderId': order_ref.id,
+        'orderPath': order_ref.path,
+        # users/{uid}/esims documents don't repeat the uid
+        'userId': order_data.get('userId') or (order_ref.parent.parent.id if order_ref.parent.parent else None),
+        'email': order_data.get('userEmail') or order_data.get('customerEmail'),
+        'countryCodes': order_country_codes(order_data),
+        'operator': order_operator(order_data),
+        'airaloOrderId': order_data.get('airaloOrderId') or (order_data.get('airaloOrderData') or {}).get('id'),
+        'indexedAt': firestore.SERVER_TIMESTAMP,
+    }
+
+def lookup_iccid(iccid):
+    """iccid_index entry for an ICCID, or None when no order carries it"""
+    iccid = str(iccid).strip()
+    snapshot = db.collection('iccid_index').document(iccid).get()
+    if snapshot.exists:
+        return snapshot.to_dict()
+    
+    # Orders that predate the index (and were not backfilled) may still carry a top-level iccid
+    for order_doc in db.collection('orders').where('iccid', '==', iccid).limit(1).stream():
+        entry = {**iccid_index_entry(order_doc.reference, order_doc.to_dict()), 'iccid': iccid}
+        db.collection('iccid_index').document(iccid).set(entry)
+        return entry
+    return None
+
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({
         'status': 'healthy',
         'service': 'data-usage-server',
-        'sdk_initialized': alo is not None
+        'sdk_initialized': alo is not None,
+        'token_cache': get_firebase_token_cache_stats()
     })
 
 @app.route('/api/user/balance', methods=['GET'])
@@ -198,28 +504,18 @@ def get_mobile_data():
                 
                 # If not found in api_usage, search in orders collection
                 if not airalo_order_id:
-                    print(f"🔍 Searching in orders collection for ICCID: {iccid}")
-                    orders_ref = db.collection('orders')
-                    orders_query = orders_ref.stream()
+                    print(f"🔍 Looking up ICCID index for: {iccid}")
+                    iccid_entry = lookup_iccid(iccid)
                     
-                    for order_doc in orders_query:
-                        order_data = order_doc.to_dict()
-                        # Check airaloOrderData.sims for ICCID
-                        airalo_order_data = order_data.get('airaloOrderData', {})
-                        sims = airalo_order_data.get('sims', [])
-                        
-                        for sim in sims:
-                            if sim.get('iccid') == iccid:
-                                airalo_order_id = order_data.get('airaloOrderId') or airalo_order_data.get('id')
-                                print(f"✅ Found order document with ICCID! Order ID: {airalo_order_id}")
-                                # Use the order data directly if available
-                                if airalo_order_data:
-                                    sdk_response = {'data': airalo_order_data}
-                                    print(f"✅ Using order data from Firestore")
-                                break
-                        
-                        if airalo_order_id:
-                            break
+                    if iccid_entry:
+                        airalo_order_id = iccid_entry.get('airaloOrderId')
+                        print(f"✅ Found order document with ICCID! Order ID: {airalo_order_id}")
+                        # Use the order data directly if available
+                        order_doc = db.document(iccid_entry['orderPath']).get() if iccid_entry.get('orderPath') else None
+                        airalo_order_data = (order_doc.to_dict() or {}).get('airaloOrderData') if order_doc and order_doc.exists else None
+                        if airalo_order_data:
+                            sdk_response = {'data': airalo_order_data}
+                            print(f"✅ Using order data from Firestore")
                 
                 # If we found an order ID but no SIM data yet, try to get SIM usage directly
                 # Note: The order API doesn't return SIM details, so we skip it and go straight to SIM usage
@@ -227,48 +523,30 @@ def get_mobile_data():
                     print(f"✅ Found Airalo order ID: {airalo_order_id}")
                     print(f"📡 Fetching SIM usage directly for ICCID: {iccid} (order API doesn't include SIM details)")
                     try:
-                        token_response = requests.post(
-                            f'{AIRALO_BASE_URL}/v2/token',
-                            json={
-                                'client_id': AIRALO_CLIENT_ID,
-                                'client_secret': AIRALO_CLIENT_SECRET,
-                                'grant_type': 'client_credentials'
-                            },
-                            timeout=30
-                        )
+                        access_token = get_airalo_token()
                         
-                        if token_response.status_code == 200:
-                            try:
-                                token_data = token_response.json()
-                                access_token = token_data.get('data', {}).get('access_token')
-                                
-                                if access_token:
-                                    # Get SIM usage directly - this is what we actually need
-                                    sim_usage_response = requests.get(
-                                        f'{AIRALO_BASE_URL}/v2/sims/{iccid}/usage',
-                                        headers={'Authorization': f'Bearer {access_token}'},
-                                        timeout=30
-                                    )
-                                    
-                                    if sim_usage_response.status_code == 200:
-                                        try:
-                                            usage_data = sim_usage_response.json()
-                                            print(f"✅ Got SIM usage data directly from API")
-                                            if usage_data.get('data'):
-                                                sdk_response = usage_data
-                                                print(f"✅ SIM usage data retrieved successfully")
-                                        except ValueError as json_error:
-                                            print(f"⚠️ SIM usage API returned non-JSON response: {sim_usage_response.text[:200]}")
-                                    else:
-                                        print(f"⚠️ SIM usage API returned status {sim_usage_response.status_code}")
-                                        if sim_usage_response.text.strip().startswith('<!DOCTYPE'):
-                                            print(f"⚠️ SIM usage API returned HTML error page")
-                                else:
-                                    print(f"⚠️ No access token in token response")
-                            except ValueError as json_error:
-                                print(f"⚠️ Failed to parse token response as JSON: {token_response.text[:200]}")
+                        if access_token:
+                            # Get SIM usage directly - this is what we actually need
+                            sim_usage_response = upstream_request('airalo', 'GET',
+                                f'{AIRALO_BASE_URL}/v2/sims/{iccid}/usage',
+                                headers={'Authorization': f'Bearer {access_token}'}
+                            )
+                            
+                            if sim_usage_response.status_code == 200:
+                                try:
+                                    usage_data = sim_usage_response.json()
+                                    print(f"✅ Got SIM usage data directly from API")
+                                    if usage_data.get('data'):
+                                        sdk_response = usage_data
+                                        print(f"✅ SIM usage data retrieved successfully")
+                                except ValueError as json_error:
+                                    print(f"⚠️ SIM usage API returned non-JSON response: {sim_usage_response.text[:200]}")
+                            else:
+                                print(f"⚠️ SIM usage API returned status {sim_usage_response.status_code}")
+                                if sim_usage_response.text.strip().startswith('<!DOCTYPE'):
+                                    print(f"⚠️ SIM usage API returned HTML error page")
                         else:
-                            print(f"⚠️ Failed to get Airalo token: {token_response.status_code}")
+                            print(f"⚠️ Failed to get Airalo token")
                             
                     except Exception as e:
                         print(f"⚠️ Failed to fetch SIM usage: {e}")
@@ -373,67 +651,55 @@ def get_mobile_data():
                     # Try to fetch SIM usage directly using the SIM endpoint
                     # Note: airalo_order_id is defined in the outer scope above
                     try:
-                        # Get access token
-                        token_response = requests.post(
-                            f'{AIRALO_BASE_URL}/v2/token',
-                            json={
-                                'client_id': AIRALO_CLIENT_ID,
-                                'client_secret': AIRALO_CLIENT_SECRET,
-                                'grant_type': 'client_credentials'
-                            },
-                            timeout=30
-                        )
-                        
-                        if token_response.status_code == 200:
-                            access_token = token_response.json().get('data', {}).get('access_token')
-                            if access_token:
-                                # Try to get SIM usage directly
-                                print(f"🔄 Attempting to fetch SIM usage directly for ICCID: {iccid}")
-                                sim_usage_response = requests.get(
-                                    f'{AIRALO_BASE_URL}/v2/sims/{iccid}/usage',
-                                    headers={'Authorization': f'Bearer {access_token}'},
-                                    timeout=30
-                                )
-                                
-                                if sim_usage_response.status_code == 200:
-                                    try:
-                                        usage_data = sim_usage_response.json()
-                                        print(f"✅ Got SIM usage data directly from API")
-                                        # Use the usage data if available
-                                        if usage_data.get('data'):
-                                            sim_data = usage_data.get('data')
-                                            print(f"✅ Found SIM usage data, processing...")
-                                            
-                                            # Process the SIM usage data (format: remaining, total, expired_at, status)
-                                            total_mb = float(sim_data.get('total', 0))
-                                            remaining_mb = float(sim_data.get('remaining', 0))
-                                            used_mb = total_mb - remaining_mb
-                                            usage_percentage = (used_mb / total_mb * 100) if total_mb > 0 else 0
-                                            
-                                            mobile_data_response = {
-                                                'iccid': iccid,
-                                                'status': sim_data.get('status', 'active').upper() if isinstance(sim_data.get('status'), str) else 'active',
-                                                'dataUsed': f'{int(used_mb)}MB',
-                                                'dataRemaining': f'{int(remaining_mb)}MB',
-                                                'dataTotal': f'{int(total_mb)}MB',
-                                                'usagePercentage': round(usage_percentage, 2),
-                                                'daysUsed': 0,  # Not available in usage API
-                                                'daysRemaining': 0,  # Not available in usage API
-                                                'expiresAt': sim_data.get('expired_at', ''),
-                                                'lastUpdated': '',
-                                            }
-                                            
-                                            print(f"✅ Mobile data status retrieved from SIM usage API")
-                                            
-                                            return jsonify({
-                                                'success': True,
-                                                'data': mobile_data_response,
-                                                'isTestMode': False
-                                            })
-                                    except ValueError as json_err:
-                                        print(f"⚠️ SIM usage API returned non-JSON response: {json_err}")
-                                else:
-                                    print(f"⚠️ SIM usage API returned status {sim_usage_response.status_code}")
+                        # Get access token (cached and shared between workers)
+                        access_token = get_airalo_token()
+                        if access_token:
+                            # Try to get SIM usage directly
+                            print(f"🔄 Attempting to fetch SIM usage directly for ICCID: {iccid}")
+                            sim_usage_response = upstream_request('airalo', 'GET',
+                                f'{AIRALO_BASE_URL}/v2/sims/{iccid}/usage',
+                                headers={'Authorization': f'Bearer {access_token}'}
+                            )
+                            
+                            if sim_usage_response.status_code == 200:
+                                try:
+                                    usage_data = sim_usage_response.json()
+                                    print(f"✅ Got SIM usage data directly from API")
+                                    # Use the usage data if available
+                                    if usage_data.get('data'):
+                                        sim_data = usage_data.get('data')
+                                        print(f"✅ Found SIM usage data, processing...")
+                                        
+                                        # Process the SIM usage data (format: remaining, total, expired_at, status)
+                                        total_mb = float(sim_data.get('total', 0))
+                                        remaining_mb = float(sim_data.get('remaining', 0))
+                                        used_mb = total_mb - remaining_mb
+                                        usage_percentage = (used_mb / total_mb * 100) if total_mb > 0 else 0
+                                        
+                                        mobile_data_response = {
+                                            'iccid': iccid,
+                                            'status': sim_data.get('status', 'active').upper() if isinstance(sim_data.get('status'), str) else 'active',
+                                            'dataUsed': f'{int(used_mb)}MB',
+                                            'dataRemaining': f'{int(remaining_mb)}MB',
+                                            'dataTotal': f'{int(total_mb)}MB',
+                                            'usagePercentage': round(usage_percentage, 2),
+                                            'daysUsed': 0,  # Not available in usage API
+                                            'daysRemaining': 0,  # Not available in usage API
+                                            'expiresAt': sim_data.get('expired_at', ''),
+                                            'lastUpdated': '',
+                                        }
+                                        
+                                        print(f"✅ Mobile data status retrieved from SIM usage API")
+                                        
+                                        return jsonify({
+                                            'success': True,
+                                            'data': mobile_data_response,
+                                            'isTestMode': False
+                                        })
+                                except ValueError as json_err:
+                                    print(f"⚠️ SIM usage API returned non-JSON response: {json_err}")
+                            else:
+                                print(f"⚠️ SIM usage API returned status {sim_usage_response.status_code}")
                     except Exception as e:
                         print(f"⚠️ Failed to fetch SIM usage directly: {e}")
                     
@@ -5,7 +5,11 @@ import uuid
 import re
 import unicodedata
 import hashlib
+import threading
 from datetime import datetime
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from dotenv import load_dotenv
@@ -54,6 +58,46 @@ WISE_API_TOKEN = 'ff9dbd3d-e3bf-401d-b82e-735027f62bbe'
 WISE_MODE = 'live'  # 'sandbox' or 'live'
 WISE_BASE_URL = 'https://api.sandbox.transferwise.tech' if WISE_MODE == 'sandbox' else 'https://api.wise.com'
 
+# ============================================================================
+# Upstream HTTP Client
+# One pooled keep-alive Session per upstream host, with connect/read timeouts
+# configured per upstream. Failed connects are retried; reads never are, so a
+# POST that reached the upstream is not replayed.
+# ============================================================================
+
+UPSTREAM_POOL_SIZE = int(os.getenv('UPSTREAM_POOL_SIZE', 10))
+UPSTREAM_TIMEOUTS = {
+    'stripe': (float(os.getenv('STRIPE_CONNECT_TIMEOUT', 5)), float(os.getenv('STRIPE_READ_TIMEOUT', 30))),
+    'wise': (float(os.getenv('WISE_CONNECT_TIMEOUT', 5)), float(os.getenv('WISE_READ_TIMEOUT', 30))),
+}
+
+_upstream_sessions = {}
+_upstream_sessions_lock = threading.Lock()
+
+def get_upstream_session(url):
+    """Shared keep-alive Session for the host of url"""
+    host = urlsplit(url).netloc
+    session = _upstream_sessions.get(host)
+    if session is None:
+        with _upstream_sessions_lock:
+            session = _upstream_sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=UPSTREAM_POOL_SIZE,
+                                      max_retries=Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.2))
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _upstream_sessions[host] = session
+    return session
+
+def upstream_request(upstream, method, url, **kwargs):
+    """Send a request through the pooled session, with the upstream's (connect, read) timeouts"""
+    kwargs.setdefault('timeout', UPSTREAM_TIMEOUTS[upstream])
+    return get_upstream_session(url).request(method, url, **kwargs)
+
+# Stripe already keeps a keep-alive session per thread; give it the same timeouts
+stripe.default_http_client = stripe.RequestsClient(timeout=UPSTREAM_TIMEOUTS['stripe'])
+
 @app.route('/', methods=['GET'])
 def index():
     return jsonify({"status": "ok", "message": "Payment endpoint running"})
@@ -632,14 +676,10 @@ def wise_api_request(method, endpoint, data=None):
     
     url = f'{WISE_BASE_URL}{endpoint}'
     
-    if method == 'GET':
-        response = requests.get(url, headers=headers)
-    elif method == 'POST':
-        response = requests.post(url, headers=headers, json=data)
-    elif method == 'PUT':
-        response = requests.put(url, headers=headers, json=data)
-    elif method == 'DELETE':
-        response = requests.delete(url, headers=headers)
+    if method in ('GET', 'DELETE'):
+        response = upstream_request('wise', method, url, headers=headers)
+    elif method in ('POST', 'PUT'):
+        response = upstream_request('wise', method, url, headers=headers, json=data)
     else:
         raise Exception(f'Unsupported HTTP method: {method}')
     
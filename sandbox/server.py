@@ -1,11 +1,19 @@
 import os
+import sqlite3
+import functools
+import hashlib
 import json
 import uuid
 import random
 import string
-from flask import Flask, request, jsonify
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
+from flask import Flask, Response, request, jsonify
 import firebase_admin
 from firebase_admin import credentials, firestore, auth
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
 from flask_cors import CORS
 
@@ -29,10 +37,208 @@ print("🧪" * 40)
 print("🧪 SANDBOX SERVER - ALL AIRALO CALLS RETURN MOCK DATA")
 print("🧪" * 40)
 
+# ============================================================================
+# API Key Identity Cache
+# Process-local index of apiCredentials.apiKey -> business identity, kept
+# current by a Firestore snapshot listener on business_users
+# ============================================================================
+
+API_KEY_CACHE_TTL = int(os.getenv('API_KEY_CACHE_TTL', 10))  # Seconds, used while the listener is down
+API_KEY_LISTENER_LOAD_GRACE = int(os.getenv('API_KEY_LISTENER_LOAD_GRACE', 300))  # Seconds the initial snapshot may take before the listener is restarted
+API_KEY_FALLBACK_CACHE_MAX = 10000
+
+_api_key_index = {}
+_api_key_by_uid = {}
+_api_key_index_lock = threading.Lock()  # Guards the index and the fallback cache
+_api_key_index_ready = False
+_api_key_listener = None
+_api_key_listener_lock = threading.RLock()  # One thread (re)starts the listener at a time
+_api_key_listener_generation = 0  # Snapshots from a replaced listener are ignored
+_api_key_listener_started_at = 0
+_api_key_fallback_cache = {}
+
+def _business_identity(uid, user_data):
+    """Build the cached identity for a business_users document"""
+    api_credentials = user_data.get('apiCredentials') or {}
+    return {
+        'uid': uid,
+        'email': user_data.get('email'),
+        'mode': api_credentials.get('mode', 'sandbox'),
+        'kycStatus': user_data.get('kycStatus', 'pending'),
+        'emailVerified': user_data.get('emailVerified', False),
+        'balance': user_data.get('balance', 0),
+    }
+
+def _on_business_users_snapshot(col_snapshot, changes, read_time, generation=None):
+    """Apply business_users changes to the API key index"""
+    global _api_key_index_ready
+    with _api_key_index_lock:
+        if generation != _api_key_listener_generation:
+            return  # Late delivery from a listener that has been replaced
+        for change in changes:
+            doc = change.document
+            old_key = _api_key_by_uid.pop(doc.id, None)
+            if old_key:
+                _api_key_index.pop(old_key, None)
+            
+            if change.type.name == 'REMOVED':
+                continue
+            
+            user_data = doc.to_dict() or {}
+            api_key = (user_data.get('apiCredentials') or {}).get('apiKey')
+            if api_key:
+                _api_key_index[api_key] = _business_identity(doc.id, user_data)
+                _api_key_by_uid[doc.id] = api_key
+        
+        _api_key_fallback_cache.clear()
+        if not _api_key_index_ready:
+            print(f"✅ API key index loaded: {len(_api_key_index)} keys")
+        _api_key_index_ready = True
+
+def start_api_key_listener():
+    """(Re)start the business_users snapshot listener that feeds the API key index"""
+    global _api_key_listener, _api_key_listener_started_at, _api_key_index_ready, _api_key_listener_generation
+    with _api_key_listener_lock:
+        _api_key_listener_started_at = time.time()
+        
+        if _api_key_listener is not None:
+            try:
+                _api_key_listener.unsubscribe()
+            except Exception as e:
+                print(f"⚠️ Could not stop API key listener: {e}")
+        
+        # The initial snapshot re-delivers every document, so start from an empty index
+        with _api_key_index_lock:
+            _api_key_listener_generation += 1
+            generation = _api_key_listener_generation
+            _api_key_index_ready = False
+            _api_key_index.clear()
+            _api_key_by_uid.clear()
+        
+        try:
+            _api_key_listener = db.collection('business_users').on_snapshot(
+                functools.partial(_on_business_users_snapshot, generation=generation))
+            print(f"👂 API key listener started on business_users")
+        except Exception as e:
+            _api_key_listener = None
+            print(f"⚠️ Could not start API key listener, using TTL cache: {e}")
+
+def _api_key_listener_stale(now):
+    """True when the listener should be restarted: it failed or stopped, or its initial snapshot is overdue"""
+    since_start = now - _api_key_listener_started_at
+    if _api_key_listener is None or not getattr(_api_key_listener, 'is_active', True):
+        return since_start > API_KEY_CACHE_TTL
+    return not _api_key_index_ready and since_start > API_KEY_LISTENER_LOAD_GRACE
+
+def _restart_stale_api_key_listener():
+    """Retry the listener from one request thread; the others carry on with the TTL cache"""
+    if not _api_key_listener_lock.acquire(blocking=False):
+        return
+    try:
+        if _api_key_listener_stale(time.time()):
+            start_api_key_listener()
+    finally:
+        _api_key_listener_lock.release()
+
+def _api_key_listener_healthy():
+    """True when the listener is running and has delivered its initial snapshot"""
+    if _api_key_listener is None or not _api_key_index_ready:
+        return False
+    return getattr(_api_key_listener, 'is_active', True)
+
+def lookup_api_key_identity(api_key):
+    """Resolve an API key to its business identity (dictionary lookup while the listener is healthy)"""
+    if _api_key_listener_healthy():
+        return _api_key_index.get(api_key)
+    
+    # Listener is down or still loading - restart it if it failed (or is stuck loading)
+    # and use a short TTL cache meanwhile
+    now = time.time()
+    if _api_key_listener_stale(now):
+        _restart_stale_api_key_listener()
+    
+    with _api_key_index_lock:
+        cached = _api_key_fallback_cache.get(api_key)
+    if cached and cached[1] > now:
+        return cached[0]
+    
+    users_ref = db.collection('business_users')
+    query = users_ref.where('apiCredentials.apiKey', '==', api_key).limit(1)
+    docs = list(query.stream())
+    identity = _business_identity(docs[0].id, docs[0].to_dict()) if docs else None
+    
+    with _api_key_index_lock:
+        if len(_api_key_fallback_cache) >= API_KEY_FALLBACK_CACHE_MAX:
+            _api_key_fallback_cache.clear()
+        _api_key_fallback_cache[api_key] = (identity, now + API_KEY_CACHE_TTL)
+    return identity
+
+start_api_key_listener()
+
+# ============================================================================
+# Firebase ID Token Cache
+# Verified claims are kept in a bounded LRU keyed by the token's SHA-256
+# digest until the token's own "exp"
+# ============================================================================
+
+FIREBASE_TOKEN_CACHE_SIZE = int(os.getenv('FIREBASE_TOKEN_CACHE_SIZE', 10000))
+FIREBASE_ID_TOKEN_CERT_URL = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
+
+_firebase_token_cache = OrderedDict()
+_firebase_token_cache_lock = threading.Lock()
+_firebase_token_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def verify_firebase_id_token(id_token):
+    """Verify a Firebase ID token, reusing cached claims while the token is unexpired"""
+    digest = hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+    now = time.time()
+    
+    with _firebase_token_cache_lock:
+        cached = _firebase_token_cache.get(digest)
+        if cached is not None:
+            if cached['exp'] > now:
+                _firebase_token_cache.move_to_end(digest)
+                _firebase_token_cache_stats['hits'] += 1
+                return cached['claims']
+            del _firebase_token_cache[digest]
+        _firebase_token_cache_stats['misses'] += 1
+    
+    decoded_token = auth.verify_id_token(id_token)
+    
+    with _firebase_token_cache_lock:
+        _firebase_token_cache[digest] = {'claims': decoded_token, 'exp': decoded_token.get('exp', 0)}
+        _firebase_token_cache.move_to_end(digest)
+        while len(_firebase_token_cache) > FIREBASE_TOKEN_CACHE_SIZE:
+            _firebase_token_cache.popitem(last=False)
+            _firebase_token_cache_stats['evictions'] += 1
+    
+    return decoded_token
+
+def get_firebase_token_cache_stats():
+    """Hit/miss counters for the ID token cache"""
+    with _firebase_token_cache_lock:
+        lookups = _firebase_token_cache_stats['hits'] + _firebase_token_cache_stats['misses']
+        return {
+            **_firebase_token_cache_stats,
+            'size': len(_firebase_token_cache),
+            'hit_rate': round(_firebase_token_cache_stats['hits'] / lookups, 4) if lookups else 0,
+        }
+
+def warm_firebase_public_keys():
+    """Prefetch the securetoken certificates into firebase_admin's cache-control session"""
+    try:
+        client = auth._get_client(firebase_admin.get_app())
+        client._token_verifier.request(url=FIREBASE_ID_TOKEN_CERT_URL)
+        print(f"🔑 Firebase public keys prefetched")
+    except Exception as e:
+        print(f"⚠️ Could not prefetch Firebase public keys: {e}")
+
+threading.Thread(target=warm_firebase_public_keys, daemon=True).start()
+
 def authenticate_firebase_token(id_token):
     """Authenticate Firebase ID token for regular users"""
     try:
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = verify_firebase_id_token(id_token)
         uid = decoded_token['uid']
         email = decoded_token.get('email')
         
@@ -47,24 +253,20 @@ def authenticate_firebase_token(id_token):
         return None
 
 def authenticate_api_key(api_key):
-    """Authenticate API key against Firestore business_users collection"""
+    """Authenticate API key against the cached business_users index"""
     try:
-        users_ref = db.collection('business_users')
-        query = users_ref.where('apiCredentials.apiKey', '==', api_key).limit(1)
-        docs = list(query.stream())
+        identity = lookup_api_key_identity(api_key)
         
-        if not docs:
+        if not identity:
             return None
-            
-        user_data = docs[0].to_dict()
         
         # Check if email is verified
-        if not user_data.get('emailVerified', False):
+        if not identity.get('emailVerified', False):
             return None
             
         return {
-            'uid': docs[0].id,
-            'email': user_data.get('email'),
+            'uid': identity['uid'],
+            'email': identity.get('email'),
             'mode': 'sandbox',  # Always sandbox
             'balance': 999999  # Unlimited balance for sandbox
         }
@@ -119,6 +321,534 @@ def generate_mock_qr():
         'directAppleInstallationUrl': f'https://esimsetup.apple.com/esim_qrcode_provisioning?carddata={mock_lpa}'
     }
 
+# ============================================================================
+# ICCID Index
+# iccid_index/{iccid} maps an eSIM to the order that created it, so ICCID
+# lookups are a single document get instead of a scan over every order.
+# ============================================================================
+
+def order_iccids(order_data):
+    """Every ICCID an order document carries (top level, esimData and the sims lists)"""
+    iccids = [order_data.get('iccid'), (order_data.get('esimData') or {}).get('iccid')]
+    for container in (order_data.get('airaloOrderData'), order_data.get('orderData'), order_data):
+        sims = container.get('sims') if isinstance(container, dict) else None
+        if isinstance(sims, list):
+            iccids.extend(sim.get('iccid') for sim in sims if isinstance(sim, dict))
+    return list(dict.fromkeys(str(iccid).strip() for iccid in iccids if iccid))
+
+def order_country_codes(order_data):
+    """Country codes of an order, from its own fields and the Airalo order data"""
+    codes = (
+        order_data.get('countryCode') or
+        order_data.get('country_code') or
+        order_data.get('countryCodes') or
+        order_data.get('country_codes') or
+        []
+    )
+    if isinstance(codes, str):
+        codes = [codes]
+    elif not isinstance(codes, list):
+        codes = []
+    codes = list(codes)
+    
+    airalo_data = order_data.get('airaloOrderData') or {}
+    package = airalo_data.get('package')
+    package_code = (package.get('country_code') or package.get('countryCode')) if isinstance(package, dict) else None
+    for code in (airalo_data.get('country_code'), package_code):
+        if code and code not in codes:
+            codes.append(code)
+    return codes
+
+def order_operator(order_data):
+    package = (order_data.get('airaloOrderData') or {}).get('package')
+    if isinstance(package, dict):
+        return package.get('operator') or package.get('operator_title')
+    return None
+
+def iccid_index_entry(order_ref, order_data):
+    """iccid_index document for an order (without the iccid itself)"""
+    return {
+        'orderId': order_ref.id,
+        'orderPath': order_ref.path,
+        # users/{uid}/esims documents don't repeat the uid
+        'userId': order_data.get('userId') or (order_ref.parent.parent.id if order_ref.parent.parent else None),
+        'email': order_data.get('userEmail') or order_data.get('customerEmail'),
+        'countryCodes': order_country_codes(order_data),
+        'operator': order_operator(order_data),
+        'airaloOrderId': order_data.get('airaloOrderId') or (order_data.get('airaloOrderData') or {}).get('id'),
+        'indexedAt': firestore.SERVER_TIMESTAMP,
+    }
+
+def index_order_iccids(order_ref, order_data, batch=None):
+    """Write iccid_index entries for an order (into batch when given); returns the ICCIDs indexed"""
+    iccids = order_iccids(order_data)
+    if not iccids:
+        return iccids
+    
+    entry = iccid_index_entry(order_ref, order_data)
+    writer = batch if batch is not None else db.batch()
+    for iccid in iccids:
+        writer.set(db.collection('iccid_index').document(iccid), {**entry, 'iccid': iccid})
+    if batch is None:
+        writer.commit()
+    return iccids
+
+# ============================================================================
+# api_usage Write-Behind Buffer
+# With API_USAGE_WRITE_BEHIND=true, api_usage documents are appended to a
+# local SQLite file (WAL mode, one INSERT per order) instead of joining the
+# order's batch, and a background thread flushes them to Firestore in batches
+# of up to 500, at most API_USAGE_FLUSH_INTERVAL after they arrive. This takes
+# a document per order off the request path, at a price: the order and its
+# usage are no longer written atomically, and usage only reaches Firestore
+# (and billing) once flushed. Off by default: orders and usage share a batch.
+# createdAt is still stamped by the server when the row is flushed, so the
+# balance checkpoint lag holds; bufferedAt records when the order was placed.
+# Rows are deleted only once their batch commits, so events buffered before a
+# crash or restart are flushed by the next process. Rows are flushed with
+# create(): a row flushed twice fails with AlreadyExists and is dropped rather
+# than re-stamping createdAt. A batch Firestore rejects is halved until the
+# rejected rows are found; those move to the usage_dead_letters table.
+# Flushers claim rows before writing them, so several workers can share the
+# file; a claim left behind by a dead worker expires after API_USAGE_CLAIM_TTL.
+# ============================================================================
+
+API_USAGE_WRITE_BEHIND = os.getenv('API_USAGE_WRITE_BEHIND', 'false').lower() == 'true'
+API_USAGE_BUFFER_FILE = os.getenv('API_USAGE_BUFFER_FILE', '/tmp/api_usage_buffer.sqlite3')
+API_USAGE_FLUSH_INTERVAL = float(os.getenv('API_USAGE_FLUSH_INTERVAL', 1.0))  # Max seconds before a buffered event is flushed
+API_USAGE_BATCH_SIZE = 500  # Firestore batch limit
+API_USAGE_CLAIM_TTL = 60  # Seconds before rows claimed by a flusher that died are flushed again
+API_USAGE_ROW_ERRORS = (google_exceptions.BadRequest, ValueError, TypeError)  # Errors caused by the rows, not by Firestore being unavailable
+
+_usage_buffer_local = threading.local()  # Per-thread SQLite connection
+_usage_buffer_wakeup = threading.Event()  # Set when a full batch is waiting
+_usage_buffer_flusher = None
+_usage_buffer_lock = threading.Lock()
+_usage_buffer_stats = {
+    'buffered': 0,
+    'buffer_seconds': 0.0,
+    'inline_fallbacks': 0,
+    'flushed': 0,
+    'flush_batches': 0,
+    'flush_errors': 0,
+    'dead_lettered': 0,
+    'last_flush_ms': None,
+    'max_flush_ms': 0.0,
+    'last_flush_lag_seconds': None,  # Age of the oldest event in the last batch when it committed
+    'unflushed_since_wakeup': 0
+}
+
+def _usage_buffer_connection():
+    """This thread's connection to the buffer file (reopened after a fork)"""
+    conn = getattr(_usage_buffer_local, 'conn', None)
+    if conn is None or _usage_buffer_local.pid != os.getpid():
+        conn = sqlite3.connect(API_USAGE_BUFFER_FILE, timeout=10)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')  # Survives a process crash without an fsync per event
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS usage_events ('
+                         'seq INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT NOT NULL, data TEXT NOT NULL, '
+                         'buffered_at REAL NOT NULL, claimed_by TEXT, claimed_at REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS usage_dead_letters ('
+                         'seq INTEGER PRIMARY KEY, path TEXT NOT NULL, data TEXT NOT NULL, '
+                         'buffered_at REAL NOT NULL, error TEXT, failed_at REAL NOT NULL)')
+        _usage_buffer_local.conn = conn
+        _usage_buffer_local.pid = os.getpid()
+    return conn
+
+def _encode_usage_value(value):
+    """JSON-safe copy of a document (SERVER_TIMESTAMP is kept as a marker for the flush)"""
+    if value is firestore.SERVER_TIMESTAMP:
+        return {'__server_timestamp__': True}
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, dict):
+        return {key: _encode_usage_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode_usage_value(item) for item in value]
+    return value
+
+def _decode_usage_value(obj):
+    if len(obj) == 1 and '__server_timestamp__' in obj:
+        return firestore.SERVER_TIMESTAMP
+    if len(obj) == 1 and '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    return obj
+
+def write_usage_now(writes):
+    """Write (document ref, data) pairs in one batch"""
+    batch = db.batch()
+    for ref, data in writes:
+        batch.set(ref, data)
+    batch.commit()
+
+def buffer_usage_writes(writes):
+    """Append (document ref, data) pairs to the buffer, writing them inline if the buffer is unavailable"""
+    started = time.perf_counter()
+    buffered_at = datetime.now(timezone.utc)
+    rows = [(ref.path, json.dumps(_encode_usage_value({**data, 'bufferedAt': buffered_at}), default=str),
+             buffered_at.timestamp())
+            for ref, data in writes]
+    try:
+        conn = _usage_buffer_connection()
+        with conn:
+            conn.executemany('INSERT INTO usage_events (path, data, buffered_at) VALUES (?, ?, ?)', rows)
+    except sqlite3.Error as e:
+        print(f"⚠️ api_usage buffer unavailable, writing {len(writes)} document(s) inline: {e}")
+        _usage_buffer_stats['inline_fallbacks'] += 1
+        write_usage_now(writes)
+        return
+    
+    _usage_buffer_stats['buffered'] += len(rows)
+    _usage_buffer_stats['buffer_seconds'] += time.perf_counter() - started
+    _usage_buffer_stats['unflushed_since_wakeup'] += len(rows)
+    if _usage_buffer_stats['unflushed_since_wakeup'] >= API_USAGE_BATCH_SIZE:
+        _usage_buffer_wakeup.set()
+    if _usage_buffer_flusher is None or not _usage_buffer_flusher.is_alive():
+        start_usage_buffer_flusher()
+
+def _create_usage_documents(rows):
+    """Create buffered rows' documents in one batch, halving it around rows Firestore rejects.
+    
+    Returns (rows written, [(row, error)] rejected); errors that are not about
+    the rows themselves (Firestore unavailable, timeouts) are raised.
+    """
+    try:
+        batch = db.batch()
+        for seq, path, data, buffered_at in rows:
+            batch.create(db.document(path), json.loads(data, object_hook=_decode_usage_value))
+        batch.commit()
+        return rows, []
+    except google_exceptions.Conflict:
+        if len(rows) == 1:
+            return rows, []  # Created by an earlier flush that died before deleting the row
+    except API_USAGE_ROW_ERRORS as e:
+        if len(rows) == 1:
+            return [], [(rows[0], e)]
+    
+    middle = len(rows) // 2
+    written, rejected = _create_usage_documents(rows[:middle])
+    more_written, more_rejected = _create_usage_documents(rows[middle:])
+    return written + more_written, rejected + more_rejected
+
+def flush_usage_buffer():
+    """Flush up to API_USAGE_BATCH_SIZE buffered events; returns how many rows were taken off the buffer"""
+    conn = _usage_buffer_connection()
+    claim = f'{os.getpid()}:{threading.get_ident()}:{time.time()}'
+    now = time.time()
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('UPDATE usage_events SET claimed_by = ?, claimed_at = ? WHERE seq IN ('
+                     'SELECT seq FROM usage_events WHERE claimed_by IS NULL OR claimed_at < ? ORDER BY seq LIMIT ?)',
+                     (claim, now, now - API_USAGE_CLAIM_TTL, API_USAGE_BATCH_SIZE))
+        rows = conn.execute('SELECT seq, path, data, buffered_at FROM usage_events WHERE claimed_by = ? ORDER BY seq',
+                            (claim,)).fetchall()
+    if not rows:
+        return 0
+    
+    started = time.time()
+    try:
+        written, rejected = _create_usage_documents(rows)
+    except Exception as e:
+        print(f"⚠️ Could not flush {len(rows)} buffered api_usage writes: {e}")
+        _usage_buffer_stats['flush_errors'] += 1
+        with conn:
+            conn.execute('UPDATE usage_events SET claimed_by = NULL, claimed_at = NULL WHERE claimed_by = ?', (claim,))
+        return 0
+    
+    finished = time.time()
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO usage_dead_letters (seq, path, data, buffered_at, error, failed_at) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         [(*row, str(error), finished) for row, error in rejected])
+        conn.execute('DELETE FROM usage_events WHERE claimed_by = ?', (claim,))
+    for (seq, path, _, _), error in rejected:
+        print(f"☠️ Firestore rejected buffered api_usage write {path}, moved to usage_dead_letters: {error}")
+    
+    flush_ms = round((finished - started) * 1000, 1)
+    _usage_buffer_stats['flushed'] += len(written)
+    _usage_buffer_stats['dead_lettered'] += len(rejected)
+    _usage_buffer_stats['flush_batches'] += 1
+    _usage_buffer_stats['last_flush_ms'] = flush_ms
+    _usage_buffer_stats['max_flush_ms'] = max(_usage_buffer_stats['max_flush_ms'], flush_ms)
+    _usage_buffer_stats['last_flush_lag_seconds'] = round(finished - min(row[3] for row in rows), 3)
+    return len(rows)
+
+def _flush_usage_buffer_forever():
+    while True:
+        _usage_buffer_wakeup.wait(API_USAGE_FLUSH_INTERVAL)
+        _usage_buffer_wakeup.clear()
+        _usage_buffer_stats['unflushed_since_wakeup'] = 0
+        try:
+            while flush_usage_buffer() == API_USAGE_BATCH_SIZE:
+                pass
+        except sqlite3.Error as e:
+            print(f"⚠️ api_usage buffer flush failed: {e}")
+
+def start_usage_buffer_flusher():
+    """Start the flusher (which also replays events left by a previous process)"""
+    global _usage_buffer_flusher
+    if not API_USAGE_WRITE_BEHIND and not os.path.exists(API_USAGE_BUFFER_FILE):
+        return
+    with _usage_buffer_lock:
+        if _usage_buffer_flusher is not None and _usage_buffer_flusher.is_alive():
+            return
+        try:
+            pending = _usage_buffer_connection().execute('SELECT COUNT(*) FROM usage_events').fetchone()[0]
+            if pending:
+                print(f"♻️ Replaying {pending} buffered api_usage writes from {API_USAGE_BUFFER_FILE}")
+        except sqlite3.Error as e:
+            print(f"⚠️ Could not open api_usage buffer {API_USAGE_BUFFER_FILE}: {e}")
+            return
+        _usage_buffer_flusher = threading.Thread(target=_flush_usage_buffer_forever, daemon=True)
+        _usage_buffer_flusher.start()
+
+def get_usage_buffer_stats():
+    """Buffer and dead-letter depth (shared by all workers) and this process's buffering and flush metrics"""
+    stats = {key: value for key, value in _usage_buffer_stats.items()
+             if key not in ('buffer_seconds', 'unflushed_since_wakeup')}
+    stats['enabled'] = API_USAGE_WRITE_BEHIND
+    stats['avg_buffer_us'] = (round(_usage_buffer_stats['buffer_seconds'] * 1e6 / _usage_buffer_stats['buffered'], 1)
+                              if _usage_buffer_stats['buffered'] else None)
+    try:
+        conn = _usage_buffer_connection()
+        depth, oldest = conn.execute('SELECT COUNT(*), MIN(buffered_at) FROM usage_events').fetchone()
+        stats['depth'] = depth
+        stats['oldest_age_seconds'] = round(time.time() - oldest, 3) if oldest else 0
+        stats['dead_letter_depth'] = conn.execute('SELECT COUNT(*) FROM usage_dead_letters').fetchone()[0]
+    except sqlite3.Error as e:
+        stats['error'] = str(e)
+    return stats
+
+start_usage_buffer_flusher()
+
+# ============================================================================
+# Order Side Effects
+# An order, its iccid_index entries, its api_usage document and the
+# business_users/{uid}/api_usage audit copy go out in one batch with
+# pre-generated ids, in one round trip. With API_USAGE_WRITE_BEHIND=true the
+# api_usage documents go through the write-behind buffer once the order is
+# recorded instead.
+# If the batch fails, say on an index entry Firestore rejects, the order is
+# written on its own and its index and api_usage after it: the upstream order
+# has already been placed, so it must not go unrecorded for want of an index.
+# ============================================================================
+
+def commit_order_side_effects(order_ref, order_data, api_usage_data, audit_uid=None):
+    """Write an order, its ICCID index entries and its api_usage documents in one batch"""
+    usage_ref = db.collection('api_usage').document()
+    usage_writes = [(usage_ref, api_usage_data)]
+    if audit_uid:
+        audit_ref = db.collection('business_users').document(audit_uid).collection('api_usage').document(usage_ref.id)
+        usage_writes.append((audit_ref, api_usage_data))
+    
+    batch = db.batch()
+    batch.set(order_ref, order_data, merge=True)  # merge: async orders complete their intent document
+    index_order_iccids(order_ref, order_data, batch=batch)
+    if not API_USAGE_WRITE_BEHIND:
+        for ref, data in usage_writes:
+            batch.set(ref, data)
+    try:
+        batch.commit()
+    except Exception as e:
+        _record_order_alone(order_ref, order_data, usage_writes, e)
+        return usage_ref
+    
+    if API_USAGE_WRITE_BEHIND:
+        buffer_usage_writes(usage_writes)
+    return usage_ref
+
+def _record_order_alone(order_ref, order_data, usage_writes, batch_error):
+    """Fallback when an order's batch fails: the order on its own, then its index and api_usage"""
+    # Airalo has already charged for the order, so it is recorded even if its index can't be
+    print(f"⚠️ Order batch for {order_ref.id} failed ({batch_error}), writing the order alone")
+    order_ref.set(order_data, merge=True)
+    try:
+        index_order_iccids(order_ref, order_data)
+    except Exception as e:
+        print(f"⚠️ ICCID index not written for order {order_ref.id}: {e}")
+    try:
+        write_usage_now(usage_writes)
+    except Exception as e:
+        print(f"⚠️ api_usage for order {order_ref.id} not written ({e}), buffering it for retry")
+        buffer_usage_writes(usage_writes)
+
+# ============================================================================
+# Idempotency Keys
+# /api/user/order (mock orders, so clients can exercise retries against it)
+# accept an Idempotency-Key header. The first request with a key runs and its
+# response is stored in idempotency_keys/{id} (scoped to the caller and path,
+# with a fingerprint of the request). Repeats get the stored response without
+# reaching Airalo; a duplicate arriving while the first is still running waits
+# for it. Reusing a key for a different request is a 422. A request that
+# fails before its side effect (an Airalo order, a balance deduction) releases
+# its key so a retry runs again; one that fails after it is stored as failed
+# and replayed, so a retry can't order or charge twice.
+# ============================================================================
+
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', 24 * 3600))  # Seconds a stored response is replayed
+IDEMPOTENCY_LOCK_TTL = 120  # Seconds before a key whose request died mid-flight can be taken over
+IDEMPOTENCY_WAIT_TIMEOUT = 60  # Seconds a duplicate waits for the first request before a 409
+IDEMPOTENCY_POLL_INTERVAL = 0.25  # Seconds between checks on a key held by another process
+# Responses for requests that never ran (and 5xx before the side effect) are not stored, so a retry runs again
+IDEMPOTENCY_UNSTORED_STATUSES = {401, 403, 409, 429}
+IDEMPOTENCY_INCOMPLETE_ERROR = 'The request failed after its side effect was committed; do not retry it, contact support'
+IDEMPOTENCY_REPLAYED_HEADERS = ('Location', 'Preference-Applied')
+
+_idempotency_inflight = {}  # key doc id -> Event set when this process finishes the request
+_idempotency_inflight_lock = threading.Lock()
+_idempotency_request = threading.local()  # side_effect flag for the request this thread is serving
+
+def idempotency_scope():
+    """Uid of the caller (API key owner or Firebase user); 'anonymous' when it can't be resolved"""
+    api_key = request.headers.get('X-API-Key', '')
+    auth_header = request.headers.get('Authorization', '')
+    bearer = auth_header[7:] if auth_header.startswith('Bearer ') else ''
+    for credential in (api_key, bearer):
+        if credential:
+            owner = authenticate_api_key(credential)
+            if owner:
+                return owner['uid']
+    if bearer:
+        user = authenticate_firebase_token(bearer)
+        if user:
+            return user['uid']
+    return 'anonymous'
+
+def request_fingerprint():
+    """Hash of the method, path, query and (canonicalized JSON) body"""
+    body = request.get_data() or b''
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True, separators=(',', ':')).encode('utf-8')
+    except ValueError:
+        pass
+    return hashlib.sha256(f"{request.method} {request.full_path}\n".encode('utf-8') + body).hexdigest()
+
+@firestore.transactional
+def _acquire_idempotency_key(transaction, key_ref, fingerprint):
+    """('acquired' | 'replay' | 'wait' | 'mismatch', stored key data)"""
+    snapshot = key_ref.get(transaction=transaction)
+    data = snapshot.to_dict() if snapshot.exists else None
+    now = datetime.now(timezone.utc)
+    if data and data.get('expiresAt') and data['expiresAt'] > now:
+        if data.get('fingerprint') != fingerprint:
+            return 'mismatch', data
+        if data.get('state') in ('completed', 'failed'):
+            return 'replay', data
+        if data.get('lockedUntil', 0) > time.time():
+            return 'wait', data
+    transaction.set(key_ref, {
+        'state': 'in_progress',
+        'fingerprint': fingerprint,
+        'path': request.path,
+        'lockedUntil': time.time() + IDEMPOTENCY_LOCK_TTL,
+        'createdAt': firestore.SERVER_TIMESTAMP,
+        'expiresAt': now + timedelta(seconds=IDEMPOTENCY_KEY_TTL)  # Firestore TTL policy field
+    })
+    return 'acquired', None
+
+def idempotent_side_effect_committed():
+    """Call once a request's side effect has happened; later failures are then replayed, not retried"""
+    _idempotency_request.side_effect = True
+
+def _store_idempotent_response(key_ref, response, side_effect=False):
+    """Keep a finished request's response for replay, or release the key if it shouldn't be replayed"""
+    try:
+        if (response.status_code in IDEMPOTENCY_UNSTORED_STATUSES or response.is_streamed
+                or (response.status_code >= 500 and not side_effect)):
+            key_ref.delete()
+            return
+        key_ref.update({
+            'state': 'failed' if response.status_code >= 500 else 'completed',
+            'lockedUntil': 0,
+            'completedAt': firestore.SERVER_TIMESTAMP,
+            'response': {
+                'status': response.status_code,
+                'body': response.get_data(as_text=True),
+                'mimetype': response.mimetype,
+                'headers': {name: response.headers[name] for name in IDEMPOTENCY_REPLAYED_HEADERS if name in response.headers}
+            }
+        })
+    except Exception as e:
+        print(f"⚠️ Could not store idempotent response for {key_ref.id}: {e}")
+
+def _replay_idempotent_response(data):
+    stored = data.get('response') or {}
+    response = Response(stored.get('body', ''), status=stored.get('status', 200),
+                        mimetype=stored.get('mimetype', 'application/json'), headers=stored.get('headers') or {})
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def _wait_for_idempotency_key(doc_id, deadline):
+    """Block until the request holding a key finishes here, or for one poll interval if it runs elsewhere"""
+    with _idempotency_inflight_lock:
+        event = _idempotency_inflight.get(doc_id)
+    if event is not None:
+        event.wait(max(0, deadline - time.time()))
+    else:
+        time.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+def idempotent(handler):
+    """Route decorator: honour the Idempotency-Key header"""
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return handler(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({'success': False, 'error': 'Idempotency-Key must be at most 255 characters'}), 400
+        
+        doc_id = hashlib.sha256(f"{idempotency_scope()}\n{request.path}\n{key}".encode('utf-8')).hexdigest()
+        key_ref = db.collection('idempotency_keys').document(doc_id)
+        fingerprint = request_fingerprint()
+        deadline = time.time() + IDEMPOTENCY_WAIT_TIMEOUT
+        while True:
+            outcome, data = _acquire_idempotency_key(db.transaction(), key_ref, fingerprint)
+            if outcome == 'acquired':
+                break
+            if outcome == 'replay':
+                print(f"🔁 Replaying response for Idempotency-Key on {request.path}")
+                return _replay_idempotent_response(data)
+            if outcome == 'mismatch':
+                return jsonify({
+                    'success': False,
+                    'error': 'Idempotency-Key was already used for a different request'
+                }), 422
+            if time.time() >= deadline:
+                response = jsonify({
+                    'success': False,
+                    'error': 'A request with this Idempotency-Key is still in progress'
+                })
+                response.status_code = 409
+                response.headers['Retry-After'] = '1'
+                return response
+            _wait_for_idempotency_key(doc_id, deadline)
+        
+        event = threading.Event()
+        with _idempotency_inflight_lock:
+            _idempotency_inflight[doc_id] = event
+        _idempotency_request.side_effect = False
+        response = None
+        try:
+            response = app.make_response(handler(*args, **kwargs))
+            return response
+        finally:
+            side_effect = _idempotency_request.side_effect
+            if response is None and side_effect:
+                # The handler raised after its side effect; keep a failure to replay
+                response = app.make_response((jsonify({'success': False, 'error': IDEMPOTENCY_INCOMPLETE_ERROR}), 500))
+            if response is not None:
+                _store_idempotent_response(key_ref, response, side_effect)
+            else:
+                try:
+                    key_ref.delete()
+                except Exception as e:
+                    print(f"⚠️ Could not release Idempotency-Key {doc_id}: {e}")
+            with _idempotency_inflight_lock:
+                _idempotency_inflight.pop(doc_id, None)
+            event.set()
+    return wrapper
+
 # ============================================================================
 # Health Check
 # ============================================================================
@@ -128,7 +858,9 @@ def health_check():
     return jsonify({
         'status': 'healthy',
         'mode': 'SANDBOX',
-        'message': 'All Airalo API calls return mock data'
+        'message': 'All Airalo API calls return mock data',
+        'token_cache': get_firebase_token_cache_stats(),
+        'api_usage_buffer': get_usage_buffer_stats()
     })
 
 # ============================================================================
@@ -136,6 +868,7 @@ def health_check():
 # ============================================================================
 
 @app.route('/api/user/order', methods=['POST'])
+@idempotent
 def create_user_order():
     """Create MOCK eSIM order (always returns test data)"""
     try:
@@ -177,6 +910,9 @@ def create_user_order():
         
         print(f"✅ MOCK order created: {mock_order_id}")
         
+        order_ref = db.collection('orders').document()
+        order_id = order_ref.id
+        
         # Save order to Firestore (marked as test)
         order_data = {
             'userId': user['uid'],
@@ -191,9 +927,6 @@ def create_user_order():
             'isTestMode': True
         }
         
-        order_ref = db.collection('orders').add(order_data)
-        order_id = order_ref[1].id
-        
         # LOG TO api_usage FOR BUSINESS DASHBOARD (marked as test, $0)
         api_usage_data = {
             'userId': user['uid'],
@@ -216,17 +949,10 @@ def create_user_order():
             }
         }
         
-        # Add to api_usage collection for business dashboard
-        db.collection('api_usage').add(api_usage_data)
-        print(f"✅ Logged to global api_usage collection (SANDBOX MODE)")
-        
-        # ALSO ADD TO USER SUBCOLLECTION
-        try:
-            user_api_usage_ref = db.collection('business_users').document(user['uid']).collection('api_usage')
-            user_api_usage_ref.add(api_usage_data)
-            print(f"✅ Logged to user subcollection (SANDBOX MODE)")
-        except Exception as subcollection_error:
-            print(f"⚠️ Warning: Could not save to user subcollection: {subcollection_error}")
+        # Order, ICCID index, api_usage and the user subcollection copy in one batch
+        commit_order_side_effects(order_ref, order_data, api_usage_data, audit_uid=user['uid'])
+        idempotent_side_effect_committed()
+        print(f"✅ Logged order and api_usage (SANDBOX MODE)")
         
         return jsonify({
             'success': True,
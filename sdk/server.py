@@ -1,10 +1,20 @@
 import os
+import sqlite3
+import functools
+import hashlib
 import json
+import random
 import re
 import sys
-from flask import Flask, request, jsonify
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
+from flask import Flask, Response, request, jsonify
 import firebase_admin
 from firebase_admin import credentials, firestore, auth
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
 from flask_cors import CORS
 from airalo import Airalo
@@ -15,7 +25,7 @@ load_dotenv()
 # Create Flask app
 app = Flask(__name__)
 CORS(app, origins="*", methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"], 
-     allow_headers=["Content-Type", "Authorization", "X-API-Key"])
+     allow_headers=["Content-Type", "Authorization", "X-API-Key", "Idempotency-Key", "Prefer"])
 
 # Firebase Admin initialization
 if not firebase_admin._apps:
@@ -69,10 +79,208 @@ def initialize_airalo_sdk():
 # Try to initialize SDK on startup
 initialize_airalo_sdk()
 
+# ============================================================================
+# API Key Identity Cache
+# Process-local index of apiCredentials.apiKey -> business identity, kept
+# current by a Firestore snapshot listener on business_users
+# ============================================================================
+
+API_KEY_CACHE_TTL = int(os.getenv('API_KEY_CACHE_TTL', 10))  # Seconds, used while the listener is down
+API_KEY_LISTENER_LOAD_GRACE = int(os.getenv('API_KEY_LISTENER_LOAD_GRACE', 300))  # Seconds the initial snapshot may take before the listener is restarted
+API_KEY_FALLBACK_CACHE_MAX = 10000
+
+_api_key_index = {}
+_api_key_by_uid = {}
+_api_key_index_lock = threading.Lock()  # Guards the index and the fallback cache
+_api_key_index_ready = False
+_api_key_listener = None
+_api_key_listener_lock = threading.RLock()  # One thread (re)starts the listener at a time
+_api_key_listener_generation = 0  # Snapshots from a replaced listener are ignored
+_api_key_listener_started_at = 0
+_api_key_fallback_cache = {}
+
+def _business_identity(uid, user_data):
+    """Build the cached identity for a business_users document"""
+    api_credentials = user_data.get('apiCredentials') or {}
+    return {
+        'uid': uid,
+        'email': user_data.get('email'),
+        'mode': api_credentials.get('mode', 'sandbox'),
+        'kycStatus': user_data.get('kycStatus', 'pending'),
+        'emailVerified': user_data.get('emailVerified', False),
+        'balance': user_data.get('balance', 0),
+    }
+
+def _on_business_users_snapshot(col_snapshot, changes, read_time, generation=None):
+    """Apply business_users changes to the API key index"""
+    global _api_key_index_ready
+    with _api_key_index_lock:
+        if generation != _api_key_listener_generation:
+            return  # Late delivery from a listener that has been replaced
+        for change in changes:
+            doc = change.document
+            old_key = _api_key_by_uid.pop(doc.id, None)
+            if old_key:
+                _api_key_index.pop(old_key, None)
+            
+            if change.type.name == 'REMOVED':
+                continue
+            
+            user_data = doc.to_dict() or {}
+            api_key = (user_data.get('apiCredentials') or {}).get('apiKey')
+            if api_key:
+                _api_key_index[api_key] = _business_identity(doc.id, user_data)
+                _api_key_by_uid[doc.id] = api_key
+        
+        _api_key_fallback_cache.clear()
+        if not _api_key_index_ready:
+            print(f"✅ API key index loaded: {len(_api_key_index)} keys")
+        _api_key_index_ready = True
+
+def start_api_key_listener():
+    """(Re)start the business_users snapshot listener that feeds the API key index"""
+    global _api_key_listener, _api_key_listener_started_at, _api_key_index_ready, _api_key_listener_generation
+    with _api_key_listener_lock:
+        _api_key_listener_started_at = time.time()
+        
+        if _api_key_listener is not None:
+            try:
+                _api_key_listener.unsubscribe()
+            except Exception as e:
+                print(f"⚠️ Could not stop API key listener: {e}")
+        
+        # The initial snapshot re-delivers every document, so start from an empty index
+        with _api_key_index_lock:
+            _api_key_listener_generation += 1
+            generation = _api_key_listener_generation
+            _api_key_index_ready = False
+            _api_key_index.clear()
+            _api_key_by_uid.clear()
+        
+        try:
+            _api_key_listener = db.collection('business_users').on_snapshot(
+                functools.partial(_on_business_users_snapshot, generation=generation))
+            print(f"👂 API key listener started on business_users")
+        except Exception as e:
+            _api_key_listener = None
+            print(f"⚠️ Could not start API key listener, using TTL cache: {e}")
+
+def _api_key_listener_stale(now):
+    """True when the listener should be restarted: it failed or stopped, or its initial snapshot is overdue"""
+    since_start = now - _api_key_listener_started_at
+    if _api_key_listener is None or not getattr(_api_key_listener, 'is_active', True):
+        return since_start > API_KEY_CACHE_TTL
+    return not _api_key_index_ready and since_start > API_KEY_LISTENER_LOAD_GRACE
+
+def _restart_stale_api_key_listener():
+    """Retry the listener from one request thread; the others carry on with the TTL cache"""
+    if not _api_key_listener_lock.acquire(blocking=False):
+        return
+    try:
+        if _api_key_listener_stale(time.time()):
+            start_api_key_listener()
+    finally:
+        _api_key_listener_lock.release()
+
+def _api_key_listener_healthy():
+    """True when the listener is running and has delivered its initial snapshot"""
+    if _api_key_listener is None or not _api_key_index_ready:
+        return False
+    return getattr(_api_key_listener, 'is_active', True)
+
+def lookup_api_key_identity(api_key):
+    """Resolve an API key to its business identity (dictionary lookup while the listener is healthy)"""
+    if _api_key_listener_healthy():
+        return _api_key_index.get(api_key)
+    
+    # Listener is down or still loading - restart it if it failed (or is stuck loading)
+    # and use a short TTL cache meanwhile
+    now = time.time()
+    if _api_key_listener_stale(now):
+        _restart_stale_api_key_listener()
+    
+    with _api_key_index_lock:
+        cached = _api_key_fallback_cache.get(api_key)
+    if cached and cached[1] > now:
+        return cached[0]
+    
+    users_ref = db.collection('business_users')
+    query = users_ref.where('apiCredentials.apiKey', '==', api_key).limit(1)
+    docs = list(query.stream())
+    identity = _business_identity(docs[0].id, docs[0].to_dict()) if docs else None
+    
+    with _api_key_index_lock:
+        if len(_api_key_fallback_cache) >= API_KEY_FALLBACK_CACHE_MAX:
+            _api_key_fallback_cache.clear()
+        _api_key_fallback_cache[api_key] = (identity, now + API_KEY_CACHE_TTL)
+    return identity
+
+start_api_key_listener()
+
+# ============================================================================
+# Firebase ID Token Cache
+# Verified claims are kept in a bounded LRU keyed by the token's SHA-256
+# digest until the token's own "exp"
+# ============================================================================
+
+FIREBASE_TOKEN_CACHE_SIZE = int(os.getenv('FIREBASE_TOKEN_CACHE_SIZE', 10000))
+FIREBASE_ID_TOKEN_CERT_URL = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
+
+_firebase_token_cache = OrderedDict()
+_firebase_token_cache_lock = threading.Lock()
+_firebase_token_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def verify_firebase_id_token(id_token):
+    """Verify a Firebase ID token, reusing cached claims while the token is unexpired"""
+    digest = hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+    now = time.time()
+    
+    with _firebase_token_cache_lock:
+        cached = _firebase_token_cache.get(digest)
+        if cached is not None:
+            if cached['exp'] > now:
+                _firebase_token_cache.move_to_end(digest)
+                _firebase_token_cache_stats['hits'] += 1
+                return cached['claims']
+            del _firebase_token_cache[digest]
+        _firebase_token_cache_stats['misses'] += 1
+    
+    decoded_token = auth.verify_id_token(id_token)
+    
+    with _firebase_token_cache_lock:
+        _firebase_token_cache[digest] = {'claims': decoded_token, 'exp': decoded_token.get('exp', 0)}
+        _firebase_token_cache.move_to_end(digest)
+        while len(_firebase_token_cache) > FIREBASE_TOKEN_CACHE_SIZE:
+            _firebase_token_cache.popitem(last=False)
+            _firebase_token_cache_stats['evictions'] += 1
+    
+    return decoded_token
+
+def get_firebase_token_cache_stats():
+    """Hit/miss counters for the ID token cache"""
+    with _firebase_token_cache_lock:
+        lookups = _firebase_token_cache_stats['hits'] + _firebase_token_cache_stats['misses']
+        return {
+            **_firebase_token_cache_stats,
+            'size': len(_firebase_token_cache),
+            'hit_rate': round(_firebase_token_cache_stats['hits'] / lookups, 4) if lookups else 0,
+        }
+
+def warm_firebase_public_keys():
+    """Prefetch the securetoken certificates into firebase_admin's cache-control session"""
+    try:
+        client = auth._get_client(firebase_admin.get_app())
+        client._token_verifier.request(url=FIREBASE_ID_TOKEN_CERT_URL)
+        print(f"🔑 Firebase public keys prefetched")
+    except Exception as e:
+        print(f"⚠️ Could not prefetch Firebase public keys: {e}")
+
+threading.Thread(target=warm_firebase_public_keys, daemon=True).start()
+
 def authenticate_firebase_token(id_token):
     """Authenticate Firebase ID token for regular users"""
     try:
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = verify_firebase_id_token(id_token)
         uid = decoded_token['uid']
         email = decoded_token.get('email')
         
@@ -86,24 +294,20 @@ def authenticate_firebase_token(id_token):
         return None
 
 def authenticate_api_key(api_key):
-    """Authenticate API key against Firestore business_users collection"""
+    """Authenticate API key against the cached business_users index"""
     try:
-        users_ref = db.collection('business_users')
-        query = users_ref.where('apiCredentials.apiKey', '==', api_key).limit(1)
-        docs = list(query.stream())
+        identity = lookup_api_key_identity(api_key)
         
-        if not docs:
+        if not identity:
             return None
-            
-        user_data = docs[0].to_dict()
         
         # Check if email is verified
-        if not user_data.get('emailVerified', False):
+        if not identity.get('emailVerified', False):
             return None
             
         return {
-            'uid': docs[0].id,
-            'email': user_data.get('email'),
+            'uid': identity['uid'],
+            'email': identity.get('email'),
         }
     except Exception as e:
         print(f"Authentication error: {e}")
@@ -195,47 +399,1222 @@ def convert_sdk_qr_to_response(sdk_response):
         'directAppleInstallationUrl': qr_data.get('direct_apple_installation_url', ''),
     }
 
-def categorize_plan(plan_data):
-    """Categorize a plan as global, regional, or other based on its properties"""
-    country_codes = plan_data.get('country_codes', []) or plan_data.get('country_ids', []) or []
-    plan_type = plan_data.get('type', '').lower()
-    plan_region = plan_data.get('region', '').lower() or plan_data.get('region_slug', '').lower()
-    plan_name = (plan_data.get('name', '') or plan_data.get('title', '') or '').lower()
-    plan_slug = (plan_data.get('slug', '') or '').lower()
+# ============================================================================
+# Bulk Firestore Writer
+# Catalog syncs queue their writes here instead of committing one 500-op
+# batch at a time: full batches are committed from a small thread pool with
+# several in flight, contention/quota errors slow every batch of the writer
+# down (and speed back up on success), and a batch that keeps failing is
+# retried write by write so one bad document doesn't drop the other 499.
+# ============================================================================
+
+BULK_WRITE_BATCH_SIZE = 500  # Firestore batch limit
+BULK_WRITE_CONCURRENCY = int(os.getenv('BULK_WRITE_CONCURRENCY', 4))
+BULK_WRITE_MAX_ATTEMPTS = 4
+BULK_WRITE_MAX_DELAY = 5.0
+
+# Errors that mean "slow down and try again" rather than "this write is bad"
+BULK_WRITE_RETRYABLE_ERRORS = (
+    google_exceptions.Aborted,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+)
+
+def start_bulk_writer(label):
+    """New writer state; queue writes with bulk_write() and finish with close_bulk_writer()"""
+    return {
+        'label': label,
+        'ops': [],
+        'executor': ThreadPoolExecutor(max_workers=BULK_WRITE_CONCURRENCY, thread_name_prefix=f'bulk-{label}'),
+        'in_flight': [],
+        'lock': threading.Lock(),
+        'delay': 0.0,
+        'next_seq': 0,
+        'committed_seq': -1,
+        'done_seqs': set(),
+        'checkpoints': [],
+        'metrics': {
+            'batches': 0,
+            'writes': 0,
+            'failed_writes': 0,
+            'retries': 0,
+            'throttled': 0,
+            'commit_seconds': 0.0,
+            'max_batch_seconds': 0.0,
+        },
+        'failed_ids': [],
+        'first_failed_seq': None,  # Checkpoints at or past this batch never fire
+        'started': time.time(),
+    }
+
+def _apply_bulk_op(target, op):
+    kind, ref, data, merge = op
+    if kind == 'set':
+        target.set(ref, data, merge=merge)
+    elif kind == 'update':
+        target.update(ref, data)
+    else:
+        target.delete(ref)
+
+def _bulk_backoff(writer, error):
+    """Widen the writer-wide delay after contention; returns how long this caller should wait"""
+    with writer['lock']:
+        writer['delay'] = min(max(writer['delay'] * 2, 0.1), BULK_WRITE_MAX_DELAY)
+        writer['metrics']['throttled'] += 1
+        delay = writer['delay']
+    print(f"⏳ Bulk writer {writer['label']} backing off {delay:.2f}s: {error}")
+    return delay * (0.5 + random.random())
+
+def _commit_bulk_ops(writer, ops):
+    """Commit ops as one batch, retrying contention errors with backoff; raises after the last attempt"""
+    for attempt in range(BULK_WRITE_MAX_ATTEMPTS):
+        if writer['delay']:
+            time.sleep(writer['delay'])
+        batch = db.batch()
+        for op in ops:
+            _apply_bulk_op(batch, op)
+        try:
+            batch.commit()
+            with writer['lock']:
+                writer['delay'] = writer['delay'] / 2 if writer['delay'] > 0.05 else 0.0
+            return attempt
+        except BULK_WRITE_RETRYABLE_ERRORS as e:
+            if attempt == BULK_WRITE_MAX_ATTEMPTS - 1:
+                raise
+            with writer['lock']:
+                writer['metrics']['retries'] += 1
+            time.sleep(_bulk_backoff(writer, e))
+
+def _run_bulk_batch(writer, seq, ops):
+    started = time.time()
+    failed = []
+    try:
+        _commit_bulk_ops(writer, ops)
+    except Exception as batch_error:
+        # Fall back to one write per commit so only the writes that really fail are lost
+        print(f"⚠️ Bulk writer {writer['label']} batch {seq} failed ({batch_error}), retrying {len(ops)} writes individually")
+        for op in ops:
+            try:
+                _commit_bulk_ops(writer, [op])
+            except Exception as write_error:
+                print(f"❌ Bulk write {op[0]} {op[1].id} failed: {write_error}")
+                failed.append(op[1].id)
+    elapsed = time.time() - started
     
-    # Check if it's a global package (VERY STRICT - only based on type/region OR known global identifiers)
-    is_global = (
-        plan_type == 'global' or
-        plan_region == 'global' or
-        plan_slug == 'global' or
-        plan_name == 'global' or
-        plan_slug.startswith('discover') or  # Discover/Discover+ are Airalo's global packages
-        plan_name.startswith('discover')
-    )
+    ready = []
+    with writer['lock']:
+        metrics = writer['metrics']
+        metrics['batches'] += 1
+        metrics['writes'] += len(ops) - len(failed)
+        metrics['failed_writes'] += len(failed)
+        metrics['commit_seconds'] += elapsed
+        metrics['max_batch_seconds'] = max(metrics['max_batch_seconds'], elapsed)
+        writer['failed_ids'].extend(failed)
+        if failed and (writer['first_failed_seq'] is None or seq < writer['first_failed_seq']):
+            writer['first_failed_seq'] = seq
+        
+        # Checkpoints fire only once every batch queued before them has committed, and
+        # never past a batch that lost writes, so a resumed job retries those writes
+        writer['done_seqs'].add(seq)
+        while writer['committed_seq'] + 1 in writer['done_seqs']:
+            writer['committed_seq'] += 1
+            writer['done_seqs'].discard(writer['committed_seq'])
+        while writer['checkpoints'] and writer['checkpoints'][0][0] <= writer['committed_seq']:
+            checkpoint_seq, callback = writer['checkpoints'].pop(0)
+            if writer['first_failed_seq'] is None or checkpoint_seq < writer['first_failed_seq']:
+                ready.append(callback)
     
-    # Check if it's a regional package (check against known regional slugs/names)
-    regional_identifiers = [
-        'asia', 'europe', 'africa', 'americas', 'middle-east', 'middle east',
-        'oceania', 'caribbean', 'latin-america', 'latin america',
-        'north-america', 'south-america', 'central-america',
-        'eastern-europe', 'western-europe', 'scandinavia',
-        'asean', 'gcc', 'european-union', 'eu', 'mena',
-        'middle-east-and-north-africa', 'middle-east-north-africa'
-    ]
+    for callback in ready:
+        try:
+            callback()
+        except Exception as e:
+            print(f"⚠️ Bulk writer {writer['label']} checkpoint failed: {e}")
+
+def _submit_bulk_batch(writer):
+    ops, writer['ops'] = writer['ops'], []
+    # Bound the batches in flight so a fast producer doesn't buffer the whole catalog
+    writer['in_flight'] = [future for future in writer['in_flight'] if not future.done()]
+    while len(writer['in_flight']) >= BULK_WRITE_CONCURRENCY * 2:
+        writer['in_flight'].pop(0).result()
+    seq = writer['next_seq']
+    writer['next_seq'] += 1
+    writer['in_flight'].append(writer['executor'].submit(_run_bulk_batch, writer, seq, ops))
+
+def bulk_write(writer, kind, ref, data=None, merge=False):
+    """Queue a 'set', 'update' or 'delete'; returns True when this write filled a batch and sent it"""
+    writer['ops'].append((kind, ref, data, merge))
+    if len(writer['ops']) >= BULK_WRITE_BATCH_SIZE:
+        _submit_bulk_batch(writer)
+        return True
+    return False
+
+def bulk_writer_checkpoint(writer, callback):
+    """Run callback once every write queued so far has been committed (never after a lost write)"""
+    if writer['ops']:
+        _submit_bulk_batch(writer)
+    with writer['lock']:
+        if writer['first_failed_seq'] is not None:
+            ready = False
+        elif writer['next_seq'] - 1 <= writer['committed_seq']:
+            ready = True
+        else:
+            writer['checkpoints'].append((writer['next_seq'] - 1, callback))
+            ready = False
+    if ready:
+        callback()
+
+def close_bulk_writer(writer):
+    """Send the last partial batch, wait for everything in flight and return the writer's metrics"""
+    if writer['ops']:
+        _submit_bulk_batch(writer)
+    writer['executor'].shutdown(wait=True)
+    metrics = dict(writer['metrics'])
+    metrics['elapsed_seconds'] = round(time.time() - writer['started'], 3)
+    metrics['commit_seconds'] = round(metrics['commit_seconds'], 3)
+    metrics['max_batch_seconds'] = round(metrics['max_batch_seconds'], 3)
+    metrics['avg_batch_seconds'] = round(metrics['commit_seconds'] / metrics['batches'], 3) if metrics['batches'] else 0.0
+    metrics['failed_ids'] = writer['failed_ids'][:50]
+    print(f"📝 Bulk writer {writer['label']}: {metrics['writes']} writes in {metrics['batches']} batches, "
+          f"{metrics['failed_writes']} failed, {metrics['retries']} retries, {metrics['elapsed_seconds']}s")
+    return metrics
+
+# ============================================================================
+# Catalog Change Feed
+# Syncs stamp every plan whose content changed with a catalogVersion and then
+# publish that version in catalog_versions/{kind}; the api service serves the
+# /api/public/{plans,topups}/changes feed from these fields.
+# ============================================================================
+
+CATALOG_VOLATILE_FIELDS = {'updated_at', 'synced_at', 'updated_by', 'contentHash', 'catalogVersion'}
+
+def catalog_content_hash(data):
+    """Stable hash of a catalog document, ignoring sync bookkeeping fields"""
+    content = {key: value for key, value in data.items() if key not in CATALOG_VOLATILE_FIELDS}
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+@firestore.transactional
+def _allocate_catalog_version(transaction, version_ref):
+    snapshot = version_ref.get(transaction=transaction)
+    data = snapshot.to_dict() if snapshot.exists else {}
+    version = max(data.get('nextVersion', 0), data.get('version', 0)) + 1
+    transaction.set(version_ref, {'nextVersion': version}, merge=True)
+    return version
+
+@firestore.transactional
+def _publish_catalog_version(transaction, version_ref, version):
+    snapshot = version_ref.get(transaction=transaction)
+    data = snapshot.to_dict() if snapshot.exists else {}
+    if version > data.get('version', 0):
+        transaction.set(version_ref, {'version': version, 'publishedAt': firestore.SERVER_TIMESTAMP}, merge=True)
+
+def stamp_catalog_change(kind, doc_data, existing, sync_state):
+    """Stamp doc_data with a new catalogVersion when it changes the stored document; returns True if it did"""
+    existing = existing or {}
+    # Hash the document as it will look after a merge write, so partial writers agree with full ones
+    content_hash = catalog_content_hash({**existing, **doc_data})
+    if content_hash == existing.get('contentHash'):
+        return False
+    
+    # Allocate the version lazily so syncs without changes don't bump it
+    if sync_state.get('version') is None:
+        version_ref = db.collection('catalog_versions').document(kind)
+        sync_state['version'] = _allocate_catalog_version(db.transaction(), version_ref)
+    
+    doc_data['contentHash'] = content_hash
+    doc_data['catalogVersion'] = sync_state['version']
+    sync_state['changed'] = sync_state.get('changed', 0) + 1
+    return True
+
+SYNC_MAX_DISABLE_FRACTION = float(os.getenv('SYNC_MAX_DISABLE_FRACTION', 0.5))  # Guard against truncated provider responses
+
+def disable_vanished_catalog_documents(collection_name, kind, seen_ids, sync_state):
+    """Disable plans an earlier sdk sync wrote that the provider no longer returns; returns how many"""
+    synced_count = 0
+    vanished = {}
+    for doc in db.collection(collection_name).where('updated_by', '==', 'sdk_sync').stream():
+        synced_count += 1
+        data = doc.to_dict() or {}
+        if doc.id not in seen_ids and data.get('enabled', True) != False:
+            vanished[doc.id] = data
+    if not vanished:
+        return 0
+    if len(vanished) > SYNC_MAX_DISABLE_FRACTION * synced_count:
+        print(f"⚠️ Not disabling {len(vanished)} of {synced_count} {collection_name} plans - provider response looks incomplete")
+        return 0
+    
+    writer = start_bulk_writer(f'{collection_name}-disable')
+    for doc_id in vanished:
+        update = {
+            'enabled': False,
+            'status': 'inactive',
+            'updated_at': firestore.SERVER_TIMESTAMP,
+            'synced_at': firestore.SERVER_TIMESTAMP,
+            'updated_by': 'sdk_sync',
+        }
+        stamp_catalog_change(kind, update, vanished[doc_id], sync_state)
+        bulk_write(writer, 'set', db.collection(collection_name).document(doc_id), update, merge=True)
+    close_bulk_writer(writer)
+    return len(vanished)
+
+def publish_catalog_version(kind, sync_state):
+    """Make a sync's changes visible to the feed (call after all its writes committed)"""
+    if sync_state.get('version') is None:
+        return
+    version_ref = db.collection('catalog_versions').document(kind)
+    _publish_catalog_version(db.transaction(), version_ref, sync_state['version'])
+    print(f"📰 Published {kind} catalog version {sync_state['version']} ({sync_state.get('changed', 0)} changed)")
+
+# ============================================================================
+# Background Sync Jobs
+# Syncs run as jobs in a background thread: the request gets a job id back at
+# once and progress/checkpoints live in sync_jobs/{id}. A leased lock in
+# sync_locks/packages (shared by every worker and service that syncs
+# packages) keeps two syncs from running at once; a watchdog resumes jobs
+# whose worker stopped heartbeating.
+# ============================================================================
+
+SYNC_JOB_LEASE_SECONDS = int(os.getenv('SYNC_JOB_LEASE_SECONDS', 120))
+SYNC_JOB_HEARTBEAT_SECONDS = 30
+SYNC_LOCK_NAME = 'packages'
+SYNC_WORKER_ID = f"{os.uname().nodename}:{os.getpid()}"
+
+SYNC_JOB_RUNNERS = {}  # job type -> function(job) returning (result, http status)
+
+_sync_job_watchdog = None
+
+@firestore.transactional
+def _acquire_sync_lock(transaction, lock_ref, job_id):
+    """Take or extend the sync lock for job_id; returns the job id holding it afterwards"""
+    snapshot = lock_ref.get(transaction=transaction)
+    now = datetime.now(timezone.utc)
+    if snapshot.exists:
+        lock = snapshot.to_dict()
+        if lock.get('jobId') != job_id and lock.get('expiresAt') and lock['expiresAt'] > now:
+            return lock.get('jobId')
+    transaction.set(lock_ref, {
+        'jobId': job_id,
+        'worker': SYNC_WORKER_ID,
+        'expiresAt': now + timedelta(seconds=SYNC_JOB_LEASE_SECONDS),
+    })
+    return job_id
+
+@firestore.transactional
+def _release_sync_lock(transaction, lock_ref, job_id):
+    snapshot = lock_ref.get(transaction=transaction)
+    if snapshot.exists and snapshot.to_dict().get('jobId') == job_id:
+        transaction.delete(lock_ref)
+
+def acquire_sync_lock(job_id):
+    lock_ref = db.collection('sync_locks').document(SYNC_LOCK_NAME)
+    return _acquire_sync_lock(db.transaction(), lock_ref, job_id)
+
+def release_sync_lock(job_id):
+    lock_ref = db.collection('sync_locks').document(SYNC_LOCK_NAME)
+    _release_sync_lock(db.transaction(), lock_ref, job_id)
+
+def _sync_job_heartbeat(job, stop_event):
+    """Keep the lock lease and job heartbeat fresh while the job runs"""
+    while not stop_event.wait(SYNC_JOB_HEARTBEAT_SECONDS):
+        try:
+            if acquire_sync_lock(job['id']) != job['id']:
+                job['lock_lost'] = True
+                return
+            job['ref'].update({'heartbeatAt': datetime.now(timezone.utc)})
+        except Exception as e:
+            print(f"⚠️ Sync job {job['id']} heartbeat failed: {e}")
+
+def ensure_sync_lock_held(job):
+    """Stop a job whose lock lease was taken over (e.g. after a long stall)"""
+    if job is not None and job.get('lock_lost'):
+        raise RuntimeError('Sync lock was taken over by another worker')
+
+def record_sync_progress(job, checkpoint, packages_seen):
+    """Store progress and a checkpoint after a committed batch (no-op outside jobs)"""
+    if job is None:
+        return
+    job['progress']['batches_committed'] += 1
+    job['progress']['packages_seen'] = packages_seen
+    job['checkpoint'] = checkpoint
+    job['ref'].update({
+        'progress': job['progress'],
+        'checkpoint': checkpoint,
+        'heartbeatAt': datetime.now(timezone.utc),
+    })
+
+def record_sync_error(job):
+    if job is not None:
+        job['progress']['errors'] += 1
+
+def _load_sync_job(snapshot):
+    data = snapshot.to_dict() or {}
+    return {
+        'id': snapshot.id,
+        'ref': snapshot.reference,
+        'type': data.get('type'),
+        'requestedBy': data.get('requestedBy', 'unknown'),
+        'checkpoint': data.get('checkpoint') or {},
+        'progress': {'packages_seen': 0, 'batches_committed': 0, 'errors': 0, **(data.get('progress') or {})},
+    }
+
+def run_sync_job(job):
+    """Run a job that already holds the sync lock; returns (result, http status)"""
+    stop_event = threading.Event()
+    threading.Thread(target=_sync_job_heartbeat, args=(job, stop_event), daemon=True).start()
+    job['ref'].update({
+        'status': 'running',
+        'worker': SYNC_WORKER_ID,
+        'startedAt': datetime.now(timezone.utc),
+        'heartbeatAt': datetime.now(timezone.utc),
+    })
+    
+    try:
+        outcome = SYNC_JOB_RUNNERS[job['type']](job)
+        result, status = outcome if isinstance(outcome, tuple) else (outcome, 200)
+        job['ref'].update({
+            'status': 'completed' if status < 400 else 'failed',
+            'result': result,
+            'progress': job['progress'],
+            'finishedAt': datetime.now(timezone.utc),
+        })
+        return result, status
+    except Exception as e:
+        print(f"❌ Sync job {job['id']} failed: {e}")
+        import traceback
+        traceback.print_exc()
+        job['ref'].update({
+            'status': 'failed',
+            'error': str(e),
+            'progress': job['progress'],
+            'finishedAt': datetime.now(timezone.utc),
+        })
+        return {'success': False, 'error': str(e)}, 500
+    finally:
+        stop_event.set()
+        try:
+            release_sync_lock(job['id'])
+        except Exception as e:
+            print(f"⚠️ Could not release sync lock for job {job['id']}: {e}")
+
+def submit_sync_job_request(job_type):
+    """Shared handler for the sync endpoints: authenticate, then queue (or with ?wait=true run) a job"""
+    api_key = request.headers.get('X-API-Key')
+    auth_header = request.headers.get('Authorization', '')
+    
+    user = None
+    if api_key:
+        user = authenticate_api_key(api_key)
+    elif auth_header.startswith('Bearer '):
+        user = authenticate_firebase_token(auth_header[7:])
+    
+    if not user:
+        return jsonify({'success': False, 'error': 'Unauthorized - API key or Firebase token required'}), 401
+    
+    job_ref = db.collection('sync_jobs').document()
+    holder = acquire_sync_lock(job_ref.id)
+    if holder != job_ref.id:
+        return jsonify({
+            'success': False,
+            'error': 'A package sync is already running',
+            'jobId': holder,
+            'statusUrl': f'/api/sync-jobs/{holder}',
+        }), 409
+    
+    job_ref.set({
+        'type': job_type,
+        'status': 'queued',
+        'requestedBy': user.get('email', 'unknown'),
+        'createdAt': datetime.now(timezone.utc),
+        'progress': {'packages_seen': 0, 'batches_committed': 0, 'errors': 0},
+        'checkpoint': {},
+    })
+    job = _load_sync_job(job_ref.get())
+    print(f"🗂️ Sync job {job['id']} ({job_type}) submitted by {job['requestedBy']}")
+    
+    if request.args.get('wait', '').lower() == 'true':
+        result, status = run_sync_job(job)
+        return jsonify({**result, 'jobId': job['id']}), status
     
-    is_regional = (
-        plan_type == 'regional' or
-        plan_slug in regional_identifiers or
-        plan_name in regional_identifiers or
-        (plan_region and plan_region != '' and plan_region != 'global' and plan_region in regional_identifiers)
+    threading.Thread(target=run_sync_job, args=(job,), daemon=True).start()
+    return jsonify({
+        'success': True,
+        'jobId': job['id'],
+        'status': 'queued',
+        'statusUrl': f"/api/sync-jobs/{job['id']}",
+    }), 202
+
+def resume_stale_sync_jobs():
+    """Resume queued/running jobs whose worker stopped heartbeating"""
+    stale_before = datetime.now(timezone.utc) - timedelta(seconds=SYNC_JOB_LEASE_SECONDS)
+    for snapshot in db.collection('sync_jobs').where('status', 'in', ['queued', 'running']).stream():
+        data = snapshot.to_dict() or {}
+        if data.get('type') not in SYNC_JOB_RUNNERS:
+            continue
+        heartbeat = data.get('heartbeatAt') or data.get('createdAt')
+        if heartbeat and heartbeat > stale_before:
+            continue
+        if acquire_sync_lock(snapshot.id) != snapshot.id:
+            continue
+        print(f"♻️ Resuming sync job {snapshot.id} from checkpoint {data.get('checkpoint')}")
+        snapshot.reference.update({'resumedAt': datetime.now(timezone.utc), 'resumeCount': firestore.Increment(1)})
+        threading.Thread(target=run_sync_job, args=(_load_sync_job(snapshot),), daemon=True).start()
+
+def _watch_sync_jobs():
+    while True:
+        try:
+            resume_stale_sync_jobs()
+        except Exception as e:
+            print(f"⚠️ Sync job watchdog failed: {e}")
+        time.sleep(SYNC_JOB_LEASE_SECONDS)
+
+def start_sync_job_watchdog():
+    global _sync_job_watchdog
+    if _sync_job_watchdog is None:
+        _sync_job_watchdog = threading.Thread(target=_watch_sync_jobs, daemon=True)
+        _sync_job_watchdog.start()
+
+@app.route('/api/sync-jobs/<job_id>', methods=['GET'])
+def get_sync_job(job_id):
+    """Status, progress and result of a background sync job"""
+    try:
+        api_key = request.headers.get('X-API-Key')
+        auth_header = request.headers.get('Authorization', '')
+        
+        user = None
+        if api_key:
+            user = authenticate_api_key(api_key)
+        elif auth_header.startswith('Bearer '):
+            user = authenticate_firebase_token(auth_header[7:])
+        
+        if not user:
+            return jsonify({'success': False, 'error': 'Unauthorized - API key or Firebase token required'}), 401
+        
+        snapshot = db.collection('sync_jobs').document(job_id).get()
+        if not snapshot.exists:
+            return jsonify({'success': False, 'error': 'Sync job not found'}), 404
+        
+        job = {key: value.isoformat() if isinstance(value, datetime) else value
+               for key, value in snapshot.to_dict().items()}
+        return jsonify({'success': True, 'jobId': job_id, **job})
+        
+    except Exception as e:
+        print(f"❌ Error fetching sync job {job_id}: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# ============================================================================
+# Airalo Ingestion Pipeline
+# Catalog syncs stream Airalo's package list through generator stages
+# (fetch page -> normalize -> categorize -> price -> diff -> write), so only
+# one page of packages and one diff chunk of documents are held at a time.
+# Every stage counts its items and time; the sync result reports the
+# throughput of each stage.
+# ============================================================================
+
+AIRALO_SYNC_PAGE_SIZE = int(os.getenv('AIRALO_SYNC_PAGE_SIZE', 100))
+SYNC_DIFF_CHUNK_SIZE = 100  # Documents looked up per Firestore get_all in the diff stage
+SYNC_PIPELINE_STAGES = ['fetch', 'normalize', 'categorize', 'price', 'diff', 'write']
+
+# Fields set on every document of the topups collection
+TOPUP_DOCUMENT_FLAGS = {
+    'is_topup_package': True,
+    'available_for_topup': True,
+    'available_for_purchase': False,
+}
+
+def ensure_airalo_sdk():
+    """Reinitialize the Airalo SDK if needed; returns an error (result, status) when it is unavailable"""
+    if alo is not None:
+        return None
+    print("🔄 Attempting to reinitialize Airalo SDK...", flush=True)
+    sys.stdout.flush()
+    if initialize_airalo_sdk():
+        print("✅ Airalo SDK reinitialized successfully", flush=True)
+        sys.stdout.flush()
+        return None
+    print("❌ Airalo SDK reinitialization failed - Airalo API still unavailable", flush=True)
+    sys.stderr.flush()
+    return {
+        'success': False,
+        'error': 'Airalo SDK is not available. The Airalo API appears to be down (502 Bad Gateway). Please try again later.'
+    }, 503
+
+def load_markup_percentage():
+    """Markup percentage from Firestore config (default 17%)"""
+    try:
+        markup_config = db.collection('config').document('pricing').get()
+        if markup_config.exists:
+            return markup_config.to_dict().get('markup_percentage', 17)
+    except Exception as e:
+        print(f"⚠️ Could not load markup config, using default 17%: {e}")
+    return 17
+
+def extract_airalo_package_list(packages_response):
+    """The package list inside an SDK response, whichever of its shapes it came in"""
+    if not packages_response:
+        return []
+    if isinstance(packages_response, list):
+        return packages_response
+    if not isinstance(packages_response, dict):
+        raise ValueError(f'Unexpected SDK response type: {type(packages_response).__name__}')
+
+    if 'data' in packages_response:
+        packages_data = packages_response['data']
+    elif 'packages' in packages_response:
+        packages_data = packages_response['packages']
+    else:
+        raise ValueError(f'Unexpected SDK response structure: {list(packages_response.keys())}')
+
+    if isinstance(packages_data, dict):
+        if 'packages' in packages_data:
+            packages_data = packages_data['packages']
+        elif 'data' in packages_data:
+            packages_data = packages_data['data']
+        else:
+            packages_data = next((value for value in packages_data.values()
+                                  if isinstance(value, list) and value), packages_data)
+    if not isinstance(packages_data, list):
+        raise ValueError(f'Invalid packages data format: expected list, got {type(packages_data).__name__}')
+    return packages_data
+
+# Concurrent catalog fetch: pages are requested AIRALO_FETCH_CONCURRENCY at a
+# time from a persistent pool and retried one by one. The SDK's HTTP resource
+# resets its headers after every request, so each pool thread has its own client.
+AIRALO_FETCH_CONCURRENCY = int(os.getenv('AIRALO_FETCH_CONCURRENCY', 4))
+AIRALO_PAGE_MAX_ATTEMPTS = 3
+AIRALO_PAGE_RETRY_BACKOFF = 0.5  # Seconds, doubled per attempt
+AIRALO_FETCH_MODE_TTL = 6 * 3600  # Seconds before a remembered fallback is probed again
+
+_airalo_fetch_executor = None
+_airalo_fetch_executor_lock = threading.Lock()
+_airalo_fetch_clients = threading.local()
+_airalo_fetch_mode = {'mode': None, 'checked_at': 0}  # 'paged', or the get_all_packages kwargs that worked
+
+def _airalo_fetch_pool():
+    global _airalo_fetch_executor
+    with _airalo_fetch_executor_lock:
+        if _airalo_fetch_executor is None:
+            _airalo_fetch_executor = ThreadPoolExecutor(max_workers=AIRALO_FETCH_CONCURRENCY, thread_name_prefix='airalo-fetch')
+        return _airalo_fetch_executor
+
+def _thread_airalo_client():
+    client = getattr(_airalo_fetch_clients, 'client', None)
+    if client is None:
+        client = Airalo({
+            "client_id": AIRALO_CLIENT_ID,
+            "client_secret": AIRALO_CLIENT_SECRET,
+        })
+        _airalo_fetch_clients.client = client
+    return client
+
+def remember_airalo_fetch_mode(mode):
+    if _airalo_fetch_mode['mode'] != mode:
+        print(f"🧭 Airalo catalog fetch mode: {mode}")
+    _airalo_fetch_mode.update({'mode': mode, 'checked_at': time.time()})
+
+def remembered_airalo_fetch_mode():
+    if time.time() - _airalo_fetch_mode['checked_at'] > AIRALO_FETCH_MODE_TTL:
+        return None
+    return _airalo_fetch_mode['mode']
+
+def fetch_airalo_page(page, page_size):
+    """One catalog page (empty past the last one), retried with exponential backoff"""
+    for attempt in range(AIRALO_PAGE_MAX_ATTEMPTS):
+        try:
+            packages_response = _thread_airalo_client().get_all_packages(flat=False, limit=page_size, page=page)
+            return extract_airalo_package_list(packages_response)
+        except Exception as e:
+            if attempt == AIRALO_PAGE_MAX_ATTEMPTS - 1:
+                raise
+            delay = AIRALO_PAGE_RETRY_BACKOFF * (2 ** attempt) * (0.5 + random.random())
+            print(f"⚠️ Airalo page {page} failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def _fetch_airalo_catalog_unpaged():
+    """The whole catalog in one call, trying the remembered response format first"""
+    remembered = remembered_airalo_fetch_mode()
+    candidates = [{'flat': False}, {}, {'flat': True}]
+    if isinstance(remembered, dict):
+        candidates.remove(remembered)
+        candidates.insert(0, remembered)
+    for kwargs in candidates:
+        try:
+            packages_response = alo.get_all_packages(**kwargs)
+            print(f"📦 get_all_packages({kwargs}) response type: {type(packages_response)}")
+            if packages_response:
+                packages = extract_airalo_package_list(packages_response)
+                remember_airalo_fetch_mode(kwargs)
+                return packages
+        except Exception as e:
+            print(f"⚠️ get_all_packages({kwargs}) failed: {e}")
+    raise RuntimeError('Failed to get packages via Airalo SDK')
+
+def _airalo_package_id(pkg):
+    return (pkg.get('id') or
+            pkg.get('slug') or
+            pkg.get('package_id') or
+            (pkg.get('data', {}).get('id') if isinstance(pkg.get('data'), dict) else None))
+
+def _airalo_country_codes(pkg):
+    if isinstance(pkg.get('countries'), list):
+        return [c.get('country_code') or c.get('code') or c for c in pkg.get('countries', []) if c]
+    if pkg.get('country_code'):
+        return [pkg.get('country_code')]
+    if isinstance(pkg.get('country_codes'), list):
+        return pkg.get('country_codes')
+    country = pkg.get('country')
+    if isinstance(country, dict):
+        return [country.get('code') or country.get('country_code')]
+    if isinstance(country, str) and country:
+        return [country]
+    return []
+
+def _airalo_sub_packages(pkg):
+    """Sub-packages of a global/regional parent (or the packages of its operators)"""
+    for key in ('packages', 'sub_packages', 'children'):
+        if isinstance(pkg.get(key), list):
+            return pkg.get(key)
+    sub_packages = []
+    if isinstance(pkg.get('operators'), list):
+        for operator in pkg.get('operators', []):
+            if isinstance(operator, dict) and isinstance(operator.get('packages'), list):
+                sub_packages.extend(operator['packages'])
+    return sub_packages
+
+def _is_airalo_topup(pkg, slug, check_name=True):
+    slug = str(slug).lower()
+    package_type = (pkg.get('type') or '').lower()
+    name = (pkg.get('name') or pkg.get('title') or '').lower() if check_name else ''
+    return (
+        pkg.get('is_topup') == True or
+        pkg.get('topup') == True or
+        '-topup' in slug or
+        'topup' in package_type or
+        'top-up' in package_type or
+        'topup' in name or
+        'top-up' in name
     )
+
+def _airalo_price(pkg):
+    """First positive price field of a package, 0 when it has none"""
+    price_fields = [
+        pkg.get('price'),
+        pkg.get('retail_price'),
+        pkg.get('amount'),
+        pkg.get('cost'),
+        pkg.get('base_price'),
+    ]
+    if isinstance(pkg.get('pricing'), dict):
+        pricing_obj = pkg.get('pricing')
+        price_fields.extend([
+            pricing_obj.get('price'),
+            pricing_obj.get('retail_price'),
+            pricing_obj.get('amount'),
+        ])
+    for price_field in price_fields:
+        if price_field is not None:
+            try:
+                price_value = float(price_field)
+                if price_value > 0:
+                    return price_value
+            except (ValueError, TypeError):
+                continue
+    return 0
+
+def _timed_stage(stats, name, items):
+    """Pass items through, adding the time spent producing them (upstream included) to stats[name]"""
+    stage = stats.setdefault(name, {'items': 0, 'seconds': 0.0})
+    iterator = iter(items)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            stage['seconds'] += time.perf_counter() - started
+            return
+        stage['seconds'] += time.perf_counter() - started
+        stage['items'] += 1
+        yield item
+
+def fetch_airalo_package_pages(ctx):
+    """Stage fetch: yield (index of first package, packages) one catalog page at a time, fetching ahead concurrently"""
+    if isinstance(remembered_airalo_fetch_mode(), dict):
+        # Paging didn't work last time; go straight to the call that did
+        yield 0, _fetch_airalo_catalog_unpaged()
+        return
+    
+    page_size = ctx['page_size']
+    first_page = ctx['start_index'] // page_size + 1
+    executor = _airalo_fetch_pool()
+    futures = {}
+    next_page = first_page
+    page = first_page
+    previous_first_id = None
+    try:
+        while True:
+            # Keep a window of pages in flight; the last page is unknown, so the tail over-fetches a little
+            while len(futures) < AIRALO_FETCH_CONCURRENCY:
+                futures[next_page] = executor.submit(fetch_airalo_page, next_page, page_size)
+                next_page += 1
+            
+            try:
+                packages = futures.pop(page).result()
+            except Exception as e:
+                if page != first_page:
+                    raise
+                print(f"⚠️ Paged get_all_packages failed ({e}), fetching the catalog in one call")
+                for future in futures.values():
+                    future.cancel()
+                yield 0, _fetch_airalo_catalog_unpaged()
+                return
+            
+            remember_airalo_fetch_mode('paged')
+            if not packages:
+                return
+            first_id = _airalo_package_id(packages[0]) if isinstance(packages[0], dict) else packages[0]
+            if first_id == previous_first_id:
+                print(f"⚠️ Airalo returned page {page} twice, stopping pagination")
+                return
+            previous_first_id = first_id
+            
+            yield (page - 1) * page_size, packages
+            if len(packages) < page_size:
+                return
+            page += 1
+    finally:
+        for future in futures.values():
+            future.cancel()
+
+def normalize_airalo_packages(pages, ctx):
+    """Stage normalize: one record per usable package with its id, countries and sub-packages"""
+    for first_index, packages in pages:
+        for offset, pkg in enumerate(packages):
+            index = first_index + offset
+            if index < ctx['start_index']:
+                continue
+            ctx['next_index'] = index + 1
+            try:
+                if isinstance(pkg, str):
+                    print(f"⚠️ Package {index} is a string (ID only): {pkg}. Skipping - need full package data.")
+                    continue
+                if not isinstance(pkg, dict):
+                    print(f"⚠️ Skipping package {index}: Unexpected type {type(pkg)}")
+                    continue
+                package_id = _airalo_package_id(pkg)
+                if not package_id:
+                    print(f"⚠️ Skipping package {index}: No ID found. Keys: {list(pkg.keys())}")
+                    continue
+                if ctx['sample_package'] is None:
+                    ctx['sample_package'] = pkg
+                ctx['counters']['packages'] += 1
+
+                yield {
+                    'index': index,
+                    'id': package_id,
+                    'pkg': pkg,
+                    'country_codes': _airalo_country_codes(pkg),
+                    'sub_packages': _airalo_sub_packages(pkg),
+                    'is_topup': _is_airalo_topup(pkg, package_id),
+                }
+            except Exception as e:
+                print(f"⚠️ Error normalizing package {index}: {e}")
+                record_sync_error(ctx['job'])
+
+def categorize_airalo_packages(records, ctx):
+    """Stage categorize: keep the packages this sync owns and tag them global/regional/other"""
+    counters = ctx['counters']
+    for record in records:
+        pkg = record['pkg']
+        if ctx['kind'] == 'plans':
+            # Topup packages are handled separately by the topup sync
+            if record['is_topup']:
+                continue
+        else:
+            counters['checked'] += 1
+            if record['is_topup']:
+                counters['topup'] += 1
+            # Sub-packages may be topups even when their parent isn't
+            elif not record['sub_packages']:
+                continue
+
+        # Same rules as the derived 'category' field, so a plan's type and category agree
+        record['category'] = categorize_public_plan({
+            'country_codes': record['country_codes'],
+            'type': pkg.get('type', ''),
+            'region': pkg.get('region', '') or pkg.get('region_slug', ''),
+            'name': pkg.get('name', '') or pkg.get('title', ''),
+            'slug': record['id'],
+        })
+        if ctx['kind'] == 'plans':
+            counters[record['category']] += 1
+        yield record
+
+def _airalo_plan_document(pkg, package_id, category, country_codes, original_price, markup_percentage):
+    return {
+        'slug': package_id,
+        'name': pkg.get('name') or pkg.get('title') or 'Unnamed Plan',
+        'description': pkg.get('description') or '',
+        'price': round(original_price * (1 + markup_percentage / 100), 2),
+        'original_price': original_price,
+        'currency': pkg.get('currency', 'USD'),
+        'country_codes': country_codes,
+        'country_ids': country_codes,
+        'capacity': pkg.get('capacity') or pkg.get('amount') or 0,
+        'period': pkg.get('period') or pkg.get('day') or 0,
+        'operator': pkg.get('operator') or '',
+        'status': 'active',
+        'type': category,
+        'is_global': category == 'global',
+        'is_regional': category == 'regional',
+        'region': pkg.get('region') or pkg.get('region_slug') or '',
+        'updated_at': firestore.SERVER_TIMESTAMP,
+        'synced_at': firestore.SERVER_TIMESTAMP,
+        'updated_by': 'sdk_sync',
+        'provider': 'airalo',
+        'enabled': True,
+        'is_roaming': pkg.get('is_roaming', False),
+    }
+
+def _airalo_sub_plan_document(pkg, sub_pkg, package_id, sub_package_id, category, country_codes, original_price, markup_percentage):
+    sub_capacity = sub_pkg.get('capacity') or sub_pkg.get('amount') or sub_pkg.get('data') or 0
+    parent_name = pkg.get('name') or pkg.get('title') or 'Regional'
+    return {
+        'slug': sub_package_id,
+        'name': sub_pkg.get('name') or sub_pkg.get('title') or f"{parent_name} - {sub_capacity}GB",
+        'description': sub_pkg.get('description') or pkg.get('description') or '',
+        'price': round(original_price * (1 + markup_percentage / 100), 2),
+        'original_price': original_price,
+        'currency': sub_pkg.get('currency') or pkg.get('currency', 'USD'),
+        'country_codes': country_codes,
+        'country_ids': country_codes,
+        'capacity': sub_capacity,
+        'period': sub_pkg.get('period') or sub_pkg.get('day') or sub_pkg.get('validity') or pkg.get('period') or 0,
+        'operator': sub_pkg.get('operator') or pkg.get('operator') or '',
+        'status': 'active',
+        'type': category,
+        'is_global': category == 'global',
+        'is_regional': category == 'regional',
+        'region': pkg.get('region') or pkg.get('region_slug') or '',
+        'parent_package_id': package_id,
+        'parent_category': category,
+        'updated_at': firestore.SERVER_TIMESTAMP,
+        'synced_at': firestore.SERVER_TIMESTAMP,
+        'updated_by': 'sdk_sync',
+        'provider': 'airalo',
+        'enabled': True,
+        'is_roaming': sub_pkg.get('is_roaming') or pkg.get('is_roaming', False),
+    }
+
+def _price_plan_record(record, markup_percentage):
+    """dataplans documents for a package: its priced sub-packages plus a container, or the plan itself"""
+    pkg, package_id, category = record['pkg'], record['id'], record['category']
+    country_codes = record['country_codes']
+    if not record['sub_packages'] or category not in ('global', 'regional'):
+        return [(package_id, _airalo_plan_document(pkg, package_id, category, country_codes, _airalo_price(pkg), markup_percentage))]
+
+    documents = []
+    for sub_idx, sub_pkg in enumerate(record['sub_packages']):
+        if not isinstance(sub_pkg, dict):
+            continue
+        sub_package_id = f"{package_id}_{sub_pkg.get('id') or sub_idx}"
+        if _is_airalo_topup(sub_pkg, sub_package_id, check_name=False):
+            continue
+        original_price = _airalo_price(sub_pkg)
+        if original_price == 0:
+            continue
+        documents.append((sub_package_id, _airalo_sub_plan_document(
+            pkg, sub_pkg, package_id, sub_package_id, category, country_codes, original_price, markup_percentage)))
+
+    # The parent is saved as a container for its sub-packages
+    parent_doc = _airalo_plan_document(pkg, package_id, category, country_codes, 0, markup_percentage)
+    parent_doc.update({'capacity': 0, 'period': 0, 'is_parent': True, 'child_count': len(record['sub_packages'])})
+    parent_doc.pop('is_roaming')
+    documents.append((package_id, parent_doc))
+    return documents
+
+def _price_topup_record(record, markup_percentage):
+    """topups documents for a package: its topup sub-packages, or the package itself when it is a topup"""
+    pkg, package_id, category = record['pkg'], record['id'], record['category']
+    country_codes = record['country_codes']
+    if not record['sub_packages']:
+        document = _airalo_plan_document(pkg, package_id, category, country_codes, _airalo_price(pkg), markup_percentage)
+        return [(package_id, {**document, **TOPUP_DOCUMENT_FLAGS})]
+
+    documents = []
+    for sub_idx, sub_pkg in enumerate(record['sub_packages']):
+        if not isinstance(sub_pkg, dict):
+            continue
+        if not _is_airalo_topup(sub_pkg, sub_pkg.get('id') or sub_pkg.get('slug') or ''):
+            continue
+        sub_package_id = f"{package_id}_{sub_pkg.get('id') or sub_idx}"
+        original_price = _airalo_price(sub_pkg)
+        if original_price == 0:
+            continue
+        document = _airalo_sub_plan_document(
+            pkg, sub_pkg, package_id, sub_package_id, category, country_codes, original_price, markup_percentage)
+        documents.append((sub_package_id, {**document, **TOPUP_DOCUMENT_FLAGS}))
+    return documents
+
+# Derived display fields, stored at sync time so the api service's public
+# endpoints don't parse them per request. These follow the api service's rules
+# (keep CATALOG_DERIVED_VERSION and the helpers below in step with it).
+CATALOG_DERIVED_VERSION = 1
+
+_VALIDITY_NAME_RE = re.compile(r'(\d+)\s*Days?')
+_VALIDITY_SLUG_RE = re.compile(r'(\d+)days?')
+
+REGIONAL_IDENTIFIERS = frozenset([
+    'asia', 'europe', 'africa', 'americas', 'middle-east', 'middle east',
+    'oceania', 'caribbean', 'latin-america', 'latin america',
+    'north-america', 'south-america', 'central-america',
+    'eastern-europe', 'western-europe', 'scandinavia',
+    'asean', 'gcc', 'european-union', 'eu', 'mena',
+    'middle-east-and-north-africa', 'middle-east-north-africa',
+    'euconnect', 'euroconnect'  # Add specific regional operators
+])
+
+def _identifier_pattern(identifiers):
+    """Regex matching any identifier as a substring, as one prefix trie so each position is tried once"""
+    # An identifier that contains another can never be the only one found
+    identifiers = [word for word in identifiers
+                   if not any(other != word and other in word for other in identifiers)]
+    trie = {}
+    for word in identifiers:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
     
-    if is_global:
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        return branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+    return re.compile(build(trie))
+
+_REGIONAL_IDENTIFIER_RE = _identifier_pattern(REGIONAL_IDENTIFIERS)
+
+def categorize_public_plan(plan_data):
+    """Global, regional or other: the api service's categorize_plan, used for a synced plan's type and its derived category"""
+    plan_type = (plan_data.get('type') or '').lower()
+    plan_region = (plan_data.get('region') or plan_data.get('region_slug') or '').lower()
+    plan_name = (plan_data.get('name') or plan_data.get('title') or '').lower()
+    plan_slug = (plan_data.get('slug') or '').lower()
+    country_codes = plan_data.get('country_codes', []) or []
+    
+    # Check if it's a global package
+    if (plan_data.get('is_global') == True or
+            plan_type == 'global' or
+            plan_region == 'global' or
+            plan_slug == 'global' or
+            plan_name == 'global' or
+            plan_slug.startswith('discover') or
+            plan_name.startswith('discover')):
         return 'global'
-    elif is_regional:
+    
+    # Check if it's a regional package; cheap field checks first, then one scan of slug and name
+    if (plan_data.get('is_regional') == True or
+            plan_type == 'regional' or
+            plan_region in REGIONAL_IDENTIFIERS or
+            # Plans with no country codes or N/A are likely regional
+            (not country_codes or country_codes == ['N/A'] or country_codes == [None]) or
+            # Plans with multiple countries (2+) are likely regional
+            (isinstance(country_codes, list) and len(country_codes) >= 2) or
+            # Regional identifiers (including regional operators) anywhere in slug/name
+            _REGIONAL_IDENTIFIER_RE.search(f"{plan_slug}\n{plan_name}")):
         return 'regional'
+    
+    return 'other'
+
+def _parse_validity(plan_data):
+    """Validity in days, falling back to the plan name/slug ("7 Days", "plan-7days-1gb")"""
+    validity = plan_data.get('validity')
+    if not validity:
+        name_match = _VALIDITY_NAME_RE.search(plan_data.get('name', '') or '')
+        if name_match:
+            validity = int(name_match.group(1))
+        else:
+            slug_match = _VALIDITY_SLUG_RE.search(plan_data.get('slug', '') or '')
+            if slug_match:
+                validity = int(slug_match.group(1))
+    return validity
+
+def derive_catalog_fields(plan_data):
+    """Derived display fields for a dataplans/topups document"""
+    operator = plan_data.get('operator')
+    return {
+        'category': categorize_public_plan(plan_data),
+        'validity_days': _parse_validity(plan_data),
+        'operator_title': operator.get('title') if isinstance(operator, dict) else operator,
+        'capacity_value': plan_data.get('data') or plan_data.get('capacity'),
+        'derived_version': CATALOG_DERIVED_VERSION,
+    }
+
+def price_airalo_packages(records, ctx):
+    """Stage price: expand each package into (doc id, document, package index) with marked-up prices and derived fields"""
+    price_record = _price_plan_record if ctx['kind'] == 'plans' else _price_topup_record
+    for record in records:
+        try:
+            for doc_id, document in price_record(record, ctx['markup_percentage']):
+                document.update(derive_catalog_fields(document))
+                ctx['counters']['synced'] += 1
+                yield doc_id, document, record['index']
+        except Exception as e:
+            print(f"⚠️ Error pricing package {record['id']}: {e}")
+            record_sync_error(ctx['job'])
+
+def _diff_catalog_chunk(chunk, ctx):
+    collection = db.collection(ctx['collection'])
+    refs = {doc_id: collection.document(doc_id) for doc_id, _, _ in chunk}
+    existing = {snapshot.id: snapshot.to_dict() or {} for snapshot in db.get_all(list(refs.values())) if snapshot.exists}
+    for doc_id, document, index in chunk:
+        ctx['seen_ids'].add(doc_id)
+        if stamp_catalog_change(ctx['kind'], document, existing.get(doc_id), ctx['sync_state']):
+            yield doc_id, document, index
+        else:
+            ctx['counters']['skipped'] += 1
+
+def diff_catalog_documents(documents, ctx):
+    """Stage diff: drop documents whose content is unchanged, looking the stored ones up a chunk at a time"""
+    chunk = []
+    for item in documents:
+        chunk.append(item)
+        if len(chunk) >= SYNC_DIFF_CHUNK_SIZE:
+            yield from _diff_catalog_chunk(chunk, ctx)
+            chunk = []
+    if chunk:
+        yield from _diff_catalog_chunk(chunk, ctx)
+
+def pipeline_stage_report(stats, total_seconds, written):
+    """Per-stage items, own time (upstream time subtracted) and throughput"""
+    report = {}
+    upstream_seconds = 0.0
+    for name in SYNC_PIPELINE_STAGES:
+        if name == 'write':
+            items, seconds = written, total_seconds - upstream_seconds
+        else:
+            stage = stats.get(name, {'items': 0, 'seconds': 0.0})
+            items, seconds = stage['items'], stage['seconds'] - upstream_seconds
+            upstream_seconds = stage['seconds']
+        seconds = max(seconds, 0.0)
+        report[name] = {
+            'items': items,
+            'seconds': round(seconds, 3),
+            'items_per_second': round(items / seconds, 1) if seconds else None,
+        }
+    return report
+
+def run_airalo_catalog_sync(job, kind):
+    """Stream the Airalo catalog into dataplans (kind 'plans') or topups (kind 'topups')"""
+    collection_name = 'dataplans' if kind == 'plans' else 'topups'
+    checkpoint = job['checkpoint']
+    page_size = checkpoint.get('page_size') or AIRALO_SYNC_PAGE_SIZE
+    start_index = checkpoint.get('next_index', 0)
+    if start_index:
+        print(f"♻️ Resuming {kind} sync at package {start_index}")
+
+    markup_percentage = load_markup_percentage()
+    print(f"💰 Using markup percentage: {markup_percentage}%")
+
+    ctx = {
+        'kind': kind,
+        'collection': collection_name,
+        'job': job,
+        'page_size': page_size,
+        'start_index': start_index,
+        'markup_percentage': markup_percentage,
+        'sync_state': {},
+        'seen_ids': set(),
+        'sample_package': None,
+        'next_index': start_index,
+        'counters': {'packages': 0, 'synced': 0, 'written': 0, 'skipped': 0, 'checked': 0, 'topup': 0,
+                     'global': 0, 'regional': 0, 'other': 0},
+    }
+    stats = {}
+    pipeline = _timed_stage(stats, 'fetch', fetch_airalo_package_pages(ctx))
+    pipeline = _timed_stage(stats, 'normalize', normalize_airalo_packages(pipeline, ctx))
+    pipeline = _timed_stage(stats, 'categorize', categorize_airalo_packages(pipeline, ctx))
+    pipeline = _timed_stage(stats, 'price', price_airalo_packages(pipeline, ctx))
+    pipeline = _timed_stage(stats, 'diff', diff_catalog_documents(pipeline, ctx))
+
+    # Stage write: changed documents go to the bulk writer; checkpoints follow committed batches
+    writer = start_bulk_writer(kind)
+    started = time.perf_counter()
+    for doc_id, document, index in pipeline:
+        ensure_sync_lock_held(job)
+        ref = db.collection(collection_name).document(doc_id)
+        if bulk_write(writer, 'set', ref, document, merge=True):
+            bulk_writer_checkpoint(writer, functools.partial(
+                record_sync_progress, job, {'next_index': index, 'page_size': page_size}, index))
+        ctx['counters']['written'] += 1
+    write_metrics = close_bulk_writer(writer)
+    total_seconds = time.perf_counter() - started
+
+    counters = ctx['counters']
+    if not counters['packages'] and not start_index:
+        return {'success': False, 'error': 'No packages found in Airalo SDK response.'}, 500
+    if not write_metrics['failed_writes']:
+        record_sync_progress(job, {'next_index': ctx['next_index'], 'page_size': page_size}, ctx['next_index'])
+    
+    # seen_ids only covers the resumed part of the feed, so a resumed run cannot tell what vanished
+    disabled_count = 0
+    if start_index:
+        print(f"⏭️ Skipping vanished-{kind} pass for resumed sync")
     else:
-        return 'other'
+        disabled_count = disable_vanished_catalog_documents(collection_name, kind, ctx['seen_ids'], ctx['sync_state'])
+    publish_catalog_version(kind, ctx['sync_state'])
+    
+    stage_report = pipeline_stage_report(stats, total_seconds, counters['written'])
+    print(f"✅ Successfully synced {counters['synced']} {kind} to Firestore {collection_name} collection")
+    print(f"   Written: {counters['written']}, unchanged: {counters['skipped']}, disabled: {disabled_count}")
+    for name, stage in stage_report.items():
+        print(f"   ⏱️ {name}: {stage['items']} in {stage['seconds']}s ({stage['items_per_second']}/s)")
+    
+    if kind == 'plans':
+        kind_counts = {
+            'global_count': counters['global'],
+            'regional_count': counters['regional'],
+            'other_count': counters['other'],
+        }
+    else:
+        kind_counts = {'topup_count': counters['topup']}
+        print(f"   - Total packages checked: {counters['checked']}, topup packages found: {counters['topup']}")
+        if counters['topup'] == 0 and counters['checked'] > 0:
+            print(f"⚠️ WARNING: No topup packages detected out of {counters['checked']} checked packages")
+            sample = ctx['sample_package'] or {}
+            print(f"   Sample package keys: {list(sample.keys())[:20]}")
+            print(f"   Sample package ID: {sample.get('id')}, slug: {sample.get('slug')}, type: {sample.get('type')}")
+    
+    sync_result = {
+        'changed_count': ctx['sync_state'].get('changed', 0),
+        'written_count': counters['written'],
+        'skipped_count': counters['skipped'],
+        'disabled_count': disabled_count,
+        'write_metrics': write_metrics,
+        'pipeline': stage_report,
+        'catalog_version': ctx['sync_state'].get('version'),
+        **kind_counts,
+    }
+    
+    # Create sync log
+    db.collection('sync_logs').document().set({
+        'timestamp': firestore.SERVER_TIMESTAMP,
+        'plans_synced': counters['synced'],
+        **sync_result,
+        'status': 'completed',
+        'source': 'sdk_sync',
+        'sync_type': 'packages_sync' if kind == 'plans' else 'topup_packages_sync',
+        'provider': 'airalo',
+        'user_email': job['requestedBy'],
+    })
+    
+    label = 'packages' if kind == 'plans' else 'topup packages'
+    return {
+        'success': True,
+        'message': f"Successfully synced {counters['synced']} {label}",
+        'total_synced': counters['synced'],
+        **sync_result,
+    }
 
 # ============================================================================
 # Health Check
@@ -248,7 +1627,9 @@ def health_check():
         'mode': 'PRODUCTION',
         'message': 'Using Airalo Python SDK for real API operations',
         'sdk_initialized': alo is not None,
-        'sdk_available': alo is not None
+        'sdk_available': alo is not None,
+        'token_cache': get_firebase_token_cache_stats(),
+        'api_usage_buffer': get_usage_buffer_stats()
     })
 
 @app.errorhandler(404)
@@ -274,1081 +1655,949 @@ def get_packages():
             return jsonify({'success': False, 'error': 'Missing API key'}), 401
         
         # Authenticate API key
-        user = authenticate_api_key(api_key)
-        if not user:
-            return jsonify({'success': False, 'error': 'Invalid API key'}), 401
-        
-        print(f"🚀 Getting packages via Airalo SDK for user {user['email']}")
-        
-        try:
-            # Get all packages using Airalo SDK
-            # Use flat=True to get a flat list of all packages
-            packages = alo.get_all_packages(flat=True)
-            
-            if not packages or 'data' not in packages:
-                return jsonify({'success': False, 'error': 'Failed to get packages via Airalo SDK'}), 500
-            
-            return jsonify(packages)
-            
-        except Exception as sdk_error:
-            print(f"❌ Airalo SDK error: {sdk_error}")
-            return jsonify({'success': False, 'error': f'Airalo SDK error: {str(sdk_error)}'}), 500
-        
-    except Exception as e:
-        print(f"❌ Error getting packages: {e}")
-        return jsonify({'success': False, 'error': str(e)}), 500
-
-@app.route('/api/sync-packages', methods=['OPTIONS'])
-def sync_packages_options():
-    """Handle CORS preflight requests"""
-    response = jsonify({})
-    response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Authorization, X-API-Key')
-    response.headers.add('Access-Control-Allow-Methods', 'POST, OPTIONS')
-    return response, 200
-
-@app.route('/api/sync-packages', methods=['POST'])
-def sync_packages():
-    """Sync packages from Airalo SDK to Firestore with global/regional categorization"""
-    try:
-        # Check if Airalo SDK is available, try to reinitialize if not
-        if alo is None:
-            print("🔄 Attempting to reinitialize Airalo SDK...", flush=True)
-            sys.stdout.flush()
-            if initialize_airalo_sdk():
-                print("✅ Airalo SDK reinitialized successfully", flush=True)
-                sys.stdout.flush()
-            else:
-                print("❌ Airalo SDK reinitialization failed - Airalo API still unavailable", flush=True)
-                sys.stderr.flush()
-                return jsonify({
-                    'success': False, 
-                    'error': 'Airalo SDK is not available. The Airalo API appears to be down (502 Bad Gateway). Please try again later.'
-                }), 503
-        
-        # Check for API key or Firebase token
-        api_key = request.headers.get('X-API-Key')
-        auth_header = request.headers.get('Authorization', '')
-        
-        user = None
-        if api_key:
-            user = authenticate_api_key(api_key)
-        elif auth_header.startswith('Bearer '):
-            id_token = auth_header[7:]
-            user = authenticate_firebase_token(id_token)
-        
-        if not user:
-            return jsonify({'success': False, 'error': 'Unauthorized - API key or Firebase token required'}), 401
-        
-        print(f"🚀 Syncing packages via Airalo SDK for user {user.get('email', 'unknown')}")
-        
-        try:
-            # Get all packages using Airalo SDK
-            packages_response = None
-            try:
-                # Prioritize flat=False to get full nested structure with sub-packages (needed for global/regional prices)
-                packages_response = alo.get_all_packages(flat=False)
-                print(f"📦 get_all_packages(flat=False) response type: {type(packages_response)}")
-            except Exception as no_flat_error:
-                print(f"⚠️ get_all_packages(flat=False) failed: {no_flat_error}")
-            
-            if not packages_response:
-                try:
-                    packages_response = alo.get_all_packages()
-                    print(f"📦 get_all_packages() response type: {type(packages_response)}")
-                except Exception as default_error:
-                    print(f"⚠️ get_all_packages() failed: {default_error}")
-                    try:
-                        packages_response = alo.get_all_packages(flat=True)
-                        print(f"📦 get_all_packages(flat=True) response type: {type(packages_response)}")
-                    except Exception as flat_error:
-                        print(f"❌ get_all_packages(flat=True) also failed: {flat_error}")
-                        return jsonify({
-                            'success': False,
-                            'error': f'Failed to get packages via Airalo SDK: {str(flat_error)}',
-                        }), 500
-            
-            if not packages_response:
-                return jsonify({
-                    'success': False,
-                    'error': 'Airalo SDK returned empty response',
-                }), 500
-            
-            # Handle different response formats
-            if isinstance(packages_response, list):
-                packages_data = packages_response
-                print(f"📦 SDK returned list directly with {len(packages_data)} items")
-            elif isinstance(packages_response, dict):
-                if 'data' in packages_response:
-                    packages_data = packages_response['data']
-                elif 'packages' in packages_response:
-                    packages_data = packages_response['packages']
-                else:
-                    return jsonify({
-                        'success': False,
-                        'error': 'Unexpected SDK response structure',
-                        'debug_info': {
-                            'response_keys': list(packages_response.keys()),
-                        }
-                    }), 500
-            else:
-                return jsonify({
-                    'success': False,
-                    'error': f'Unexpected SDK response type: {type(packages_response).__name__}',
-                }), 500
-            
-            if not isinstance(packages_data, list):
-                if isinstance(packages_data, dict):
-                    if 'packages' in packages_data:
-                        packages_data = packages_data['packages']
-                    elif 'data' in packages_data:
-                        packages_data = packages_data['data']
-                    else:
-                        for key, value in packages_data.items():
-                            if isinstance(value, list) and len(value) > 0:
-                                packages_data = value
-                                break
-                
-                if not isinstance(packages_data, list):
-                    return jsonify({
-                        'success': False, 
-                        'error': f'Invalid packages data format: expected list, got {type(packages_data).__name__}',
-                    }), 500
-            
-            print(f"📦 Received {len(packages_data)} packages from Airalo SDK")
-            
-            if len(packages_data) == 0:
-                return jsonify({
-                    'success': False,
-                    'error': 'No packages found in Airalo SDK response.',
-                }), 500
-            
-            # Get markup percentage from Firestore config (default 17%)
-            markup_percentage = 17
-            try:
-                markup_config = db.collection('config').document('pricing').get()
-                if markup_config.exists:
-                    markup_data = markup_config.to_dict()
-                    markup_percentage = markup_data.get('markup_percentage', 17)
-            except Exception as e:
-                print(f"⚠️ Could not load markup config, using default 17%: {e}")
-            
-            print(f"💰 Using markup percentage: {markup_percentage}%")
-            
-            # Process and save packages
-            synced_count = 0
-            global_count = 0
-            regional_count = 0
-            other_count = 0
-            batch = db.batch()
-            batch_count = 0
-            MAX_BATCH_SIZE = 500  # Firestore batch limit
-            
-            for idx, pkg in enumerate(packages_data):
-                try:
-                    # Handle different package formats
-                    if isinstance(pkg, str):
-                        package_id = pkg
-                        print(f"⚠️ Package {idx} is a string (ID only): {package_id}. Skipping - need full package data.")
-                        continue
-                    elif isinstance(pkg, dict):
-                        package_id = (pkg.get('id') or 
-                                     pkg.get('slug') or 
-                                     pkg.get('package_id') or
-                                     (pkg.get('data', {}).get('id') if isinstance(pkg.get('data'), dict) else None))
-                        
-                    if not package_id:
-                        print(f"⚠️ Skipping package {idx}: No ID found. Keys: {list(pkg.keys())}")
-                        continue
-                    else:
-                        print(f"⚠️ Skipping package {idx}: Unexpected type {type(pkg)}")
-                        continue
-                    
-                    # Skip topup packages - they should not be synced to dataplans collection
-                    # Topup packages are handled separately by the topup service
-                    package_slug = str(package_id).lower()
-                    package_name = (pkg.get('name') or pkg.get('title') or '').lower()
-                    package_type = (pkg.get('type') or '').lower()
-                    
-                    is_topup_package = (
-                        pkg.get('is_topup') == True or
-                        pkg.get('topup') == True or
-                        '-topup' in package_slug or
-                        package_slug.endswith('-topup') or
-                        'topup' in package_type or
-                        'top-up' in package_type or
-                        'topup' in package_name or
-                        'top-up' in package_name
-                    )
-                    
-                    if is_topup_package:
-                        print(f"⏭️ Skipping topup package {idx}: {package_id} (topup packages are handled separately)")
-                        continue
-                    
-                    # Extract country codes
-                    country_codes = []
-                    if isinstance(pkg, dict):
-                        if isinstance(pkg.get('countries'), list):
-                            country_codes = [c.get('country_code') or c.get('code') or c for c in pkg.get('countries', []) if c]
-                        elif pkg.get('country_code'):
-                            country_codes = [pkg.get('country_code')]
-                        elif isinstance(pkg.get('country_codes'), list):
-                            country_codes = pkg.get('country_codes')
-                        elif pkg.get('country'):
-                            country = pkg.get('country')
-                            if isinstance(country, dict):
-                                country_codes = [country.get('code') or country.get('country_code')]
-                            elif isinstance(country, str):
-                                country_codes = [country]
-                    
-                    # Prepare plan data for categorization
-                    plan_data = {
-                        'country_codes': country_codes,
-                        'type': pkg.get('type', ''),
-                        'region': pkg.get('region', '') or pkg.get('region_slug', ''),
-                        'name': pkg.get('name', '') or pkg.get('title', '')
-                    }
-                    
-                    # Categorize the plan
-                    category = categorize_plan(plan_data)
-                    
-                    if category == 'global':
-                        global_count += 1
-                    elif category == 'regional':
-                        regional_count += 1
-                    else:
-                        other_count += 1
-                    
-                    # Check for sub-packages (for global/regional parent packages)
-                    sub_packages = []
-                    if isinstance(pkg.get('packages'), list):
-                        sub_packages = pkg.get('packages')
-                    elif isinstance(pkg.get('sub_packages'), list):
-                        sub_packages = pkg.get('sub_packages')
-                    elif isinstance(pkg.get('children'), list):
-                        sub_packages = pkg.get('children')
-                    elif isinstance(pkg.get('operators'), list):
-                        operators = pkg.get('operators', [])
-                        for operator in operators:
-                            if isinstance(operator, dict) and 'packages' in operator:
-                                if isinstance(operator['packages'], list):
-                                    sub_packages.extend(operator['packages'])
-                    
-                    # For global/regional packages with sub-packages, save each sub-package as a separate plan
-                    if isinstance(sub_packages, list) and len(sub_packages) > 0 and (category == 'global' or category == 'regional'):
-                        for sub_idx, sub_pkg in enumerate(sub_packages):
-                            if not isinstance(sub_pkg, dict):
-                                continue
-                            
-                            try:
-                                sub_package_id = f"{package_id}_{sub_idx}"
-                                if sub_pkg.get('id'):
-                                    sub_package_id = f"{package_id}_{sub_pkg.get('id')}"
-                                
-                                # Skip topup sub-packages
-                                sub_slug = (sub_package_id or sub_pkg.get('slug') or '').lower()
-                                sub_type = (sub_pkg.get('type') or '').lower()
-                                sub_is_topup = (
-                                    sub_pkg.get('is_topup') == True or
-                                    sub_pkg.get('topup') == True or
-                                    '-topup' in sub_slug or
-                                    sub_slug.endswith('-topup') or
-                                    'topup' in sub_type or
-                                    'top-up' in sub_type
-                                )
-                                
-                                if sub_is_topup:
-                                    print(f"⏭️ Skipping topup sub-package {sub_idx}: {sub_package_id}")
-                                    continue
-                                
-                                # Extract price for this sub-package
-                                sub_price_fields = [
-                                    sub_pkg.get('price'),
-                                    sub_pkg.get('retail_price'),
-                                    sub_pkg.get('amount'),
-                                    sub_pkg.get('cost'),
-                                    sub_pkg.get('base_price'),
-                                ]
-                                
-                                if isinstance(sub_pkg.get('pricing'), dict):
-                                    pricing_obj = sub_pkg.get('pricing')
-                                    sub_price_fields.extend([
-                                        pricing_obj.get('price'),
-                                        pricing_obj.get('retail_price'),
-                                        pricing_obj.get('amount'),
-                                    ])
-                                
-                                sub_original_price = 0
-                                for sub_price in sub_price_fields:
-                                    if sub_price is not None:
-                                        try:
-                                            sub_price_value = float(sub_price)
-                                            if sub_price_value > 0:
-                                                sub_original_price = sub_price_value
-                                                break
-                                        except (ValueError, TypeError):
-                                            continue
-                                
-                                if sub_original_price == 0:
-                                    continue
-                                
-                                sub_retail_price = round(sub_original_price * (1 + markup_percentage / 100), 2)
-                                
-                                sub_capacity = sub_pkg.get('capacity') or sub_pkg.get('amount') or sub_pkg.get('data') or 0
-                                sub_period = sub_pkg.get('period') or sub_pkg.get('day') or sub_pkg.get('validity') or pkg.get('period') or 0
-                                
-                                parent_name = pkg.get('name') or pkg.get('title') or 'Regional'
-                                sub_name = (sub_pkg.get('name') or 
-                                           sub_pkg.get('title') or 
-                                           f"{parent_name} - {sub_capacity}GB")
-                                
-                                sub_plan_ref = db.collection('dataplans').document(sub_package_id)
-                                sub_plan_doc = {
-                                    'slug': sub_package_id,
-                                    'name': sub_name,
-                                    'description': sub_pkg.get('description') or pkg.get('description') or '',
-                                    'price': sub_retail_price,
-                                    'original_price': sub_original_price,
-                                    'currency': sub_pkg.get('currency') or pkg.get('currency', 'USD'),
-                                    'country_codes': country_codes,
-                                    'country_ids': country_codes,
-                                    'capacity': sub_capacity,
-                                    'period': sub_period,
-                                    'operator': sub_pkg.get('operator') or pkg.get('operator') or '',
-                                    'status': 'active',
-                                    'type': category,
-                                    'is_global': category == 'global',
-                                    'is_regional': category == 'regional',
-                                    'region': pkg.get('region') or pkg.get('region_slug') or '',
-                                    'parent_package_id': package_id,
-                                    'parent_category': category,
-                                    'updated_at': firestore.SERVER_TIMESTAMP,
-                                    'synced_at': firestore.SERVER_TIMESTAMP,
-                                    'updated_by': 'sdk_sync',
-                                    'provider': 'airalo',
-                                    'enabled': True,
-                                    'is_roaming': sub_pkg.get('is_roaming') or pkg.get('is_roaming', False),
-                                }
-                                
-                                batch.set(sub_plan_ref, sub_plan_doc, merge=True)
-                                batch_count += 1
-                                synced_count += 1
-                                
-                                if batch_count >= MAX_BATCH_SIZE:
-                                    batch.commit()
-                                    batch = db.batch()
-                                    batch_count = 0
-                                    
-                            except Exception as sub_pkg_error:
-                                print(f"⚠️ Error processing sub-package {sub_idx}: {sub_pkg_error}")
-                                continue
-                        
-                        # Save parent package as a container
-                        parent_plan_ref = db.collection('dataplans').document(package_id)
-                        parent_plan_doc = {
-                            'slug': package_id,
-                            'name': pkg.get('name') or pkg.get('title') or 'Unnamed Plan',
-                            'description': pkg.get('description') or '',
-                            'price': 0,
-                            'original_price': 0,
-                            'currency': pkg.get('currency', 'USD'),
-                            'country_codes': country_codes,
-                            'country_ids': country_codes,
-                            'capacity': 0,
-                            'period': 0,
-                            'operator': pkg.get('operator') or '',
-                            'status': 'active',
-                            'type': category,
-                            'is_global': category == 'global',
-                            'is_regional': category == 'regional',
-                            'region': pkg.get('region') or pkg.get('region_slug') or '',
-                            'is_parent': True,
-                            'child_count': len(sub_packages),
-                            'updated_at': firestore.SERVER_TIMESTAMP,
-                            'synced_at': firestore.SERVER_TIMESTAMP,
-                            'updated_by': 'sdk_sync',
-                            'provider': 'airalo',
-                            'enabled': True,
-                        }
-                        
-                        batch.set(parent_plan_ref, parent_plan_doc, merge=True)
-                        batch_count += 1
-                        synced_count += 1
-                        
-                        if batch_count >= MAX_BATCH_SIZE:
-                            batch.commit()
-                            batch = db.batch()
-                            batch_count = 0
-                        
-                        continue
-                    
-                    # Calculate price with markup
-                    price_fields = [
-                        pkg.get('price'),
-                        pkg.get('retail_price'),
-                        pkg.get('amount'),
-                        pkg.get('cost'),
-                        pkg.get('base_price'),
-                    ]
-                    
-                    if isinstance(pkg.get('pricing'), dict):
-                        pricing_obj = pkg.get('pricing')
-                        price_fields.extend([
-                            pricing_obj.get('price'),
-                            pricing_obj.get('retail_price'),
-                            pricing_obj.get('amount'),
-                        ])
-                    
-                    original_price = 0
-                    for price_field in price_fields:
-                        if price_field is not None:
-                            try:
-                                price_value = float(price_field)
-                                if price_value > 0:
-                                    original_price = price_value
-                                    break
-                            except (ValueError, TypeError):
-                                continue
-                    
-                    retail_price = round(original_price * (1 + markup_percentage / 100), 2)
-                    
-                    # Prepare Firestore document
-                    plan_ref = db.collection('dataplans').document(package_id)
-                    plan_doc = {
-                        'slug': package_id,
-                        'name': pkg.get('name') or pkg.get('title') or 'Unnamed Plan',
-                        'description': pkg.get('description') or '',
-                        'price': retail_price,
-                        'original_price': original_price,
-                        'currency': pkg.get('currency', 'USD'),
-                        'country_codes': country_codes,
-                        'country_ids': country_codes,
-                        'capacity': pkg.get('capacity') or pkg.get('amount') or 0,
-                        'period': pkg.get('period') or pkg.get('day') or 0,
-                        'operator': pkg.get('operator') or '',
-                        'status': 'active',
-                        'type': category,
-                        'is_global': category == 'global',
-                        'is_regional': category == 'regional',
-                        'region': pkg.get('region') or pkg.get('region_slug') or '',
-                        'updated_at': firestore.SERVER_TIMESTAMP,
-                        'synced_at': firestore.SERVER_TIMESTAMP,
-                        'updated_by': 'sdk_sync',
-                        'provider': 'airalo',
-                        'enabled': True,
-                        'is_roaming': pkg.get('is_roaming', False),
-                    }
-                    
-                    batch.set(plan_ref, plan_doc, merge=True)
-                    batch_count += 1
-                    synced_count += 1
-                    
-                    if batch_count >= MAX_BATCH_SIZE:
-                        batch.commit()
-                        batch = db.batch()
-                        batch_count = 0
-                    
-                except Exception as pkg_error:
-                    print(f"⚠️ Error processing package {pkg.get('id', 'unknown')}: {pkg_error}")
-                    continue
-            
-            # Commit remaining batch
-            if batch_count > 0:
-                batch.commit()
-            
-            print(f"✅ Successfully synced {synced_count} packages to Firestore")
-            print(f"   - Global: {global_count}")
-            print(f"   - Regional: {regional_count}")
-            print(f"   - Other: {other_count}")
-            
-            # Create sync log
-            log_ref = db.collection('sync_logs').document()
-            log_ref.set({
-                'timestamp': firestore.SERVER_TIMESTAMP,
-                'plans_synced': synced_count,
-                'global_count': global_count,
-                'regional_count': regional_count,
-                'other_count': other_count,
-                'status': 'completed',
-                'source': 'sdk_sync',
-                'sync_type': 'packages_sync',
-                'provider': 'airalo',
-                'user_email': user.get('email', 'unknown')
-            })
-            
-            return jsonify({
-                'success': True,
-                'message': f'Successfully synced {synced_count} packages',
-                'total_synced': synced_count,
-                'global_count': global_count,
-                'regional_count': regional_count,
-                'other_count': other_count,
-            })
-            
-        except Exception as sdk_error:
-            print(f"❌ Airalo SDK error: {sdk_error}")
-            import traceback
-            traceback.print_exc()
-            return jsonify({'success': False, 'error': f'Airalo SDK error: {str(sdk_error)}'}), 500
-        
-    except Exception as e:
-        print(f"❌ Error syncing packages: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({'success': False, 'error': str(e)}), 500
-
-@app.route('/api/sync-topup-packages', methods=['OPTIONS'])
-def sync_topup_packages_options():
-    """Handle CORS preflight requests"""
-    response = jsonify({})
-    response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Authorization, X-API-Key')
-    response.headers.add('Access-Control-Allow-Methods', 'POST, OPTIONS')
-    return response, 200
-
-@app.route('/api/sync-topup-packages', methods=['POST'])
-def sync_topup_packages():
-    """Sync ONLY topup packages from Airalo SDK to Firestore topups collection"""
-    try:
-        # Check if Airalo SDK is available, try to reinitialize if not
-        if alo is None:
-            print("🔄 Attempting to reinitialize Airalo SDK...", flush=True)
-            sys.stdout.flush()
-            if initialize_airalo_sdk():
-                print("✅ Airalo SDK reinitialized successfully", flush=True)
-                sys.stdout.flush()
-            else:
-                print("❌ Airalo SDK reinitialization failed - Airalo API still unavailable", flush=True)
-                sys.stderr.flush()
-                return jsonify({
-                    'success': False, 
-                    'error': 'Airalo SDK is not available. The Airalo API appears to be down (502 Bad Gateway). Please try again later.'
-                }), 503
-        
-        # Check for API key or Firebase token
-        api_key = request.headers.get('X-API-Key')
-        auth_header = request.headers.get('Authorization', '')
-        
-        user = None
-        if api_key:
-            user = authenticate_api_key(api_key)
-        elif auth_header.startswith('Bearer '):
-            id_token = auth_header[7:]
-            user = authenticate_firebase_token(id_token)
-        
-        if not user:
-            return jsonify({'success': False, 'error': 'Unauthorized - API key or Firebase token required'}), 401
-        
-        print(f"🚀 Syncing TOPUP packages via Airalo SDK for user {user.get('email', 'unknown')}")
-        
-        try:
-            # Get all packages using Airalo SDK
-            packages_response = None
-            try:
-                packages_response = alo.get_all_packages(flat=False)
-                print(f"📦 get_all_packages(flat=False) response type: {type(packages_response)}")
-            except Exception as no_flat_error:
-                print(f"⚠️ get_all_packages(flat=False) failed: {no_flat_error}")
-            
-            if not packages_response:
-                try:
-                    packages_response = alo.get_all_packages()
-                    print(f"📦 get_all_packages() response type: {type(packages_response)}")
-                except Exception as default_error:
-                    print(f"⚠️ get_all_packages() failed: {default_error}")
-                    try:
-                        packages_response = alo.get_all_packages(flat=True)
-                        print(f"📦 get_all_packages(flat=True) response type: {type(packages_response)}")
-                    except Exception as flat_error:
-                        print(f"❌ get_all_packages(flat=True) also failed: {flat_error}")
-                        return jsonify({
-                            'success': False,
-                            'error': f'Failed to get packages via Airalo SDK: {str(flat_error)}',
-                        }), 500
-            
-            if not packages_response:
-                return jsonify({
-                    'success': False,
-                    'error': 'Airalo SDK returned empty response',
-                }), 500
-            
-            # Handle different response formats
-            if isinstance(packages_response, list):
-                packages_data = packages_response
-                print(f"📦 SDK returned list directly with {len(packages_data)} items")
-            elif isinstance(packages_response, dict):
-                if 'data' in packages_response:
-                    packages_data = packages_response['data']
-                elif 'packages' in packages_response:
-                    packages_data = packages_response['packages']
-                else:
-                    return jsonify({
-                        'success': False,
-                        'error': 'Unexpected SDK response structure',
-                    }), 500
-            else:
-                return jsonify({
-                    'success': False,
-                    'error': f'Unexpected SDK response type: {type(packages_response).__name__}',
-                }), 500
-            
-            if not isinstance(packages_data, list):
-                if isinstance(packages_data, dict):
-                    if 'packages' in packages_data:
-                        packages_data = packages_data['packages']
-                    elif 'data' in packages_data:
-                        packages_data = packages_data['data']
-                    else:
-                        for key, value in packages_data.items():
-                            if isinstance(value, list) and len(value) > 0:
-                                packages_data = value
-                                break
-                
-                if not isinstance(packages_data, list):
-                    return jsonify({
-                        'success': False, 
-                        'error': f'Invalid packages data format: expected list, got {type(packages_data).__name__}',
-                    }), 500
-            
-            print(f"📦 Received {len(packages_data)} packages from Airalo SDK")
-            
-            # Get markup percentage from Firestore config (default 17%)
-            markup_percentage = 17
-            try:
-                markup_config = db.collection('config').document('pricing').get()
-                if markup_config.exists:
-                    markup_data = markup_config.to_dict()
-                    markup_percentage = markup_data.get('markup_percentage', 17)
-            except Exception as e:
-                print(f"⚠️ Could not load markup config, using default 17%: {e}")
-            
-            print(f"💰 Using markup percentage: {markup_percentage}%")
-            
-            # Process and save ONLY topup packages
-            synced_count = 0
-            topup_count = 0
-            checked_count = 0
-            batch = db.batch()
-            batch_count = 0
-            MAX_BATCH_SIZE = 500  # Firestore batch limit
-            
-            for idx, pkg in enumerate(packages_data):
-                try:
-                    # Handle different package formats
-                    if isinstance(pkg, str):
-                        package_id = pkg
-                        print(f"⚠️ Package {idx} is a string (ID only): {package_id}. Skipping - need full package data.")
-                        continue
-                    elif isinstance(pkg, dict):
-                        package_id = (pkg.get('id') or 
-                                     pkg.get('slug') or 
-                                     pkg.get('package_id') or
-                                     (pkg.get('data', {}).get('id') if isinstance(pkg.get('data'), dict) else None))
-                        
-                        if not package_id:
-                            continue
-                    else:
-                        continue
-                    
-                    checked_count += 1
-                    
-                    # Check if this is a topup package - ONLY sync topup packages
-                    package_slug = str(package_id).lower()
-                    package_name = (pkg.get('name') or pkg.get('title') or '').lower()
-                    package_type = (pkg.get('type') or '').lower()
-                    
-                    # Debug: Log first 10 packages to understand structure
-                    if checked_count <= 10:
-                        print(f"🔍 Checking package {checked_count}:")
-                        print(f"   ID: {package_id}")
-                        print(f"   Slug: {package_slug}")
-                        print(f"   Name: {package_name}")
-                        print(f"   Type: {package_type}")
-                        print(f"   Keys: {list(pkg.keys())[:15]}")
-                        print(f"   is_topup: {pkg.get('is_topup')}")
-                        print(f"   topup: {pkg.get('topup')}")
-                    
-                    is_topup_package = (
-                        pkg.get('is_topup') == True or
-                        pkg.get('topup') == True or
-                        '-topup' in package_slug or
-                        package_slug.endswith('-topup') or
-                        'topup' in package_type or
-                        'top-up' in package_type or
-                        'topup' in package_name or
-                        'top-up' in package_name
-                    )
-                    
-                    if checked_count <= 10:
-                        print(f"   Detected as topup: {is_topup_package}")
-                    
-                    # Check sub-packages FIRST (before skipping parent) - they might contain topup packages
-                    # Extract country codes and categorize (needed for sub-package processing)
-                    country_codes = []
-                    if isinstance(pkg, dict):
-                        if isinstance(pkg.get('countries'), list):
-                            country_codes = [c.get('country_code') or c.get('code') or c for c in pkg.get('countries', []) if c]
-                        elif pkg.get('country_code'):
-                            country_codes = [pkg.get('country_code')]
-                        elif isinstance(pkg.get('country_codes'), list):
-                            country_codes = pkg.get('country_codes')
-                        elif pkg.get('country'):
-                            country = pkg.get('country')
-                            if isinstance(country, dict):
-                                country_codes = [country.get('code') or country.get('country_code')]
-                            elif isinstance(country, str):
-                                country_codes = [country]
-                    
-                    plan_data = {
-                        'country_codes': country_codes,
-                        'type': pkg.get('type', ''),
-                        'region': pkg.get('region', '') or pkg.get('region_slug', ''),
-                        'name': pkg.get('name') or pkg.get('title', '')
-                    }
-                    category = categorize_plan(plan_data)
-                    
-                    # Check sub-packages for ALL packages (not just topup ones)
-                    sub_packages = []
-                    if isinstance(pkg.get('packages'), list):
-                        sub_packages = pkg.get('packages')
-                    elif isinstance(pkg.get('sub_packages'), list):
-                        sub_packages = pkg.get('sub_packages')
-                    elif isinstance(pkg.get('children'), list):
-                        sub_packages = pkg.get('children')
-                    elif isinstance(pkg.get('operators'), list):
-                        operators = pkg.get('operators', [])
-                        for operator in operators:
-                            if isinstance(operator, dict) and 'packages' in operator:
-                                if isinstance(operator['packages'], list):
-                                    sub_packages.extend(operator['packages'])
-                    
-                    # Process sub-packages if they exist (they might be topup even if parent isn't)
-                    has_topup_subpackages = False
-                    if isinstance(sub_packages, list) and len(sub_packages) > 0:
-                        if checked_count <= 10:
-                            print(f"   Found {len(sub_packages)} sub-packages - checking for topup...")
-                        # Sub-package processing will happen below, set flag to skip parent if we process sub-packages
-                        has_topup_subpackages = True  # We'll check this in the sub-package loop
-                    
-                    # Skip non-topup packages (but only if they don't have sub-packages to check)
-                    if not is_topup_package and not has_topup_subpackages:
-                        continue
-                    
-                    # If parent is topup package, process it
-                    if is_topup_package:
-                        topup_count += 1
-                        print(f"✅ Found topup package {idx}: {package_id}")
-                    
-                    # Extract country codes
-                    country_codes = []
-                    if isinstance(pkg, dict):
-                        if isinstance(pkg.get('countries'), list):
-                            country_codes = [c.get('country_code') or c.get('code') or c for c in pkg.get('countries', []) if c]
-                        elif pkg.get('country_code'):
-                            country_codes = [pkg.get('country_code')]
-                        elif isinstance(pkg.get('country_codes'), list):
-                            country_codes = pkg.get('country_codes')
-                        elif pkg.get('country'):
-                            country = pkg.get('country')
-                            if isinstance(country, dict):
-                                country_codes = [country.get('code') or country.get('country_code')]
-                            elif isinstance(country, str):
-                                country_codes = [country]
-                    
-                    # Prepare plan data for categorization
-                    plan_data = {
-                        'country_codes': country_codes,
-                        'type': pkg.get('type', ''),
-                        'region': pkg.get('region', '') or pkg.get('region_slug', ''),
-                        'name': pkg.get('name', '') or pkg.get('title', '')
-                    }
-                    
-                    # Categorize the plan
-                    category = categorize_plan(plan_data)
-                    
-                    # Check for sub-packages (for global/regional parent packages)
-                    sub_packages = []
-                    if isinstance(pkg.get('packages'), list):
-                        sub_packages = pkg.get('packages')
-                    elif isinstance(pkg.get('sub_packages'), list):
-                        sub_packages = pkg.get('sub_packages')
-                    elif isinstance(pkg.get('children'), list):
-                        sub_packages = pkg.get('children')
-                    elif isinstance(pkg.get('operators'), list):
-                        operators = pkg.get('operators', [])
-                        for operator in operators:
-                            if isinstance(operator, dict) and 'packages' in operator:
-                                if isinstance(operator['packages'], list):
-                                    sub_packages.extend(operator['packages'])
-                    
-                    if topup_count <= 5 and len(sub_packages) > 0:
-                        print(f"   Found {len(sub_packages)} sub-packages")
-                    
-                    # For global/regional packages with sub-packages, save each topup sub-package
-                    # Also check regular packages for nested topup packages
-                    if isinstance(sub_packages, list) and len(sub_packages) > 0:
-                        if topup_count <= 5:
-                            print(f"   Checking {len(sub_packages)} sub-packages for topup packages...")
-                        
-                        for sub_idx, sub_pkg in enumerate(sub_packages):
-                            if not isinstance(sub_pkg, dict):
-                                continue
-                            
-                            try:
-                                # Check if sub-package is a topup package
-                                sub_id = sub_pkg.get('id') or sub_pkg.get('slug') or ''
-                                sub_slug = str(sub_id).lower()
-                                sub_name = (sub_pkg.get('name') or sub_pkg.get('title') or '').lower()
-                                sub_type = (sub_pkg.get('type') or '').lower()
-                                
-                                if topup_count <= 5 and sub_idx < 3:
-                                    print(f"      Sub-package {sub_idx}: id={sub_id}, slug={sub_slug}, type={sub_type}")
-                                
-                                sub_is_topup = (
-                                    sub_pkg.get('is_topup') == True or
-                                    sub_pkg.get('topup') == True or
-                                    '-topup' in sub_slug or
-                                    sub_slug.endswith('-topup') or
-                                    'topup' in sub_type or
-                                    'top-up' in sub_type or
-                                    'topup' in sub_name or
-                                    'top-up' in sub_name
-                                )
-                                
-                                if topup_count <= 5 and sub_idx < 3:
-                                    print(f"         Detected as topup: {sub_is_topup}")
-                                
-                                # Skip non-topup sub-packages
-                                if not sub_is_topup:
-                                    continue
-                                
-                                sub_package_id = f"{package_id}_{sub_idx}"
-                                if sub_pkg.get('id'):
-                                    sub_package_id = f"{package_id}_{sub_pkg.get('id')}"
-                                
-                                # Extract price for this sub-package
-                                sub_price_fields = [
-                                    sub_pkg.get('price'),
-                                    sub_pkg.get('retail_price'),
-                                    sub_pkg.get('amount'),
-                                    sub_pkg.get('cost'),
-                                    sub_pkg.get('base_price'),
-                                ]
-                                
-                                if isinstance(sub_pkg.get('pricing'), dict):
-                                    pricing_obj = sub_pkg.get('pricing')
-                                    sub_price_fields.extend([
-                                        pricing_obj.get('price'),
-                                        pricing_obj.get('retail_price'),
-                                        pricing_obj.get('amount'),
-                                    ])
-                                
-                                sub_original_price = 0
-                                for sub_price in sub_price_fields:
-                                    if sub_price is not None:
-                                        try:
-                                            sub_price_value = float(sub_price)
-                                            if sub_price_value > 0:
-                                                sub_original_price = sub_price_value
-                                                break
-                                        except (ValueError, TypeError):
-                                            continue
-                                
-                                if sub_original_price == 0:
-                                    continue
-                                
-                                sub_retail_price = round(sub_original_price * (1 + markup_percentage / 100), 2)
-                                
-                                sub_capacity = sub_pkg.get('capacity') or sub_pkg.get('amount') or sub_pkg.get('data') or 0
-                                sub_period = sub_pkg.get('period') or sub_pkg.get('day') or sub_pkg.get('validity') or pkg.get('period') or 0
-                                
-                                parent_name = pkg.get('name') or pkg.get('title') or 'Regional'
-                                sub_name = (sub_pkg.get('name') or 
-                                           sub_pkg.get('title') or 
-                                           f"{parent_name} - {sub_capacity}GB")
-                                
-                                # Save to topups collection
-                                sub_plan_ref = db.collection('topups').document(sub_package_id)
-                                sub_plan_doc = {
-                                    'slug': sub_package_id,
-                                    'name': sub_name,
-                                    'description': sub_pkg.get('description') or pkg.get('description') or '',
-                                    'price': sub_retail_price,
-                                    'original_price': sub_original_price,
-                                    'currency': sub_pkg.get('currency') or pkg.get('currency', 'USD'),
-                                    'country_codes': country_codes,
-                                    'country_ids': country_codes,
-                                    'capacity': sub_capacity,
-                                    'period': sub_period,
-                                    'operator': sub_pkg.get('operator') or pkg.get('operator') or '',
-                                    'status': 'active',
-                                    'type': category,
-                                    'is_global': category == 'global',
-                                    'is_regional': category == 'regional',
-                                    'region': pkg.get('region') or pkg.get('region_slug') or '',
-                                    'parent_package_id': package_id,
-                                    'parent_category': category,
-                                    'updated_at': firestore.SERVER_TIMESTAMP,
-                                    'synced_at': firestore.SERVER_TIMESTAMP,
-                                    'updated_by': 'sdk_sync',
-                                    'provider': 'airalo',
-                                    'enabled': True,
-                                    'is_roaming': sub_pkg.get('is_roaming') or pkg.get('is_roaming', False),
-                                    'is_topup_package': True,
-                                    'available_for_topup': True,
-                                    'available_for_purchase': False,
-                                }
-                                
-                                batch.set(sub_plan_ref, sub_plan_doc, merge=True)
-                                batch_count += 1
-                                synced_count += 1
-                                
-                                if batch_count >= MAX_BATCH_SIZE:
-                                    batch.commit()
-                                    batch = db.batch()
-                                    batch_count = 0
-                                    
-                            except Exception as sub_pkg_error:
-                                print(f"⚠️ Error processing topup sub-package {sub_idx}: {sub_pkg_error}")
-                                continue
-                        
-                        continue
-                    
-                    # Calculate price with markup
-                    price_fields = [
-                        pkg.get('price'),
-                        pkg.get('retail_price'),
-                        pkg.get('amount'),
-                        pkg.get('cost'),
-                        pkg.get('base_price'),
-                    ]
-                    
-                    if isinstance(pkg.get('pricing'), dict):
-                        pricing_obj = pkg.get('pricing')
-                        price_fields.extend([
-                            pricing_obj.get('price'),
-                            pricing_obj.get('retail_price'),
-                            pricing_obj.get('amount'),
-                        ])
-                    
-                    original_price = 0
-                    for price_field in price_fields:
-                        if price_field is not None:
-                            try:
-                                price_value = float(price_field)
-                                if price_value > 0:
-                                    original_price = price_value
-                                    break
-                            except (ValueError, TypeError):
-                                continue
-                    
-                    retail_price = round(original_price * (1 + markup_percentage / 100), 2)
-                    
-                    # Save to topups collection (not dataplans)
-                    plan_ref = db.collection('topups').document(package_id)
-                    plan_doc = {
-                        'slug': package_id,
-                        'name': pkg.get('name') or pkg.get('title') or 'Unnamed Plan',
-                        'description': pkg.get('description') or '',
-                        'price': retail_price,
-                        'original_price': original_price,
-                        'currency': pkg.get('currency', 'USD'),
-                        'country_codes': country_codes,
-                        'country_ids': country_codes,
-                        'capacity': pkg.get('capacity') or pkg.get('amount') or 0,
-                        'period': pkg.get('period') or pkg.get('day') or 0,
-                        'operator': pkg.get('operator') or '',
-                        'status': 'active',
-                        'type': category,
-                        'is_global': category == 'global',
-                        'is_regional': category == 'regional',
-                        'region': pkg.get('region') or pkg.get('region_slug') or '',
-                        'updated_at': firestore.SERVER_TIMESTAMP,
-                        'synced_at': firestore.SERVER_TIMESTAMP,
-                        'updated_by': 'sdk_sync',
-                        'provider': 'airalo',
-                        'enabled': True,
-                        'is_roaming': pkg.get('is_roaming', False),
-                        'is_topup_package': True,
-                        'available_for_topup': True,
-                        'available_for_purchase': False,
-                    }
-                    
-                    batch.set(plan_ref, plan_doc, merge=True)
-                    batch_count += 1
-                    synced_count += 1
-                    
-                    if batch_count >= MAX_BATCH_SIZE:
-                        batch.commit()
-                        batch = db.batch()
-                        batch_count = 0
-                    
-                except Exception as pkg_error:
-                    print(f"⚠️ Error processing topup package {pkg.get('id', 'unknown')}: {pkg_error}")
-                    continue
-            
-            # Commit remaining batch
-            if batch_count > 0:
-                batch.commit()
-            
-            print(f"✅ Successfully synced {synced_count} topup packages to Firestore topups collection")
-            print(f"   - Total packages checked: {checked_count}")
-            print(f"   - Total topup packages found: {topup_count}")
-            print(f"   - Total packages synced: {synced_count}")
-            
-            if topup_count == 0 and checked_count > 0:
-                print(f"⚠️ WARNING: No topup packages detected out of {checked_count} checked packages")
-                print(f"   This might mean:")
-                print(f"   1. Topup packages use a different identifier pattern")
-                print(f"   2. Topup packages are nested deeper in the structure")
-                print(f"   3. Topup packages need to be synced from a different endpoint")
-                # Log sample package structure for debugging
-                if len(packages_data) > 0:
-                    sample = packages_data[0]
-                    if isinstance(sample, dict):
-                        print(f"   Sample package keys: {list(sample.keys())[:20]}")
-                        print(f"   Sample package ID: {sample.get('id')}")
-                        print(f"   Sample package slug: {sample.get('slug')}")
-                        print(f"   Sample package name: {sample.get('name') or sample.get('title')}")
-                        print(f"   Sample package type: {sample.get('type')}")
+        user = authenticate_api_key(api_key)
+        if not user:
+            return jsonify({'success': False, 'error': 'Invalid API key'}), 401
+        
+        print(f"🚀 Getting packages via Airalo SDK for user {user['email']}")
+        
+        try:
+            # Get all packages using Airalo SDK
+            # Use flat=True to get a flat list of all packages
+            packages = alo.get_all_packages(flat=True)
             
-            # Create sync log
-            log_ref = db.collection('sync_logs').document()
-            log_ref.set({
-                'timestamp': firestore.SERVER_TIMESTAMP,
-                'plans_synced': synced_count,
-                'topup_count': topup_count,
-                'status': 'completed',
-                'source': 'sdk_sync',
-                'sync_type': 'topup_packages_sync',
-                'provider': 'airalo',
-                'user_email': user.get('email', 'unknown')
-            })
+            if not packages or 'data' not in packages:
+                return jsonify({'success': False, 'error': 'Failed to get packages via Airalo SDK'}), 500
             
-            return jsonify({
-                'success': True,
-                'message': f'Successfully synced {synced_count} topup packages',
-                'total_synced': synced_count,
-                'topup_count': topup_count,
-            })
+            return jsonify(packages)
             
         except Exception as sdk_error:
             print(f"❌ Airalo SDK error: {sdk_error}")
-            import traceback
-            traceback.print_exc()
             return jsonify({'success': False, 'error': f'Airalo SDK error: {str(sdk_error)}'}), 500
         
+    except Exception as e:
+        print(f"❌ Error getting packages: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/sync-packages', methods=['OPTIONS'])
+def sync_packages_options():
+    """Handle CORS preflight requests"""
+    response = jsonify({})
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Authorization, X-API-Key')
+    response.headers.add('Access-Control-Allow-Methods', 'POST, OPTIONS')
+    return response, 200
+
+def _sync_packages_from_airalo(job):
+    """Sync packages from Airalo SDK to Firestore with global/regional categorization; runs inside a background sync job and resumes from job['checkpoint']"""
+    try:
+        unavailable = ensure_airalo_sdk()
+        if unavailable:
+            return unavailable
+        
+        print(f"🚀 Syncing packages via Airalo SDK for user {job['requestedBy']}")
+        return run_airalo_catalog_sync(job, 'plans')
+        
+    except Exception as e:
+        print(f"❌ Error syncing packages: {e}")
+        import traceback
+        traceback.print_exc()
+        return {'success': False, 'error': f'Airalo SDK error: {str(e)}'}, 500
+
+@app.route('/api/sync-packages', methods=['POST'])
+def sync_packages():
+    """Sync packages from Airalo SDK to Firestore with global/regional categorization"""
+    try:
+        # Runs as a background job; poll /api/sync-jobs/<jobId> (or pass ?wait=true)
+        return submit_sync_job_request('airalo_plans')
+        
+    except Exception as e:
+        print(f"❌ Error syncing packages: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/sync-topup-packages', methods=['OPTIONS'])
+def sync_topup_packages_options():
+    """Handle CORS preflight requests"""
+    response = jsonify({})
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Authorization, X-API-Key')
+    response.headers.add('Access-Control-Allow-Methods', 'POST, OPTIONS')
+    return response, 200
+
+def _sync_topup_packages_from_airalo(job):
+    """Sync ONLY topup packages from Airalo SDK to Firestore topups collection; runs inside a background sync job and resumes from job['checkpoint']"""
+    try:
+        unavailable = ensure_airalo_sdk()
+        if unavailable:
+            return unavailable
+        
+        print(f"🚀 Syncing TOPUP packages via Airalo SDK for user {job['requestedBy']}")
+        return run_airalo_catalog_sync(job, 'topups')
+        
+    except Exception as e:
+        print(f"❌ Error syncing topup packages: {e}")
+        import traceback
+        traceback.print_exc()
+        return {'success': False, 'error': f'Airalo SDK error: {str(e)}'}, 500
+
+@app.route('/api/sync-topup-packages', methods=['POST'])
+def sync_topup_packages():
+    """Sync ONLY topup packages from Airalo SDK to Firestore topups collection"""
+    try:
+        # Runs as a background job; poll /api/sync-jobs/<jobId> (or pass ?wait=true)
+        return submit_sync_job_request('airalo_topups')
+        
     except Exception as e:
         print(f"❌ Error syncing topup packages: {e}")
         import traceback
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
 
+SYNC_JOB_RUNNERS.update({
+    'airalo_plans': _sync_packages_from_airalo,
+    'airalo_topups': _sync_topup_packages_from_airalo,
+})
+start_sync_job_watchdog()
+
+# ============================================================================
+# ICCID Index
+# iccid_index/{iccid} maps an eSIM to the order that created it, so ICCID
+# lookups are a single document get instead of a scan over every order.
+# ============================================================================
+
+def order_iccids(order_data):
+    """Every ICCID an order document carries (top level, esimData and the sims lists)"""
+    iccids = [order_data.get('iccid'), (order_data.get('esimData') or {}).get('iccid')]
+    for container in (order_data.get('airaloOrderData'), order_data.get('orderData'), order_data):
+        sims = container.get('sims') if isinstance(container, dict) else None
+        if isinstance(sims, list):
+            iccids.extend(sim.get('iccid') for sim in sims if isinstance(sim, dict))
+    return list(dict.fromkeys(str(iccid).strip() for iccid in iccids if iccid))
+
+def order_country_codes(order_data):
+    """Country codes of an order, from its own fields and the Airalo order data"""
+    codes = (
+        order_data.get('countryCode') or
+        order_data.get('country_code') or
+        order_data.get('countryCodes') or
+        order_data.get('country_codes') or
+        []
+    )
+    if isinstance(codes, str):
+        codes = [codes]
+    elif not isinstance(codes, list):
+        codes = []
+    codes = list(codes)
+    
+    airalo_data = order_data.get('airaloOrderData') or {}
+    package = airalo_data.get('package')
+    package_code = (package.get('country_code') or package.get('countryCode')) if isinstance(package, dict) else None
+    for code in (airalo_data.get('country_code'), package_code):
+        if code and code not in codes:
+            codes.append(code)
+    return codes
+
+def order_operator(order_data):
+    package = (order_data.get('airaloOrderData') or {}).get('package')
+    if isinstance(package, dict):
+        return package.get('operator') or package.get('operator_title')
+    return None
+
+def iccid_index_entry(order_ref, order_data):
+    """iccid_index document for an order (without the iccid itself)"""
+    return {
+        'orderId': order_ref.id,
+        'orderPath': order_ref.path,
+        # users/{uid}/esims documents don't repeat the uid
+        'userId': order_data.get('userId') or (order_ref.parent.parent.id if order_ref.parent.parent else None),
+        'email': order_data.get('userEmail') or order_data.get('customerEmail'),
+        'countryCodes': order_country_codes(order_data),
+        'operator': order_operator(order_data),
+        'airaloOrderId': order_data.get('airaloOrderId') or (order_data.get('airaloOrderData') or {}).get('id'),
+        'indexedAt': firestore.SERVER_TIMESTAMP,
+    }
+
+def index_order_iccids(order_ref, order_data, batch=None):
+    """Write iccid_index entries for an order (into batch when given); returns the ICCIDs indexed"""
+    iccids = order_iccids(order_data)
+    if not iccids:
+        return iccids
+    
+    entry = iccid_index_entry(order_ref, order_data)
+    writer = batch if batch is not None else db.batch()
+    for iccid in iccids:
+        writer.set(db.collection('iccid_index').document(iccid), {**entry, 'iccid': iccid})
+    if batch is None:
+        writer.commit()
+    return iccids
+
+# ============================================================================
+# api_usage Write-Behind Buffer
+# With API_USAGE_WRITE_BEHIND=true, api_usage documents are appended to a
+# local SQLite file (WAL mode, one INSERT per order) instead of joining the
+# order's batch, and a background thread flushes them to Firestore in batches
+# of up to 500, at most API_USAGE_FLUSH_INTERVAL after they arrive. This takes
+# a document per order off the request path, at a price: the order and its
+# usage are no longer written atomically, and usage only reaches Firestore
+# (and billing) once flushed. Off by default: orders and usage share a batch.
+# createdAt is still stamped by the server when the row is flushed, so the
+# balance checkpoint lag holds; bufferedAt records when the order was placed.
+# Rows are deleted only once their batch commits, so events buffered before a
+# crash or restart are flushed by the next process. Rows are flushed with
+# create(): a row flushed twice fails with AlreadyExists and is dropped rather
+# than re-stamping createdAt. A batch Firestore rejects is halved until the
+# rejected rows are found; those move to the usage_dead_letters table.
+# Flushers claim rows before writing them, so several workers can share the
+# file; a claim left behind by a dead worker expires after API_USAGE_CLAIM_TTL.
+# ============================================================================
+
+API_USAGE_WRITE_BEHIND = os.getenv('API_USAGE_WRITE_BEHIND', 'false').lower() == 'true'
+API_USAGE_BUFFER_FILE = os.getenv('API_USAGE_BUFFER_FILE', '/tmp/api_usage_buffer.sqlite3')
+API_USAGE_FLUSH_INTERVAL = float(os.getenv('API_USAGE_FLUSH_INTERVAL', 1.0))  # Max seconds before a buffered event is flushed
+API_USAGE_BATCH_SIZE = 500  # Firestore batch limit
+API_USAGE_CLAIM_TTL = 60  # Seconds before rows claimed by a flusher that died are flushed again
+API_USAGE_ROW_ERRORS = (google_exceptions.BadRequest, ValueError, TypeError)  # Errors caused by the rows, not by Firestore being unavailable
+
+_usage_buffer_local = threading.local()  # Per-thread SQLite connection
+_usage_buffer_wakeup = threading.Event()  # Set when a full batch is waiting
+_usage_buffer_flusher = None
+_usage_buffer_lock = threading.Lock()
+_usage_buffer_stats = {
+    'buffered': 0,
+    'buffer_seconds': 0.0,
+    'inline_fallbacks': 0,
+    'flushed': 0,
+    'flush_batches': 0,
+    'flush_errors': 0,
+    'dead_lettered': 0,
+    'last_flush_ms': None,
+    'max_flush_ms': 0.0,
+    'last_flush_lag_seconds': None,  # Age of the oldest event in the last batch when it committed
+    'unflushed_since_wakeup': 0
+}
+
+def _usage_buffer_connection():
+    """This thread's connection to the buffer file (reopened after a fork)"""
+    conn = getattr(_usage_buffer_local, 'conn', None)
+    if conn is None or _usage_buffer_local.pid != os.getpid():
+        conn = sqlite3.connect(API_USAGE_BUFFER_FILE, timeout=10)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')  # Survives a process crash without an fsync per event
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS usage_events ('
+                         'seq INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT NOT NULL, data TEXT NOT NULL, '
+                         'buffered_at REAL NOT NULL, claimed_by TEXT, claimed_at REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS usage_dead_letters ('
+                         'seq INTEGER PRIMARY KEY, path TEXT NOT NULL, data TEXT NOT NULL, '
+                         'buffered_at REAL NOT NULL, error TEXT, failed_at REAL NOT NULL)')
+        _usage_buffer_local.conn = conn
+        _usage_buffer_local.pid = os.getpid()
+    return conn
+
+def _encode_usage_value(value):
+    """JSON-safe copy of a document (SERVER_TIMESTAMP is kept as a marker for the flush)"""
+    if value is firestore.SERVER_TIMESTAMP:
+        return {'__server_timestamp__': True}
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, dict):
+        return {key: _encode_usage_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode_usage_value(item) for item in value]
+    return value
+
+def _decode_usage_value(obj):
+    if len(obj) == 1 and '__server_timestamp__' in obj:
+        return firestore.SERVER_TIMESTAMP
+    if len(obj) == 1 and '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    return obj
+
+def write_usage_now(writes):
+    """Write (document ref, data) pairs in one batch"""
+    batch = db.batch()
+    for ref, data in writes:
+        batch.set(ref, data)
+    batch.commit()
+
+def buffer_usage_writes(writes):
+    """Append (document ref, data) pairs to the buffer, writing them inline if the buffer is unavailable"""
+    started = time.perf_counter()
+    buffered_at = datetime.now(timezone.utc)
+    rows = [(ref.path, json.dumps(_encode_usage_value({**data, 'bufferedAt': buffered_at}), default=str),
+             buffered_at.timestamp())
+            for ref, data in writes]
+    try:
+        conn = _usage_buffer_connection()
+        with conn:
+            conn.executemany('INSERT INTO usage_events (path, data, buffered_at) VALUES (?, ?, ?)', rows)
+    except sqlite3.Error as e:
+        print(f"⚠️ api_usage buffer unavailable, writing {len(writes)} document(s) inline: {e}")
+        _usage_buffer_stats['inline_fallbacks'] += 1
+        write_usage_now(writes)
+        return
+    
+    _usage_buffer_stats['buffered'] += len(rows)
+    _usage_buffer_stats['buffer_seconds'] += time.perf_counter() - started
+    _usage_buffer_stats['unflushed_since_wakeup'] += len(rows)
+    if _usage_buffer_stats['unflushed_since_wakeup'] >= API_USAGE_BATCH_SIZE:
+        _usage_buffer_wakeup.set()
+    if _usage_buffer_flusher is None or not _usage_buffer_flusher.is_alive():
+        start_usage_buffer_flusher()
+
+def _create_usage_documents(rows):
+    """Create buffered rows' documents in one batch, halving it around rows Firestore rejects.
+    
+    Returns (rows written, [(row, error)] rejected); errors that are not about
+    the rows themselves (Firestore unavailable, timeouts) are raised.
+    """
+    try:
+        batch = db.batch()
+        for seq, path, data, buffered_at in rows:
+            batch.create(db.document(path), json.loads(data, object_hook=_decode_usage_value))
+        batch.commit()
+        return rows, []
+    except google_exceptions.Conflict:
+        if len(rows) == 1:
+            return rows, []  # Created by an earlier flush that died before deleting the row
+    except API_USAGE_ROW_ERRORS as e:
+        if len(rows) == 1:
+            return [], [(rows[0], e)]
+    
+    middle = len(rows) // 2
+    written, rejected = _create_usage_documents(rows[:middle])
+    more_written, more_rejected = _create_usage_documents(rows[middle:])
+    return written + more_written, rejected + more_rejected
+
+def flush_usage_buffer():
+    """Flush up to API_USAGE_BATCH_SIZE buffered events; returns how many rows were taken off the buffer"""
+    conn = _usage_buffer_connection()
+    claim = f'{os.getpid()}:{threading.get_ident()}:{time.time()}'
+    now = time.time()
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('UPDATE usage_events SET claimed_by = ?, claimed_at = ? WHERE seq IN ('
+                     'SELECT seq FROM usage_events WHERE claimed_by IS NULL OR claimed_at < ? ORDER BY seq LIMIT ?)',
+                     (claim, now, now - API_USAGE_CLAIM_TTL, API_USAGE_BATCH_SIZE))
+        rows = conn.execute('SELECT seq, path, data, buffered_at FROM usage_events WHERE claimed_by = ? ORDER BY seq',
+                            (claim,)).fetchall()
+    if not rows:
+        return 0
+    
+    started = time.time()
+    try:
+        written, rejected = _create_usage_documents(rows)
+    except Exception as e:
+        print(f"⚠️ Could not flush {len(rows)} buffered api_usage writes: {e}")
+        _usage_buffer_stats['flush_errors'] += 1
+        with conn:
+            conn.execute('UPDATE usage_events SET claimed_by = NULL, claimed_at = NULL WHERE claimed_by = ?', (claim,))
+        return 0
+    
+    finished = time.time()
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO usage_dead_letters (seq, path, data, buffered_at, error, failed_at) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         [(*row, str(error), finished) for row, error in rejected])
+        conn.execute('DELETE FROM usage_events WHERE claimed_by = ?', (claim,))
+    for (seq, path, _, _), error in rejected:
+        print(f"☠️ Firestore rejected buffered api_usage write {path}, moved to usage_dead_letters: {error}")
+    
+    flush_ms = round((finished - started) * 1000, 1)
+    _usage_buffer_stats['flushed'] += len(written)
+    _usage_buffer_stats['dead_lettered'] += len(rejected)
+    _usage_buffer_stats['flush_batches'] += 1
+    _usage_buffer_stats['last_flush_ms'] = flush_ms
+    _usage_buffer_stats['max_flush_ms'] = max(_usage_buffer_stats['max_flush_ms'], flush_ms)
+    _usage_buffer_stats['last_flush_lag_seconds'] = round(finished - min(row[3] for row in rows), 3)
+    return len(rows)
+
+def _flush_usage_buffer_forever():
+    while True:
+        _usage_buffer_wakeup.wait(API_USAGE_FLUSH_INTERVAL)
+        _usage_buffer_wakeup.clear()
+        _usage_buffer_stats['unflushed_since_wakeup'] = 0
+        try:
+            while flush_usage_buffer() == API_USAGE_BATCH_SIZE:
+                pass
+        except sqlite3.Error as e:
+            print(f"⚠️ api_usage buffer flush failed: {e}")
+
+def start_usage_buffer_flusher():
+    """Start the flusher (which also replays events left by a previous process)"""
+    global _usage_buffer_flusher
+    if not API_USAGE_WRITE_BEHIND and not os.path.exists(API_USAGE_BUFFER_FILE):
+        return
+    with _usage_buffer_lock:
+        if _usage_buffer_flusher is not None and _usage_buffer_flusher.is_alive():
+            return
+        try:
+            pending = _usage_buffer_connection().execute('SELECT COUNT(*) FROM usage_events').fetchone()[0]
+            if pending:
+                print(f"♻️ Replaying {pending} buffered api_usage writes from {API_USAGE_BUFFER_FILE}")
+        except sqlite3.Error as e:
+            print(f"⚠️ Could not open api_usage buffer {API_USAGE_BUFFER_FILE}: {e}")
+            return
+        _usage_buffer_flusher = threading.Thread(target=_flush_usage_buffer_forever, daemon=True)
+        _usage_buffer_flusher.start()
+
+def get_usage_buffer_stats():
+    """Buffer and dead-letter depth (shared by all workers) and this process's buffering and flush metrics"""
+    stats = {key: value for key, value in _usage_buffer_stats.items()
+             if key not in ('buffer_seconds', 'unflushed_since_wakeup')}
+    stats['enabled'] = API_USAGE_WRITE_BEHIND
+    stats['avg_buffer_us'] = (round(_usage_buffer_stats['buffer_seconds'] * 1e6 / _usage_buffer_stats['buffered'], 1)
+                              if _usage_buffer_stats['buffered'] else None)
+    try:
+        conn = _usage_buffer_connection()
+        depth, oldest = conn.execute('SELECT COUNT(*), MIN(buffered_at) FROM usage_events').fetchone()
+        stats['depth'] = depth
+        stats['oldest_age_seconds'] = round(time.time() - oldest, 3) if oldest else 0
+        stats['dead_letter_depth'] = conn.execute('SELECT COUNT(*) FROM usage_dead_letters').fetchone()[0]
+    except sqlite3.Error as e:
+        stats['error'] = str(e)
+    return stats
+
+# ============================================================================
+# Order Side Effects
+# An order, its iccid_index entries, its api_usage document and the
+# business_users/{uid}/api_usage audit copy go out in one batch with
+# pre-generated ids, in one round trip. With API_USAGE_WRITE_BEHIND=true the
+# api_usage documents go through the write-behind buffer once the order is
+# recorded instead.
+# If the batch fails, say on an index entry Firestore rejects, the order is
+# written on its own and its index and api_usage after it: the upstream order
+# has already been placed, so it must not go unrecorded for want of an index.
+# ============================================================================
+
+def commit_order_side_effects(order_ref, order_data, api_usage_data, audit_uid=None):
+    """Write an order, its ICCID index entries and its api_usage documents in one batch"""
+    usage_ref = db.collection('api_usage').document()
+    usage_writes = [(usage_ref, api_usage_data)]
+    if audit_uid:
+        audit_ref = db.collection('business_users').document(audit_uid).collection('api_usage').document(usage_ref.id)
+        usage_writes.append((audit_ref, api_usage_data))
+    
+    batch = db.batch()
+    batch.set(order_ref, order_data, merge=True)  # merge: async orders complete their intent document
+    index_order_iccids(order_ref, order_data, batch=batch)
+    if not API_USAGE_WRITE_BEHIND:
+        for ref, data in usage_writes:
+            batch.set(ref, data)
+    try:
+        batch.commit()
+    except Exception as e:
+        _record_order_alone(order_ref, order_data, usage_writes, e)
+        return usage_ref
+    
+    if API_USAGE_WRITE_BEHIND:
+        buffer_usage_writes(usage_writes)
+    return usage_ref
+
+def _record_order_alone(order_ref, order_data, usage_writes, batch_error):
+    """Fallback when an order's batch fails: the order on its own, then its index and api_usage"""
+    # Airalo has already charged for the order, so it is recorded even if its index can't be
+    print(f"⚠️ Order batch for {order_ref.id} failed ({batch_error}), writing the order alone")
+    order_ref.set(order_data, merge=True)
+    try:
+        index_order_iccids(order_ref, order_data)
+    except Exception as e:
+        print(f"⚠️ ICCID index not written for order {order_ref.id}: {e}")
+    try:
+        write_usage_now(usage_writes)
+    except Exception as e:
+        print(f"⚠️ api_usage for order {order_ref.id} not written ({e}), buffering it for retry")
+        buffer_usage_writes(usage_writes)
+
+# ============================================================================
+# Idempotency Keys
+# /api/user/order and /api/orders
+# accept an Idempotency-Key header. The first request with a key runs and its
+# response is stored in idempotency_keys/{id} (scoped to the caller and path,
+# with a fingerprint of the request). Repeats get the stored response without
+# reaching Airalo; a duplicate arriving while the first is still running waits
+# for it. Reusing a key for a different request is a 422. A request that
+# fails before its side effect (an Airalo order, a balance deduction) releases
+# its key so a retry runs again; one that fails after it is stored as failed
+# and replayed, so a retry can't order or charge twice.
+# ============================================================================
+
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', 24 * 3600))  # Seconds a stored response is replayed
+IDEMPOTENCY_LOCK_TTL = 120  # Seconds before a key whose request died mid-flight can be taken over
+IDEMPOTENCY_WAIT_TIMEOUT = 60  # Seconds a duplicate waits for the first request before a 409
+IDEMPOTENCY_POLL_INTERVAL = 0.25  # Seconds between checks on a key held by another process
+# Responses for requests that never ran (and 5xx before the side effect) are not stored, so a retry runs again
+IDEMPOTENCY_UNSTORED_STATUSES = {401, 403, 409, 429}
+IDEMPOTENCY_INCOMPLETE_ERROR = 'The request failed after its side effect was committed; do not retry it, contact support'
+IDEMPOTENCY_REPLAYED_HEADERS = ('Location', 'Preference-Applied')
+
+_idempotency_inflight = {}  # key doc id -> Event set when this process finishes the request
+_idempotency_inflight_lock = threading.Lock()
+_idempotency_request = threading.local()  # side_effect flag for the request this thread is serving
+
+def idempotency_scope():
+    """Uid of the caller (API key owner or Firebase user); 'anonymous' when it can't be resolved"""
+    api_key = request.headers.get('X-API-Key', '')
+    auth_header = request.headers.get('Authorization', '')
+    bearer = auth_header[7:] if auth_header.startswith('Bearer ') else ''
+    for credential in (api_key, bearer):
+        if credential:
+            owner = authenticate_api_key(credential)
+            if owner:
+                return owner['uid']
+    if bearer:
+        user = authenticate_firebase_token(bearer)
+        if user:
+            return user['uid']
+    return 'anonymous'
+
+def request_fingerprint():
+    """Hash of the method, path, query and (canonicalized JSON) body"""
+    body = request.get_data() or b''
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True, separators=(',', ':')).encode('utf-8')
+    except ValueError:
+        pass
+    return hashlib.sha256(f"{request.method} {request.full_path}\n".encode('utf-8') + body).hexdigest()
+
+@firestore.transactional
+def _acquire_idempotency_key(transaction, key_ref, fingerprint):
+    """('acquired' | 'replay' | 'wait' | 'mismatch', stored key data)"""
+    snapshot = key_ref.get(transaction=transaction)
+    data = snapshot.to_dict() if snapshot.exists else None
+    now = datetime.now(timezone.utc)
+    if data and data.get('expiresAt') and data['expiresAt'] > now:
+        if data.get('fingerprint') != fingerprint:
+            return 'mismatch', data
+        if data.get('state') in ('completed', 'failed'):
+            return 'replay', data
+        if data.get('lockedUntil', 0) > time.time():
+            return 'wait', data
+    transaction.set(key_ref, {
+        'state': 'in_progress',
+        'fingerprint': fingerprint,
+        'path': request.path,
+        'lockedUntil': time.time() + IDEMPOTENCY_LOCK_TTL,
+        'createdAt': firestore.SERVER_TIMESTAMP,
+        'expiresAt': now + timedelta(seconds=IDEMPOTENCY_KEY_TTL)  # Firestore TTL policy field
+    })
+    return 'acquired', None
+
+def idempotent_side_effect_committed():
+    """Call once a request's side effect has happened; later failures are then replayed, not retried"""
+    _idempotency_request.side_effect = True
+
+def _store_idempotent_response(key_ref, response, side_effect=False):
+    """Keep a finished request's response for replay, or release the key if it shouldn't be replayed"""
+    try:
+        if (response.status_code in IDEMPOTENCY_UNSTORED_STATUSES or response.is_streamed
+                or (response.status_code >= 500 and not side_effect)):
+            key_ref.delete()
+            return
+        key_ref.update({
+            'state': 'failed' if response.status_code >= 500 else 'completed',
+            'lockedUntil': 0,
+            'completedAt': firestore.SERVER_TIMESTAMP,
+            'response': {
+                'status': response.status_code,
+                'body': response.get_data(as_text=True),
+                'mimetype': response.mimetype,
+                'headers': {name: response.headers[name] for name in IDEMPOTENCY_REPLAYED_HEADERS if name in response.headers}
+            }
+        })
+    except Exception as e:
+        print(f"⚠️ Could not store idempotent response for {key_ref.id}: {e}")
+
+def _replay_idempotent_response(data):
+    stored = data.get('response') or {}
+    response = Response(stored.get('body', ''), status=stored.get('status', 200),
+                        mimetype=stored.get('mimetype', 'application/json'), headers=stored.get('headers') or {})
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def _wait_for_idempotency_key(doc_id, deadline):
+    """Block until the request holding a key finishes here, or for one poll interval if it runs elsewhere"""
+    with _idempotency_inflight_lock:
+        event = _idempotency_inflight.get(doc_id)
+    if event is not None:
+        event.wait(max(0, deadline - time.time()))
+    else:
+        time.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+def idempotent(handler):
+    """Route decorator: honour the Idempotency-Key header"""
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return handler(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({'success': False, 'error': 'Idempotency-Key must be at most 255 characters'}), 400
+        
+        doc_id = hashlib.sha256(f"{idempotency_scope()}\n{request.path}\n{key}".encode('utf-8')).hexdigest()
+        key_ref = db.collection('idempotency_keys').document(doc_id)
+        fingerprint = request_fingerprint()
+        deadline = time.time() + IDEMPOTENCY_WAIT_TIMEOUT
+        while True:
+            outcome, data = _acquire_idempotency_key(db.transaction(), key_ref, fingerprint)
+            if outcome == 'acquired':
+                break
+            if outcome == 'replay':
+                print(f"🔁 Replaying response for Idempotency-Key on {request.path}")
+                return _replay_idempotent_response(data)
+            if outcome == 'mismatch':
+                return jsonify({
+                    'success': False,
+                    'error': 'Idempotency-Key was already used for a different request'
+                }), 422
+            if time.time() >= deadline:
+                response = jsonify({
+                    'success': False,
+                    'error': 'A request with this Idempotency-Key is still in progress'
+                })
+                response.status_code = 409
+                response.headers['Retry-After'] = '1'
+                return response
+            _wait_for_idempotency_key(doc_id, deadline)
+        
+        event = threading.Event()
+        with _idempotency_inflight_lock:
+            _idempotency_inflight[doc_id] = event
+        _idempotency_request.side_effect = False
+        response = None
+        try:
+            response = app.make_response(handler(*args, **kwargs))
+            return response
+        finally:
+            side_effect = _idempotency_request.side_effect
+            if response is None and side_effect:
+                # The handler raised after its side effect; keep a failure to replay
+                response = app.make_response((jsonify({'success': False, 'error': IDEMPOTENCY_INCOMPLETE_ERROR}), 500))
+            if response is not None:
+                _store_idempotent_response(key_ref, response, side_effect)
+            else:
+                try:
+                    key_ref.delete()
+                except Exception as e:
+                    print(f"⚠️ Could not release Idempotency-Key {doc_id}: {e}")
+            with _idempotency_inflight_lock:
+                _idempotency_inflight.pop(doc_id, None)
+            event.set()
+    return wrapper
+
+# ============================================================================
+# Async Orders
+# With `Prefer: respond-async` (or ?async=1) /api/user/order validates the
+# request, stores it as an order intent and answers 202. A worker pool places
+# the Airalo order and completes the same orders/{id} document, so slow
+# upstream responses hold pool threads instead of request threads. Clients
+# poll /api/orders/<id>/status, paced by its Retry-After header. An intent
+# whose worker died mid-order is moved to 'unknown' after
+# ORDER_PROCESSING_LEASE rather than placed again, since Airalo may already
+# have accepted it.
+# ============================================================================
+
+ORDER_WORKER_CONCURRENCY = int(os.getenv('ORDER_WORKER_CONCURRENCY', 8))
+ORDER_INTENT_RECOVERY_INTERVAL = 60  # Seconds between scans for intents left queued
+ORDER_INTENT_RECOVERY_AFTER = int(os.getenv('ORDER_INTENT_RECOVERY_AFTER', 300))  # Seconds queued before another process takes over
+ORDER_PROCESSING_LEASE = int(os.getenv('ORDER_PROCESSING_LEASE', 900))  # Seconds processing before an intent is given up as 'unknown'
+ORDER_STATUS_RETRY_AFTER = 2  # Seconds clients should wait between status polls
+ORDER_PENDING_STATES = ('queued', 'processing')
+ORDER_UNSETTLED_STATES = ('failed', 'unknown')  # Terminal states other than completed
+
+_order_pool = ThreadPoolExecutor(max_workers=ORDER_WORKER_CONCURRENCY, thread_name_prefix='order')
+_order_intent_recovery = None
+
+def wants_async_order():
+    prefer = request.headers.get('Prefer', '')
+    return 'respond-async' in prefer or request.args.get('async', '').lower() in ('1', 'true', 'yes')
+
+def submit_order_intent(order_request):
+    """Persist an order intent, queue it and answer 202 Accepted"""
+    order_ref = db.collection('orders').document()
+    order_ref.set({
+        'userId': order_request['user']['uid'],
+        'userEmail': order_request['user']['email'],
+        'packageId': order_request['package_id'],
+        'quantity': order_request['quantity'],
+        'status': 'queued',
+        'intent': order_request,
+        'asyncOrder': True,
+        'queuedAt': firestore.SERVER_TIMESTAMP,
+        'createdAt': firestore.SERVER_TIMESTAMP,
+        'mode': 'production',
+        'isTestMode': False
+    })
+    _order_pool.submit(run_order_intent, order_ref.id)
+    print(f"📥 Order intent {order_ref.id} queued for {order_request['user']['email']} ({order_request['package_id']})")
+    
+    status_url = f"/api/orders/{order_ref.id}/status"
+    response = jsonify({
+        'success': True,
+        'orderId': order_ref.id,
+        'status': 'queued',
+        'statusUrl': status_url,
+        'isTestMode': False
+    })
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    response.headers['Retry-After'] = str(ORDER_STATUS_RETRY_AFTER)
+    response.headers['Preference-Applied'] = 'respond-async'
+    return response
+
+@firestore.transactional
+def _claim_order_intent(transaction, order_ref):
+    """Move a queued intent to processing; returns its request, or None if it isn't queued"""
+    snapshot = order_ref.get(transaction=transaction)
+    data = snapshot.to_dict() if snapshot.exists else None
+    if not data or data.get('status') != 'queued':
+        return None
+    transaction.update(order_ref, {'status': 'processing', 'processingAt': firestore.SERVER_TIMESTAMP})
+    return data.get('intent')
+
+@firestore.transactional
+def _expire_order_intent(transaction, order_ref, cutoff):
+    """Move an intent stuck in processing since before cutoff to 'unknown'; True if it did"""
+    snapshot = order_ref.get(transaction=transaction)
+    data = snapshot.to_dict() if snapshot.exists else None
+    if not data or data.get('status') != 'processing':
+        return False
+    processing_at = data.get('processingAt')
+    if not processing_at or processing_at >= cutoff:
+        return False
+    transaction.update(order_ref, {
+        'status': 'unknown',
+        'error': 'The order worker stopped while placing this order; it may or may not have been placed',
+        'expiredAt': firestore.SERVER_TIMESTAMP
+    })
+    return True
+
+def run_order_intent(order_id):
+    """Pool task: place a queued order unless another worker already claimed it"""
+    order_ref = db.collection('orders').document(order_id)
+    try:
+        order_request = _claim_order_intent(db.transaction(), order_ref)
+    except Exception as e:
+        print(f"⚠️ Could not claim order intent {order_id}: {e}")
+        return
+    if order_request is None:
+        return
+    
+    try:
+        # The SDK client isn't thread-safe; pool threads each use their own
+        payload, status_code = place_user_order(order_request, order_ref, client=_thread_airalo_client())
+    except Exception as e:
+        print(f"❌ Error placing queued order {order_id}: {e}")
+        payload = {'success': False, 'error': str(e)}
+    if not payload.get('success'):
+        update = {'error': payload.get('error'), 'failedAt': firestore.SERVER_TIMESTAMP}
+        # Once Airalo accepted the order it stands, even if recording it failed afterwards
+        if payload.get('airaloOrderId'):
+            update.update({'status': 'unknown', 'airaloOrderId': payload['airaloOrderId']})
+        elif not (order_ref.get().to_dict() or {}).get('airaloOrderId'):
+            update['status'] = 'failed'
+        order_ref.set(update, merge=True)
+
+def _recover_order_intents_forever():
+    """Requeue intents whose process went away before placing them; give up on ones it died placing"""
+    while True:
+        time.sleep(ORDER_INTENT_RECOVERY_INTERVAL)
+        try:
+            cutoff = datetime.now(timezone.utc) - timedelta(seconds=ORDER_INTENT_RECOVERY_AFTER)
+            for doc in db.collection('orders').where('status', '==', 'queued').limit(100).stream():
+                queued_at = (doc.to_dict() or {}).get('queuedAt')
+                if queued_at and queued_at < cutoff:
+                    print(f"♻️ Recovering order intent {doc.id}")
+                    _order_pool.submit(run_order_intent, doc.id)
+            
+            # Never resubmitted: Airalo may have accepted the order before the worker died
+            lease_cutoff = datetime.now(timezone.utc) - timedelta(seconds=ORDER_PROCESSING_LEASE)
+            for doc in db.collection('orders').where('status', '==', 'processing').limit(100).stream():
+                processing_at = (doc.to_dict() or {}).get('processingAt')
+                if processing_at and processing_at < lease_cutoff:
+                    if _expire_order_intent(db.transaction(), doc.reference, lease_cutoff):
+                        print(f"⚠️ Order intent {doc.id} stuck in processing, marked unknown")
+        except Exception as e:
+            print(f"⚠️ Order intent recovery failed: {e}")
+
+def start_order_intent_recovery():
+    global _order_intent_recovery
+    if _order_intent_recovery is not None:
+        return
+    _order_intent_recovery = threading.Thread(target=_recover_order_intents_forever, daemon=True)
+    _order_intent_recovery.start()
+
+def order_requester_ids():
+    """Uids this request authenticates as (API key owner and/or Firebase user)"""
+    ids = set()
+    api_key = request.headers.get('X-API-Key', '')
+    auth_header = request.headers.get('Authorization', '')
+    bearer = auth_header[7:] if auth_header.startswith('Bearer ') else ''
+    if api_key:
+        owner = authenticate_api_key(api_key)
+        if owner:
+            ids.add(owner['uid'])
+    if bearer:
+        owner = authenticate_api_key(bearer)
+        if owner:
+            ids.add(owner['uid'])
+        else:
+            user = authenticate_firebase_token(bearer)
+            if user:
+                ids.add(user['uid'])
+    return ids
+
+def order_status_payload(order_id, order_data):
+    """Status response for an order (async or not)"""
+    status = order_data.get('status', 'pending')
+    payload = {
+        'success': True,
+        'orderId': order_id,
+        'status': status if status in ORDER_PENDING_STATES or status in ORDER_UNSETTLED_STATES else 'completed',
+        'orderStatus': status,
+        'isTestMode': order_data.get('isTestMode', False)
+    }
+    if order_data.get('airaloOrderId'):
+        payload['airaloOrderId'] = order_data['airaloOrderId']
+        payload['orderData'] = order_data.get('orderData', {})
+    if status in ORDER_UNSETTLED_STATES:
+        payload['error'] = order_data.get('error')
+    return payload
+
+def _load_requested_order(order_id):
+    """(order data, None) for an order the caller may see, else (None, error response)"""
+    requester_ids = order_requester_ids()
+    if not requester_ids:
+        return None, (jsonify({'success': False, 'error': 'Unauthorized'}), 401)
+    snapshot = db.collection('orders').document(order_id).get()
+    order_data = snapshot.to_dict() if snapshot.exists else None
+    if not order_data or order_data.get('userId') not in requester_ids:
+        return None, (jsonify({'success': False, 'error': 'Order not found'}), 404)
+    return order_data, None
+
+@app.route('/api/orders/<order_id>/status', methods=['GET'])
+def get_order_status(order_id):
+    """Status of an order; async orders report queued/processing until placed"""
+    try:
+        order_data, error = _load_requested_order(order_id)
+        if error:
+            return error
+        payload = order_status_payload(order_id, order_data)
+        response = jsonify(payload)
+        if payload['status'] in ORDER_PENDING_STATES:
+            response.headers['Retry-After'] = str(ORDER_STATUS_RETRY_AFTER)
+        return response
+    except Exception as e:
+        print(f"❌ Error fetching order status: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 # ============================================================================
 # Order Routes - /api/user/order, /api/user/qr-code, /api/orders
 # ============================================================================
 
+def place_user_order(order_request, order_ref=None, client=None):
+    """Place a validated /api/user/order request through the Airalo SDK and record it; returns (payload, status code)"""
+    user = order_request['user']
+    package_id = order_request['package_id']
+    quantity = order_request['quantity']
+    to_email = order_request['to_email']
+    
+    print(f"🚀 Creating order via Airalo SDK")
+    print(f"  User: {user['email']} ({user['uid']})")
+    print(f"  Package: {package_id}")
+    print(f"  Quantity: {quantity}")
+    
+    # Create order using Airalo SDK
+    try:
+        sdk_response = (client or alo).create_order(
+            package_id=package_id,
+            quantity=int(quantity),
+            to_email=to_email
+        )
+        
+        if not sdk_response:
+            return {'success': False, 'error': 'Failed to create order via Airalo SDK'}, 500
+        idempotent_side_effect_committed()
+        
+        # Convert SDK response to our format
+        order_result = convert_sdk_order_to_response(sdk_response, package_id, quantity)
+        
+        if not order_result:
+            return {'success': False, 'error': 'Invalid response from Airalo SDK'}, 500
+        
+        airalo_order_id = order_result['data']['id']
+        order_data = order_result['data']
+        
+        print(f"✅ Order created successfully: {airalo_order_id}")
+        
+        if order_ref is None:
+            order_ref = db.collection('orders').document()
+        order_id = order_ref.id
+        
+        # Save order to Firestore
+        firestore_order_data = {
+            'userId': user['uid'],
+            'userEmail': user['email'],
+            'airaloOrderId': airalo_order_id,
+            'packageId': package_id,
+            'quantity': quantity,
+            'status': order_data.get('status', 'pending'),
+            'price': order_data.get('price', 0),
+            'orderData': order_data,
+            'createdAt': firestore.SERVER_TIMESTAMP,
+            'mode': 'production',
+            'isTestMode': False
+        }
+        
+        # Log to api_usage for business dashboard
+        api_usage_data = {
+            'userId': user['uid'],
+            'userEmail': user['email'],
+            'endpoint': '/api/user/order',
+            'method': 'POST',
+            'mode': 'production',
+            'packageId': package_id,
+            'packageName': package_id,
+            'orderId': order_id,
+            'airaloOrderId': airalo_order_id,
+            'amount': order_data.get('price', 0),
+            'status': order_data.get('status', 'pending'),
+            'isTestOrder': False,
+            'createdAt': firestore.SERVER_TIMESTAMP,
+            'metadata': {
+                'quantity': quantity,
+                'iccid': order_data.get('sims', [{}])[0].get('iccid', '') if order_data.get('sims') else ''
+            }
+        }
+        
+        # One batch for the order and its ICCID index; api_usage and the user's copy follow it
+        try:
+            commit_order_side_effects(order_ref, firestore_order_data, api_usage_data, audit_uid=user['uid'])
+        except Exception as record_error:
+            print(f"❌ Order {airalo_order_id} placed with Airalo but not recorded: {record_error}")
+            return {
+                'success': False,
+                'error': f'Order placed with Airalo but could not be recorded: {record_error}',
+                'airaloOrderId': airalo_order_id,
+                'recorded': False
+            }, 500
+        
+        return {
+            'success': True,
+            'orderId': order_id,
+            'airaloOrderId': airalo_order_id,
+            'orderData': order_data,
+            'isTestMode': False
+        }, 200
+        
+    except Exception as sdk_error:
+        print(f"❌ Airalo SDK error: {sdk_error}")
+        return {'success': False, 'error': f'Airalo SDK error: {str(sdk_error)}'}, 500
+
 @app.route('/api/user/order', methods=['POST'])
+@idempotent
 def create_user_order():
     """Create eSIM order using Airalo SDK"""
     try:
@@ -1372,92 +2621,17 @@ def create_user_order():
         if not package_id:
             return jsonify({'success': False, 'error': 'package_id is required'}), 400
         
-        print(f"🚀 Creating order via Airalo SDK")
-        print(f"  User: {user['email']} ({user['uid']})")
-        print(f"  Package: {package_id}")
-        print(f"  Quantity: {quantity}")
+        order_request = {
+            'user': {'uid': user['uid'], 'email': user['email']},
+            'package_id': package_id,
+            'quantity': quantity,
+            'to_email': to_email,
+        }
+        if wants_async_order():
+            return submit_order_intent(order_request)
         
-        # Create order using Airalo SDK
-        try:
-            sdk_response = alo.create_order(
-                package_id=package_id,
-                quantity=int(quantity),
-                to_email=to_email
-            )
-            
-            if not sdk_response:
-                return jsonify({'success': False, 'error': 'Failed to create order via Airalo SDK'}), 500
-            
-            # Convert SDK response to our format
-            order_result = convert_sdk_order_to_response(sdk_response, package_id, quantity)
-            
-            if not order_result:
-                return jsonify({'success': False, 'error': 'Invalid response from Airalo SDK'}), 500
-            
-            airalo_order_id = order_result['data']['id']
-            order_data = order_result['data']
-            
-            print(f"✅ Order created successfully: {airalo_order_id}")
-            
-            # Save order to Firestore
-            firestore_order_data = {
-                'userId': user['uid'],
-                'userEmail': user['email'],
-                'airaloOrderId': airalo_order_id,
-                'packageId': package_id,
-                'quantity': quantity,
-                'status': order_data.get('status', 'pending'),
-                'price': order_data.get('price', 0),
-                'orderData': order_data,
-                'createdAt': firestore.SERVER_TIMESTAMP,
-                'mode': 'production',
-                'isTestMode': False
-            }
-            
-            order_ref = db.collection('orders').add(firestore_order_data)
-            order_id = order_ref[1].id
-            
-            # Log to api_usage for business dashboard
-            api_usage_data = {
-                'userId': user['uid'],
-                'userEmail': user['email'],
-                'endpoint': '/api/user/order',
-                'method': 'POST',
-                'mode': 'production',
-                'packageId': package_id,
-                'packageName': package_id,
-                'orderId': order_id,
-                'airaloOrderId': airalo_order_id,
-                'amount': order_data.get('price', 0),
-                'status': order_data.get('status', 'pending'),
-                'isTestOrder': False,
-                'createdAt': firestore.SERVER_TIMESTAMP,
-                'metadata': {
-                    'quantity': quantity,
-                    'iccid': order_data.get('sims', [{}])[0].get('iccid', '') if order_data.get('sims') else ''
-                }
-            }
-            
-            db.collection('api_usage').add(api_usage_data)
-            
-            # Also add to user subcollection
-            try:
-                user_api_usage_ref = db.collection('business_users').document(user['uid']).collection('api_usage')
-                user_api_usage_ref.add(api_usage_data)
-            except Exception as subcollection_error:
-                print(f"⚠️ Warning: Could not save to user subcollection: {subcollection_error}")
-            
-            return jsonify({
-                'success': True,
-                'orderId': order_id,
-                'airaloOrderId': airalo_order_id,
-                'orderData': order_data,
-                'isTestMode': False
-            })
-            
-        except Exception as sdk_error:
-            print(f"❌ Airalo SDK error: {sdk_error}")
-            return jsonify({'success': False, 'error': f'Airalo SDK error: {str(sdk_error)}'}), 500
+        payload, status_code = place_user_order(order_request)
+        return jsonify(payload), status_code
         
     except Exception as e:
         print(f"❌ Error creating order: {e}")
@@ -1577,6 +2751,7 @@ def get_user_qr_code():
                                             order_ref.update({
                                                 'orderData.sims': sims
                                             })
+                                        index_order_iccids(order_ref, {**order_data, 'orderData': {'sims': sims}})
                                     except Exception as update_error:
                                         print(f"⚠️ Could not update Firestore: {update_error}")
                                     
@@ -1629,6 +2804,7 @@ def get_user_qr_code():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/orders', methods=['POST'])
+@idempotent
 def create_order():
     """Create order using Airalo SDK (API key auth)"""
     try:
@@ -1663,6 +2839,7 @@ def create_order():
             
             if not sdk_response:
                 return jsonify({'success': False, 'error': 'Failed to create order via Airalo SDK'}), 500
+            idempotent_side_effect_committed()
             
             # Convert SDK response to our format
             order_result = convert_sdk_order_to_response(sdk_response, package_id, quantity)
@@ -1730,6 +2907,9 @@ def get_user_balance():
         print(f"❌ Error getting balance: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+start_order_intent_recovery()
+start_usage_buffer_flusher()
+
 # ============================================================================
 # Main Application Entry Point
 # ============================================================================
@@ -3,18 +3,30 @@ Standalone Flask server for topup operations only
 Simple, no circular imports, just works
 """
 import os
-from flask import Flask, request, jsonify
+import functools
+import hashlib
+import json
+import tempfile
+import random
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 from firebase_admin import credentials, firestore, auth
+from google.api_core import exceptions as google_exceptions
 import firebase_admin
 from dotenv import load_dotenv
 from airalo import Airalo
+from airalo.helpers.cached import Cached
 
 load_dotenv()
 
 app = Flask(__name__)
 CORS(app, origins="*", methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"], 
-     allow_headers=["Content-Type", "Authorization", "X-API-Key"])
+     allow_headers=["Content-Type", "Authorization", "X-API-Key", "Idempotency-Key"])
 
 # Firebase Admin initialization
 if not firebase_admin._apps:
@@ -42,10 +54,70 @@ if AIRALO_CLIENT_ID and AIRALO_CLIENT_SECRET:
         print(f"⚠️ Airalo SDK initialization failed: {e}")
         alo = None
 
+# ============================================================================
+# Firebase ID Token Cache
+# Verified claims are kept in a bounded LRU keyed by the token's SHA-256
+# digest until the token's own "exp"
+# ============================================================================
+
+FIREBASE_TOKEN_CACHE_SIZE = int(os.getenv('FIREBASE_TOKEN_CACHE_SIZE', 10000))
+FIREBASE_ID_TOKEN_CERT_URL = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
+
+_firebase_token_cache = OrderedDict()
+_firebase_token_cache_lock = threading.Lock()
+_firebase_token_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def verify_firebase_id_token(id_token):
+    """Verify a Firebase ID token, reusing cached claims while the token is unexpired"""
+    digest = hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+    now = time.time()
+    
+    with _firebase_token_cache_lock:
+        cached = _firebase_token_cache.get(digest)
+        if cached is not None:
+            if cached['exp'] > now:
+                _firebase_token_cache.move_to_end(digest)
+                _firebase_token_cache_stats['hits'] += 1
+                return cached['claims']
+            del _firebase_token_cache[digest]
+        _firebase_token_cache_stats['misses'] += 1
+    
+    decoded_token = auth.verify_id_token(id_token)
+    
+    with _firebase_token_cache_lock:
+        _firebase_token_cache[digest] = {'claims': decoded_token, 'exp': decoded_token.get('exp', 0)}
+        _firebase_token_cache.move_to_end(digest)
+        while len(_firebase_token_cache) > FIREBASE_TOKEN_CACHE_SIZE:
+            _firebase_token_cache.popitem(last=False)
+            _firebase_token_cache_stats['evictions'] += 1
+    
+    return decoded_token
+
+def get_firebase_token_cache_stats():
+    """Hit/miss counters for the ID token cache"""
+    with _firebase_token_cache_lock:
+        lookups = _firebase_token_cache_stats['hits'] + _firebase_token_cache_stats['misses']
+        return {
+            **_firebase_token_cache_stats,
+            'size': len(_firebase_token_cache),
+            'hit_rate': round(_firebase_token_cache_stats['hits'] / lookups, 4) if lookups else 0,
+        }
+
+def warm_firebase_public_keys():
+    """Prefetch the securetoken certificates into firebase_admin's cache-control session"""
+    try:
+        client = auth._get_client(firebase_admin.get_app())
+        client._token_verifier.request(url=FIREBASE_ID_TOKEN_CERT_URL)
+        print(f"🔑 Firebase public keys prefetched")
+    except Exception as e:
+        print(f"⚠️ Could not prefetch Firebase public keys: {e}")
+
+threading.Thread(target=warm_firebase_public_keys, daemon=True).start()
+
 def authenticate_firebase_token(id_token):
     """Authenticate Firebase ID token"""
     try:
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = verify_firebase_id_token(id_token)
         return {
             'uid': decoded_token['uid'],
             'email': decoded_token.get('email'),
@@ -55,15 +127,603 @@ def authenticate_firebase_token(id_token):
         print(f"Firebase token authentication error: {e}")
         return None
 
+# ============================================================================
+# ICCID Index
+# iccid_index/{iccid} maps an eSIM to the order that created it, so ICCID
+# lookups are a single document get instead of a scan over every order.
+# Entries are written by the order services (api, sdk, sandbox).
+# ============================================================================
+
+def order_country_codes(order_data):
+    """Country codes of an order, from its own fields and the Airalo order data"""
+    codes = (
+        order_data.get('countryCode') or
+        order_data.get('country_code') or
+        order_data.get('countryCodes') or
+        order_data.get('country_codes') or
+        []
+    )
+    if isinstance(codes, str):
+        codes = [codes]
+    elif not isinstance(codes, list):
+        codes = []
+    codes = list(codes)
+    
+    airalo_data = order_data.get('airaloOrderData') or {}
+    package = airalo_data.get('package')
+    package_code = (package.get('country_code') or package.get('countryCode')) if isinstance(package, dict) else None
+    for code in (airalo_data.get('country_code'), package_code):
+        if code and code not in codes:
+            codes.append(code)
+    return codes
+
+def order_operator(order_data):
+    package = (order_data.get('airaloOrderData') or {}).get('package')
+    if isinstance(package, dict):
+        return package.get('operator') or package.get('operator_title')
+    return None
+
+def iccid_index_entry(order_ref, order_data):
+    """iccid_index document for an order (without the iccid itself)"""
+    return {
+        'orderId': order_ref.id,
+        'orderPath': order_ref.path,
+        # users/{uid}/esims documents don't repeat the uid
+        'userId': order_data.get('userId') or (order_ref.parent.parent.id if order_ref.parent.parent else None),
+        'email': order_data.get('userEmail') or order_data.get('customerEmail'),
+        'countryCodes': order_country_codes(order_data),
+        'operator': order_operator(order_data),
+        'airaloOrderId': order_data.get('airaloOrderId') or (order_data.get('airaloOrderData') or {}).get('id'),
+        'indexedAt': firestore.SERVER_TIMESTAMP,
+    }
+
+def lookup_iccid(iccid):
+    """iccid_index entry for an ICCID, or None when no order carries it"""
+    iccid = str(iccid).strip()
+    snapshot = db.collection('iccid_index').document(iccid).get()
+    if snapshot.exists:
+        return snapshot.to_dict()
+    
+    # Orders that predate the index (and were not backfilled) may still carry a top-level iccid
+    for order_doc in db.collection('orders').where('iccid', '==', iccid).limit(1).stream():
+        entry = {**iccid_index_entry(order_doc.reference, order_doc.to_dict()), 'iccid': iccid}
+        db.collection('iccid_index').document(iccid).set(entry)
+        return entry
+    return None
+
+# ============================================================================
+# Topup Compatibility Catalog
+# Airalo's package list is refreshed in the background and indexed by country
+# code (packages sorted by price) and by operator, so a compatibility query is
+# a dictionary lookup instead of a get_all_packages() call per request.
+# ============================================================================
+
+# Syncs that publish catalog_versions/topups trigger a refresh right away, so the
+# periodic one only catches changes made outside a sync
+TOPUP_CATALOG_REFRESH_INTERVAL = int(os.getenv('TOPUP_CATALOG_REFRESH_INTERVAL', 3600))  # Seconds
+TOPUP_CATALOG_RETRY_INTERVAL = 60  # Seconds after a failed refresh
+# The last good catalog is kept on disk so a restarted worker answers from it
+# while the first refresh runs, instead of blocking on Airalo
+TOPUP_CATALOG_SNAPSHOT_FILE = os.getenv('TOPUP_CATALOG_SNAPSHOT_FILE', '/tmp/topup_catalog.json')
+TOPUP_CATALOG_SNAPSHOT_MAX_AGE = int(os.getenv('TOPUP_CATALOG_SNAPSHOT_MAX_AGE', 24 * 3600))  # Seconds
+
+_topup_catalog = {'packages': [], 'by_country': {}, 'by_operator': {}, 'loaded_at': None}
+_topup_catalog_lock = threading.Lock()
+_topup_catalog_refresher = None
+_topup_catalog_invalidated = threading.Event()
+_topup_catalog_version = {'version': None, 'watch': None}
+
+# Pages are requested AIRALO_FETCH_CONCURRENCY at a time and retried one by
+# one. The SDK's HTTP resource resets its headers after every request, so each
+# pool thread has its own client.
+AIRALO_PAGE_SIZE = int(os.getenv('AIRALO_PAGE_SIZE', 100))
+AIRALO_FETCH_CONCURRENCY = int(os.getenv('AIRALO_FETCH_CONCURRENCY', 4))
+AIRALO_PAGE_MAX_ATTEMPTS = 3
+AIRALO_PAGE_RETRY_BACKOFF = 0.5  # Seconds, doubled per attempt
+AIRALO_FETCH_MODE_TTL = 6 * 3600  # Seconds before a remembered fallback is probed again
+
+_airalo_fetch_executor = None
+_airalo_fetch_clients = threading.local()
+_airalo_fetch_mode = {'mode': None, 'checked_at': 0}  # 'paged', or the get_all_packages kwargs that worked
+
+def _thread_airalo_client():
+    client = getattr(_airalo_fetch_clients, 'client', None)
+    if client is None:
+        client = Airalo({
+            "client_id": AIRALO_CLIENT_ID,
+            "client_secret": AIRALO_CLIENT_SECRET,
+        })
+        _airalo_fetch_clients.client = client
+    return client
+
+def _remember_airalo_fetch_mode(mode):
+    if _airalo_fetch_mode['mode'] != mode:
+        print(f"🧭 Airalo catalog fetch mode: {mode}")
+    _airalo_fetch_mode.update({'mode': mode, 'checked_at': time.time()})
+
+def _remembered_airalo_fetch_mode():
+    if time.time() - _airalo_fetch_mode['checked_at'] > AIRALO_FETCH_MODE_TTL:
+        return None
+    return _airalo_fetch_mode['mode']
+
+def _extract_package_list(packages_response):
+    if isinstance(packages_response, list):
+        all_packages = packages_response
+    elif isinstance(packages_response, dict):
+        all_packages = packages_response.get('data') or packages_response.get('packages') or []
+    else:
+        raise RuntimeError('Unexpected SDK response format')
+    
+    if not isinstance(all_packages, list):
+        raise RuntimeError('Invalid packages data format')
+    return all_packages
+
+def _fetch_airalo_page(page):
+    """One catalog page (empty past the last one), retried with exponential backoff"""
+    for attempt in range(AIRALO_PAGE_MAX_ATTEMPTS):
+        try:
+            packages_response = _thread_airalo_client().get_all_packages(flat=False, limit=AIRALO_PAGE_SIZE, page=page)
+            return _extract_package_list(packages_response) if packages_response else []
+        except Exception as e:
+            if attempt == AIRALO_PAGE_MAX_ATTEMPTS - 1:
+                raise
+            delay = AIRALO_PAGE_RETRY_BACKOFF * (2 ** attempt) * (0.5 + random.random())
+            print(f"⚠️ Airalo page {page} failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def _fetch_airalo_pages_concurrently():
+    global _airalo_fetch_executor
+    if _airalo_fetch_executor is None:
+        _airalo_fetch_executor = ThreadPoolExecutor(max_workers=AIRALO_FETCH_CONCURRENCY, thread_name_prefix='airalo-fetch')
+    
+    all_packages = []
+    futures = {}
+    next_page = 1
+    page = 1
+    try:
+        while True:
+            # Keep a window of pages in flight; the last page is unknown, so the tail over-fetches a little
+            while len(futures) < AIRALO_FETCH_CONCURRENCY:
+                futures[next_page] = _airalo_fetch_executor.submit(_fetch_airalo_page, next_page)
+                next_page += 1
+            packages = futures.pop(page).result()
+            if not packages:
+                break
+            if all_packages and packages[0] == all_packages[-AIRALO_PAGE_SIZE]:
+                print(f"⚠️ Airalo returned page {page} twice, stopping pagination")
+                break
+            all_packages.extend(packages)
+            if len(packages) < AIRALO_PAGE_SIZE:
+                break
+            page += 1
+    finally:
+        for future in futures.values():
+            future.cancel()
+    return all_packages
+
+def _fetch_airalo_package_list():
+    """All packages from the Airalo SDK as a list, fetched page by page when paging works"""
+    if not isinstance(_remembered_airalo_fetch_mode(), dict):
+        try:
+            all_packages = _fetch_airalo_pages_concurrently()
+            _remember_airalo_fetch_mode('paged')
+            if all_packages:
+                return all_packages
+        except Exception as e:
+            print(f"⚠️ Paged get_all_packages failed ({e}), fetching the catalog in one call")
+    
+    # Same fallback chain as before, trying the call that worked last time first
+    remembered = _remembered_airalo_fetch_mode()
+    candidates = [{'flat': False}, {}, {'flat': True}]
+    if isinstance(remembered, dict):
+        candidates.remove(remembered)
+        candidates.insert(0, remembered)
+    last_error = None
+    for kwargs in candidates:
+        try:
+            packages_response = alo.get_all_packages(**kwargs)
+        except Exception as e:
+            last_error = e
+            continue
+        if not packages_response:
+            raise RuntimeError('Airalo SDK returned empty response')
+        all_packages = _extract_package_list(packages_response)
+        _remember_airalo_fetch_mode(kwargs)
+        return all_packages
+    raise last_error
+
+def _package_country_codes(pkg):
+    pkg_country_codes = []
+    if isinstance(pkg.get('countries'), list):
+        pkg_country_codes = [
+            c.get('country_code') or c.get('code') if isinstance(c, dict) else c
+            for c in pkg.get('countries', [])
+            if c
+        ]
+    elif pkg.get('country_code'):
+        pkg_country_codes = [pkg.get('country_code')]
+    elif isinstance(pkg.get('country_codes'), list):
+        pkg_country_codes = pkg.get('country_codes')
+    
+    return [str(c).upper().strip() for c in pkg_country_codes if c]
+
+def _operator_key(operator):
+    if isinstance(operator, dict):
+        operator = operator.get('title') or operator.get('name')
+    return str(operator).strip().lower() if operator else None
+
+def _format_topup_package(pkg, package_id, pkg_country_codes):
+    """Response entry for a compatible package"""
+    price = (
+        pkg.get('price') or 
+        pkg.get('retail_price') or 
+        pkg.get('amount') or 
+        pkg.get('cost') or
+        0
+    )
+    
+    data_amount = (
+        pkg.get('capacity') or 
+        pkg.get('amount') or 
+        pkg.get('data') or 
+        'N/A'
+    )
+    
+    validity = (
+        pkg.get('period') or 
+        pkg.get('day') or 
+        pkg.get('days') or
+        pkg.get('validity') or 
+        'N/A'
+    )
+    
+    return {
+        'slug': package_id,
+        'package_id': package_id,
+        'name': pkg.get('name') or pkg.get('title') or f'{data_amount} - {validity}',
+        'title': pkg.get('name') or pkg.get('title') or f'{data_amount} - {validity}',
+        'price': float(price) if price else 0,
+        'data': data_amount,
+        'data_amount': data_amount,
+        'validity': validity,
+        'period': validity,
+        'days': validity if isinstance(validity, (int, float)) else None,
+        'country_codes': pkg_country_codes,
+        'country_code': pkg_country_codes[0] if pkg_country_codes else None,
+        'operator': pkg.get('operator'),
+        'description': pkg.get('description') or pkg.get('short_info') or ''
+    }
+
+def index_topup_entries(packages, loaded_at):
+    """Catalog with price-sorted country lists and an operator index over formatted entries"""
+    by_country = {}
+    by_operator = {}
+    
+    for entry in packages:
+        for code in set(entry['country_codes']):
+            by_country.setdefault(code, []).append(entry)
+        operator = _operator_key(entry['operator'])
+        if operator:
+            by_operator.setdefault(operator, set()).add(entry['package_id'])
+    
+    packages.sort(key=lambda entry: entry['price'])
+    for entries in by_country.values():
+        entries.sort(key=lambda entry: entry['price'])
+    
+    return {'packages': packages, 'by_country': by_country, 'by_operator': by_operator, 'loaded_at': loaded_at}
+
+def build_topup_catalog(all_packages):
+    """Format Airalo packages and index them"""
+    packages = []
+    for pkg in all_packages:
+        if not isinstance(pkg, dict):
+            continue
+        package_id = pkg.get('id') or pkg.get('slug')
+        if not package_id:
+            continue
+        packages.append(_format_topup_package(pkg, package_id, _package_country_codes(pkg)))
+    return index_topup_entries(packages, time.time())
+
+def save_topup_catalog_snapshot(catalog):
+    """Atomically write the formatted packages to the snapshot file"""
+    try:
+        snapshot_dir = os.path.dirname(TOPUP_CATALOG_SNAPSHOT_FILE) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=snapshot_dir, prefix='.topup_catalog_')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'loaded_at': catalog['loaded_at'], 'packages': catalog['packages']}, f, default=str)
+        os.replace(tmp_path, TOPUP_CATALOG_SNAPSHOT_FILE)
+    except OSError as e:
+        print(f"⚠️ Could not save topup catalog snapshot: {e}")
+
+def load_topup_catalog_snapshot():
+    """Serve the catalog saved by a previous run until the first refresh completes"""
+    global _topup_catalog
+    try:
+        with open(TOPUP_CATALOG_SNAPSHOT_FILE, 'r') as f:
+            snapshot = json.load(f)
+        loaded_at = float(snapshot['loaded_at'])
+        packages = snapshot['packages']
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"⚠️ Could not load topup catalog snapshot: {e}")
+        return
+    
+    if time.time() - loaded_at > TOPUP_CATALOG_SNAPSHOT_MAX_AGE:
+        print(f"⚠️ Topup catalog snapshot is {round(time.time() - loaded_at)}s old, ignoring it")
+        return
+    with _topup_catalog_lock:
+        if _topup_catalog['loaded_at'] is None:
+            _topup_catalog = index_topup_entries(packages, loaded_at)
+    print(f"💾 Topup catalog restored from snapshot: {len(packages)} packages, {round(time.time() - loaded_at)}s old")
+
+def refresh_topup_catalog():
+    """Fetch packages from Airalo and swap in a freshly indexed catalog"""
+    global _topup_catalog
+    catalog = build_topup_catalog(_fetch_airalo_package_list())
+    _topup_catalog = catalog
+    save_topup_catalog_snapshot(catalog)
+    print(f"📦 Topup catalog refreshed: {len(catalog['packages'])} packages, {len(catalog['by_country'])} countries")
+    return catalog
+
+def ensure_topup_catalog():
+    """Loaded catalog, fetching it synchronously only if no refresh has succeeded yet"""
+    if _topup_catalog['loaded_at'] is None:
+        with _topup_catalog_lock:
+            if _topup_catalog['loaded_at'] is None:
+                refresh_topup_catalog()
+    return _topup_catalog
+
+def _refresh_topup_catalog_forever():
+    invalidated = False
+    while True:
+        try:
+            if invalidated:
+                # The SDK keeps get_all_packages responses in its file cache for an hour
+                Cached.clear_cache()
+            with _topup_catalog_lock:
+                refresh_topup_catalog()
+            delay = TOPUP_CATALOG_REFRESH_INTERVAL
+        except Exception as e:
+            print(f"⚠️ Topup catalog refresh failed: {e}")
+            delay = TOPUP_CATALOG_RETRY_INTERVAL
+        invalidated = _topup_catalog_invalidated.wait(delay)
+        _topup_catalog_invalidated.clear()
+
+def _on_topup_catalog_version(doc_snapshots, changes, read_time):
+    """catalog_versions/topups listener: refresh now when a sync publishes a new version"""
+    for snapshot in doc_snapshots:
+        version = (snapshot.to_dict() or {}).get('version', 0) if snapshot.exists else 0
+        previous = _topup_catalog_version['version']
+        _topup_catalog_version['version'] = version
+        if previous is not None and version != previous:
+            print(f"📰 Topups catalog version {version} published, refreshing topup catalog")
+            _topup_catalog_invalidated.set()
+
+def start_topup_catalog_refresher():
+    global _topup_catalog_refresher
+    if alo is None or _topup_catalog_refresher is not None:
+        return
+    _topup_catalog_refresher = threading.Thread(target=_refresh_topup_catalog_forever, daemon=True)
+    _topup_catalog_refresher.start()
+    try:
+        version_ref = db.collection('catalog_versions').document('topups')
+        _topup_catalog_version['watch'] = version_ref.on_snapshot(_on_topup_catalog_version)
+    except Exception as e:
+        print(f"⚠️ Could not listen for topup catalog versions: {e}")
+
+def query_topup_catalog(country_codes, operator=None):
+    """Packages sold in any of country_codes (all packages when empty), cheapest first"""
+    catalog = ensure_topup_catalog()
+    if country_codes:
+        lists = [catalog['by_country'].get(code, []) for code in country_codes]
+        if len(lists) == 1:
+            matches = list(lists[0])
+        else:
+            unique = {entry['package_id']: entry for entries in lists for entry in entries}
+            matches = sorted(unique.values(), key=lambda entry: entry['price'])
+    else:
+        matches = list(catalog['packages'])
+    
+    if operator:
+        allowed = catalog['by_operator'].get(_operator_key(operator), set())
+        matches = [entry for entry in matches if entry['package_id'] in allowed]
+    return matches
+
+def get_topup_catalog_stats():
+    loaded_at = _topup_catalog['loaded_at']
+    return {
+        'packages': len(_topup_catalog['packages']),
+        'countries': len(_topup_catalog['by_country']),
+        'operators': len(_topup_catalog['by_operator']),
+        'age_seconds': round(time.time() - loaded_at) if loaded_at else None,
+        'catalog_version': _topup_catalog_version['version'],
+    }
+
+load_topup_catalog_snapshot()
+start_topup_catalog_refresher()
+
+# ============================================================================
+# Idempotency Keys
+# /api/user/topup
+# accept an Idempotency-Key header. The first request with a key runs and its
+# response is stored in idempotency_keys/{id} (scoped to the caller and path,
+# with a fingerprint of the request). Repeats get the stored response without
+# reaching Airalo; a duplicate arriving while the first is still running waits
+# for it. Reusing a key for a different request is a 422. A request that
+# fails before its side effect (an Airalo order, a balance deduction) releases
+# its key so a retry runs again; one that fails after it is stored as failed
+# and replayed, so a retry can't order or charge twice.
+# ============================================================================
+
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', 24 * 3600))  # Seconds a stored response is replayed
+IDEMPOTENCY_LOCK_TTL = 120  # Seconds before a key whose request died mid-flight can be taken over
+IDEMPOTENCY_WAIT_TIMEOUT = 60  # Seconds a duplicate waits for the first request before a 409
+IDEMPOTENCY_POLL_INTERVAL = 0.25  # Seconds between checks on a key held by another process
+# Responses for requests that never ran (and 5xx before the side effect) are not stored, so a retry runs again
+IDEMPOTENCY_UNSTORED_STATUSES = {401, 403, 409, 429}
+IDEMPOTENCY_INCOMPLETE_ERROR = 'The request failed after its side effect was committed; do not retry it, contact support'
+IDEMPOTENCY_REPLAYED_HEADERS = ('Location', 'Preference-Applied')
+
+_idempotency_inflight = {}  # key doc id -> Event set when this process finishes the request
+_idempotency_inflight_lock = threading.Lock()
+_idempotency_request = threading.local()  # side_effect flag for the request this thread is serving
+
+def idempotency_scope():
+    """Uid of the Firebase user; 'anonymous' for unauthenticated topups"""
+    auth_header = request.headers.get('Authorization', '')
+    if auth_header.startswith('Bearer '):
+        user = authenticate_firebase_token(auth_header[7:])
+        if user:
+            return user['uid']
+    return 'anonymous'
+
+def request_fingerprint():
+    """Hash of the method, path, query and (canonicalized JSON) body"""
+    body = request.get_data() or b''
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True, separators=(',', ':')).encode('utf-8')
+    except ValueError:
+        pass
+    return hashlib.sha256(f"{request.method} {request.full_path}\n".encode('utf-8') + body).hexdigest()
+
+@firestore.transactional
+def _acquire_idempotency_key(transaction, key_ref, fingerprint):
+    """('acquired' | 'replay' | 'wait' | 'mismatch', stored key data)"""
+    snapshot = key_ref.get(transaction=transaction)
+    data = snapshot.to_dict() if snapshot.exists else None
+    now = datetime.now(timezone.utc)
+    if data and data.get('expiresAt') and data['expiresAt'] > now:
+        if data.get('fingerprint') != fingerprint:
+            return 'mismatch', data
+        if data.get('state') in ('completed', 'failed'):
+            return 'replay', data
+        if data.get('lockedUntil', 0) > time.time():
+            return 'wait', data
+    transaction.set(key_ref, {
+        'state': 'in_progress',
+        'fingerprint': fingerprint,
+        'path': request.path,
+        'lockedUntil': time.time() + IDEMPOTENCY_LOCK_TTL,
+        'createdAt': firestore.SERVER_TIMESTAMP,
+        'expiresAt': now + timedelta(seconds=IDEMPOTENCY_KEY_TTL)  # Firestore TTL policy field
+    })
+    return 'acquired', None
+
+def idempotent_side_effect_committed():
+    """Call once a request's side effect has happened; later failures are then replayed, not retried"""
+    _idempotency_request.side_effect = True
+
+def _store_idempotent_response(key_ref, response, side_effect=False):
+    """Keep a finished request's response for replay, or release the key if it shouldn't be replayed"""
+    try:
+        if (response.status_code in IDEMPOTENCY_UNSTORED_STATUSES or response.is_streamed
+                or (response.status_code >= 500 and not side_effect)):
+            key_ref.delete()
+            return
+        key_ref.update({
+            'state': 'failed' if response.status_code >= 500 else 'completed',
+            'lockedUntil': 0,
+            'completedAt': firestore.SERVER_TIMESTAMP,
+            'response': {
+                'status': response.status_code,
+                'body': response.get_data(as_text=True),
+                'mimetype': response.mimetype,
+                'headers': {name: response.headers[name] for name in IDEMPOTENCY_REPLAYED_HEADERS if name in response.headers}
+            }
+        })
+    except Exception as e:
+        print(f"⚠️ Could not store idempotent response for {key_ref.id}: {e}")
+
+def _replay_idempotent_response(data):
+    stored = data.get('response') or {}
+    response = Response(stored.get('body', ''), status=stored.get('status', 200),
+                        mimetype=stored.get('mimetype', 'application/json'), headers=stored.get('headers') or {})
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def _wait_for_idempotency_key(doc_id, deadline):
+    """Block until the request holding a key finishes here, or for one poll interval if it runs elsewhere"""
+    with _idempotency_inflight_lock:
+        event = _idempotency_inflight.get(doc_id)
+    if event is not None:
+        event.wait(max(0, deadline - time.time()))
+    else:
+        time.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+def idempotent(handler):
+    """Route decorator: honour the Idempotency-Key header"""
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return handler(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({'success': False, 'error': 'Idempotency-Key must be at most 255 characters'}), 400
+        
+        doc_id = hashlib.sha256(f"{idempotency_scope()}\n{request.path}\n{key}".encode('utf-8')).hexdigest()
+        key_ref = db.collection('idempotency_keys').document(doc_id)
+        fingerprint = request_fingerprint()
+        deadline = time.time() + IDEMPOTENCY_WAIT_TIMEOUT
+        while True:
+            outcome, data = _acquire_idempotency_key(db.transaction(), key_ref, fingerprint)
+            if outcome == 'acquired':
+                break
+            if outcome == 'replay':
+                print(f"🔁 Replaying response for Idempotency-Key on {request.path}")
+                return _replay_idempotent_response(data)
+            if outcome == 'mismatch':
+                return jsonify({
+                    'success': False,
+                    'error': 'Idempotency-Key was already used for a different request'
+                }), 422
+            if time.time() >= deadline:
+                response = jsonify({
+                    'success': False,
+                    'error': 'A request with this Idempotency-Key is still in progress'
+                })
+                response.status_code = 409
+                response.headers['Retry-After'] = '1'
+                return response
+            _wait_for_idempotency_key(doc_id, deadline)
+        
+        event = threading.Event()
+        with _idempotency_inflight_lock:
+            _idempotency_inflight[doc_id] = event
+        _idempotency_request.side_effect = False
+        response = None
+        try:
+            response = app.make_response(handler(*args, **kwargs))
+            return response
+        finally:
+            side_effect = _idempotency_request.side_effect
+            if response is None and side_effect:
+                # The handler raised after its side effect; keep a failure to replay
+                response = app.make_response((jsonify({'success': False, 'error': IDEMPOTENCY_INCOMPLETE_ERROR}), 500))
+            if response is not None:
+                _store_idempotent_response(key_ref, response, side_effect)
+            else:
+                try:
+                    key_ref.delete()
+                except Exception as e:
+                    print(f"⚠️ Could not release Idempotency-Key {doc_id}: {e}")
+            with _idempotency_inflight_lock:
+                _idempotency_inflight.pop(doc_id, None)
+            event.set()
+    return wrapper
+
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({
         'status': 'healthy',
         'service': 'topup-server',
-        'sdk_initialized': alo is not None
+        'sdk_initialized': alo is not None,
+        'token_cache': get_firebase_token_cache_stats(),
+        'topup_catalog': get_topup_catalog_stats()
     })
 
 @app.route('/api/user/topup', methods=['POST'])
+@idempotent
 def create_topup():
     """Create topup for existing eSIM using Airalo SDK"""
     try:
@@ -83,24 +743,11 @@ def create_topup():
         
         print(f"🔍 Looking up order by ICCID: {iccid}")
         
-        orders_ref = db.collection('orders')
-        orders = orders_ref.stream()
-        
-        for order_doc in orders:
-            order_data = order_doc.to_dict()
-            found_iccid = (
-                order_data.get('iccid') or
-                order_data.get('esimData', {}).get('iccid') or
-                (order_data.get('airaloOrderData', {}).get('sims', [{}])[0].get('iccid') if order_data.get('airaloOrderData', {}).get('sims') else None) or
-                (order_data.get('orderData', {}).get('sims', [{}])[0].get('iccid') if order_data.get('orderData', {}).get('sims') else None) or
-                (order_data.get('sims', [{}])[0].get('iccid') if order_data.get('sims') else None)
-            )
-            
-            if found_iccid and str(found_iccid).strip() == str(iccid).strip():
-                order_user_email = order_data.get('userEmail') or order_data.get('customerEmail')
-                order_user_id = order_data.get('userId')
-                print(f"✅ Found order for ICCID: {iccid}")
-                break
+        iccid_entry = lookup_iccid(iccid)
+        if iccid_entry:
+            order_user_email = iccid_entry.get('email')
+            order_user_id = iccid_entry.get('userId')
+            print(f"✅ Found order for ICCID: {iccid}")
         
         # Also check user subcollections if we have auth
         if not order_user_email:
@@ -148,6 +795,7 @@ def create_topup():
             
             if not sdk_response:
                 return jsonify({'success': False, 'error': 'Failed to create topup via Airalo SDK'}), 500
+            idempotent_side_effect_committed()
             
             print(f"✅ Topup created successfully")
             
@@ -220,52 +868,13 @@ def get_topup_packages():
         
         print(f"🔍 Looking up order by ICCID: {iccid}")
         
-        orders_ref = db.collection('orders')
-        orders = orders_ref.stream()
-        
-        for order_doc in orders:
-            order_data = order_doc.to_dict()
-            found_iccid = (
-                order_data.get('iccid') or
-                order_data.get('esimData', {}).get('iccid') or
-                (order_data.get('airaloOrderData', {}).get('sims', [{}])[0].get('iccid') if order_data.get('airaloOrderData', {}).get('sims') else None) or
-                (order_data.get('orderData', {}).get('sims', [{}])[0].get('iccid') if order_data.get('orderData', {}).get('sims') else None) or
-                (order_data.get('sims', [{}])[0].get('iccid') if order_data.get('sims') else None)
-            )
-            
-            if found_iccid and str(found_iccid).strip() == str(iccid).strip():
-                print(f"✅ Found order for ICCID: {iccid}")
-                
-                order_country_codes = (
-                    order_data.get('countryCode') or 
-                    order_data.get('country_code') or 
-                    order_data.get('countryCodes') or 
-                    order_data.get('country_codes') or 
-                    []
-                )
-                
-                if isinstance(order_country_codes, str):
-                    order_country_codes = [order_country_codes]
-                elif not isinstance(order_country_codes, list):
-                    order_country_codes = []
-                
-                airalo_data = order_data.get('airaloOrderData', {})
-                if airalo_data.get('country_code'):
-                    country_code = airalo_data['country_code']
-                    if country_code not in order_country_codes:
-                        order_country_codes.append(country_code)
-                
-                if airalo_data.get('package'):
-                    pkg_data = airalo_data['package']
-                    if isinstance(pkg_data, dict):
-                        pkg_country_code = pkg_data.get('country_code') or pkg_data.get('countryCode')
-                        if pkg_country_code and pkg_country_code not in order_country_codes:
-                            order_country_codes.append(pkg_country_code)
-                        order_carrier = pkg_data.get('operator') or pkg_data.get('operator_title')
-                
-                print(f"   Country codes: {order_country_codes}")
-                print(f"   Carrier: {order_carrier}")
-                break
+        iccid_entry = lookup_iccid(iccid)
+        if iccid_entry:
+            print(f"✅ Found order for ICCID: {iccid}")
+            order_country_codes = list(iccid_entry.get('countryCodes') or [])
+            order_carrier = iccid_entry.get('operator')
+            print(f"   Country codes: {order_country_codes}")
+            print(f"   Carrier: {order_carrier}")
         
         # Check user collection if no country codes found
         if not order_country_codes and user:
@@ -287,119 +896,20 @@ def get_topup_packages():
                         order_country_codes = [airalo_data['country_code']]
                     break
         
-        if not alo:
+        if not alo and _topup_catalog['loaded_at'] is None:
             return jsonify({'success': False, 'error': 'Airalo SDK not available'}), 503
         
         try:
-            # Get all packages from Airalo SDK
-            print(f"📦 Fetching packages from Airalo SDK...")
-            packages_response = None
-            
-            try:
-                packages_response = alo.get_all_packages(flat=False)
-            except:
-                try:
-                    packages_response = alo.get_all_packages()
-                except:
-                    packages_response = alo.get_all_packages(flat=True)
-            
-            if not packages_response:
-                return jsonify({'success': False, 'error': 'Airalo SDK returned empty response'}), 500
-            
-            # Extract packages list
-            if isinstance(packages_response, list):
-                all_packages = packages_response
-            elif isinstance(packages_response, dict):
-                all_packages = packages_response.get('data') or packages_response.get('packages') or []
-            else:
-                return jsonify({'success': False, 'error': 'Unexpected SDK response format'}), 500
-            
-            if not isinstance(all_packages, list):
-                return jsonify({'success': False, 'error': 'Invalid packages data format'}), 500
-            
-            print(f"📦 Found {len(all_packages)} total packages")
-            
             # Normalize country codes
             order_country_codes_normalized = [str(c).upper().strip() for c in order_country_codes if c]
             
-            # Filter compatible packages
-            compatible_packages = []
-            
-            for pkg in all_packages:
-                if not isinstance(pkg, dict):
-                    continue
-                
-                # Get package country codes
-                pkg_country_codes = []
-                if isinstance(pkg.get('countries'), list):
-                    pkg_country_codes = [
-                        c.get('country_code') or c.get('code') or str(c) 
-                        for c in pkg.get('countries', []) 
-                        if c
-                    ]
-                elif pkg.get('country_code'):
-                    pkg_country_codes = [pkg.get('country_code')]
-                elif isinstance(pkg.get('country_codes'), list):
-                    pkg_country_codes = [str(c) for c in pkg.get('country_codes') if c]
-                
-                pkg_country_codes = [str(c).upper().strip() for c in pkg_country_codes if c]
-                
-                # Filter by country codes if we have them
-                if order_country_codes_normalized:
-                    has_matching_country = any(
-                        code in pkg_country_codes or 
-                        any(code in str(pc).upper() for pc in pkg_country_codes)
-                        for code in order_country_codes_normalized
-                    )
-                    if not has_matching_country:
-                        continue
-                
-                package_id = pkg.get('id') or pkg.get('slug')
-                if not package_id:
-                    continue
-                
-                price = (
-                    pkg.get('price') or 
-                    pkg.get('retail_price') or 
-                    pkg.get('amount') or 
-                    pkg.get('cost') or
-                    0
-                )
-                
-                data_amount = (
-                    pkg.get('capacity') or 
-                    pkg.get('amount') or 
-                    pkg.get('data') or 
-                    'N/A'
-                )
-                
-                validity = (
-                    pkg.get('period') or 
-                    pkg.get('day') or 
-                    pkg.get('days') or
-                    pkg.get('validity') or 
-                    'N/A'
-                )
-                
-                compatible_packages.append({
-                    'slug': package_id,
-                    'package_id': package_id,
-                    'name': pkg.get('name') or pkg.get('title') or f'{data_amount} - {validity}',
-                    'title': pkg.get('name') or pkg.get('title') or f'{data_amount} - {validity}',
-                    'price': float(price) if price else 0,
-                    'data': data_amount,
-                    'data_amount': data_amount,
-                    'validity': validity,
-                    'period': validity,
-                    'days': validity if isinstance(validity, (int, float)) else None,
-                    'country_codes': pkg_country_codes,
-                    'country_code': pkg_country_codes[0] if pkg_country_codes else None,
-                    'operator': pkg.get('operator') or order_carrier,
-                    'description': pkg.get('description') or pkg.get('short_info') or ''
-                })
-            
-            # Sort by price
-            compatible_packages.sort(key=lambda x: x.get('price', 0))
+            # Compatible packages come from the in-memory catalog, cheapest first
+            compatible_packages = query_topup_catalog(order_country_codes_normalized, operator=data.get('operator'))
+            if order_carrier:
+                compatible_packages = [
+                    entry if entry.get('operator') else {**entry, 'operator': order_carrier}
+                    for entry in compatible_packages
+                ]
             
             print(f"✅ Found {len(compatible_packages)} topup-compatible packages")
             
@@ -423,6 +933,179 @@ def get_topup_packages():
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# ============================================================================
+# Bulk Firestore Writer
+# Bulk catalog maintenance queues its writes here instead of committing one 500-op
+# batch at a time: full batches are committed from a small thread pool with
+# several in flight, contention/quota errors slow every batch of the writer
+# down (and speed back up on success), and a batch that keeps failing is
+# retried write by write so one bad document doesn't drop the other 499.
+# ============================================================================
+
+BULK_WRITE_BATCH_SIZE = 500  # Firestore batch limit
+BULK_WRITE_CONCURRENCY = int(os.getenv('BULK_WRITE_CONCURRENCY', 4))
+BULK_WRITE_MAX_ATTEMPTS = 4
+BULK_WRITE_MAX_DELAY = 5.0
+
+# Errors that mean "slow down and try again" rather than "this write is bad"
+BULK_WRITE_RETRYABLE_ERRORS = (
+    google_exceptions.Aborted,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+)
+
+def start_bulk_writer(label):
+    """New writer state; queue writes with bulk_write() and finish with close_bulk_writer()"""
+    return {
+        'label': label,
+        'ops': [],
+        'executor': ThreadPoolExecutor(max_workers=BULK_WRITE_CONCURRENCY, thread_name_prefix=f'bulk-{label}'),
+        'in_flight': [],
+        'lock': threading.Lock(),
+        'delay': 0.0,
+        'next_seq': 0,
+        'committed_seq': -1,
+        'done_seqs': set(),
+        'checkpoints': [],
+        'metrics': {
+            'batches': 0,
+            'writes': 0,
+            'failed_writes': 0,
+            'retries': 0,
+            'throttled': 0,
+            'commit_seconds': 0.0,
+            'max_batch_seconds': 0.0,
+        },
+        'failed_ids': [],
+        'started': time.time(),
+    }
+
+def _apply_bulk_op(target, op):
+    kind, ref, data, merge = op
+    if kind == 'set':
+        target.set(ref, data, merge=merge)
+    elif kind == 'update':
+        target.update(ref, data)
+    else:
+        target.delete(ref)
+
+def _bulk_backoff(writer, error):
+    """Widen the writer-wide delay after contention; returns how long this caller should wait"""
+    with writer['lock']:
+        writer['delay'] = min(max(writer['delay'] * 2, 0.1), BULK_WRITE_MAX_DELAY)
+        writer['metrics']['throttled'] += 1
+        delay = writer['delay']
+    print(f"⏳ Bulk writer {writer['label']} backing off {delay:.2f}s: {error}")
+    return delay * (0.5 + random.random())
+
+def _commit_bulk_ops(writer, ops):
+    """Commit ops as one batch, retrying contention errors with backoff; raises after the last attempt"""
+    for attempt in range(BULK_WRITE_MAX_ATTEMPTS):
+        if writer['delay']:
+            time.sleep(writer['delay'])
+        batch = db.batch()
+        for op in ops:
+            _apply_bulk_op(batch, op)
+        try:
+            batch.commit()
+            with writer['lock']:
+                writer['delay'] = writer['delay'] / 2 if writer['delay'] > 0.05 else 0.0
+            return attempt
+        except BULK_WRITE_RETRYABLE_ERRORS as e:
+            if attempt == BULK_WRITE_MAX_ATTEMPTS - 1:
+                raise
+            with writer['lock']:
+                writer['metrics']['retries'] += 1
+            time.sleep(_bulk_backoff(writer, e))
+
+def _run_bulk_batch(writer, seq, ops):
+    started = time.time()
+    failed = []
+    try:
+        _commit_bulk_ops(writer, ops)
+    except Exception as batch_error:
+        # Fall back to one write per commit so only the writes that really fail are lost
+        print(f"⚠️ Bulk writer {writer['label']} batch {seq} failed ({batch_error}), retrying {len(ops)} writes individually")
+        for op in ops:
+            try:
+                _commit_bulk_ops(writer, [op])
+            except Exception as write_error:
+                print(f"❌ Bulk write {op[0]} {op[1].id} failed: {write_error}")
+                failed.append(op[1].id)
+    elapsed = time.time() - started
+    
+    ready = []
+    with writer['lock']:
+        metrics = writer['metrics']
+        metrics['batches'] += 1
+        metrics['writes'] += len(ops) - len(failed)
+        metrics['failed_writes'] += len(failed)
+        metrics['commit_seconds'] += elapsed
+        metrics['max_batch_seconds'] = max(metrics['max_batch_seconds'], elapsed)
+        writer['failed_ids'].extend(failed)
+        
+        # Checkpoints fire only once every batch queued before them has committed
+        writer['done_seqs'].add(seq)
+        while writer['committed_seq'] + 1 in writer['done_seqs']:
+            writer['committed_seq'] += 1
+            writer['done_seqs'].discard(writer['committed_seq'])
+        while writer['checkpoints'] and writer['checkpoints'][0][0] <= writer['committed_seq']:
+            ready.append(writer['checkpoints'].pop(0)[1])
+    
+    for callback in ready:
+        try:
+            callback()
+        except Exception as e:
+            print(f"⚠️ Bulk writer {writer['label']} checkpoint failed: {e}")
+
+def _submit_bulk_batch(writer):
+    ops, writer['ops'] = writer['ops'], []
+    # Bound the batches in flight so a fast producer doesn't buffer the whole catalog
+    writer['in_flight'] = [future for future in writer['in_flight'] if not future.done()]
+    while len(writer['in_flight']) >= BULK_WRITE_CONCURRENCY * 2:
+        writer['in_flight'].pop(0).result()
+    seq = writer['next_seq']
+    writer['next_seq'] += 1
+    writer['in_flight'].append(writer['executor'].submit(_run_bulk_batch, writer, seq, ops))
+
+def bulk_write(writer, kind, ref, data=None, merge=False):
+    """Queue a 'set', 'update' or 'delete'; returns True when this write filled a batch and sent it"""
+    writer['ops'].append((kind, ref, data, merge))
+    if len(writer['ops']) >= BULK_WRITE_BATCH_SIZE:
+        _submit_bulk_batch(writer)
+        return True
+    return False
+
+def bulk_writer_checkpoint(writer, callback):
+    """Run callback once every write queued so far has been committed"""
+    if writer['ops']:
+        _submit_bulk_batch(writer)
+    with writer['lock']:
+        if writer['next_seq'] - 1 <= writer['committed_seq']:
+            ready = True
+        else:
+            writer['checkpoints'].append((writer['next_seq'] - 1, callback))
+            ready = False
+    if ready:
+        callback()
+
+def close_bulk_writer(writer):
+    """Send the last partial batch, wait for everything in flight and return the writer's metrics"""
+    if writer['ops']:
+        _submit_bulk_batch(writer)
+    writer['executor'].shutdown(wait=True)
+    metrics = dict(writer['metrics'])
+    metrics['elapsed_seconds'] = round(time.time() - writer['started'], 3)
+    metrics['commit_seconds'] = round(metrics['commit_seconds'], 3)
+    metrics['max_batch_seconds'] = round(metrics['max_batch_seconds'], 3)
+    metrics['avg_batch_seconds'] = round(metrics['commit_seconds'] / metrics['batches'], 3) if metrics['batches'] else 0.0
+    metrics['failed_ids'] = writer['failed_ids'][:50]
+    print(f"📝 Bulk writer {writer['label']}: {metrics['writes']} writes in {metrics['batches']} batches, "
+          f"{metrics['failed_writes']} failed, {metrics['retries']} retries, {metrics['elapsed_seconds']}s")
+    return metrics
+
 @app.route('/api/sync-topup-packages', methods=['OPTIONS'])
 def sync_topup_packages_options():
     """Handle CORS preflight requests"""
@@ -450,10 +1133,8 @@ def cleanup_topup_packages():
         print("🧹 CLEANUP TOPUP PACKAGES - Removing non-topup packages")
         print("=" * 80)
         
-        MAX_BATCH_SIZE = 500
         cleanup_count = 0
-        cleanup_batch = db.batch()
-        cleanup_batch_count = 0
+        writer = start_bulk_writer('topups-cleanup')
         
         try:
             all_topups = db.collection('topups').stream()
@@ -466,17 +1147,11 @@ def cleanup_topup_packages():
                 has_topup_in_id = '-topup' in doc_id or doc_id.endswith('-topup')
                 
                 if not (has_topup_in_slug or has_topup_in_id):
-                    cleanup_batch.delete(doc.reference)
-                    cleanup_batch_count += 1
+                    bulk_write(writer, 'delete', doc.reference)
                     cleanup_count += 1
-                    
-                    if cleanup_batch_count >= MAX_BATCH_SIZE:
-                        cleanup_batch.commit()
-                        cleanup_batch = db.batch()
-                        cleanup_batch_count = 0
             
-            if cleanup_batch_count > 0:
-                cleanup_batch.commit()
+            write_metrics = close_bulk_writer(writer)
+            cleanup_count -= write_metrics['failed_writes']
             
             print(f"✅ Cleanup complete: Removed {cleanup_count} non-topup packages")
             print("=" * 80)
@@ -484,6 +1159,7 @@ def cleanup_topup_packages():
             return jsonify({
                 'success': True,
                 'removed': cleanup_count,
+                'write_metrics': write_metrics,
                 'message': f'Removed {cleanup_count} non-topup packages from topups collection'
             })
             